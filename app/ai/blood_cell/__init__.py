@@ -0,0 +1,52 @@
+from .analyze import (
+    ANALYSIS_VERSION,
+    CELL_TYPES,
+    MAX_IMAGE_PIXELS,
+    StainParameters,
+    ImageTooLargeError,
+    load_image,
+    normalize_colors,
+    stain_parameters,
+    foreground_mask,
+    segment_cells,
+    measure_cells,
+    classify_cells,
+    summarize_cells,
+    detect_cells,
+    find_cells,
+    analyze_array,
+    analyze_image
+)
+from .slide import SlidePlan, analyze_slide
+from .ingest import STORAGE_FORMATS, ingest_image
+from .descriptor import DESCRIPTOR_VERSION, DESCRIPTOR_NAMES, image_descriptor, describe_image
+from .synthetic import synthetic_smear
+
+__all__ = [
+    'ANALYSIS_VERSION',
+    'CELL_TYPES',
+    'MAX_IMAGE_PIXELS',
+    'StainParameters',
+    'ImageTooLargeError',
+    'load_image',
+    'normalize_colors',
+    'stain_parameters',
+    'foreground_mask',
+    'segment_cells',
+    'measure_cells',
+    'classify_cells',
+    'summarize_cells',
+    'detect_cells',
+    'find_cells',
+    'analyze_array',
+    'analyze_image',
+    'SlidePlan',
+    'analyze_slide',
+    'STORAGE_FORMATS',
+    'ingest_image',
+    'DESCRIPTOR_VERSION',
+    'DESCRIPTOR_NAMES',
+    'image_descriptor',
+    'describe_image',
+    'synthetic_smear'
+]
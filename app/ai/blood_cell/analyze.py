@@ -0,0 +1,380 @@
+"""
+Blood smear image analysis with OpenCV.
+
+1. Colour normalization: gray-world white balance, then CLAHE on the
+   lightness channel, so stain and illumination differences between
+   microscopes do not move the thresholds.
+2. Segmentation: Otsu threshold on saturation (stained cells against the
+   pale background) with holes filled (red cell central pallor), then a
+   watershed on the distance transform to split touching cells.
+3. Measurement: area, perimeter, diameter, circularity, elongation, mean
+   saturation/value and the fraction of nuclear stain of every cell.
+4. Classification and summary: platelets by size, white cells by nuclear
+   stain, the rest red cells. Red cell size variation and shape
+   abnormality are turned into morphology flags.
+
+Everything works on NumPy arrays and module-level functions, so analysis
+can run in worker processes. The colour statistics of steps 1-2 are
+measured once per image (StainParameters), and steps 1-3 only look at a
+cell's neighbourhood, so a large slide can be detected tile by tile and
+classified as a whole (see slide.py).
+"""
+import os
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+
+# Bump when results change, so cached analyses are recomputed
+ANALYSIS_VERSION = "2"
+
+MIN_CELL_AREA = 6               # px; smaller objects are noise
+MIN_STAIN_CONTRAST = 25         # saturation gap between stained and background pixels
+PLATELET_AREA_RATIO = 0.2       # platelets are smaller than this fraction of the median red cell
+WBC_NUCLEUS_FRACTION = 0.25     # white cells have at least this fraction of nuclear stain
+NUCLEUS_VALUE_RATIO = 0.8       # nuclear stain is darker than this fraction of the median cell
+ABNORMAL_CIRCULARITY = 0.8      # red cells below this are counted as abnormally shaped
+ANISOCYTOSIS_CV = 0.15          # red cell diameter variation flagged above this
+POIKILOCYTOSIS_FRACTION = 0.10  # abnormally shaped red cell fraction flagged above this
+MIN_RBC_FOR_FLAGS = 20          # too few red cells to judge morphology below this
+CLAHE_TILE = 128                # px per contrast equalization tile, independent of image size
+
+# OpenCV refuses to decode larger images (2**30 px, about 32768 x 32768, unless
+# CV_IO_MAX_IMAGE_PIXELS is set before start-up); images are always decoded whole
+MAX_IMAGE_PIXELS = int(os.getenv("CV_IO_MAX_IMAGE_PIXELS", str(1 << 30)))
+
+CELL_TYPES = ('rbc', 'wbc', 'platelet')
+CELL_COLUMNS = [
+    'x', 'y', 'x_min', 'y_min', 'x_max', 'y_max', 'area', 'perimeter', 'diameter',
+    'circularity', 'elongation', 'saturation', 'value', 'nucleus_fraction'
+]
+
+
+class StainParameters(NamedTuple):
+    """Image-wide colour statistics, so separate tiles of one slide are treated alike"""
+    gains: Tuple[float, float, float]   # white balance per BGR channel
+    threshold: Optional[float]          # saturation threshold of stained pixels (None: no stain)
+    nucleus_value: float                # value (brightness) below which pixels are nuclear stain
+
+
+# =================== Pre-processing ===================
+
+class ImageTooLargeError(ValueError):
+    """The image has more pixels than OpenCV decodes (MAX_IMAGE_PIXELS)."""
+
+
+def load_image(path, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """
+    Read an image (as BGR by default).
+
+    Raises:
+        ImageTooLargeError: If it has more than MAX_IMAGE_PIXELS pixels
+        ValueError: If it cannot be decoded
+    """
+    name = os.path.basename(str(path))
+    try:
+        image = cv2.imread(str(path), flags)
+    except cv2.error as e:
+        # Raised from the header, before anything is decoded
+        if 'CV_IO_MAX_IMAGE_PIXELS' in str(e):
+            raise ImageTooLargeError(
+                f"{name} is too large: images may have at most {MAX_IMAGE_PIXELS:,} pixels "
+                f"(about {int(MAX_IMAGE_PIXELS ** 0.5):,} x {int(MAX_IMAGE_PIXELS ** 0.5):,})"
+            ) from e
+        raise ValueError(f"Not a readable image: {name}") from e
+    if image is None:
+        raise ValueError(f"Not a readable image: {name}")
+    return image
+
+
+def white_balance_gains(image: np.ndarray) -> Tuple[float, float, float]:
+    """Gray-world gains: scale each channel to the mean brightness."""
+    means = np.asarray(cv2.mean(image)[:3])
+    return tuple(float(g) for g in means.mean() / np.maximum(means, 1e-6))
+
+
+def normalize_colors(image: np.ndarray, gains: Optional[Tuple[float, float, float]] = None) -> np.ndarray:
+    """Gray-world white balance, then contrast-limited equalization of lightness."""
+    gains = np.asarray(white_balance_gains(image) if gains is None else gains)
+    # One lookup table per channel instead of float arithmetic over the image
+    lut = np.clip(np.arange(256)[:, None] * gains[None, :], 0, 255).astype(np.uint8)
+    balanced = cv2.LUT(image, lut.reshape(256, 1, 3))
+
+    lab = cv2.cvtColor(balanced, cv2.COLOR_BGR2LAB)
+    grid = (max(1, -(-image.shape[1] // CLAHE_TILE)), max(1, -(-image.shape[0] // CLAHE_TILE)))
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=grid)
+    lab[..., 0] = clahe.apply(lab[..., 0])
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
+
+def stain_parameters(image: np.ndarray) -> StainParameters:
+    """
+    Measure white balance, stain threshold and nuclear stain level of an image.
+
+    For a large slide, pass a downsampled overview: the statistics only
+    need a representative sample of pixels.
+    """
+    gains = white_balance_gains(image)
+    hsv = cv2.cvtColor(normalize_colors(image, gains), cv2.COLOR_BGR2HSV)
+    saturation = cv2.GaussianBlur(hsv[..., 1], (5, 5), 0)
+    threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Otsu always splits; a blank field only has noise on either side
+    stained = saturation > threshold
+    if not stained.any() or stained.all() or (
+        saturation[stained].mean() - saturation[~stained].mean() < MIN_STAIN_CONTRAST
+    ):
+        return StainParameters(gains, None, 0.0)
+    return StainParameters(gains, float(threshold), NUCLEUS_VALUE_RATIO * float(np.median(hsv[..., 2][stained])))
+
+
+# =================== Segmentation ===================
+
+def foreground_mask(hsv: np.ndarray, threshold: Optional[float]) -> np.ndarray:
+    """Stained pixels: saturation above the threshold, opened, with holes filled."""
+    if threshold is None:
+        return np.zeros(hsv.shape[:2], dtype=bool)
+    saturation = cv2.GaussianBlur(hsv[..., 1], (5, 5), 0)
+    mask = np.where(saturation > threshold, 255, 0).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+    # Fill holes: whatever the background flood from the border cannot reach
+    outside = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(outside, None, (0, 0), 255)
+    return (mask > 0) | (outside[1:-1, 1:-1] == 0)
+
+
+def segment_cells(mask: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Split the foreground into cells with a marker-based watershed.
+
+    Markers are local maxima of the distance transform that reach at least
+    half of their component's maximum, searched in a window about one
+    typical cell radius wide, so touching cells get one marker each while
+    small isolated platelets keep theirs.
+
+    Returns:
+        (labels, n_cells): int32 label image (0 = background) and label count
+    """
+    components, n_components = ndimage.label(mask)
+    if n_components == 0 or not mask.any():
+        return np.zeros(mask.shape, dtype=np.int32), 0
+
+    dist = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 5)
+    component_max = np.zeros(n_components + 1, dtype=np.float32)
+    np.maximum.at(component_max, components[mask], dist[mask])
+    radius = float(np.median(component_max[1:]))
+
+    window = max(3, int(round(radius)) | 1)
+    core = mask & (dist >= 0.5 * component_max[components])
+    peaks = core & (dist == cv2.dilate(dist, cv2.getStructuringElement(cv2.MORPH_RECT, (window, window))))
+
+    # Grow peaks into seeds half a radius wide, so several maxima inside
+    # one cell merge into a single marker
+    seed = 2 * max(1, int(radius * 0.5)) + 1
+    peaks = core & cv2.dilate(
+        peaks.astype(np.uint8), cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (seed, seed))
+    ).astype(bool)
+    markers, n_markers = ndimage.label(peaks)
+
+    # Background is marker 1, cells 2..n+1, undecided foreground 0
+    markers = markers.astype(np.int32) + 1
+    markers[mask & ~peaks] = 0
+    relief = cv2.normalize(dist, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    cv2.watershed(cv2.cvtColor(255 - relief, cv2.COLOR_GRAY2BGR), markers)
+
+    labels = markers - 1
+    labels[labels < 1] = 0  # background and watershed lines
+    return labels, n_markers
+
+
+# =================== Measurement ===================
+
+def measure_cells(hsv: np.ndarray, labels: np.ndarray, n_labels: int, nucleus_value: float) -> pd.DataFrame:
+    """Per-cell position, bounding box, size, shape and colour (one row per label of at least MIN_CELL_AREA)."""
+    if n_labels == 0:
+        return pd.DataFrame(columns=CELL_COLUMNS)
+
+    # Sums over the foreground pixels only, one bincount per statistic
+    height, width = labels.shape
+    pixels = np.flatnonzero(labels)
+    owner = labels.ravel()[pixels]
+
+    def per_cell(weights=None):
+        return np.bincount(owner, weights=weights, minlength=n_labels + 1)[1:]
+
+    area = per_cell().astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = per_cell(pixels // width) / area
+        x = per_cell(pixels % width) / area
+        saturation = per_cell(hsv[..., 1].ravel()[pixels]) / area
+        value_pixels = hsv[..., 2].ravel()[pixels]
+        value = per_cell(value_pixels) / area
+        nucleus_fraction = per_cell(value_pixels < nucleus_value) / area
+
+    perimeter = np.zeros(n_labels)
+    elongation = np.zeros(n_labels)
+    box = np.zeros((n_labels, 4))
+    for i, bounds in enumerate(ndimage.find_objects(labels, max_label=n_labels)):
+        if bounds is None or area[i] < MIN_CELL_AREA:
+            continue
+        rows, cols = bounds
+        box[i] = (cols.start, rows.start, cols.stop - 1, rows.stop - 1)
+        # One pixel of margin so the contour closes around cells at the bounding box edge
+        rows = slice(max(rows.start - 1, 0), min(rows.stop + 1, height))
+        cols = slice(max(cols.start - 1, 0), min(cols.stop + 1, width))
+        cell = (labels[rows, cols] == i + 1).astype(np.uint8)
+        contours, _ = cv2.findContours(cell, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        contour = max(contours, key=cv2.contourArea)
+        perimeter[i] = cv2.arcLength(contour, True)
+        if len(contour) >= 5:
+            axes = sorted(cv2.fitEllipse(contour)[1])
+            elongation[i] = 1.0 - axes[0] / axes[1] if axes[1] > 0 else 0.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        circularity = np.minimum(1.0, np.nan_to_num(4 * np.pi * area / perimeter ** 2))
+
+    cells = pd.DataFrame({
+        'x': x,
+        'y': y,
+        'x_min': box[:, 0],
+        'y_min': box[:, 1],
+        'x_max': box[:, 2],
+        'y_max': box[:, 3],
+        'area': area,
+        'perimeter': perimeter,
+        'diameter': 2 * np.sqrt(area / np.pi),
+        'circularity': circularity,
+        'elongation': elongation,
+        'saturation': saturation,
+        'value': value,
+        'nucleus_fraction': nucleus_fraction,
+    })
+    return cells[cells['area'] >= MIN_CELL_AREA].reset_index(drop=True)
+
+
+# =================== Classification ===================
+
+def classify_cells(cells: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add ``cell_type`` (rbc, wbc, platelet) and ``type_confidence``.
+
+    Confidence maps the distance to the nearest decision boundary to
+    [0.5, 1]: a cell twice (or half) the platelet size limit, or whose
+    nuclear stain fraction is twice (or zero) the white cell threshold,
+    is classified with full confidence.
+    """
+    cells = cells.copy()
+    if cells.empty:
+        cells['cell_type'] = pd.Series(dtype=str)
+        cells['type_confidence'] = pd.Series(dtype=float)
+        return cells
+
+    area = cells['area'].to_numpy()
+    nucleus = cells['nucleus_fraction'].to_numpy()
+    without_nucleus = nucleus < WBC_NUCLEUS_FRACTION
+    reference_area = np.median(area[without_nucleus]) if without_nucleus.any() else np.median(area)
+    platelet_limit = PLATELET_AREA_RATIO * reference_area
+
+    is_platelet = area < platelet_limit
+    is_wbc = ~is_platelet & ~without_nucleus
+    cells['cell_type'] = np.select([is_platelet, is_wbc], ['platelet', 'wbc'], 'rbc')
+
+    size_margin = np.abs(np.log2(area / platelet_limit))
+    stain_margin = np.abs(nucleus - WBC_NUCLEUS_FRACTION) / WBC_NUCLEUS_FRACTION
+    margin = np.where(is_platelet, size_margin, np.minimum(size_margin, stain_margin))
+    cells['type_confidence'] = 0.5 + 0.5 * np.clip(margin, 0.0, 1.0)
+    return cells
+
+
+def summarize_cells(cells: pd.DataFrame, width: int, height: int) -> Dict:
+    """Counts, red cell morphology, flags, confidence and a one-line summary."""
+    counts = {t: int((cells['cell_type'] == t).sum()) for t in CELL_TYPES} if len(cells) else dict.fromkeys(CELL_TYPES, 0)
+    rbc = cells[cells['cell_type'] == 'rbc'] if len(cells) else cells
+
+    morphology = None
+    flags = []
+    if len(rbc):
+        diameter_cv = float(rbc['diameter'].std(ddof=0) / rbc['diameter'].mean())
+        abnormal_fraction = float((rbc['circularity'] < ABNORMAL_CIRCULARITY).mean())
+        morphology = {
+            "mean_diameter_px": round(float(rbc['diameter'].mean()), 2),
+            "diameter_cv": round(diameter_cv, 4),
+            "abnormal_shape_fraction": round(abnormal_fraction, 4),
+            "mean_circularity": round(float(rbc['circularity'].mean()), 4),
+            "mean_elongation": round(float(rbc['elongation'].mean()), 4),
+        }
+        if len(rbc) >= MIN_RBC_FOR_FLAGS:
+            if diameter_cv > ANISOCYTOSIS_CV:
+                flags.append("Anisocytosis")
+            if abnormal_fraction > POIKILOCYTOSIS_FRACTION:
+                flags.append("Poikilocytosis")
+
+    n_cells = int(len(cells))
+    confidence = float(cells['type_confidence'].mean()) if n_cells else 0.0
+
+    if n_cells == 0:
+        summary = "Automated analysis: no cells detected."
+    else:
+        summary = (
+            f"Automated analysis: {n_cells} cells ({counts['rbc']} RBC, {counts['wbc']} WBC, "
+            f"{counts['platelet']} platelets)."
+        )
+        if morphology:
+            summary += (
+                f" RBC size variation {morphology['diameter_cv'] * 100:.1f}%,"
+                f" abnormal shapes {morphology['abnormal_shape_fraction'] * 100:.1f}%."
+            )
+        summary += f" Flags: {', '.join(flags)}." if flags else " No morphology flags."
+
+    return {
+        "version": ANALYSIS_VERSION,
+        "width": int(width),
+        "height": int(height),
+        "cells": n_cells,
+        "counts": counts,
+        "rbc_morphology": morphology,
+        "flags": flags,
+        "confidence": round(confidence, 4),
+        "summary": summary,
+    }
+
+
+# =================== Pipeline ===================
+
+def detect_cells(image: np.ndarray, params: StainParameters) -> pd.DataFrame:
+    """Normalize, segment and measure the cells of a BGR image (not yet classified)."""
+    hsv = cv2.cvtColor(normalize_colors(image, params.gains), cv2.COLOR_BGR2HSV)
+    labels, n_labels = segment_cells(foreground_mask(hsv, params.threshold))
+    return measure_cells(hsv, labels, n_labels, params.nucleus_value)
+
+
+def find_cells(image: np.ndarray) -> pd.DataFrame:
+    """Detect and classify the cells of a BGR image."""
+    return classify_cells(detect_cells(image, stain_parameters(image)))
+
+
+def analyze_array(image: np.ndarray) -> Dict:
+    """Analyze a BGR image held in memory."""
+    return summarize_cells(find_cells(image), image.shape[1], image.shape[0])
+
+
+def analyze_image(path) -> Dict:
+    """
+    Analyze a blood smear image file.
+
+    Returns:
+        JSON-serializable dict with counts, rbc_morphology, flags,
+        confidence (0-1), summary and the analysis time in seconds
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    start = time.perf_counter()
+    result = analyze_array(load_image(path))
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
@@ -0,0 +1,90 @@
+"""
+Throughput benchmark of the blood smear analysis.
+
+Each image (and a synthetic smear of each requested size) is analyzed
+``--repeat`` times in this process and then on a process pool of
+``--workers`` processes, as the web service does. Reports images and
+megapixels per second for both.
+
+    python -m app.ai.blood_cell.benchmark test-data/blood-cell.jpg --synthetic 1024 4096 --workers 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+import cv2
+
+from .analyze import analyze_image, load_image
+from .synthetic import synthetic_smear
+
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_REPEAT = 8
+
+
+def benchmark_image(path: str, repeat: int, pool: ProcessPoolExecutor, workers: int) -> Dict:
+    """Time sequential and pooled analysis of one image."""
+    height, width = load_image(path).shape[:2]
+    result = analyze_image(path)  # warm-up, and the counts to report
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        analyze_image(path)
+    sequential = time.perf_counter() - start
+
+    list(pool.map(analyze_image, [path] * workers))  # warm up the workers
+    start = time.perf_counter()
+    list(pool.map(analyze_image, [path] * repeat))
+    pooled = time.perf_counter() - start
+
+    megapixels = width * height / 1e6
+    return {
+        "image": os.path.basename(path),
+        "width": width,
+        "height": height,
+        "cells": result["cells"],
+        "images_per_second": repeat / sequential,
+        "pool_images_per_second": repeat / pooled,
+        "megapixels_per_second": repeat * megapixels / sequential,
+        "pool_megapixels_per_second": repeat * megapixels / pooled,
+    }
+
+
+def run_benchmark(paths: List[str], sizes: List[int], workers: int, repeat: int) -> List[Dict]:
+    """Benchmark the given files plus synthetic smears of the given side lengths."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = list(paths)
+        for size in sizes:
+            image, _ = synthetic_smear(size, size, seed=size)
+            path = os.path.join(tmp_dir, f"synthetic_{size}.png")
+            cv2.imwrite(path, image)
+            paths.append(path)
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            return [benchmark_image(path, repeat, pool, workers) for path in paths]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark blood smear image analysis throughput.")
+    parser.add_argument("files", nargs="*", help="images to analyze")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[1024, 4096], metavar="SIZE",
+                        help="side lengths of synthetic smears to add")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="analyses per image and mode")
+    args = parser.parse_args()
+
+    rows = run_benchmark(args.files, args.synthetic, args.workers, args.repeat)
+    print(f"{'image':<24} {'size':>11} {'cells':>7} {'img/s':>8} {'MP/s':>7} "
+          f"{'pool img/s':>11} {'pool MP/s':>10}  ({args.workers} workers)")
+    for r in rows:
+        print(f"{r['image']:<24} {r['width']:>5}x{r['height']:<5} {r['cells']:>7,} "
+              f"{r['images_per_second']:>8.2f} {r['megapixels_per_second']:>7.2f} "
+              f"{r['pool_images_per_second']:>11.2f} {r['pool_megapixels_per_second']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Compact descriptors of blood smear images, for finding similar smears.
+
+A descriptor concatenates four groups, each of at most unit length times
+its weight, so no group dominates the Euclidean distance:
+
+1. Colour: joint hue/saturation histogram of the normalized image
+   (square-rooted, so the distance between histograms is the Hellinger
+   distance).
+2. Lightness: histogram of the normalized L channel.
+3. Cells: type fractions, density and red cell morphology from the
+   analysis result, each mapped to roughly [0, 1].
+4. Texture: radially averaged power spectrum of the lightness, in
+   log-spaced frequency bands. Unlike a downsampled thumbnail it does not
+   depend on where the cells happen to lie on the slide.
+
+Colour and texture are measured on a copy of at most DESCRIPTOR_SIZE px.
+"""
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+from .analyze import load_image, normalize_colors
+
+
+# Bump when descriptors change, so they are recomputed and re-indexed
+DESCRIPTOR_VERSION = "1"
+
+DESCRIPTOR_SIZE = 512     # px; long side of the image descriptors are measured on
+HUE_BINS = 12
+SATURATION_BINS = 4
+LIGHTNESS_BINS = 8
+TEXTURE_BINS = 8
+
+# Weight of each group in the distance
+COLOUR_WEIGHT = 1.0
+LIGHTNESS_WEIGHT = 0.5
+CELL_WEIGHT = 1.0
+TEXTURE_WEIGHT = 0.5
+
+# Values mapped to 1 in the cell group
+MAX_DENSITY = 5000.0      # cells per megapixel
+MAX_DIAMETER = 60.0       # px
+MAX_DIAMETER_CV = 0.5
+
+CELL_FEATURES = [
+    'rbc_fraction', 'wbc_fraction', 'platelet_fraction', 'cell_density', 'mean_diameter',
+    'diameter_cv', 'abnormal_shape_fraction', 'mean_circularity', 'mean_elongation'
+]
+DESCRIPTOR_NAMES: List[str] = (
+    [f'hue_{h}_sat_{s}' for h in range(HUE_BINS) for s in range(SATURATION_BINS)]
+    + [f'lightness_{i}' for i in range(LIGHTNESS_BINS)]
+    + CELL_FEATURES
+    + [f'texture_{i}' for i in range(TEXTURE_BINS)]
+)
+
+
+def colour_features(image: np.ndarray) -> np.ndarray:
+    """Square-rooted hue/saturation and lightness histograms of a normalized BGR image."""
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    hue_saturation = cv2.calcHist([hsv], [0, 1], None, [HUE_BINS, SATURATION_BINS], [0, 180, 0, 256])
+    lightness = cv2.calcHist([cv2.cvtColor(image, cv2.COLOR_BGR2LAB)], [0], None, [LIGHTNESS_BINS], [0, 256])
+    return np.concatenate([
+        COLOUR_WEIGHT * np.sqrt(hue_saturation.ravel() / max(hue_saturation.sum(), 1)),
+        LIGHTNESS_WEIGHT * np.sqrt(lightness.ravel() / max(lightness.sum(), 1)),
+    ])
+
+
+def texture_features(image: np.ndarray) -> np.ndarray:
+    """Share of lightness variation in log-spaced spatial frequency bands."""
+    lightness = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)[..., 0].astype(np.float32)
+    lightness -= lightness.mean()
+    window = np.outer(np.hanning(lightness.shape[0]), np.hanning(lightness.shape[1])).astype(np.float32)
+    power = np.abs(np.fft.rfft2(lightness * window)) ** 2
+
+    fy = np.fft.fftfreq(lightness.shape[0])[:, None]
+    fx = np.fft.rfftfreq(lightness.shape[1])[None, :]
+    radius = np.sqrt(fx ** 2 + fy ** 2)
+    edges = np.geomspace(1 / max(lightness.shape), 0.5, TEXTURE_BINS + 1)
+    bands = np.digitize(radius.ravel(), edges) - 1
+    valid = (bands >= 0) & (bands < TEXTURE_BINS)
+    spectrum = np.bincount(bands[valid], weights=power.ravel()[valid], minlength=TEXTURE_BINS)
+    return TEXTURE_WEIGHT * np.sqrt(spectrum / max(spectrum.sum(), 1e-12))
+
+
+def cell_features(analysis: Dict) -> np.ndarray:
+    """Cell type fractions, density and red cell morphology of an analysis result."""
+    cells = max(int(analysis.get("cells", 0)), 0)
+    counts = analysis.get("counts", {})
+    megapixels = max(analysis.get("width", 0) * analysis.get("height", 0) / 1e6, 1e-6)
+    morphology = analysis.get("rbc_morphology") or {}
+    values = np.array([
+        counts.get('rbc', 0) / cells if cells else 0.0,
+        counts.get('wbc', 0) / cells if cells else 0.0,
+        counts.get('platelet', 0) / cells if cells else 0.0,
+        np.log1p(cells / megapixels) / np.log1p(MAX_DENSITY),
+        morphology.get("mean_diameter_px", 0.0) / MAX_DIAMETER,
+        morphology.get("diameter_cv", 0.0) / MAX_DIAMETER_CV,
+        morphology.get("abnormal_shape_fraction", 0.0),
+        morphology.get("mean_circularity", 0.0),
+        morphology.get("mean_elongation", 0.0),
+    ])
+    return CELL_WEIGHT * np.clip(values, 0, 1) / np.sqrt(len(values))
+
+
+def image_descriptor(image: np.ndarray, analysis: Dict) -> np.ndarray:
+    """Descriptor of a BGR image and its analysis result (float32, DESCRIPTOR_NAMES order)."""
+    scale = DESCRIPTOR_SIZE / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(
+            image,
+            (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+    normalized = normalize_colors(image)
+    return np.concatenate([
+        colour_features(normalized),
+        cell_features(analysis),
+        texture_features(normalized),
+    ]).astype(np.float32)
+
+
+def describe_image(path, analysis: Dict) -> np.ndarray:
+    """
+    Descriptor of an image file.
+
+    JPEGs are decoded at a reduced scale when the analysis says the image
+    is much larger than DESCRIPTOR_SIZE, so large slides are cheap to describe.
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    longest = max(analysis.get("width", 0), analysis.get("height", 0))
+    flags = cv2.IMREAD_COLOR
+    for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                            (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if longest >= factor * DESCRIPTOR_SIZE:
+            flags = reduced
+            break
+    image = cv2.imread(str(path), flags)
+    if image is None:
+        image = load_image(path)
+    return image_descriptor(image, analysis)
@@ -0,0 +1,205 @@
+"""
+Storage encoding of uploaded blood smear images.
+
+Uploads are rewritten before they are stored, according to
+IMAGE_STORAGE_FORMAT:
+
+- ``lossless`` (default): BMP and TIFF images, often tens of times larger
+  than needed, are re-encoded as PNG; PNG and JPEG files keep their
+  compressed pixel data as is.
+- ``jpeg``: everything that is not a JPEG already is re-encoded as JPEG at
+  IMAGE_STORAGE_QUALITY. The analysis still runs on the uploaded pixels.
+- ``original``: files are stored byte for byte.
+
+Except in ``original`` mode, metadata is removed. Re-encoded images carry
+none. PNG files lose their ancillary chunks (text, EXIF, ICC profiles,
+timestamps), and JPEG files lose their APPn and comment segments, except
+the JFIF, ICC and Adobe ones that decoders need. A JPEG whose EXIF data
+rotates the image is decoded and re-encoded upright, so the image does not
+turn when its EXIF data is dropped.
+
+This module only needs cv2 (and the image loader of analyze.py), so it
+runs in the analysis workers.
+"""
+import hashlib
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Optional
+
+import cv2
+
+from .analyze import load_image
+
+
+IMAGE_STORAGE_FORMAT = os.getenv("IMAGE_STORAGE_FORMAT", "lossless")
+IMAGE_STORAGE_QUALITY = int(os.getenv("IMAGE_STORAGE_QUALITY", "92"))
+STORAGE_FORMATS = ("lossless", "jpeg", "original")
+
+PNG_COMPRESSION = 6  # zlib level; higher levels take longer for under 1% less
+
+JPEG_EXTENSIONS = {".jpg", ".jpeg"}
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Ancillary PNG chunks that change the decoded pixels
+_PNG_KEEP = {b"tRNS"}
+# JPEG segments decoders need: JFIF (APP0), ICC profile (APP2), Adobe colour transform (APP14)
+_JPEG_KEEP_APP = {0xE0, 0xE2, 0xEE}
+_JPEG_SOS = 0xDA
+_EXIF_ORIENTATION = 0x0112
+
+
+# ==================== Metadata ====================
+
+def strip_png_metadata(data: bytes) -> bytes:
+    """PNG file without its ancillary chunks (pixel data untouched)"""
+    if not data.startswith(_PNG_SIGNATURE):
+        raise ValueError("Not a PNG file")
+    out = [_PNG_SIGNATURE]
+    pos = len(_PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        end = pos + 12 + length
+        # Critical chunks have an upper-case first letter
+        if kind[:1].isupper() or kind in _PNG_KEEP:
+            out.append(data[pos:end])
+        pos = end
+        if kind == b"IEND":
+            break
+    return b"".join(out)
+
+
+def exif_orientation(segment: bytes) -> int:
+    """Orientation tag of an APP1 EXIF payload (1, upright, if absent)"""
+    if not segment.startswith(b"Exif\x00\x00") or len(segment) < 14:
+        return 1
+    tiff = segment[6:]
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return 1
+    try:
+        (ifd,) = struct.unpack(order + "I", tiff[4:8])
+        (count,) = struct.unpack(order + "H", tiff[ifd:ifd + 2])
+        for i in range(count):
+            entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+            tag, _, _, value = struct.unpack(order + "HHIH", entry[:10])
+            if tag == _EXIF_ORIENTATION:
+                return value
+    except struct.error:
+        pass
+    return 1
+
+
+def strip_jpeg_metadata(data: bytes) -> Optional[bytes]:
+    """
+    JPEG file without its metadata segments (compressed data untouched).
+
+    Returns:
+        The stripped file, or None if its EXIF data rotates the image (it
+        must then be re-encoded upright instead)
+    """
+    if not data.startswith(b"\xff\xd8"):
+        raise ValueError("Not a JPEG file")
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG file")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == _JPEG_SOS:
+            out.append(data[pos:])
+            return b"".join(out)
+        (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        segment = data[pos:pos + 2 + length]
+        if marker == 0xE1 and exif_orientation(segment[4:]) not in (0, 1):
+            return None
+        is_metadata = (0xE0 <= marker <= 0xEF and marker not in _JPEG_KEEP_APP) or marker == 0xFE
+        if not is_metadata:
+            out.append(segment)
+        pos += 2 + length
+    raise ValueError("Corrupt JPEG file")
+
+
+# ==================== Encoding ====================
+
+def _encode(path: str, extension: str, quality: int) -> bytes:
+    # Keep 16-bit depth and transparency when storing losslessly
+    image = load_image(path, cv2.IMREAD_UNCHANGED if extension == ".png" else cv2.IMREAD_COLOR)
+    if extension == ".png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f"Could not encode {os.path.basename(path)}")
+    return encoded.tobytes()
+
+
+def storage_extension(extension: str, storage_format: str) -> str:
+    """Extension an upload is stored with"""
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown IMAGE_STORAGE_FORMAT: {storage_format}")
+    if storage_format == "original" or extension in JPEG_EXTENSIONS:
+        return extension
+    if storage_format == "jpeg":
+        return ".jpg"
+    return ".png"
+
+
+def ingest_image(
+    path,
+    extension: str,
+    storage_format: Optional[str] = None,
+    quality: Optional[int] = None
+) -> Dict:
+    """
+    Write the storage encoding of an uploaded image next to it.
+
+    Args:
+        path: Uploaded image
+        extension: Its extension (e.g. '.tiff')
+        storage_format: 'lossless', 'jpeg' or 'original' (default IMAGE_STORAGE_FORMAT)
+        quality: JPEG quality of re-encoded images (default IMAGE_STORAGE_QUALITY)
+
+    Returns:
+        Dict with the stored file's path, extension, size and sha256, and
+        the uploaded size. The upload itself is left in place; path is the
+        upload's own path when nothing had to change
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    storage_format = storage_format or IMAGE_STORAGE_FORMAT
+    quality = quality or IMAGE_STORAGE_QUALITY
+    path = Path(path)
+    data = path.read_bytes()
+    stored_extension = storage_extension(extension, storage_format)
+
+    if storage_format == "original":
+        stored = data
+    elif stored_extension != extension:
+        stored = _encode(str(path), stored_extension, quality)
+    else:
+        try:
+            stored = strip_png_metadata(data) if extension == ".png" else strip_jpeg_metadata(data)
+        except ValueError:
+            # Misnamed or damaged file: store what the decoder makes of it
+            stored = None
+        if stored is None:
+            stored = _encode(str(path), extension, quality)
+
+    if stored == data:
+        stored_path = path
+    else:
+        stored_path = path.with_name(f"{path.stem}.stored{stored_extension}")
+        stored_path.write_bytes(stored)
+    return {
+        "path": str(stored_path),
+        "extension": stored_extension,
+        "size": len(stored),
+        "sha256": hashlib.sha256(stored).hexdigest(),
+        "original_size": len(data),
+    }
@@ -0,0 +1,219 @@
+"""
+Tiled analysis of large (whole-slide) blood smear images.
+
+A slide is decoded once into an uncompressed ``.npy`` pixel cache that
+workers memory-map, so each worker only pages in the tile it analyzes.
+The slide is cut into a grid of core tiles; each is read with an overlap
+wider than any cell, so every cell whose centre lies in a core is seen
+whole. Cells are detected per tile with slide-wide stain parameters,
+kept by the tile owning their centre, then classified and summarized
+together, exactly as a small image is. Peak memory of a worker is bounded
+by the tile size, not the slide size.
+
+The slide itself is decoded whole before the pixel cache is written, so it
+may have at most MAX_IMAGE_PIXELS pixels (OpenCV's decoding limit, about
+32768 x 32768 by default); larger slides raise ImageTooLargeError.
+
+    slide = start_analysis("slide.tif", "slide.npy")
+    if isinstance(slide, SlidePlan):
+        result = merge_tiles(slide, [analyze_tile(slide, tile) for tile in slide.tiles])
+"""
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .analyze import (
+    CLAHE_TILE,
+    StainParameters,
+    analyze_array,
+    classify_cells,
+    detect_cells,
+    load_image,
+    stain_parameters,
+    summarize_cells
+)
+
+
+SLIDE_TILE_SIZE = int(os.getenv("SLIDE_TILE_SIZE", "2048"))        # px per side of a core tile
+SLIDE_TILE_OVERLAP = int(os.getenv("SLIDE_TILE_OVERLAP", "128"))   # px; must exceed the largest cell
+OVERVIEW_SIZE = 2048  # px; long side of the sample used for stain parameters
+
+Box = Tuple[int, int, int, int]  # x0, y0, x1, y1 (exclusive)
+
+
+class Tile(NamedTuple):
+    """Grid cell owning the cells centred in ``core``, analyzed over ``read``"""
+    core: Box
+    read: Box
+
+
+class SlidePlan(NamedTuple):
+    """Everything a worker needs to analyze one tile of a slide"""
+    pixels_path: str
+    width: int
+    height: int
+    params: StainParameters
+    tiles: List[Tile]
+
+
+def _aligned(size: int) -> int:
+    """Round up to whole contrast equalization tiles, so every tile is normalized on the same grid."""
+    return max(CLAHE_TILE, -(-size // CLAHE_TILE) * CLAHE_TILE)
+
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: int) -> List[Tile]:
+    """Cover the image with core tiles, each widened by the overlap and clipped to the image."""
+    tile_size, overlap = _aligned(tile_size), _aligned(overlap)
+    return [
+        Tile(
+            core=(x, y, min(x + tile_size, width), min(y + tile_size, height)),
+            read=(max(x - overlap, 0), max(y - overlap, 0),
+                  min(x + tile_size + overlap, width), min(y + tile_size + overlap, height))
+        )
+        for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)
+    ]
+
+
+# ==================== Pixel Cache ====================
+
+def write_pixels(image: np.ndarray, pixels_path) -> None:
+    """Write decoded pixels as a memory-mappable .npy file (atomically)."""
+    pixels_path = Path(pixels_path)
+    tmp_path = pixels_path.with_name(f".{uuid.uuid4().hex[:8]}.{pixels_path.name}")
+    try:
+        pixels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=image.shape)
+        pixels[:] = image
+        pixels.flush()
+        del pixels
+        os.replace(tmp_path, pixels_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def open_pixels(pixels_path) -> np.ndarray:
+    """Memory-map a pixel cache read-only."""
+    return np.load(pixels_path, mmap_mode='r')
+
+
+def slide_parameters(pixels: np.ndarray) -> StainParameters:
+    """Stain parameters of a whole slide, measured on an evenly subsampled overview."""
+    step = max(1, -(-max(pixels.shape[:2]) // OVERVIEW_SIZE))
+    return stain_parameters(np.ascontiguousarray(pixels[::step, ::step]))
+
+
+# ==================== Analysis ====================
+
+def start_analysis(
+    image_path,
+    pixels_path,
+    tile_size: Optional[int] = None,
+    overlap: Optional[int] = None
+) -> Union[Dict, SlidePlan]:
+    """
+    Analyze an image, or plan its tiles if it is larger than one tile.
+
+    Decodes the image (or maps an existing pixel cache). An image that fits
+    in a single tile is analyzed right away; a larger one is written to the
+    pixel cache at ``pixels_path`` and a plan of its tiles is returned.
+
+    Returns:
+        The analysis result (see analyze.analyze_image), or a SlidePlan
+
+    Raises:
+        ImageTooLargeError: If the image has more than MAX_IMAGE_PIXELS pixels
+        ValueError: If the file is not a readable image
+    """
+    start = time.perf_counter()
+    tile_size = tile_size or SLIDE_TILE_SIZE
+    overlap = overlap or SLIDE_TILE_OVERLAP
+
+    if os.path.exists(pixels_path):
+        pixels = open_pixels(pixels_path)
+    else:
+        pixels = load_image(image_path)
+        height, width = pixels.shape[:2]
+        if width <= _aligned(tile_size) and height <= _aligned(tile_size):
+            result = analyze_array(pixels)
+            result["seconds"] = round(time.perf_counter() - start, 4)
+            return result
+        write_pixels(pixels, pixels_path)
+        del pixels
+        pixels = open_pixels(pixels_path)
+
+    height, width = pixels.shape[:2]
+    return SlidePlan(
+        pixels_path=str(pixels_path),
+        width=width,
+        height=height,
+        params=slide_parameters(pixels),
+        tiles=tile_grid(width, height, tile_size, overlap)
+    )
+
+
+def analyze_tile(plan: SlidePlan, tile: Tile) -> pd.DataFrame:
+    """
+    Detect the cells owned by one tile, in slide coordinates.
+
+    Cells cut by the edge of the read area are dropped (they are whole in
+    the neighbouring tile), as are cells centred outside the core.
+    """
+    x0, y0, x1, y1 = tile.read
+    image = np.ascontiguousarray(open_pixels(plan.pixels_path)[y0:y1, x0:x1])
+    cells = detect_cells(image, plan.params)
+    if not len(cells):
+        return cells
+
+    cells[['x', 'x_min', 'x_max']] += x0
+    cells[['y', 'y_min', 'y_max']] += y0
+    cx0, cy0, cx1, cy1 = tile.core
+    keep = (
+        ((cells['x_min'] > x0) | (x0 == 0))
+        & ((cells['y_min'] > y0) | (y0 == 0))
+        & ((cells['x_max'] < x1 - 1) | (x1 == plan.width))
+        & ((cells['y_max'] < y1 - 1) | (y1 == plan.height))
+        & (cells['x'] >= cx0) & (cells['x'] < cx1)
+        & (cells['y'] >= cy0) & (cells['y'] < cy1)
+    )
+    return cells[keep]
+
+
+def merge_tiles(plan: SlidePlan, tile_cells: Iterable[pd.DataFrame]) -> Dict:
+    """Classify and summarize the cells of all tiles together."""
+    cells = pd.concat(list(tile_cells), ignore_index=True)
+    return summarize_cells(classify_cells(cells), plan.width, plan.height)
+
+
+def analyze_slide(
+    image_path,
+    pixels_path,
+    tile_size: Optional[int] = None,
+    overlap: Optional[int] = None,
+    map_fn: Callable = map
+) -> Dict:
+    """
+    Analyze an image of any size, tiling it if needed.
+
+    Args:
+        image_path: Image file
+        pixels_path: Where to cache the decoded pixels of a large image
+        tile_size, overlap: Tile geometry in pixels (default: SLIDE_TILE_SIZE, SLIDE_TILE_OVERLAP)
+        map_fn: Runs analyze_tile over the tiles, e.g. a process pool's map
+
+    Raises:
+        ImageTooLargeError: If the image has more than MAX_IMAGE_PIXELS pixels
+        ValueError: If the file is not a readable image
+    """
+    start = time.perf_counter()
+    plan = start_analysis(image_path, pixels_path, tile_size, overlap)
+    if not isinstance(plan, SlidePlan):
+        return plan
+    result = merge_tiles(plan, map_fn(analyze_tile, [plan] * len(plan.tiles), plan.tiles))
+    result["tiles"] = len(plan.tiles)
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
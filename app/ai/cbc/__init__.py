@@ -1,13 +1,64 @@
 from .predict import (
     load_model_and_assets,
+    model_version,
     prepare_dataframe_for_inference,
     build_report,
+    display_column,
+    DUPLICATE_ROWS,
+    predict_unique,
     predict_and_annotate_dataframe
 )
+from .reference_ranges import (
+    FLAG_PARAMETERS,
+    flag_batch,
+    add_reference_flags,
+    has_reference_flags,
+    row_flags
+)
+from .indices import (
+    DERIVED_INDICES,
+    compute_indices,
+    add_derived_indices,
+    has_derived_indices,
+    row_indices
+)
+from .explain import (
+    explain_batch,
+    add_attributions,
+    has_attributions,
+    row_attributions
+)
+from .drift import FeatureDriftMonitor, build_reference, load_reference
+from .evaluate import binary_metrics, evaluate_files
+from .feature_store import FeatureStore
 
 __all__ = [
     'load_model_and_assets',
+    'model_version',
     'prepare_dataframe_for_inference',
     'build_report',
-    'predict_and_annotate_dataframe'
+    'display_column',
+    'DUPLICATE_ROWS',
+    'predict_unique',
+    'predict_and_annotate_dataframe',
+    'FLAG_PARAMETERS',
+    'flag_batch',
+    'add_reference_flags',
+    'has_reference_flags',
+    'row_flags',
+    'DERIVED_INDICES',
+    'compute_indices',
+    'add_derived_indices',
+    'has_derived_indices',
+    'row_indices',
+    'explain_batch',
+    'add_attributions',
+    'has_attributions',
+    'row_attributions',
+    'FeatureDriftMonitor',
+    'build_reference',
+    'load_reference',
+    'binary_metrics',
+    'evaluate_files',
+    'FeatureStore'
 ]
\ No newline at end of file
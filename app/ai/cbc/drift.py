@@ -0,0 +1,226 @@
+"""
+Online feature-drift monitoring for CBC inference inputs.
+
+Every scored batch updates running per-feature statistics: mean and variance
+(Welford, merged batch-wise with Chan's formula) and counts over fixed
+histogram bins. Nothing per-row is retained, so the cost is a few vectorized
+NumPy calls per batch and memory is constant.
+
+The reference is an empirical histogram of the training data, saved next to
+the model by ``python -m app.ai.cbc.drift <training.csv>``. CBC features are
+skewed and heavy-tailed, so bins are the training deciles of each feature and
+drift is scored with the Population Stability Index (PSI) against the share
+of training rows that fell in each bin.
+"""
+import argparse
+import json
+import math
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+# =================== Configuration ===================
+
+REFERENCE_PATH = str(Path(__file__).parent / "drift_reference.json")
+
+# Inner bin edges are these quantiles of the training data; two open-ended
+# bins catch everything below the first and above the last edge
+REFERENCE_QUANTILES = np.linspace(0.1, 0.9, 9)
+
+# PSI thresholds (common rule of thumb)
+PSI_MODERATE = 0.1
+PSI_SIGNIFICANT = 0.25
+
+# Floor for bin shares so empty bins do not make the PSI infinite
+_EPS = 1e-4
+
+
+def _bin_counts(X: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Rows of X per feature and bin, for per-feature inner edges."""
+    bins = (X[:, :, None] >= edges[None, :, :]).sum(axis=2)
+    n_bins = edges.shape[1] + 1
+    offsets = np.arange(edges.shape[0]) * n_bins
+    counts = np.bincount((bins + offsets).ravel(), minlength=len(offsets) * n_bins)
+    return counts.reshape(edges.shape[0], n_bins)
+
+
+def build_reference(X, feature_names) -> dict:
+    """
+    Summarize training rows as the reference of a FeatureDriftMonitor.
+
+    Args:
+        X: Array-like of shape (n_rows, n_features), raw (unscaled) values
+        feature_names: Column names of X
+
+    Returns:
+        JSON-serializable dict with the features, their mean and standard
+        deviation, inner bin edges and the share of rows in each bin
+    """
+    X = np.asarray(X, dtype=np.float64)
+    X = X[~np.isnan(X).any(axis=1)]
+    if len(X) < 2:
+        raise ValueError("At least two complete rows are needed for a drift reference")
+
+    edges = np.quantile(X, REFERENCE_QUANTILES, axis=0).T
+    shares = _bin_counts(X, edges) / len(X)
+    return {
+        "features": list(feature_names),
+        "rows": int(len(X)),
+        "mean": X.mean(axis=0).tolist(),
+        "std": X.std(axis=0, ddof=1).tolist(),
+        "edges": edges.tolist(),
+        "shares": shares.tolist(),
+    }
+
+
+def load_reference(path: str = REFERENCE_PATH) -> dict:
+    """Read a reference written by save_reference."""
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_reference(reference: dict, path: str = REFERENCE_PATH):
+    with open(path, "w") as f:
+        json.dump(reference, f, indent=2)
+
+
+def drift_status(psi: float) -> str:
+    """Map a PSI value to 'stable', 'moderate' or 'drift'."""
+    if psi >= PSI_SIGNIFICANT:
+        return 'drift'
+    if psi >= PSI_MODERATE:
+        return 'moderate'
+    return 'stable'
+
+
+# =================== Monitor ===================
+
+class FeatureDriftMonitor:
+    """
+    Running per-feature statistics compared against a training reference.
+
+    Thread-safe: inference may run in several worker threads.
+    """
+
+    def __init__(self, feature_names, reference: dict):
+        self.feature_names = list(feature_names)
+        index = [reference["features"].index(name) for name in self.feature_names]
+        self.ref_mean = np.asarray(reference["mean"], dtype=np.float64)[index]
+        self.ref_std = np.asarray(reference["std"], dtype=np.float64)[index]
+        self.ref_std[self.ref_std == 0] = 1.0
+        self.edges = np.asarray(reference["edges"], dtype=np.float64)[index]
+        self.expected = np.asarray(reference["shares"], dtype=np.float64)[index]
+        self.n_bins = self.expected.shape[1]
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything observed so far."""
+        n_features = len(self.feature_names)
+        with self._lock:
+            self.count = 0
+            self.mean = np.zeros(n_features)
+            self.m2 = np.zeros(n_features)
+            self.histogram = np.zeros((n_features, self.n_bins), dtype=np.int64)
+            self.started_at = time.time()
+
+    def update(self, X):
+        """
+        Fold a batch of raw (unscaled) feature rows into the statistics.
+
+        Args:
+            X: Array-like of shape (n_rows, n_features), columns in
+               feature_names order. Rows containing NaN are ignored.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != len(self.feature_names):
+            return
+        X = X[~np.isnan(X).any(axis=1)]
+        n_b = len(X)
+        if n_b == 0:
+            return
+
+        mean_b = X.mean(axis=0)
+        m2_b = ((X - mean_b) ** 2).sum(axis=0)
+        counts = _bin_counts(X, self.edges)
+
+        with self._lock:
+            n_a = self.count
+            n = n_a + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta * (n_b / n)
+            self.m2 = self.m2 + m2_b + delta ** 2 * (n_a * n_b / n)
+            self.count = n
+            self.histogram += counts
+
+    def report(self) -> dict:
+        """
+        Compare the observed distribution with the reference.
+
+        Returns:
+            Dict with rows observed, the overall drift score (largest feature
+            PSI), its status and a per-feature breakdown
+        """
+        with self._lock:
+            count = self.count
+            mean = self.mean.copy()
+            m2 = self.m2.copy()
+            histogram = self.histogram.copy()
+            started_at = self.started_at
+
+        features = []
+        for f, name in enumerate(self.feature_names):
+            if count:
+                observed = np.maximum(histogram[f] / count, _EPS)
+                expected = np.maximum(self.expected[f], _EPS)
+                psi = float(np.sum((observed - expected) * np.log(observed / expected)))
+                std = math.sqrt(m2[f] / (count - 1)) if count > 1 else 0.0
+                mean_shift = float((mean[f] - self.ref_mean[f]) / self.ref_std[f])
+            else:
+                psi, std, mean_shift = 0.0, 0.0, 0.0
+
+            features.append({
+                "feature": name,
+                "mean": float(mean[f]),
+                "std": std,
+                "reference_mean": float(self.ref_mean[f]),
+                "reference_std": float(self.ref_std[f]),
+                "mean_shift": mean_shift,
+                "variance_ratio": (std / self.ref_std[f]) ** 2,
+                "psi": psi,
+                "status": drift_status(psi),
+            })
+
+        score = max((f["psi"] for f in features), default=0.0)
+        return {
+            "rows_observed": count,
+            "since": started_at,
+            "drift_score": score,
+            "status": drift_status(score) if count else 'no data',
+            "features": features,
+        }
+
+
+def main():
+    import pandas as pd
+    from .predict import FEATURES_PTH, prepare_dataframe_for_inference
+
+    parser = argparse.ArgumentParser(description="Write the CBC drift reference from the training data.")
+    parser.add_argument("files", nargs="+", help="CSV files the model was trained on")
+    parser.add_argument("--output", default=REFERENCE_PATH, help="reference file to write")
+    args = parser.parse_args()
+
+    with open(FEATURES_PTH, "r") as f:
+        used_features = json.load(f)
+    frames = [prepare_dataframe_for_inference(pd.read_csv(path), used_features) for path in args.files]
+    X = pd.concat(frames)[used_features].to_numpy(dtype=np.float64)
+
+    save_reference(build_reference(X, used_features), args.output)
+    print(f"Drift reference of {len(X):,} rows written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Offline evaluation of the CBC anemia model on labeled files.
+
+Each file needs the model features plus a ``Diagnosis`` column (0/1, or
+text such as "Healthy" / "Iron deficiency anemia"; the anemia diagnoses in
+ANEMIA_LABELS count as positive, every other label as negative). Rows are scored in fixed-size chunks on a thread
+pool and every metric is computed with vectorized NumPy over the pooled
+predictions.
+
+Results are cached per (model version, dataset hash), so re-evaluating the
+same model on the same files returns immediately.
+
+    python -m app.ai.cbc.evaluate test-data/cbc-records-v1.csv [--write-accuracy]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .predict import load_model_and_assets, model_version, prepare_dataframe_for_inference
+
+
+# =================== Configuration ===================
+
+LABEL_COLUMN = 'Diagnosis'
+DEFAULT_CHUNK_SIZE = 2048
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+CALIBRATION_BINS = 10
+THRESHOLD = 0.5
+
+CACHE_DIR = Path(os.getenv("EVAL_CACHE_DIR", "data/evaluations"))
+
+# Normalized Diagnosis texts that mean anemia (negations such as "no anemia" do not)
+ANEMIA_LABELS = frozenset({
+    'anemia',
+    'anemic',
+    'iron deficiency anemia',
+    'normocytic hypochromic anemia',
+    'normocytic normochromic anemia',
+    'microcytic anemia',
+    'other microcytic anemia',
+    'macrocytic anemia',
+})
+
+
+# =================== Metrics ===================
+
+def anemia_labels(series: pd.Series) -> np.ndarray:
+    """Map a Diagnosis column to 0/1 anemia labels (NaN where missing)."""
+    numeric = pd.to_numeric(series, errors='coerce')
+    if numeric.notna().all():
+        return (numeric.to_numpy(dtype=np.float64) > 0).astype(np.float64)
+    text = (
+        series.astype(str).str.lower()
+        .str.replace('anaemi', 'anemi', regex=False)
+        .str.split().str.join(' ')
+    )
+    labels = text.isin(ANEMIA_LABELS).to_numpy(dtype=np.float64)
+    labels[series.isna().to_numpy()] = np.nan
+    return labels
+
+
+def roc_auc(y_true: np.ndarray, y_score: np.ndarray) -> float:
+    """Area under the ROC curve via the rank-sum statistic (ties get average ranks)."""
+    y_true = y_true.astype(bool)
+    n_pos = int(y_true.sum())
+    n_neg = len(y_true) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return float('nan')
+
+    _, inverse, counts = np.unique(y_score, return_inverse=True, return_counts=True)
+    ends = np.cumsum(counts)
+    ranks = ((ends - counts + 1 + ends) / 2.0)[inverse]
+
+    return float((ranks[y_true].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def calibration_table(y_true: np.ndarray, y_prob: np.ndarray, n_bins: int = CALIBRATION_BINS) -> dict:
+    """Reliability bins, expected calibration error and Brier score."""
+    bins = np.minimum((y_prob * n_bins).astype(np.intp), n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    prob_sums = np.bincount(bins, weights=y_prob, minlength=n_bins)
+    true_sums = np.bincount(bins, weights=y_true, minlength=n_bins)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_prob = prob_sums / counts
+        observed = true_sums / counts
+
+    filled = counts > 0
+    ece = float(np.sum(counts[filled] / len(y_prob) * np.abs(mean_prob[filled] - observed[filled])))
+
+    return {
+        "ece": ece,
+        "brier": float(np.mean((y_prob - y_true) ** 2)),
+        "bins": [
+            {
+                "lower": b / n_bins,
+                "upper": (b + 1) / n_bins,
+                "count": int(counts[b]),
+                "mean_probability": float(mean_prob[b]) if filled[b] else None,
+                "observed_rate": float(observed[b]) if filled[b] else None,
+            }
+            for b in range(n_bins)
+        ],
+    }
+
+
+def binary_metrics(y_true: np.ndarray, y_prob: np.ndarray, threshold: float = THRESHOLD) -> dict:
+    """Accuracy, sensitivity, specificity, precision, AUC and calibration."""
+    y_true = y_true.astype(np.float64)
+    actual = y_true.astype(bool)
+    predicted = y_prob >= threshold
+
+    tp = int(np.sum(predicted & actual))
+    tn = int(np.sum(~predicted & ~actual))
+    fp = int(np.sum(predicted & ~actual))
+    fn = int(np.sum(~predicted & actual))
+
+    def ratio(num, den):
+        return num / den if den else float('nan')
+
+    return {
+        "accuracy": ratio(tp + tn, len(y_true)),
+        "sensitivity": ratio(tp, tp + fn),
+        "specificity": ratio(tn, tn + fp),
+        "precision": ratio(tp, tp + fp),
+        "auc": roc_auc(actual, y_prob),
+        "confusion": {"tp": tp, "tn": tn, "fp": fp, "fn": fn},
+        "calibration": calibration_table(y_true, y_prob),
+    }
+
+
+# =================== Evaluation ===================
+
+def dataset_hash(paths) -> str:
+    """SHA-256 over the contents of the files (order-independent)."""
+    file_digests = []
+    for path in paths:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        file_digests.append(digest.hexdigest())
+
+    combined = hashlib.sha256()
+    for d in sorted(file_digests):
+        combined.update(d.encode())
+    return combined.hexdigest()
+
+
+def _score_chunk(chunk: pd.DataFrame, model, scaler, used_features):
+    """Return (labels, anemia probabilities) for the valid labeled rows of a chunk."""
+    try:
+        df = prepare_dataframe_for_inference(chunk, used_features)
+    except ValueError:
+        return np.empty(0), np.empty(0)
+
+    labels = anemia_labels(df[LABEL_COLUMN])
+    keep = ~np.isnan(labels)
+    if not keep.any():
+        return np.empty(0), np.empty(0)
+
+    X_scaled = scaler.transform(df.loc[keep, used_features].to_numpy(dtype=np.float64))
+    probabilities = model.predict_proba(X_scaled)[:, 1]
+    return labels[keep], probabilities
+
+
+def evaluate_files(
+    paths,
+    model=None,
+    scaler=None,
+    used_features=None,
+    version: str = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    use_cache: bool = True,
+    cache_dir: Path = None
+) -> dict:
+    """
+    Evaluate the CBC model on labeled CSV files.
+
+    Args:
+        paths: Labeled CSV files
+        model, scaler, used_features: Model assets (loaded from disk when omitted)
+        version: Model version used for the cache key (computed when omitted)
+        chunk_size: Rows per scoring chunk
+        workers: Scoring threads
+        use_cache: Read and write the result cache
+        cache_dir: Cache directory (default CACHE_DIR)
+
+    Returns:
+        Dict with model_version, dataset_hash, rows, rows_skipped, metrics,
+        seconds, rows_per_second and whether it came from the cache
+
+    Raises:
+        ValueError: If a file has no Diagnosis column or no row can be scored
+    """
+    paths = [str(p) for p in paths]
+    version = version or model_version()
+    data_hash = dataset_hash(paths)
+    cache_dir = Path(cache_dir or CACHE_DIR)
+    cache_path = cache_dir / f"{version}_{data_hash[:16]}.json"
+
+    if use_cache and cache_path.exists():
+        with open(cache_path, "r") as f:
+            result = json.load(f)
+        result["cached"] = True
+        return result
+
+    if model is None:
+        model, scaler, used_features = load_model_and_assets()
+
+    start = time.perf_counter()
+
+    chunks, total_rows = [], 0
+    for path in paths:
+        df = pd.read_csv(path)
+        if LABEL_COLUMN not in df.columns:
+            raise ValueError(f"{path} has no '{LABEL_COLUMN}' column")
+        total_rows += len(df)
+        chunks.extend(df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        scored = list(pool.map(lambda c: _score_chunk(c, model, scaler, used_features), chunks))
+
+    y_true = np.concatenate([s[0] for s in scored]) if scored else np.empty(0)
+    y_prob = np.concatenate([s[1] for s in scored]) if scored else np.empty(0)
+    if len(y_true) == 0:
+        raise ValueError("No labeled rows could be scored")
+
+    metrics = binary_metrics(y_true, y_prob)
+    seconds = time.perf_counter() - start
+
+    result = {
+        "model_version": version,
+        "dataset_hash": data_hash,
+        "files": paths,
+        "rows": len(y_true),
+        "rows_skipped": total_rows - len(y_true),
+        "positives": int(y_true.sum()),
+        "metrics": metrics,
+        "seconds": seconds,
+        "rows_per_second": len(y_true) / seconds if seconds > 0 else float('inf'),
+        "cached": False,
+    }
+
+    if use_cache:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, cache_path)
+
+    return result
+
+
+def write_model_accuracy(accuracy: float, model_name: str = "CBC Anemia Detection") -> bool:
+    """Store a measured accuracy (0-1) on the models table as a percentage."""
+    from app.database import SessionLocal, Model
+
+    db = SessionLocal()
+    try:
+        model = db.query(Model).filter(Model.name == model_name).first()
+        if not model:
+            return False
+        model.accuracy = round(accuracy * 100, 2)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+# =================== Command Line ===================
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the CBC anemia model on labeled CSV files.")
+    parser.add_argument("files", nargs="+", help="CSV files with CBC features and a Diagnosis column")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per scoring chunk")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="scoring threads")
+    parser.add_argument("--no-cache", action="store_true", help="ignore and do not write cached results")
+    parser.add_argument("--write-accuracy", action="store_true", help="store the measured accuracy on the models table")
+    parser.add_argument("--json", action="store_true", help="print the full result as JSON")
+    args = parser.parse_args()
+
+    result = evaluate_files(
+        args.files,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        use_cache=not args.no_cache
+    )
+    m = result["metrics"]
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"Model {result['model_version']} on {result['rows']:,} rows "
+              f"({result['rows_skipped']:,} skipped){' [cached]' if result['cached'] else ''}")
+        print(f"  Accuracy:    {m['accuracy']:.4f}")
+        print(f"  Sensitivity: {m['sensitivity']:.4f}")
+        print(f"  Specificity: {m['specificity']:.4f}")
+        print(f"  AUC:         {m['auc']:.4f}")
+        print(f"  ECE / Brier: {m['calibration']['ece']:.4f} / {m['calibration']['brier']:.4f}")
+        print(f"  Throughput:  {result['rows_per_second']:,.0f} rows/s ({result['seconds']:.3f}s)")
+
+    if args.write_accuracy:
+        if write_model_accuracy(m["accuracy"]):
+            print(f"Stored accuracy {m['accuracy'] * 100:.2f}% on the models table")
+        else:
+            print("CBC Anemia Detection model not found; accuracy not stored")
+
+
+if __name__ == "__main__":
+    main()
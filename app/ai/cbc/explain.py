@@ -0,0 +1,79 @@
+"""
+Per-sample feature attributions from TabNet's attentive feature masks.
+
+``TabNetClassifier.explain`` aggregates the step masks into one importance
+value per input feature. Attributions are computed for all rows of a result
+in one batched call and stored next to them as ``<FEATURE>_Attribution``
+columns (each row sums to 1), so later views read them instead of running
+the model again.
+"""
+import numpy as np
+import pandas as pd
+
+
+# =================== Configuration ===================
+
+# Suffix of the attribution columns written next to each model feature
+ATTRIBUTION_SUFFIX = '_Attribution'
+
+
+# =================== Computation ===================
+
+def explain_batch(df: pd.DataFrame, model, scaler, used_features) -> np.ndarray:
+    """
+    Compute normalized feature attributions for every row in one model pass.
+
+    Args:
+        df: Dataframe holding the model features (standardized names)
+        model: Trained TabNet model
+        scaler: Fitted scaler
+        used_features: List of feature names, in model input order
+
+    Returns:
+        float64 array of shape (len(df), len(used_features)); each row sums
+        to 1 (all zeros if the model attended to nothing)
+    """
+    X = df[used_features].to_numpy(dtype=np.float64)
+    X_scaled = scaler.transform(X)
+
+    explain_matrix, _ = model.explain(X_scaled)
+    explain_matrix = np.asarray(explain_matrix, dtype=np.float64)
+
+    totals = explain_matrix.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.where(totals > 0, explain_matrix / totals, 0.0)
+
+    return shares
+
+
+def add_attributions(df: pd.DataFrame, model, scaler, used_features) -> pd.DataFrame:
+    """
+    Add a ``<FEATURE>_Attribution`` column for every model feature.
+
+    Args:
+        df: Dataframe holding the model features
+        model: Trained TabNet model
+        scaler: Fitted scaler
+        used_features: List of feature names
+
+    Returns:
+        The same dataframe with attribution columns added
+    """
+    shares = explain_batch(df, model, scaler, used_features)
+    for f, feature in enumerate(used_features):
+        df[feature + ATTRIBUTION_SUFFIX] = np.round(shares[:, f], 4)
+    return df
+
+
+def has_attributions(df: pd.DataFrame) -> bool:
+    """Check whether attribution columns were already stored with the results."""
+    return any(str(c).endswith(ATTRIBUTION_SUFFIX) for c in df.columns)
+
+
+def row_attributions(row) -> dict:
+    """Collect the stored attributions of a single result row as {feature: share}, largest first."""
+    attributions = {}
+    for key, value in row.items():
+        if isinstance(key, str) and key.endswith(ATTRIBUTION_SUFFIX) and pd.notna(value):
+            attributions[key[:-len(ATTRIBUTION_SUFFIX)]] = float(value)
+    return dict(sorted(attributions.items(), key=lambda item: item[1], reverse=True))
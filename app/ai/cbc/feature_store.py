@@ -0,0 +1,154 @@
+"""
+Append-only, memory-mappable store of CBC feature vectors.
+
+Every scored row is appended as a fixed-width float32 record to
+``features.f32`` and its (test ID, row index) pair to ``index.i64``, so the
+whole history can be mapped with ``np.memmap`` and scanned as one
+contiguous array instead of reading thousands of per-test CSV files.
+
+Layout of a store directory:
+
+- ``meta.json``    feature names, in column order
+- ``features.f32`` float32, shape (n_rows, n_features), C order
+- ``index.i64``    int64, shape (n_rows, 2): test_id, row_index
+
+Records are only ever appended. Appends take an exclusive file lock, so
+several worker processes can share a store; a torn append (e.g. a crash
+between the two files) is trimmed back to the last complete row on the
+next append.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+
+FEATURE_DTYPE = np.float32
+INDEX_DTYPE = np.int64
+
+META_FILE = 'meta.json'
+FEATURES_FILE = 'features.f32'
+INDEX_FILE = 'index.i64'
+LOCK_FILE = '.lock'
+
+
+class FeatureStore:
+    """Append-only float32 feature matrix with a (test_id, row_index) index."""
+
+    def __init__(self, directory, feature_names):
+        self.directory = Path(directory).resolve()
+        self.feature_names = list(feature_names)
+        self.n_features = len(self.feature_names)
+        self._row_bytes = self.n_features * np.dtype(FEATURE_DTYPE).itemsize
+        self._index_bytes = 2 * np.dtype(INDEX_DTYPE).itemsize
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta_path = self.directory / META_FILE
+        if meta_path.exists():
+            with open(meta_path, "r") as f:
+                stored = json.load(f)["features"]
+            if stored != self.feature_names:
+                raise ValueError(f"Feature store at {self.directory} holds {stored}, not {self.feature_names}")
+        else:
+            tmp_path = meta_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"features": self.feature_names, "dtype": "float32"}, f)
+            os.replace(tmp_path, meta_path)
+
+    @property
+    def features_path(self) -> Path:
+        return self.directory / FEATURES_FILE
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / INDEX_FILE
+
+    def __len__(self) -> int:
+        return self._complete_rows()
+
+    def _complete_rows(self) -> int:
+        """Rows present in full in both files."""
+        features_size = self.features_path.stat().st_size if self.features_path.exists() else 0
+        index_size = self.index_path.stat().st_size if self.index_path.exists() else 0
+        return min(features_size // self._row_bytes, index_size // self._index_bytes)
+
+    # =================== Writing ===================
+
+    def append(self, test_id: int, X) -> int:
+        """
+        Append the feature rows of one test.
+
+        Args:
+            test_id: Test the rows belong to
+            X: Array-like (n_rows, n_features), columns in feature_names order
+
+        Returns:
+            Number of rows appended
+        """
+        X = np.ascontiguousarray(X, dtype=FEATURE_DTYPE)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected shape (n, {self.n_features}), got {X.shape}")
+        if len(X) == 0:
+            return 0
+
+        index = np.empty((len(X), 2), dtype=INDEX_DTYPE)
+        index[:, 0] = test_id
+        index[:, 1] = np.arange(len(X))
+
+        with self._lock, open(self.directory / LOCK_FILE, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                rows = self._complete_rows()
+                with open(self.features_path, "ab") as f:
+                    f.truncate(rows * self._row_bytes)
+                    f.write(X.tobytes())
+                with open(self.index_path, "ab") as f:
+                    f.truncate(rows * self._index_bytes)
+                    f.write(index.tobytes())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        return len(X)
+
+    # =================== Reading ===================
+
+    def load(self):
+        """
+        Map the store read-only without copying.
+
+        Returns:
+            Tuple (features, index): float32 memmap (n_rows, n_features) and
+            int64 memmap (n_rows, 2) of (test_id, row_index); empty arrays
+            when nothing has been stored yet
+        """
+        rows = self._complete_rows()
+        if rows == 0:
+            return (
+                np.empty((0, self.n_features), dtype=FEATURE_DTYPE),
+                np.empty((0, 2), dtype=INDEX_DTYPE),
+            )
+        features = np.memmap(self.features_path, dtype=FEATURE_DTYPE, mode='r', shape=(rows, self.n_features))
+        index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r', shape=(rows, 2))
+        return features, index
+
+    def test_ids(self) -> np.ndarray:
+        """Distinct test IDs present in the store."""
+        _, index = self.load()
+        return np.unique(index[:, 0])
+
+    def rows_for_test(self, test_id: int) -> np.ndarray:
+        """Feature rows of one test, in row order."""
+        features, index = self.load()
+        mask = index[:, 0] == test_id
+        rows = features[mask]
+        return rows[np.argsort(index[mask, 1], kind='stable')]
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 from pathlib import Path
 import warnings
 
@@ -13,6 +14,10 @@ import pandas as pd
 import joblib
 from pytorch_tabnet.tab_model import TabNetClassifier
 
+from .reference_ranges import FLAG_SUFFIX, add_reference_flags, row_flags
+from .indices import INDEX_SUFFIX, add_derived_indices
+from .explain import ATTRIBUTION_SUFFIX
+
 
 # =================== Configuration ===================
 # Get the directory where this file is located
@@ -40,12 +45,22 @@ ALIASES = {
 }
 
 
+# Stored result columns the result pages render or build reports from
+DISPLAY_COLUMNS = set(ALIASES) | {'Diagnosis', 'Predicted_Anemia'}
+
+
 # =================== Helper Functions ===================
 
 def norm(s: str) -> str:
     return str(s).strip().lower().replace(' ', '').replace('.', '').replace('-', '').replace('_', '')
 
 
+def display_column(name: str, with_attributions: bool = True) -> bool:
+    """Whether a stored result column is needed to render a result page"""
+    suffixes = (FLAG_SUFFIX, INDEX_SUFFIX, ATTRIBUTION_SUFFIX) if with_attributions else (FLAG_SUFFIX, INDEX_SUFFIX)
+    return name in DISPLAY_COLUMNS or name.endswith(suffixes)
+
+
 def build_rename_map(df_columns):
     rename_map = {}
     for std_name, variants in ALIASES.items():
@@ -124,6 +139,16 @@ def load_model_and_assets():
     return model, scaler, used_features
 
 
+def model_version() -> str:
+    """Short content hash of the model, scaler and feature files (changes whenever any is replaced)"""
+    digest = hashlib.sha256()
+    for path in (MODEL_PATH, SCALER_PATH, FEATURES_PTH):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
 # =================== Medical Report Generation ===================
 def _val(row, col):
     try:
@@ -154,12 +179,23 @@ def _anemia_phenotype(row):
     
     return phenotype, hints
 
+def _out_of_range_line(row):
+    flagged = [f"{param} ({label})" for param, label in row_flags(row).items() if label != 'Normal']
+    if not flagged:
+        return None
+    return "Out-of-Range Values: " + ", ".join(flagged)
+
 def build_report(row):
+    out_of_range = _out_of_range_line(row)
+    
     if int(row['Predicted_Anemia']) == 0:
-        return (
+        report = (
             "Result: Not Anemic ✅\n"
             "Note: A healthy lifestyle, adequate hydration, and periodic CBC tests as advised by your doctor are recommended."
         )
+        if out_of_range:
+            report += "\n" + out_of_range
+        return report
     
     phenotype, hints = _anemia_phenotype(row)
     hgb = _val(row, 'HGB')
@@ -210,6 +246,8 @@ def build_report(row):
     lines.append(f"Expected Classification: {phenotype}")
     if hints:
         lines.append("Supporting Observations: " + "; ".join(hints))
+    if out_of_range:
+        lines.append(out_of_range)
     
     lines.append("\n🔬 Suggested Tests (according to physician's evaluation):")
     for t in base_tests + extra_tests:
@@ -232,9 +270,54 @@ def build_report(row):
 
 
 # =================== Prediction with DataFrame Output ===================
+# df.attrs key holding how many rows of a scored frame repeated an earlier row
+DUPLICATE_ROWS = 'duplicate_rows'
+
+
+def unique_rows(X: np.ndarray):
+    """
+    Hash-based unique/inverse mapping over the rows of a feature matrix.
+    
+    Returns:
+        Tuple (first, inverse): index of the first occurrence of each distinct
+        row, in order of appearance, and for every row the position of its
+        distinct row in ``first`` (so ``X[first][inverse]`` equals ``X``)
+    """
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(X), index=False).to_numpy()
+    inverse, uniques = pd.factorize(hashes)
+    _, first = np.unique(inverse, return_index=True)
+    # A 64-bit hash collision would merge different rows; fall back to an exact comparison
+    if not np.array_equal(X[first][inverse], X):
+        _, first, inverse = np.unique(X, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    return first, inverse
+
+
+def predict_unique(model, scaler, X: np.ndarray):
+    """
+    Score only the distinct rows of X and scatter the results back to every row.
+    
+    Lab exports often repeat rows (re-runs, duplicated sample IDs); each
+    distinct feature vector goes through the model once.
+    
+    Returns:
+        Tuple of (predictions, probabilities, number of duplicate rows)
+    """
+    first, inverse = unique_rows(X)
+    X_scaled = scaler.transform(X[first])
+    predictions = model.predict(X_scaled)[inverse]
+    probabilities = model.predict_proba(X_scaled)[inverse]
+    return predictions, probabilities, len(X) - len(first)
+
+
 def predict_and_annotate_dataframe(df: pd.DataFrame, model, scaler, used_features):
     """
-    Make predictions on a dataframe and add Diagnosis and Predicted_Anemia columns.
+    Make predictions on a dataframe and add Diagnosis and Predicted_Anemia columns,
+    plus a <PARAM>_Flag reference-range column for each CBC parameter and a
+    <Name>_Index column for each derived index whose inputs are present.
+    
+    Identical feature rows are scored once; their count is left in
+    ``df_output.attrs[DUPLICATE_ROWS]``.
     
     Args:
         df: Input dataframe with CBC data
@@ -250,11 +333,9 @@ def predict_and_annotate_dataframe(df: pd.DataFrame, model, scaler, used_feature
     
     # Extract features and scale
     X = df_prepared[used_features].values
-    X_scaled = scaler.transform(X)
     
-    # Make predictions
-    predictions = model.predict(X_scaled)
-    probabilities = model.predict_proba(X_scaled)
+    # Make predictions, once per distinct feature row
+    predictions, probabilities, duplicates = predict_unique(model, scaler, X)
     
     # Create output dataframe with original data
     df_output = df_prepared.copy()
@@ -263,4 +344,11 @@ def predict_and_annotate_dataframe(df: pd.DataFrame, model, scaler, used_feature
     df_output['Predicted_Anemia'] = predictions
     df_output['Diagnosis'] = ['Anemia' if pred == 1 else 'Normal' for pred in predictions]
     
+    # Flag every parameter against its age/sex reference range
+    df_output = add_reference_flags(df_output)
+    
+    # Derived hematology indices (Mentzer, RDWI, Green & King, ...)
+    df_output = add_derived_indices(df_output)
+    df_output.attrs[DUPLICATE_ROWS] = duplicates
+    
     return df_output, probabilities
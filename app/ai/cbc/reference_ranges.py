@@ -0,0 +1,212 @@
+"""
+Reference-range flagging for CBC parameters.
+
+Ranges are kept in lookup tables indexed by (age band, sex) so a whole batch
+can be flagged with a handful of NumPy gathers and comparisons instead of a
+per-row Python loop.
+"""
+import numpy as np
+import pandas as pd
+
+
+# =================== Configuration ===================
+
+# Parameters that get a reference flag, in table column order
+FLAG_PARAMETERS = ['RBC', 'HGB', 'PCV', 'MCV', 'MCH', 'MCHC', 'RDW', 'TLC', 'PLT']
+
+# Age band lower edges (years): child < 12 <= adolescent < 18 <= adult < 65 <= elderly
+AGE_BANDS = ['child', 'adolescent', 'adult', 'elderly']
+AGE_BAND_EDGES = np.array([12.0, 18.0, 65.0])
+DEFAULT_AGE_BAND = AGE_BANDS.index('adult')
+
+# Sex index follows normalize_sex_column: 0 = female, 1 = male, 2 = unknown
+SEX_FEMALE, SEX_MALE, SEX_UNKNOWN = 0, 1, 2
+
+# Flag codes and their display labels (label index = code + 2)
+FLAG_CRITICAL_LOW, FLAG_LOW, FLAG_NORMAL, FLAG_HIGH, FLAG_CRITICAL_HIGH = -2, -1, 0, 1, 2
+FLAG_LABELS = np.array(['Critical Low', 'Low', 'Normal', 'High', 'Critical High'], dtype=object)
+
+# Suffix of the flag columns written next to each parameter
+FLAG_SUFFIX = '_Flag'
+
+_INF = np.inf
+
+# (critical_low, low, high, critical_high) per parameter.
+# Sex-dependent parameters map to {'F': (...), 'M': (...)}.
+# Units follow the upload format: RBC 10^6/µL, HGB g/dL, PCV %, MCV fL, MCH pg,
+# MCHC g/dL, RDW %, TLC and PLT 10^3/µL.
+REFERENCE_RANGES = {
+    'child': {
+        'RBC':  (2.0, 4.0, 5.2, 8.0),
+        'HGB':  (7.0, 11.5, 15.5, 20.0),
+        'PCV':  (20.0, 35.0, 45.0, 60.0),
+        'MCV':  (60.0, 77.0, 95.0, 120.0),
+        'MCH':  (18.0, 25.0, 33.0, 40.0),
+        'MCHC': (28.0, 31.0, 37.0, 40.0),
+        'RDW':  (-_INF, 11.5, 14.5, 20.0),
+        'TLC':  (2.0, 5.0, 14.5, 30.0),
+        'PLT':  (50.0, 150.0, 450.0, 1000.0),
+    },
+    'adolescent': {
+        'RBC':  {'F': (2.0, 4.1, 5.1, 8.0), 'M': (2.0, 4.5, 5.3, 8.0)},
+        'HGB':  {'F': (7.0, 12.0, 16.0, 20.0), 'M': (7.0, 13.0, 16.0, 20.0)},
+        'PCV':  {'F': (20.0, 36.0, 46.0, 60.0), 'M': (20.0, 37.0, 49.0, 60.0)},
+        'MCV':  (60.0, 78.0, 98.0, 120.0),
+        'MCH':  (18.0, 25.0, 35.0, 40.0),
+        'MCHC': (28.0, 31.0, 37.0, 40.0),
+        'RDW':  (-_INF, 11.5, 14.5, 20.0),
+        'TLC':  (2.0, 4.5, 13.0, 30.0),
+        'PLT':  (50.0, 150.0, 450.0, 1000.0),
+    },
+    'adult': {
+        'RBC':  {'F': (2.0, 4.1, 5.1, 8.0), 'M': (2.0, 4.5, 5.9, 8.0)},
+        'HGB':  {'F': (7.0, 12.0, 15.5, 20.0), 'M': (7.0, 13.5, 17.5, 20.0)},
+        'PCV':  {'F': (20.0, 36.0, 46.0, 60.0), 'M': (20.0, 41.0, 53.0, 60.0)},
+        'MCV':  (60.0, 80.0, 100.0, 120.0),
+        'MCH':  (18.0, 27.0, 33.0, 40.0),
+        'MCHC': (28.0, 32.0, 36.0, 40.0),
+        'RDW':  (-_INF, 11.5, 14.5, 20.0),
+        'TLC':  (2.0, 4.0, 11.0, 30.0),
+        'PLT':  (50.0, 150.0, 450.0, 1000.0),
+    },
+    'elderly': {
+        'RBC':  {'F': (2.0, 3.9, 5.1, 8.0), 'M': (2.0, 4.2, 5.7, 8.0)},
+        'HGB':  {'F': (7.0, 11.5, 15.5, 20.0), 'M': (7.0, 12.5, 17.0, 20.0)},
+        'PCV':  {'F': (20.0, 35.0, 46.0, 60.0), 'M': (20.0, 38.0, 51.0, 60.0)},
+        'MCV':  (60.0, 80.0, 100.0, 120.0),
+        'MCH':  (18.0, 27.0, 34.0, 40.0),
+        'MCHC': (28.0, 32.0, 36.0, 40.0),
+        'RDW':  (-_INF, 11.5, 15.0, 20.0),
+        'TLC':  (2.0, 4.0, 11.0, 30.0),
+        'PLT':  (50.0, 140.0, 440.0, 1000.0),
+    },
+}
+
+
+# =================== Lookup Tables ===================
+
+def _build_tables():
+    """
+    Expand REFERENCE_RANGES into four (n_bands * 3, n_params) bound tables.
+
+    Row ``band * 3 + sex`` holds the bounds for that group. The unknown-sex
+    row takes the widest of the female and male bounds so that rows without
+    a Sex column are only flagged when they are out of range for both.
+    """
+    n_groups = len(AGE_BANDS) * 3
+    tables = np.empty((4, n_groups, len(FLAG_PARAMETERS)), dtype=np.float64)
+
+    for b, band in enumerate(AGE_BANDS):
+        for p, param in enumerate(FLAG_PARAMETERS):
+            spec = REFERENCE_RANGES[band][param]
+            female = np.asarray(spec['F'] if isinstance(spec, dict) else spec, dtype=np.float64)
+            male = np.asarray(spec['M'] if isinstance(spec, dict) else spec, dtype=np.float64)
+            unknown = np.array([
+                min(female[0], male[0]),
+                min(female[1], male[1]),
+                max(female[2], male[2]),
+                max(female[3], male[3]),
+            ])
+            tables[:, b * 3 + SEX_FEMALE, p] = female
+            tables[:, b * 3 + SEX_MALE, p] = male
+            tables[:, b * 3 + SEX_UNKNOWN, p] = unknown
+
+    return tables
+
+
+CRITICAL_LOW, LOW, HIGH, CRITICAL_HIGH = _build_tables()
+
+
+# =================== Flagging ===================
+
+def _group_index(df: pd.DataFrame) -> np.ndarray:
+    """Map each row to its (age band, sex) row in the bound tables."""
+    n = len(df)
+
+    if 'Age' in df.columns:
+        age = pd.to_numeric(df['Age'], errors='coerce').to_numpy(dtype=np.float64)
+        band = np.searchsorted(AGE_BAND_EDGES, age, side='right')
+        band[np.isnan(age)] = DEFAULT_AGE_BAND
+    else:
+        band = np.full(n, DEFAULT_AGE_BAND, dtype=np.intp)
+
+    if 'Sex' in df.columns:
+        sex = pd.to_numeric(df['Sex'], errors='coerce').to_numpy(dtype=np.float64)
+        sex_idx = np.full(n, SEX_UNKNOWN, dtype=np.intp)
+        sex_idx[sex == 0] = SEX_FEMALE
+        sex_idx[sex == 1] = SEX_MALE
+    else:
+        sex_idx = np.full(n, SEX_UNKNOWN, dtype=np.intp)
+
+    return band * 3 + sex_idx
+
+
+def flag_batch(df: pd.DataFrame) -> np.ndarray:
+    """
+    Flag every CBC parameter of every row in one vectorized pass.
+
+    Args:
+        df: Dataframe with standardized column names (see ALIASES). Age and
+            Sex are used when present; missing parameters are left unflagged.
+
+    Returns:
+        float array of shape (len(df), len(FLAG_PARAMETERS)) holding flag
+        codes (FLAG_CRITICAL_LOW .. FLAG_CRITICAL_HIGH), NaN where the value
+        is missing.
+    """
+    values = np.full((len(df), len(FLAG_PARAMETERS)), np.nan)
+    for p, param in enumerate(FLAG_PARAMETERS):
+        if param in df.columns:
+            values[:, p] = pd.to_numeric(df[param], errors='coerce').to_numpy(dtype=np.float64)
+
+    group = _group_index(df)
+
+    with np.errstate(invalid='ignore'):
+        codes = (
+            (values > HIGH[group]).astype(np.float64)
+            + (values > CRITICAL_HIGH[group])
+            - (values < LOW[group])
+            - (values < CRITICAL_LOW[group])
+        )
+    codes[np.isnan(values)] = np.nan
+
+    return codes
+
+
+def add_reference_flags(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add a ``<PARAM>_Flag`` label column for every parameter present in df.
+
+    Args:
+        df: Dataframe with standardized column names
+
+    Returns:
+        The same dataframe with flag columns added
+    """
+    codes = flag_batch(df)
+
+    for p, param in enumerate(FLAG_PARAMETERS):
+        if param not in df.columns:
+            continue
+        column = codes[:, p]
+        labels = np.full(len(df), None, dtype=object)
+        present = ~np.isnan(column)
+        labels[present] = FLAG_LABELS[column[present].astype(np.intp) + 2]
+        df[param + FLAG_SUFFIX] = labels
+
+    return df
+
+
+def has_reference_flags(df: pd.DataFrame) -> bool:
+    """Check whether the flag columns were already stored with the results."""
+    return any(param + FLAG_SUFFIX in df.columns for param in FLAG_PARAMETERS)
+
+
+def row_flags(row) -> dict:
+    """Collect the stored flag labels of a single result row as {param: label}."""
+    flags = {}
+    for param in FLAG_PARAMETERS:
+        label = row.get(param + FLAG_SUFFIX)
+        if isinstance(label, str):
+            flags[param] = label
+    return flags
@@ -1,10 +1,17 @@
 # Database configuration and session management
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Numeric, Text, ForeignKey, Table
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Numeric, Text, ForeignKey, Table, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from collections import deque
 from datetime import datetime
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -15,31 +22,198 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL environment variable not set.")
 
+# Async drivers used for the same database by async route handlers
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url: str) -> str:
+    """The URL of the same database through its asyncio driver (asyncpg or aiosqlite)"""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend} databases.")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+# Connection pool settings, per engine (the sync and the async engine each have a pool)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))    # seconds a checkout waits
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))    # seconds; -1 never recycles
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+
+class DurationStats:
+    """Count and distribution of recent durations, safe to update from any thread"""
+
+    def __init__(self, window: int = 1000):
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._recent.append(seconds)
+            self.count += 1
+            self.max = max(self.max, seconds)
+
+    def report(self) -> dict:
+        """Total count and max, and mean/p50/p95 of the recent window, in ms"""
+        with self._lock:
+            recent = sorted(self._recent)
+            count, longest = self.count, self.max
+        if not recent:
+            return {"count": count, "mean_ms": None, "p50_ms": None, "p95_ms": None, "max_ms": None}
+        return {
+            "count": count,
+            "mean_ms": round(1000 * sum(recent) / len(recent), 3),
+            "p50_ms": round(1000 * recent[len(recent) // 2], 3),
+            "p95_ms": round(1000 * recent[min(len(recent) - 1, int(0.95 * len(recent)))], 3),
+            "max_ms": round(1000 * longest, 3),
+        }
+
+
+class _TimedCheckout:
+    """Pool mixin recording how long each checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = DurationStats()
+        self.checkout_timeouts = 0
+
+    def _do_get(self):
+        # Includes opening a new connection when the pool is below its limit
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.checkout_wait.add(time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_options(url: str, is_async: bool = False) -> dict:
+    """create_engine pool arguments for a database URL, from the DB_POOL_* settings"""
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in one connection: there is no pool to size
+        return options
+    options.update(
+        poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    return options
+
+
 engine = create_engine(
-    DATABASE_URL
+    DATABASE_URL,
+    **pool_options(DATABASE_URL)
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async routes use their own engine, so a query waits on the network without holding the event loop.
+# Objects outlive the commit: async sessions cannot lazy-load expired attributes in templates.
+async_engine = create_async_engine(
+    async_database_url(DATABASE_URL),
+    **pool_options(DATABASE_URL, is_async=True)
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
+# Indexes added after the first release are also created by migrations (app/migrations)
+# for existing databases; keep their names in step.
+
 # Association table for many-to-many relationship between doctors and patients
 doctor_patients = Table(
     'doctor_patients',
     Base.metadata,
     Column('doctor_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
     Column('patient_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
-    Column('created_at', DateTime, default=datetime.utcnow)
+    Column('created_at', DateTime, default=datetime.utcnow),
+    Index('ix_doctor_patients_patient_id', 'patient_id', 'doctor_id')
 )
 
+# How long request sessions stay open, from dependency setup to teardown
+session_lifetime = {"sync": DurationStats(), "async": DurationStats()}
+
+
 def get_db():
     db = SessionLocal()
+    started = time.perf_counter()
     try:
         yield db
     finally:
         db.close()
+        session_lifetime["sync"].add(time.perf_counter() - started)
+
+
+async def get_async_db():
+    """Async session for async route handlers; relationships must be loaded explicitly"""
+    started = time.perf_counter()
+    try:
+        async with AsyncSessionLocal() as db:
+            yield db
+    finally:
+        session_lifetime["async"].add(time.perf_counter() - started)
+
+
+def pool_status(pool) -> dict:
+    """Connections of a pool in use, idle and in overflow, and its checkout waits"""
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            # Negative while the pool has not opened all of its connections yet
+            overflow=max(pool.overflow(), 0),
+            timeout=pool.timeout(),
+        )
+    if isinstance(pool, _TimedCheckout):
+        status["checkout_wait"] = pool.checkout_wait.report()
+        status["checkout_timeouts"] = pool.checkout_timeouts
+    return status
+
+
+def database_metrics() -> dict:
+    """Pool settings and usage of both engines, and request session lifetimes"""
+    return {
+        "settings": {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING,
+        },
+        "pools": {
+            "sync": pool_status(engine.pool),
+            "async": pool_status(async_engine.pool),
+        },
+        "session_lifetime": {kind: stats.report() for kind, stats in session_lifetime.items()},
+    }
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_role_created_at", "role", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String(100), unique=True, nullable=False)
     password = Column(String(255), nullable=False)
@@ -77,6 +251,9 @@ class DoctorInfo(Base):
 
 class MedicalHistory(Base):
     __tablename__ = "medical_history"
+    __table_args__ = (
+        Index("ix_medical_history_patient_id_created_at", "patient_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True)
     patient_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     doctor_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
@@ -88,6 +265,11 @@ class MedicalHistory(Base):
 
 class Test(Base):
     __tablename__ = "tests"
+    __table_args__ = (
+        Index("ix_tests_patient_id_created_at", "patient_id", "created_at"),
+        Index("ix_tests_review_requested", "review_requested_from", "review_status", "review_requested_at"),
+        Index("ix_tests_reviewed_by_created_at", "reviewed_by", "created_at"),
+    )
     id = Column(Integer, primary_key=True)
     patient_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     model_id = Column(Integer, ForeignKey("models.id", ondelete="SET NULL"), nullable=True)
@@ -108,6 +290,9 @@ class Test(Base):
 
 class TestFile(Base):
     __tablename__ = "test_files"
+    __table_args__ = (
+        Index("ix_test_files_test_id", "test_id"),
+    )
     id = Column(Integer, primary_key=True)
     test_id = Column(Integer, ForeignKey("tests.id", ondelete="CASCADE"), nullable=False)
     name = Column(String(255), nullable=False)
@@ -120,6 +305,16 @@ class TestFile(Base):
     test = relationship("Test", back_populates="test_files")
 
 
+class Blob(Base):
+    __tablename__ = "blobs"
+    sha256 = Column(String(64), primary_key=True)
+    extension = Column(String(50), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, default=0, nullable=False)  # test_files.path / users.profile_image pointing here
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    released_at = Column(DateTime, nullable=True)  # when ref_count last dropped to 0
+
+
 class Model(Base):
     __tablename__ = "models"
     id = Column(Integer, primary_key=True)
@@ -129,6 +324,25 @@ class Model(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 
+class RescoringJob(Base):
+    __tablename__ = "rescoring_jobs"
+    id = Column(Integer, primary_key=True)
+    model_id = Column(Integer, ForeignKey("models.id", ondelete="CASCADE"), nullable=False)
+    model_version = Column(String(64), nullable=False)
+    status = Column(String(20), default='pending', nullable=False)  # pending, running, cancelled, completed, failed
+    last_test_id = Column(Integer, default=0, nullable=False)  # checkpoint: highest test ID processed
+    tests_processed = Column(Integer, default=0, nullable=False)
+    tests_skipped = Column(Integer, default=0, nullable=False)
+    rows_processed = Column(Integer, default=0, nullable=False)
+    batch_size = Column(Integer, nullable=False)
+    cpu_budget = Column(Numeric(3,2), nullable=False)
+    error = Column(Text, nullable=True)
+    created_by = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
 class PasswordResetToken(Base):
     __tablename__ = "password_reset_tokens"
     id = Column(Integer, primary_key=True)
@@ -5,8 +5,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse, JSONResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from contextlib import asynccontextmanager
-from app.routers import auth, doctors, patients, admin, public
+from app.routers import auth, doctors, patients, admin, public, api
 from app.services.ui_service import set_flash_message
+from app.services.preview_service import register_filters
 import os
 from dotenv import load_dotenv
 
@@ -28,8 +29,9 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    # Shutdown (if needed in the future)
-    # Add cleanup code here
+    # Shutdown
+    from app.services.ai_service import blood_image_service
+    blood_image_service.shutdown()
 
 app = FastAPI(
     title=os.getenv("APP_NAME", "Blood Diagnosis System"),
@@ -40,15 +42,20 @@ app = FastAPI(
 
 # Initialize templates early so exception handlers can use it
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
+
+def wants_json(request: Request) -> bool:
+    """JSON clients and the /api routes get JSON errors instead of HTML pages"""
+    accept_header = request.headers.get("accept", "")
+    return "application/json" in accept_header or request.url.path.startswith("/api/")
 
 # Custom exception handler for HTTP errors
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    accept_header = request.headers.get("accept", "")
     
     # Handle 401 - Unauthorized
     if exc.status_code == 401:
-        if "application/json" in accept_header:
+        if wants_json(request):
             return JSONResponse(
                 status_code=exc.status_code,
                 content={"detail": exc.detail}
@@ -64,7 +71,7 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     
     # Handle 403 - Forbidden
     if exc.status_code == 403:
-        if "application/json" in accept_header:
+        if wants_json(request):
             return JSONResponse(
                 status_code=exc.status_code,
                 content={"detail": exc.detail}
@@ -97,7 +104,7 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     
     # Handle 404 - Not Found
     if exc.status_code == 404:
-        if "application/json" in accept_header:
+        if wants_json(request):
             return JSONResponse(
                 status_code=exc.status_code,
                 content={"detail": exc.detail}
@@ -112,6 +119,11 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
         )
     
     # Handle other status codes with generic error page
+    if wants_json(request):
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={"detail": exc.detail}
+        )
     return templates.TemplateResponse(
         "base.html",
         {
@@ -124,9 +136,7 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
 # Custom exception handler for 500 Internal Server Errors
 @app.exception_handler(500)
 async def internal_server_error_handler(request: Request, exc: Exception):
-    accept_header = request.headers.get("accept", "")
-    
-    if "application/json" in accept_header:
+    if wants_json(request):
         return JSONResponse(
             status_code=500,
             content={"detail": "Internal server error occurred"}
@@ -151,9 +161,7 @@ async def internal_server_error_handler(request: Request, exc: Exception):
 # Global exception handler for unhandled exceptions
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    accept_header = request.headers.get("accept", "")
-    
-    if "application/json" in accept_header:
+    if wants_json(request):
         return JSONResponse(
             status_code=500,
             content={"detail": "Internal server error occurred"}
@@ -195,4 +203,5 @@ app.include_router(auth.router)
 app.include_router(admin.router)
 app.include_router(doctors.router)
 app.include_router(patients.router)
+app.include_router(api.router)
 
@@ -0,0 +1,172 @@
+"""
+Versioned schema migrations.
+
+Base.metadata.create_all creates the tables of a new database, but does
+not change tables that already exist. Changes to existing tables are
+migrations: modules of this package named v<NNNN>_<name>.py, each with
+
+    def upgrade(connection): ...
+    def downgrade(connection): ...
+
+They are applied in version order, each in its own transaction, and the
+applied versions are recorded in the schema_migrations table. A database
+created by init_db.py has the current schema already, so it is stamped
+with every version instead.
+
+    python -m app.migrations status
+    python -m app.migrations upgrade          # create missing tables, apply pending migrations
+    python -m app.migrations downgrade 0000   # revert the migrations above a version
+    python -m app.migrations stamp            # record all migrations as applied
+"""
+import argparse
+import importlib
+import pkgutil
+import re
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, select
+from sqlalchemy.engine import Connection, Engine
+
+
+MIGRATION_MODULE = re.compile(r"^v(\d{4})_(\w+)$")
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _metadata,
+    Column("version", String(4), primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: str
+    name: str
+    module: object
+
+
+def migrations() -> List[Migration]:
+    """All migrations of this package, oldest first"""
+    found = []
+    for info in pkgutil.iter_modules(__path__):
+        match = MIGRATION_MODULE.match(info.name)
+        if match:
+            module = importlib.import_module(f"{__name__}.{info.name}")
+            found.append(Migration(match.group(1), match.group(2), module))
+    return sorted(found, key=lambda m: m.version)
+
+
+def applied_versions(connection: Connection) -> Dict[str, datetime]:
+    """Applied migration versions and when they were applied"""
+    schema_migrations.create(connection, checkfirst=True)
+    return dict(connection.execute(select(schema_migrations.c.version, schema_migrations.c.applied_at)).all())
+
+
+def _record(connection: Connection, migration: Migration):
+    connection.execute(schema_migrations.insert().values(
+        version=migration.version, name=migration.name, applied_at=datetime.utcnow()
+    ))
+
+
+def upgrade(engine: Engine, target: Optional[str] = None) -> List[str]:
+    """
+    Create missing tables, then apply the pending migrations up to target (default: all).
+
+    Returns:
+        The versions applied
+    """
+    from app.database import Base
+
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+    done = []
+    for migration in migrations():
+        if migration.version in applied or (target and migration.version > target):
+            continue
+        with engine.begin() as connection:
+            migration.module.upgrade(connection)
+            _record(connection, migration)
+        done.append(migration.version)
+    return done
+
+
+def downgrade(engine: Engine, target: str) -> List[str]:
+    """
+    Revert the applied migrations above target, newest first.
+
+    Returns:
+        The versions reverted
+    """
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+    done = []
+    for migration in reversed(migrations()):
+        if migration.version not in applied or migration.version <= target:
+            continue
+        with engine.begin() as connection:
+            migration.module.downgrade(connection)
+            connection.execute(schema_migrations.delete().where(schema_migrations.c.version == migration.version))
+        done.append(migration.version)
+    return done
+
+
+def stamp(engine: Engine, target: Optional[str] = None) -> List[str]:
+    """
+    Record the migrations up to target (default: all) as applied, without running them.
+
+    For databases created from the current models, which have their changes already.
+    """
+    done = []
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+        for migration in migrations():
+            if migration.version in applied or (target and migration.version > target):
+                continue
+            _record(connection, migration)
+            done.append(migration.version)
+    return done
+
+
+def status(engine: Engine) -> List[Dict]:
+    """Every migration with the time it was applied (None if pending)"""
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+    return [
+        {"version": m.version, "name": m.name, "applied_at": applied.get(m.version)}
+        for m in migrations()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply or revert versioned schema migrations.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="list migrations and whether they are applied")
+    up = subparsers.add_parser("upgrade", help="create missing tables and apply pending migrations")
+    up.add_argument("version", nargs="?", help="last version to apply (default: all)")
+    down = subparsers.add_parser("downgrade", help="revert the migrations above a version")
+    down.add_argument("version", help="version to return to (0000 reverts all)")
+    mark = subparsers.add_parser("stamp", help="record migrations as applied without running them")
+    mark.add_argument("version", nargs="?", help="last version to record (default: all)")
+    args = parser.parse_args()
+
+    from app.database import engine
+
+    if args.command == "status":
+        for migration in status(engine):
+            applied_at = migration["applied_at"]
+            state = f"applied {applied_at:%Y-%m-%d %H:%M}" if applied_at else "pending"
+            print(f"{migration['version']}  {migration['name']:<40} {state}")
+        return
+
+    if args.command == "upgrade":
+        versions = upgrade(engine, args.version)
+    elif args.command == "downgrade":
+        versions = downgrade(engine, args.version)
+    else:
+        versions = stamp(engine, args.version)
+    print(f"{args.command}: {', '.join(versions) if versions else 'nothing to do'}")
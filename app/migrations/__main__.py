@@ -0,0 +1,3 @@
+from app.migrations import main
+
+main()
@@ -0,0 +1,39 @@
+"""
+Composite indexes for the queries behind the dashboards and patient pages.
+
+Before this, tests, test_files, medical_history and the patient side of
+doctor_patients were only reachable by primary key, so every patient page
+scanned the whole tests table. Each index leads with the filtered columns
+and ends with the column the page sorts by, so a page reads its rows in
+order and stops at its limit. The same indexes are declared on the models
+in app.database.
+"""
+from sqlalchemy import text
+
+
+INDEXES = [
+    # A patient's tests, newest first (patient dashboard and tests page)
+    ("ix_tests_patient_id_created_at", "tests", "patient_id, created_at"),
+    # Review requests to a doctor by status, newest request first (doctor dashboard)
+    ("ix_tests_review_requested", "tests", "review_requested_from, review_status, review_requested_at"),
+    # Tests a doctor reviewed, newest first
+    ("ix_tests_reviewed_by_created_at", "tests", "reviewed_by, created_at"),
+    # Files of a test
+    ("ix_test_files_test_id", "test_files", "test_id"),
+    # A patient's medical history, newest first
+    ("ix_medical_history_patient_id_created_at", "medical_history", "patient_id, created_at"),
+    # Doctors of a patient (the primary key starts with doctor_id)
+    ("ix_doctor_patients_patient_id", "doctor_patients", "patient_id, doctor_id"),
+    # Users of a role, newest first (admin lists, doctor patient lists)
+    ("ix_users_role_created_at", "users", "role, created_at"),
+]
+
+
+def upgrade(connection):
+    for name, table, columns in INDEXES:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def downgrade(connection):
+    for name, _, _ in INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
@@ -1,5 +1,5 @@
 # Admin router for admin-specific routes
-from fastapi import APIRouter, Request, Depends, Form, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Request, Depends, Form, UploadFile, File
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import Session
@@ -9,13 +9,21 @@ from app.services import (
     set_flash_message,
     create_patient,
     get_patient_doctors,
-    hash_password
+    hash_password,
+    cbc_prediction_service
+)
+from app.services.rescoring_service import (
+    start_rescoring_job,
+    resume_rescoring_job,
+    cancel_rescoring_job,
+    get_recent_jobs
 )
 from app.services.profile_service import (
     update_user_profile,
     change_user_password,
     upload_user_profile_image
 )
+from app.services.preview_service import generate_previews, register_filters
 import os
 import uuid
 from pathlib import Path
@@ -23,6 +31,7 @@ from datetime import datetime
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 
 
@@ -125,6 +134,78 @@ def admin_dashboard(
     })
 
 
+@router.get("/models")
+def admin_models(
+    request: Request,
+    current_user: User = Depends(require_role(["admin"])),
+    db: Session = Depends(get_db)
+):
+    from sqlalchemy import func
+    from app.database import Model
+    
+    models = db.query(Model).all()
+    avg_accuracy = db.query(func.avg(Model.accuracy)).scalar() or 0
+    total_tests = db.query(func.sum(Model.tests_count)).scalar() or 0
+    
+    return templates.TemplateResponse("admin/models.html", {
+        "request": request,
+        "current_user": current_user,
+        "models": models,
+        "total_models": len(models),
+        "avg_accuracy": round(avg_accuracy, 2),
+        "total_tests": total_tests,
+        "cbc_drift": cbc_prediction_service.drift_report(),
+        "rescoring_jobs": get_recent_jobs(db),
+        "model_version": cbc_prediction_service.model_version
+    })
+
+
+@router.post("/models/rescore")
+def start_rescore(
+    batch_size: int = Form(None),
+    cpu_budget: float = Form(None),
+    current_user: User = Depends(require_role(["admin"])),
+    db: Session = Depends(get_db)
+):
+    options = {}
+    if batch_size:
+        options["batch_size"] = batch_size
+    if cpu_budget:
+        options["cpu_budget"] = cpu_budget
+    
+    result = start_rescoring_job(db, created_by=current_user.id, **options)
+    
+    response = RedirectResponse(url="/admin/models", status_code=303)
+    set_flash_message(response, "success" if result["success"] else "error", result["message"])
+    return response
+
+
+@router.post("/models/rescore/{job_id}/cancel")
+def cancel_rescore(
+    job_id: int,
+    current_user: User = Depends(require_role(["admin"])),
+    db: Session = Depends(get_db)
+):
+    result = cancel_rescoring_job(db, job_id)
+    
+    response = RedirectResponse(url="/admin/models", status_code=303)
+    set_flash_message(response, "success" if result["success"] else "error", result["message"])
+    return response
+
+
+@router.post("/models/rescore/{job_id}/resume")
+def resume_rescore(
+    job_id: int,
+    current_user: User = Depends(require_role(["admin"])),
+    db: Session = Depends(get_db)
+):
+    result = resume_rescoring_job(db, job_id)
+    
+    response = RedirectResponse(url="/admin/models", status_code=303)
+    set_flash_message(response, "success" if result["success"] else "error", result["message"])
+    return response
+
+
 @router.get("/doctors")
 def admin_doctors(
     request: Request,
@@ -569,6 +650,7 @@ async def change_password(
 @router.post("/upload-profile-image")
 async def upload_profile_image(
     request: Request,
+    background_tasks: BackgroundTasks,
     profile_image: UploadFile = File(...),
     current_user: User = Depends(require_role(["admin"])),
     db: Session = Depends(get_db)
@@ -578,6 +660,8 @@ async def upload_profile_image(
         db=db,
         profile_image=profile_image
     )
+    if success:
+        background_tasks.add_task(generate_previews, current_user.profile_image)
     
     response = RedirectResponse(url="/admin/account", status_code=303)
     set_flash_message(response, "success" if success else "error", message)
@@ -0,0 +1,174 @@
+# API router for machine clients (JSON in, JSON out)
+from typing import Any, Dict, List
+from fastapi import APIRouter, Body, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.database import get_db, database_metrics, User
+from app.services import require_api_role, check_account_active, check_patient_access, cbc_prediction_service
+from app.services.lab_feed_service import ingest_cbc_feed, DEFAULT_BATCH_SIZE
+import json
+import os
+
+router = APIRouter(prefix="/api", tags=["api"])
+
+# Largest number of records accepted by one /api/cbc/predict call
+MAX_PREDICT_BATCH = int(os.getenv("MAX_PREDICT_BATCH", "10000"))
+
+# Responses with more results than this are streamed instead of built in memory
+STREAM_THRESHOLD = int(os.getenv("PREDICT_STREAM_THRESHOLD", "500"))
+
+
+def _stream_prediction_payload(header: Dict[str, Any], results):
+    """Yield a JSON object whose "results" array is serialized one item at a time"""
+    yield json.dumps(header)[:-1] + ', "results": ['
+    for i, result in enumerate(results):
+        yield ("," if i else "") + json.dumps(result)
+    yield "]}"
+
+
+@router.post("/cbc/predict")
+async def cbc_predict(
+    records: List[Dict[str, Any]] = Body(...),
+    with_report: bool = True,
+    current_user: User = Depends(require_api_role(["doctor", "admin"])),
+):
+    """
+    Predict anemia for a JSON array of CBC records.
+    
+    Record keys may use any column name known to the CBC aliases. Rows
+    missing a required feature are skipped; each result carries the
+    row_index of its record in the request. Set with_report=false to skip
+    the per-row medical report.
+    """
+    if not check_account_active(current_user):
+        return JSONResponse(status_code=403, content={"detail": "Account is deactivated"})
+    
+    if not cbc_prediction_service.is_available():
+        return JSONResponse(status_code=503, content={"detail": "AI prediction modules are not available"})
+    
+    if not records:
+        return JSONResponse(status_code=400, content={"detail": "Request body must be a non-empty array of CBC records"})
+    
+    if len(records) > MAX_PREDICT_BATCH:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"Too many records: {len(records)} (maximum is {MAX_PREDICT_BATCH} per request)"}
+        )
+    
+    try:
+        df_prepared, predictions, probabilities = await run_in_threadpool(
+            cbc_prediction_service.score_records, records
+        )
+    except ValueError as ve:
+        return JSONResponse(status_code=422, content={"detail": str(ve)})
+    
+    from app.ai.cbc import DUPLICATE_ROWS
+    
+    header = {
+        "success": True,
+        "count": len(df_prepared),
+        "skipped": len(records) - len(df_prepared),
+        "duplicates": df_prepared.attrs.get(DUPLICATE_ROWS, 0)
+    }
+    results = cbc_prediction_service.iter_batch_results(
+        df_prepared, predictions, probabilities, with_report=with_report
+    )
+    
+    if len(df_prepared) > STREAM_THRESHOLD:
+        return StreamingResponse(
+            _stream_prediction_payload(header, results),
+            media_type="application/json"
+        )
+    
+    return JSONResponse(content={**header, "results": list(results)})
+
+
+@router.get("/cbc/tests/{test_id}/attributions")
+async def cbc_test_attributions(
+    test_id: int,
+    current_user: User = Depends(require_api_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Per-row feature attributions for a CBC test.
+    
+    Attributions are computed in one batched model pass the first time a
+    test is requested and stored with its results; later calls read them.
+    """
+    from app.database import Test
+    
+    if not check_account_active(current_user):
+        return JSONResponse(status_code=403, content={"detail": "Account is deactivated"})
+    
+    test = db.query(Test).filter(Test.id == test_id).first()
+    if not test:
+        return JSONResponse(status_code=404, content={"detail": "Test not found"})
+    
+    patient = db.query(User).filter(User.id == test.patient_id).first()
+    has_access, _ = check_patient_access(current_user, patient, db)
+    if not has_access:
+        return JSONResponse(status_code=403, content={"detail": "You don't have access to this patient's tests"})
+    
+    if not cbc_prediction_service.is_available():
+        return JSONResponse(status_code=503, content={"detail": "AI prediction modules are not available"})
+    
+    try:
+        rows = await run_in_threadpool(cbc_prediction_service.get_test_attributions, db, test_id)
+    except ValueError as ve:
+        return JSONResponse(status_code=422, content={"detail": str(ve)})
+    
+    if rows is None:
+        return JSONResponse(status_code=404, content={"detail": "Test has no CBC results"})
+    
+    return JSONResponse(content={"success": True, "test_id": test_id, "count": len(rows), "results": rows})
+
+
+@router.get("/metrics")
+async def metrics(
+    current_user: User = Depends(require_api_role(["admin"]))
+):
+    """Operational metrics for monitoring (admin only)"""
+    return JSONResponse(content={
+        "cbc_drift": cbc_prediction_service.drift_report(),
+        "database": database_metrics()
+    })
+
+
+@router.post("/cbc/feed")
+async def cbc_lab_feed(
+    request: Request,
+    format: str = "auto",
+    match_by: str = "id",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    notes: str = None,
+    current_user: User = Depends(require_api_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """
+    Ingest a streamed CBC lab feed.
+    
+    The body is NDJSON (one result object per line) or HL7 v2-style
+    pipe-delimited ORU messages. Rows are routed to patients by their
+    identifier (matched against the patient's id, username or email) and
+    scored in batches while the body is still being received.
+    """
+    if not check_account_active(current_user):
+        return JSONResponse(status_code=403, content={"detail": "Account is deactivated"})
+    
+    result = await ingest_cbc_feed(
+        request.stream(),
+        current_user=current_user,
+        db=db,
+        fmt=format,
+        match_by=match_by,
+        batch_size=batch_size,
+        notes=notes or ""
+    )
+    
+    if result["success"]:
+        status_code = 200
+    else:
+        # A feed that failed part way still reports the batches it stored
+        status_code = 500 if "error" in result else 400
+    return JSONResponse(status_code=status_code, content=result)
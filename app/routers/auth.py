@@ -1,11 +1,14 @@
 # Authentication router
-from fastapi import APIRouter, Depends, Request, Response, Form
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, Form, status
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from datetime import timedelta
-from app.database import get_db, User, DoctorInfo
+from app.database import get_db, get_async_db, User, DoctorInfo
 from app.models.schemas import UserCreate, UserResponse, Token, DoctorInfoCreate
 from app.services import (
     verify_password, 
@@ -16,9 +19,11 @@ from app.services import (
     get_current_user_optional,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from app.services.preview_service import register_filters
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 
 @router.get("/login")
@@ -69,7 +74,7 @@ async def login(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Authenticate user and redirect to appropriate dashboard.
@@ -84,11 +89,13 @@ async def login(
         RedirectResponse: Redirect to dashboard based on role
     """
     # Find user by email or username
-    user = db.query(User).filter(
+    result = await db.execute(select(User).where(
         (User.email == email) | (User.username == email)
-    ).first()
+    ))
+    user = result.scalars().first()
     
-    if not user or not verify_password(password, user.password):
+    # bcrypt is deliberately slow; keep it off the event loop
+    if not user or not await run_in_threadpool(verify_password, password, user.password):
         # Return to login page with error message
         return templates.TemplateResponse(
             "auth/login.html",
@@ -135,7 +142,7 @@ async def login(
 async def api_login(
     response: Response,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     API endpoint for authentication (returns JSON token).
@@ -151,9 +158,10 @@ async def api_login(
         HTTPException: If credentials are invalid
     """
     # Find user by username
-    user = db.query(User).filter(User.username == form_data.username).first()
+    result = await db.execute(select(User).where(User.username == form_data.username))
+    user = result.scalars().first()
     
-    if not user or not verify_password(form_data.password, user.password):
+    if not user or not await run_in_threadpool(verify_password, form_data.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
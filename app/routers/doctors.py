@@ -1,17 +1,24 @@
 # Doctors router
-from fastapi import APIRouter, Depends, Request, Form, UploadFile, File
+import os
+from typing import List
+from fastapi import APIRouter, BackgroundTasks, Depends, Request, Form, UploadFile, File
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db, User
+from app.database import get_db, get_async_db, User
 from app.services import (
     require_role,
+    require_role_async,
     set_flash_message,
     create_patient,
     get_patient_doctors,
     cbc_prediction_service,
     blood_image_service,
 )
+from app.services.ai_service import compute_test_attributions
 from app.services.profile_service import (
     update_doctor_profile,
     change_user_password,
@@ -23,52 +30,56 @@ from app.services.medical_history_service import (
     update_diagnosis,
     delete_diagnosis
 )
+from app.services.row_index import DEFAULT_PAGE_SIZE, page_bounds
+from app.services.result_storage import RESULT_EXTENSIONS, count_result_rows, read_results, result_columns, export_csv
+from app.services.similarity_service import find_similar_cases
+from app.services.image_similarity_service import find_similar_images, index_test_image
+from app.services.preview_service import IMAGE_EXTENSIONS, generate_previews, register_filters
+from app.services import blob_store, tile_service
 
 router = APIRouter(prefix="/doctor", tags=["doctors"])
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 @router.get("/dashboard")
 async def doctor_dashboard(
     request: Request,
-    current_user: User = Depends(require_role(["doctor", "admin"])),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(require_role_async(["doctor", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     from app.database import doctor_patients, Test
-    from sqlalchemy import select
+    from sqlalchemy import func
     
-    # Get only linked patients count
-    patient_ids_query = select(doctor_patients.c.patient_id).where(
+    # Linked patients only
+    linked_patient_ids = select(doctor_patients.c.patient_id).where(
         doctor_patients.c.doctor_id == current_user.id
     )
-    patient_ids = [row[0] for row in db.execute(patient_ids_query).fetchall()]
-    total_patients = db.query(User).filter(
-        User.role == "patient", 
-        User.is_active == 1,
-        User.id.in_(patient_ids) if patient_ids else False
-    ).count()
-    
-    # Get recent linked patients only
-    recent_patients_query = db.query(User).filter(
-        User.role == "patient", 
+    active_linked_patients = select(User).where(
+        User.role == "patient",
         User.is_active == 1,
-        User.id.in_(patient_ids) if patient_ids else False
-    ).order_by(User.created_at.desc()).limit(5).all()
-    
-    # Get pending tests count for linked patients
-    pending_reports = db.query(Test).filter(
-        Test.patient_id.in_(patient_ids) if patient_ids else False,
-        Test.review_status == 'pending'
+        User.id.in_(linked_patient_ids)
     )
+    total_patients = await db.scalar(select(func.count()).select_from(active_linked_patients.subquery()))
     
-    # Get review requests for this doctor
-    review_requests = db.query(Test).filter(
-        Test.review_requested_from == current_user.id,
-        Test.review_status == 'pending'
-    ).order_by(Test.review_requested_at.desc()).limit(5).all()
+    # Get recent linked patients only
+    recent_patients_query = (await db.execute(
+        active_linked_patients.order_by(User.created_at.desc()).limit(5)
+    )).scalars().all()
+    
+    # Pending tests of linked patients
+    pending_filter = (Test.patient_id.in_(linked_patient_ids), Test.review_status == 'pending')
+    pending_count = await db.scalar(select(func.count(Test.id)).where(*pending_filter))
+    
+    # Get review requests for this doctor, with their patients
+    review_requests = (await db.execute(
+        select(Test, User).join(User, User.id == Test.patient_id).where(
+            Test.review_requested_from == current_user.id,
+            Test.review_status == 'pending'
+        ).order_by(Test.review_requested_at.desc()).limit(5)
+    )).all()
     
     review_requests_list = []
-    for test in review_requests:
-        patient = db.query(User).filter(User.id == test.patient_id).first()
+    for test, patient in review_requests:
         review_requests_list.append({
             "test_id": test.id,
             "patient_name": f"{patient.fname} {patient.lname}",
@@ -79,7 +90,7 @@ async def doctor_dashboard(
     
     stats = {
         "total_patients": total_patients,
-        "pending_reports": len(pending_reports.all()),
+        "pending_reports": pending_count,
         "completed_today": 0,
         "review_requests": len(review_requests_list)
     }
@@ -96,8 +107,9 @@ async def doctor_dashboard(
     ]
 
     # Recent tests the doctor is involved with (reviewed_by or review_requested_from)
-    from app.database import Test
-    recent_tests_query = db.query(Test).filter(Test.reviewed_by == current_user.id).order_by(Test.created_at.desc()).limit(5).all()
+    recent_tests_query = (await db.execute(
+        select(Test).where(Test.reviewed_by == current_user.id).order_by(Test.created_at.desc()).limit(5)
+    )).scalars().all()
     recent_tests = [
         {
             "id": test.id,
@@ -110,7 +122,9 @@ async def doctor_dashboard(
     ]
 
     # Pending reports involving the doctor
-    all_pending_reports = pending_reports.order_by(Test.created_at.desc()).limit(5).all()
+    all_pending_reports = (await db.execute(
+        select(Test).where(*pending_filter).order_by(Test.created_at.desc()).limit(5)
+    )).scalars().all()
     pending_reports = [
         {
             "id": test.id,
@@ -139,49 +153,43 @@ async def patients_list(
     blood_type: str = None,
     gender: str = None,
     my_patients: str = None,
-    current_user: User = Depends(require_role(["doctor", "admin"])),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(require_role_async(["doctor", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     from app.database import doctor_patients
-    from sqlalchemy import select
     
     # Build query for patients
-    query = db.query(User).filter(User.role == "patient")
+    query = select(User).where(User.role == "patient")
+    linked_patient_ids = select(doctor_patients.c.patient_id).where(
+        doctor_patients.c.doctor_id == current_user.id
+    )
     
     # Filter by doctor's patients only
     if my_patients == "true" and current_user.role == "doctor":
-        # Get patient IDs linked to this doctor
-        patient_ids_query = select(doctor_patients.c.patient_id).where(
-            doctor_patients.c.doctor_id == current_user.id
-        )
-        patient_ids = [row[0] for row in db.execute(patient_ids_query).fetchall()]
-        query = query.filter(User.id.in_(patient_ids))
+        query = query.where(User.id.in_(linked_patient_ids))
     
     # Apply filters
     if search:
         search_term = f"%{search}%"
-        query = query.filter(
+        query = query.where(
             (User.fname.ilike(search_term)) | 
             (User.lname.ilike(search_term)) | 
             (User.email.ilike(search_term))
         )
     
     if blood_type:
-        query = query.filter(User.blood_type == blood_type)
+        query = query.where(User.blood_type == blood_type)
     
     if gender:
-        query = query.filter(User.gender == gender)
+        query = query.where(User.gender == gender)
     
     # Get patients
-    patients = query.order_by(User.created_at.desc()).all()
+    patients = (await db.execute(query.order_by(User.created_at.desc()))).scalars().all()
     
     # Get patient IDs linked to current doctor (for displaying link status)
     doctor_patient_ids = []
     if current_user.role == "doctor":
-        patient_ids_query = select(doctor_patients.c.patient_id).where(
-            doctor_patients.c.doctor_id == current_user.id
-        )
-        doctor_patient_ids = [row[0] for row in db.execute(patient_ids_query).fetchall()]
+        doctor_patient_ids = (await db.execute(linked_patient_ids)).scalars().all()
     
     return templates.TemplateResponse("doctor/patients.html", {
         "request": request,
@@ -481,7 +489,7 @@ async def upload_cbc_csv(
     if access_error:
         return access_error
     
-    result = cbc_prediction_service.process_csv_upload(
+    result = await cbc_prediction_service.process_csv_upload(
         file=file,
         patient_id=patient_id,
         uploaded_by_id=current_user.id,
@@ -573,25 +581,80 @@ async def upload_image_page(
         "patient": patient,
         "base_layout": "layouts/base_doctor.html",
         "back_url": f"/doctor/upload-test/{patient_id}",
-        "form_action": f"/doctor/upload-blood-image/{patient_id}"
+        "form_action": f"/doctor/upload-blood-image/{patient_id}",
+        "batch_form_action": f"/doctor/upload-blood-images/{patient_id}"
     })
 
 @router.post("/upload-blood-image/{patient_id}")
 async def upload_blood_image(
     request: Request,
     patient_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     description: str = Form(None),
     current_user: User = Depends(require_role(["doctor", "admin"])),
     db: Session = Depends(get_db)
 ):
-    result = blood_image_service.process_image_upload(
+    patient = db.query(User).filter(User.id == patient_id, User.role == "patient").first()
+    if not patient:
+        response = RedirectResponse(url="/doctor/patients", status_code=303)
+        set_flash_message(response, "error", "Patient not found")
+        return response
+    
+    # Check patient access using policy service
+    from app.services.policy_service import require_patient_access
+    access_error = require_patient_access(request, current_user, patient, db)
+    if access_error:
+        return access_error
+    
+    result = await blood_image_service.process_image_upload(
         file=file,
         patient_id=patient_id,
         uploaded_by_id=current_user.id,
         description=description,
         db=db
     )
+    if result["success"]:
+        background_tasks.add_task(generate_previews, result["file_path"])
+        background_tasks.add_task(index_test_image, result["test_id"], result["file_path"], result["analysis"])
+    
+    response = RedirectResponse(url=f"/doctor/patient/{patient_id}", status_code=303)
+    set_flash_message(response, "success" if result["success"] else "error", result["message"])
+    return response
+
+@router.post("/upload-blood-images/{patient_id}")
+async def upload_blood_images(
+    request: Request,
+    patient_id: int,
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    description: str = Form(None),
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Upload a session of blood cell images at once, one test per image"""
+    patient = db.query(User).filter(User.id == patient_id, User.role == "patient").first()
+    if not patient:
+        response = RedirectResponse(url="/doctor/patients", status_code=303)
+        set_flash_message(response, "error", "Patient not found")
+        return response
+    
+    # Check patient access using policy service
+    from app.services.policy_service import require_patient_access
+    access_error = require_patient_access(request, current_user, patient, db)
+    if access_error:
+        return access_error
+    
+    result = await blood_image_service.process_image_batch(
+        files=files,
+        patient_id=patient_id,
+        uploaded_by_id=current_user.id,
+        description=description,
+        db=db
+    )
+    for test_id, file_path in zip(result.get("test_ids", []), result.get("file_paths", [])):
+        background_tasks.add_task(generate_previews, file_path)
+        background_tasks.add_task(index_test_image, test_id, file_path)
     
     response = RedirectResponse(url=f"/doctor/patient/{patient_id}", status_code=303)
     set_flash_message(response, "success" if result["success"] else "error", result["message"])
@@ -601,65 +664,111 @@ async def upload_blood_image(
 async def view_test(
     request: Request,
     test_id: int,
-    current_user: User = Depends(require_role(["doctor", "admin"])),
-    db: Session = Depends(get_db)
+    background_tasks: BackgroundTasks,
+    page: int = 1,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    current_user: User = Depends(require_role_async(["doctor", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """View test details for review"""
     from app.database import Test, TestFile, doctor_patients, Model
     from datetime import datetime
     
     # Get the test
-    test = db.query(Test).filter(Test.id == test_id).first()
+    test = await db.get(Test, test_id)
     if not test:
         response = RedirectResponse(url="/doctor/dashboard", status_code=303)
         set_flash_message(response, "error", "Test not found")
         return response
     
     # Get patient info
-    patient = db.query(User).filter(User.id == test.patient_id).first()
+    patient = await db.get(User, test.patient_id)
     
     # Check if doctor has access to this patient
     if current_user.role == "doctor":
-        is_linked = patient in current_user.patients
+        is_linked = await db.scalar(select(doctor_patients.c.patient_id).where(
+            doctor_patients.c.doctor_id == current_user.id,
+            doctor_patients.c.patient_id == test.patient_id
+        )) is not None
         if not is_linked:
             response = RedirectResponse(url="/doctor/dashboard", status_code=303)
             set_flash_message(response, "error", "You don't have access to this patient's tests")
             return response
     
     # Get test files
-    test_files = db.query(TestFile).filter(TestFile.test_id == test_id).all()
+    test_files = (await db.execute(select(TestFile).where(TestFile.test_id == test_id))).scalars().all()
     
-    # Load CSV data if exists
+    # Load CBC results if they exist
     csv_data = None
-    csv_file = None
+    result_file = None
+    pagination = None
     for file in test_files:
-        if file.extension == '.csv' and file.type == 'output':
-            csv_file = file
+        if file.extension in RESULT_EXTENSIONS and file.type == 'output':
+            result_file = file
+            # Attributions are computed once, after the test is first opened
             try:
-                import pandas as pd
-                from app.ai.cbc import build_report
-                df = pd.read_csv(file.path)
+                from app.ai.cbc.explain import ATTRIBUTION_SUFFIX
+                if (not any(c.endswith(ATTRIBUTION_SUFFIX) for c in await run_in_threadpool(result_columns, file.path))
+                        and cbc_prediction_service.claim_attributions(test_id)):
+                    background_tasks.add_task(compute_test_attributions, test_id)
+            except Exception as e:
+                print(f"Error reading result columns: {e}")
+            try:
+                from app.ai.cbc import (
+                    build_report, add_reference_flags, has_reference_flags,
+                    add_derived_indices, has_derived_indices, row_indices,
+                    display_column,
+                    row_attributions
+                )
+                # Only the requested page and the displayed columns are read, off the event loop
+                total_rows = await run_in_threadpool(count_result_rows, file.path)
+                page, page_size, total_pages, start, stop = page_bounds(page, page_size, total_rows)
+                df = await run_in_threadpool(read_results, file.path, columns=display_column, start=start, stop=stop)
+                pagination = {
+                    "page": page,
+                    "page_size": page_size,
+                    "total_pages": total_pages,
+                    "total_rows": total_rows,
+                    "start": start,
+                    "stop": stop
+                }
+                # Results stored before flagging/indices existed get them on read
+                if not has_reference_flags(df):
+                    df = add_reference_flags(df)
+                if not has_derived_indices(df):
+                    df = add_derived_indices(df)
                 csv_data = df.to_dict('records')
-                # Generate reports for each record
+                for row_index, record in zip(df.index, csv_data):
+                    record['row_index'] = int(row_index)
+                # Generate reports and collect derived indices and attributions for each record
                 for record in csv_data:
                     record['medical_report'] = build_report(record)
+                    record['derived_indices'] = row_indices(record)
+                    record['attributions'] = row_attributions(record)
             except Exception as e:
-                print(f"Error loading CSV: {e}")
+                print(f"Error loading results: {e}")
                 csv_data = None
             break
     
     # Get reviewer info if reviewed
     reviewer = None
     if test.reviewed_by:
-        reviewer = db.query(User).filter(User.id == test.reviewed_by).first()
+        reviewer = await db.get(User, test.reviewed_by)
     
     # Get model name for test type
     model_name = None
     if test.model_id:
-        model = db.query(Model).filter(Model.id == test.model_id).first()
+        model = await db.get(Model, test.model_id)
         if model:
             model_name = model.name
     
+    # Stored images are shown in the deep zoom viewer
+    zoomable_file_ids = {
+        file.id for file in test_files
+        if file.type == 'input' and (file.extension or '').lower() in IMAGE_EXTENSIONS
+        and blob_store.blob_sha256(file.path)
+    }
+    
     return templates.TemplateResponse("doctor/test_detail.html", {
         "request": request,
         "current_user": current_user,
@@ -667,11 +776,165 @@ async def view_test(
         "patient": patient,
         "test_files": test_files,
         "csv_data": csv_data,
-        "csv_file": csv_file,
+        "result_file": result_file,
+        "pagination": pagination,
         "reviewer": reviewer,
-        "model_name": model_name
+        "model_name": model_name,
+        "zoomable_file_ids": zoomable_file_ids
     })
 
+def _zoomable_test_file(db: Session, current_user: User, test_id: int, file_id: int):
+    """The stored image of a test the user may view, or a JSON error response"""
+    from app.database import Test, TestFile
+
+    test = db.query(Test).filter(Test.id == test_id).first()
+    file = db.query(TestFile).filter(TestFile.id == file_id, TestFile.test_id == test_id).first()
+    if not test or not file or (file.extension or '').lower() not in IMAGE_EXTENSIONS:
+        return JSONResponse({"success": False, "message": "Image not found"}, status_code=404)
+
+    if current_user.role == "doctor":
+        patient = db.query(User).filter(User.id == test.patient_id).first()
+        if patient not in current_user.patients:
+            return JSONResponse(
+                {"success": False, "message": "You don't have access to this patient's tests"},
+                status_code=403
+            )
+    return file
+
+async def _test_image_pyramid(db: Session, current_user: User, test_id: int, file_id: int):
+    """The tile pyramid of a test image (built on its first view), or a JSON error response"""
+    file = _zoomable_test_file(db, current_user, test_id, file_id)
+    if isinstance(file, JSONResponse):
+        return file
+    try:
+        pyramid = await tile_service.build_pyramid(file.path)
+    except (ValueError, FileNotFoundError):
+        pyramid = None
+    if pyramid is None:
+        return JSONResponse({"success": False, "message": "Image cannot be zoomed"}, status_code=404)
+    return pyramid
+
+@router.get("/test/{test_id}/files/{file_id}/image.dzi")
+async def test_image_descriptor(
+    test_id: int,
+    file_id: int,
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Deep Zoom descriptor of a test image"""
+    pyramid = await _test_image_pyramid(db, current_user, test_id, file_id)
+    if isinstance(pyramid, JSONResponse):
+        return pyramid
+    return FileResponse(
+        pyramid / "image.dzi",
+        media_type="application/xml",
+        headers={"Cache-Control": tile_service.TILE_CACHE_CONTROL}
+    )
+
+@router.get("/test/{test_id}/files/{file_id}/image_files/{level}/{col}_{row}.jpg")
+async def test_image_tile(
+    test_id: int,
+    file_id: int,
+    level: int,
+    col: int,
+    row: int,
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """One 256px tile of a test image; immutable, so browsers cache it for a year"""
+    pyramid = await _test_image_pyramid(db, current_user, test_id, file_id)
+    if isinstance(pyramid, JSONResponse):
+        return pyramid
+    path = tile_service.tile_path(pyramid, level, col, row)
+    if path is None:
+        return JSONResponse({"success": False, "message": "Tile not found"}, status_code=404)
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": tile_service.TILE_CACHE_CONTROL})
+
+@router.get("/test/{test_id}/similar")
+async def similar_cases(
+    test_id: int,
+    row: int = 0,
+    k: int = 5,
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Reviewed CBC cases of accessible patients closest to one row of a test"""
+    from app.database import Test
+
+    test = db.query(Test).filter(Test.id == test_id).first()
+    if not test:
+        return JSONResponse({"success": False, "message": "Test not found"}, status_code=404)
+
+    if current_user.role == "doctor":
+        patient = db.query(User).filter(User.id == test.patient_id).first()
+        if patient not in current_user.patients:
+            return JSONResponse(
+                {"success": False, "message": "You don't have access to this patient's tests"},
+                status_code=403
+            )
+
+    if row < 0 or k < 1:
+        return JSONResponse({"success": False, "message": "row must be >= 0 and k >= 1"}, status_code=422)
+
+    result = await run_in_threadpool(find_similar_cases, db, current_user, test_id, row, k)
+    return JSONResponse(result, status_code=200 if result["success"] else 404)
+
+@router.get("/test/{test_id}/similar-images")
+async def similar_images(
+    test_id: int,
+    k: int = 5,
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Image tests of accessible patients that look most like the image of a test"""
+    if k < 1:
+        return JSONResponse({"success": False, "message": "k must be >= 1"}, status_code=422)
+
+    result = await run_in_threadpool(find_similar_images, db, current_user, test_id, k)
+    if result["success"]:
+        return JSONResponse(result)
+    status_code = 404 if result["reason"] in ("not_found", "not_indexed") else 403
+    return JSONResponse({"success": False, "message": result["message"]}, status_code=status_code)
+
+@router.get("/test/{test_id}/download")
+async def download_test_results(
+    test_id: int,
+    current_user: User = Depends(require_role(["doctor", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Download the CBC results of a test as CSV (converted from the stored format on the fly)"""
+    from app.database import Test, TestFile
+    
+    test = db.query(Test).filter(Test.id == test_id).first()
+    if not test:
+        response = RedirectResponse(url="/doctor/dashboard", status_code=303)
+        set_flash_message(response, "error", "Test not found")
+        return response
+    
+    if current_user.role == "doctor":
+        patient = db.query(User).filter(User.id == test.patient_id).first()
+        if patient not in current_user.patients:
+            response = RedirectResponse(url="/doctor/dashboard", status_code=303)
+            set_flash_message(response, "error", "You don't have access to this patient's tests")
+            return response
+    
+    result_file = db.query(TestFile).filter(
+        TestFile.test_id == test_id,
+        TestFile.type == 'output',
+        TestFile.extension.in_(RESULT_EXTENSIONS)
+    ).first()
+    if not result_file or not os.path.exists(result_file.path):
+        response = RedirectResponse(url=f"/doctor/test/{test_id}", status_code=303)
+        set_flash_message(response, "error", "No results file found for this test")
+        return response
+    
+    filename = f"{os.path.splitext(result_file.name)[0]}.csv"
+    return StreamingResponse(
+        export_csv(result_file.path),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @router.post("/test/{test_id}/review")
 async def review_test(
     request: Request,
@@ -807,6 +1070,7 @@ async def change_password(
 @router.post("/upload-profile-image")
 async def upload_profile_image(
     request: Request,
+    background_tasks: BackgroundTasks,
     profile_image: UploadFile = File(...),
     current_user: User = Depends(require_role(["doctor", "admin"])),
     db: Session = Depends(get_db)
@@ -816,6 +1080,8 @@ async def upload_profile_image(
         db=db,
         profile_image=profile_image
     )
+    if success:
+        background_tasks.add_task(generate_previews, current_user.profile_image)
     
     response = RedirectResponse(url="/doctor/account", status_code=303)
     set_flash_message(response, "success" if success else "error", message)
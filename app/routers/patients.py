@@ -1,11 +1,15 @@
 # Patients router
-from fastapi import APIRouter, Depends, Request, Form, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Depends, Request, Form, UploadFile, File
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db, User
+from app.database import get_db, get_async_db, User
 from app.services import (
     require_role,
+    require_role_async,
     set_flash_message,
     get_patient_doctors,
     cbc_prediction_service,
@@ -17,29 +21,36 @@ from app.services.profile_service import (
     upload_user_profile_image
 )
 from app.services.medical_history_service import get_patient_medical_history
+from app.services.row_index import DEFAULT_PAGE_SIZE, page_bounds
+from app.services.result_storage import RESULT_EXTENSIONS, count_result_rows, read_results, export_csv
+from app.services.preview_service import generate_previews, register_filters
+from app.services.image_similarity_service import index_test_image
 import os
+from typing import List
 import uuid
 from pathlib import Path
 
 router = APIRouter(prefix="/patient", tags=["patients"])
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 @router.get("/dashboard")
 async def patient_dashboard(
     request: Request,
-    current_user: User = Depends(require_role(["patient", "admin"])),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(require_role_async(["patient", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     from app.database import Test
+    from sqlalchemy import func
     
     # Get all medical history and limit to 3 most recent for dashboard
-    all_medical_history = get_patient_medical_history(current_user.id, db)
+    all_medical_history = await db.run_sync(lambda session: get_patient_medical_history(current_user.id, session))
     recent_medical_history = all_medical_history[:3] if all_medical_history else []
     
     # Get recent tests
-    recent_tests_query = db.query(Test).filter(
-        Test.patient_id == current_user.id
-    ).order_by(Test.created_at.desc()).limit(5).all()
+    recent_tests_query = (await db.execute(
+        select(Test).where(Test.patient_id == current_user.id).order_by(Test.created_at.desc()).limit(5)
+    )).scalars().all()
     
     recent_tests = [
         {
@@ -52,11 +63,11 @@ async def patient_dashboard(
     ]
     
     # Get total tests count
-    total_tests = db.query(Test).filter(Test.patient_id == current_user.id).count()
-    pending_results = db.query(Test).filter(
+    total_tests = await db.scalar(select(func.count(Test.id)).where(Test.patient_id == current_user.id))
+    pending_results = await db.scalar(select(func.count(Test.id)).where(
         Test.patient_id == current_user.id,
         Test.review_status == 'pending'
-    ).count()
+    ))
     
     stats = {
         "total_tests": total_tests,
@@ -93,20 +104,26 @@ async def patient_medical_history(
 @router.get("/tests")
 async def patient_tests(
     request: Request,
-    current_user: User = Depends(require_role(["patient", "admin"])),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(require_role_async(["patient", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Patient's tests page"""
     from app.database import Test
     
     # Get all tests for the patient
-    tests = db.query(Test).filter(
-        Test.patient_id == current_user.id
-    ).order_by(Test.created_at.desc()).all()
+    tests = (await db.execute(
+        select(Test).where(Test.patient_id == current_user.id).order_by(Test.created_at.desc())
+    )).scalars().all()
+    
+    # Reviewers of all tests in one query
+    reviewer_ids = {test.reviewed_by for test in tests if test.reviewed_by}
+    reviewers = {
+        user.id: user for user in (await db.execute(select(User).where(User.id.in_(reviewer_ids)))).scalars()
+    } if reviewer_ids else {}
     
     test_reports = []
     for test in tests:
-        reviewer = db.query(User).filter(User.id == test.reviewed_by).first() if test.reviewed_by else None
+        reviewer = reviewers.get(test.reviewed_by)
         test_reports.append({
             "id": test.id,
             "result": test.result or "Pending",
@@ -180,7 +197,7 @@ async def upload_cbc_csv(
     if not check_account_active(current_user):
         return handle_policy_violation(request, current_user, "deactivated")
     
-    result = cbc_prediction_service.process_csv_upload(
+    result = await cbc_prediction_service.process_csv_upload(
         file=file,
         patient_id=current_user.id,
         uploaded_by_id=current_user.id,
@@ -253,12 +270,14 @@ async def upload_image_page(
         "current_user": current_user,
         "base_layout": "layouts/base_patient.html",
         "back_url": "/patient/upload-test",
-        "form_action": "/patient/upload-blood-image"
+        "form_action": "/patient/upload-blood-image",
+        "batch_form_action": "/patient/upload-blood-images"
     })
 
 @router.post("/upload-blood-image")
 async def upload_blood_image(
     request: Request,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     description: str = Form(None),
     current_user: User = Depends(require_role(["patient", "admin"])),
@@ -269,13 +288,46 @@ async def upload_blood_image(
     # Check if account is active
     if not check_account_active(current_user):
         return handle_policy_violation(request, current_user, "deactivated")
-    result = blood_image_service.process_image_upload(
+    result = await blood_image_service.process_image_upload(
         file=file,
         patient_id=current_user.id,
         uploaded_by_id=current_user.id,
         description=description,
         db=db
     )
+    if result["success"]:
+        background_tasks.add_task(generate_previews, result["file_path"])
+        background_tasks.add_task(index_test_image, result["test_id"], result["file_path"], result["analysis"])
+    
+    response = RedirectResponse(url="/patient/dashboard", status_code=303)
+    set_flash_message(response, "success" if result["success"] else "error", result["message"])
+    return response
+
+@router.post("/upload-blood-images")
+async def upload_blood_images(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    description: str = Form(None),
+    current_user: User = Depends(require_role(["patient", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Upload a session of blood cell images at once, one test per image"""
+    from app.services.policy_service import check_account_active, handle_policy_violation
+    
+    # Check if account is active
+    if not check_account_active(current_user):
+        return handle_policy_violation(request, current_user, "deactivated")
+    result = await blood_image_service.process_image_batch(
+        files=files,
+        patient_id=current_user.id,
+        uploaded_by_id=current_user.id,
+        description=description,
+        db=db
+    )
+    for test_id, file_path in zip(result.get("test_ids", []), result.get("file_paths", [])):
+        background_tasks.add_task(generate_previews, file_path)
+        background_tasks.add_task(index_test_image, test_id, file_path)
     
     response = RedirectResponse(url="/patient/dashboard", status_code=303)
     set_flash_message(response, "success" if result["success"] else "error", result["message"])
@@ -285,14 +337,16 @@ async def upload_blood_image(
 async def view_test(
     request: Request,
     test_id: int,
-    current_user: User = Depends(require_role(["patient", "admin"])),
-    db: Session = Depends(get_db)
+    page: int = 1,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    current_user: User = Depends(require_role_async(["patient", "admin"])),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """View test details"""
     from app.database import Test, TestFile, Model
     
     # Get the test
-    test = db.query(Test).filter(Test.id == test_id).first()
+    test = await db.get(Test, test_id)
     if not test:
         response = RedirectResponse(url="/patient/dashboard", status_code=303)
         set_flash_message(response, "error", "Test not found")
@@ -305,44 +359,70 @@ async def view_test(
         return response
     
     # Get test files
-    test_files = db.query(TestFile).filter(TestFile.test_id == test_id).all()
+    test_files = (await db.execute(select(TestFile).where(TestFile.test_id == test_id))).scalars().all()
     
-    # Load CSV data if exists
+    # Load CBC results if they exist
     csv_data = None
-    csv_file = None
+    result_file = None
+    pagination = None
     for file in test_files:
-        if file.extension == '.csv' and file.type == 'output':
-            csv_file = file
+        if file.extension in RESULT_EXTENSIONS and file.type == 'output':
+            result_file = file
             try:
-                import pandas as pd
-                from app.ai.cbc import build_report
-                df = pd.read_csv(file.path)
+                from app.ai.cbc import (
+                    build_report, add_reference_flags, has_reference_flags,
+                    add_derived_indices, has_derived_indices, row_indices,
+                    display_column
+                )
+                # Only the requested page and the displayed columns are read, off the event loop
+                total_rows = await run_in_threadpool(count_result_rows, file.path)
+                page, page_size, total_pages, start, stop = page_bounds(page, page_size, total_rows)
+                df = await run_in_threadpool(
+                    read_results, file.path,
+                    columns=lambda c: display_column(c, with_attributions=False), start=start, stop=stop
+                )
+                pagination = {
+                    "page": page,
+                    "page_size": page_size,
+                    "total_pages": total_pages,
+                    "total_rows": total_rows,
+                    "start": start,
+                    "stop": stop
+                }
+                # Results stored before flagging/indices existed get them on read
+                if not has_reference_flags(df):
+                    df = add_reference_flags(df)
+                if not has_derived_indices(df):
+                    df = add_derived_indices(df)
                 csv_data = df.to_dict('records')
-                # Generate reports for each record
+                for row_index, record in zip(df.index, csv_data):
+                    record['row_index'] = int(row_index)
+                # Generate reports and collect derived indices for each record
                 for record in csv_data:
                     record['medical_report'] = build_report(record)
+                    record['derived_indices'] = row_indices(record)
             except Exception as e:
-                print(f"Error loading CSV: {e}")
+                print(f"Error loading results: {e}")
                 csv_data = None
             break
     
     # Get reviewer info if reviewed
     reviewer = None
     if test.reviewed_by:
-        reviewer = db.query(User).filter(User.id == test.reviewed_by).first()
+        reviewer = await db.get(User, test.reviewed_by)
     
     # Get review requested doctor if exists
     review_requested_doctor = None
     if test.review_requested_from:
-        review_requested_doctor = db.query(User).filter(User.id == test.review_requested_from).first()
+        review_requested_doctor = await db.get(User, test.review_requested_from)
     
     # Get connected doctors for patient
-    connected_doctors = get_patient_doctors(current_user.id, db)
+    connected_doctors = await db.run_sync(lambda session: get_patient_doctors(current_user.id, session))
     
     # Get model name for test type
     model_name = None
     if test.model_id:
-        model = db.query(Model).filter(Model.id == test.model_id).first()
+        model = await db.get(Model, test.model_id)
         if model:
             model_name = model.name
     
@@ -352,13 +432,51 @@ async def view_test(
         "test": test,
         "test_files": test_files,
         "csv_data": csv_data,
-        "csv_file": csv_file,
+        "result_file": result_file,
+        "pagination": pagination,
         "reviewer": reviewer,
         "review_requested_doctor": review_requested_doctor,
         "connected_doctors": connected_doctors,
         "model_name": model_name
     })
 
+@router.get("/test/{test_id}/download")
+async def download_test_results(
+    test_id: int,
+    current_user: User = Depends(require_role(["patient", "admin"])),
+    db: Session = Depends(get_db)
+):
+    """Download the CBC results of a test as CSV (converted from the stored format on the fly)"""
+    from app.database import Test, TestFile
+    
+    test = db.query(Test).filter(Test.id == test_id).first()
+    if not test:
+        response = RedirectResponse(url="/patient/dashboard", status_code=303)
+        set_flash_message(response, "error", "Test not found")
+        return response
+    
+    if current_user.role != "admin" and test.patient_id != current_user.id:
+        response = RedirectResponse(url="/patient/dashboard", status_code=303)
+        set_flash_message(response, "error", "You don't have access to this test")
+        return response
+    
+    result_file = db.query(TestFile).filter(
+        TestFile.test_id == test_id,
+        TestFile.type == 'output',
+        TestFile.extension.in_(RESULT_EXTENSIONS)
+    ).first()
+    if not result_file or not os.path.exists(result_file.path):
+        response = RedirectResponse(url=f"/patient/test/{test_id}", status_code=303)
+        set_flash_message(response, "error", "No results file found for this test")
+        return response
+    
+    filename = f"{os.path.splitext(result_file.name)[0]}.csv"
+    return StreamingResponse(
+        export_csv(result_file.path),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @router.post("/test/{test_id}/request-review")
 async def request_test_review(
     request: Request,
@@ -513,6 +631,7 @@ async def change_password(
 @router.post("/upload-profile-image")
 async def upload_profile_image(
     request: Request,
+    background_tasks: BackgroundTasks,
     profile_image: UploadFile = File(...),
     current_user: User = Depends(require_role(["patient", "admin"])),
     db: Session = Depends(get_db)
@@ -522,6 +641,8 @@ async def upload_profile_image(
         db=db,
         profile_image=profile_image
     )
+    if success:
+        background_tasks.add_task(generate_previews, current_user.profile_image)
     
     response = RedirectResponse(url="/patient/account", status_code=303)
     set_flash_message(response, "success" if success else "error", message)
@@ -2,30 +2,34 @@
 from fastapi import APIRouter, Request, Depends, Form
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.database import get_db, get_async_db
 from app.services import get_current_user_optional
 from app.models.schemas import MessageCreate
 from app.services.message_service import create_message
+from app.services.preview_service import register_filters
 
 router = APIRouter(tags=["public"])
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 
 @router.get("/")
-async def home(request: Request, db: Session = Depends(get_db)):
+async def home(request: Request, db: AsyncSession = Depends(get_async_db)):
     current_user = await get_current_user_optional(request, db)
     return templates.TemplateResponse("public/home.html", {"request": request, "current_user": current_user})
 
 
 @router.get("/about")
-async def about(request: Request, db: Session = Depends(get_db)):
+async def about(request: Request, db: AsyncSession = Depends(get_async_db)):
     current_user = await get_current_user_optional(request, db)
     return templates.TemplateResponse("public/about.html", {"request": request, "current_user": current_user})
 
 
 @router.get("/contact")
-async def contact(request: Request, success: int = 0, error: int = 0, subject: str = "", db: Session = Depends(get_db)):
+async def contact(request: Request, success: int = 0, error: int = 0, subject: str = "", db: AsyncSession = Depends(get_async_db)):
     current_user = await get_current_user_optional(request, db)
     flash_message = None
     if success:
@@ -64,7 +68,7 @@ async def contact_post(
 
 
 @router.get("/account-deactivated")
-async def account_deactivated(request: Request, db: Session = Depends(get_db)):
+async def account_deactivated(request: Request, db: AsyncSession = Depends(get_async_db)):
     current_user = await get_current_user_optional(request, db)
     
     # Get deactivation info based on current user
@@ -83,7 +87,7 @@ async def account_deactivated(request: Request, db: Session = Depends(get_db)):
 @router.get("/models")
 async def public_models(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     from app.database import Model
     from sqlalchemy import func
@@ -91,12 +95,13 @@ async def public_models(
     current_user = await get_current_user_optional(request, db)
     
     # Fetch actual models from database
-    models = db.query(Model).all()
+    models = (await db.execute(select(Model))).scalars().all()
     
     # Calculate aggregate statistics
     total_models = len(models)
-    avg_accuracy = db.query(func.avg(Model.accuracy)).scalar() or 0
-    total_tests = db.query(func.sum(Model.tests_count)).scalar() or 0
+    avg_accuracy, total_tests = (await db.execute(select(func.avg(Model.accuracy), func.sum(Model.tests_count)))).one()
+    avg_accuracy = avg_accuracy or 0
+    total_tests = total_tests or 0
     
     return templates.TemplateResponse("public/models.html", {
         "request": request,
@@ -17,8 +17,12 @@ from .auth_service import (
     verify_token,
     get_current_user,
     get_current_user_from_cookie,
+    get_current_user_from_cookie_async,
     get_current_user_optional,
+    get_current_user_from_request,
     require_role,
+    require_role_async,
+    require_api_role,
     require_authentication,
     SECRET_KEY,
     ALGORITHM,
@@ -71,8 +75,12 @@ __all__ = [
     "verify_token",
     "get_current_user",
     "get_current_user_from_cookie",
+    "get_current_user_from_cookie_async",
     "get_current_user_optional",
+    "get_current_user_from_request",
     "require_role",
+    "require_role_async",
+    "require_api_role",
     "require_authentication",
     "SECRET_KEY",
     "ALGORITHM",
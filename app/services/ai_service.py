@@ -3,24 +3,51 @@ AI Prediction Service
 Handles CBC anemia predictions and blood cell image analysis
 """
 import pandas as pd
-import io
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any
 import numpy as np
-import cv2
+import asyncio
+import json
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 import os
+import time
 import uuid
+import tempfile
 from datetime import datetime
 from pathlib import Path
 
+from app.ai.blood_cell import ANALYSIS_VERSION, ImageTooLargeError, ingest, slide
+from app.services import blob_store
+from app.services.upload_service import StoredUpload, UploadTooLargeError, format_size, save_upload
+from app.services.result_storage import RESULT_EXTENSIONS, read_results, result_extension, write_results
+
 # Try to import AI modules, gracefully handle if not available
 try:
     from app.ai.cbc import (
         load_model_and_assets,
+        model_version,
         prepare_dataframe_for_inference,
         build_report,
-        predict_and_annotate_dataframe
+        DUPLICATE_ROWS,
+        predict_unique,
+        predict_and_annotate_dataframe,
+        add_reference_flags,
+        row_flags,
+        add_derived_indices,
+        row_indices,
+        add_attributions,
+        has_attributions,
+        row_attributions,
+        FeatureDriftMonitor,
+        load_reference,
+        FeatureStore
     )
     CBC_AI_AVAILABLE = True
 except ImportError as e:
@@ -30,6 +57,35 @@ except ImportError as e:
 
 # ==================== CBC Anemia Prediction ====================
 
+# Column tracking each record's position in the caller's input list
+INPUT_ROW = '_input_row'
+
+# Seconds a drift report is reused before the statistics are compared again
+DRIFT_REPORT_INTERVAL = int(os.getenv("DRIFT_REPORT_INTERVAL", "60"))
+
+# Directory of the append-only feature store written during inference
+# (kept outside uploads/, which is served without authentication)
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR", "data/feature_store/cbc")
+
+# Session.info key of the feature rows waiting for their test to be committed
+PENDING_FEATURES = 'pending_feature_rows'
+
+
+def _append_pending_features(session):
+    """after_commit: the tests exist now, so their rows can be stored"""
+    for store, test_id, X in session.info.pop(PENDING_FEATURES, []):
+        try:
+            store.append(test_id, X)
+        except Exception as e:
+            print(f"⚠️ Could not append to feature store: {e}")
+
+
+def _discard_pending_features(session, transaction):
+    """after_transaction_end: rows of a rolled back transaction never reach the store"""
+    if transaction.parent is None:
+        session.info.pop(PENDING_FEATURES, None)
+
+
 class CBCPredictionService:
     """Service for CBC Anemia predictions"""
     
@@ -37,8 +93,17 @@ class CBCPredictionService:
         self.model = None
         self.scaler = None
         self.used_features = None
+        self.model_version = None
         self._loaded = False
         self._available = CBC_AI_AVAILABLE
+        self.drift_monitor = None
+        self._drift_report = None
+        self._drift_report_at = 0.0
+        self._feature_store = None
+        # Per-test locks of attribution passes, and tests with one queued
+        self._attribution_locks: Dict[int, threading.Lock] = {}
+        self._attributions_queued = set()
+        self._attribution_guard = threading.Lock()
     
     def is_available(self) -> bool:
         """Check if AI prediction is available"""
@@ -51,59 +116,178 @@ class CBCPredictionService:
         
         if not self._loaded:
             self.model, self.scaler, self.used_features = load_model_and_assets()
+            self.model_version = model_version()
+            try:
+                self.drift_monitor = FeatureDriftMonitor(self.used_features, load_reference())
+            except FileNotFoundError:
+                print("⚠️ CBC drift reference not found; input drift is not monitored")
             self._loaded = True
             print("✅ CBC Anemia model loaded successfully")
     
-    def predict_single(self, cbc_data: Dict, with_report: bool = False) -> Dict:
+    def observe_features(self, df: pd.DataFrame):
+        """Fold the model inputs of a scored batch into the drift statistics"""
+        if self.drift_monitor is not None:
+            self.drift_monitor.update(df[self.used_features].to_numpy(dtype=np.float64))
+    
+    def drift_report(self, max_age: Optional[float] = None) -> Optional[Dict]:
+        """
+        Compare recent inputs against the training distribution saved with the model.
+        
+        The comparison is recomputed at most every max_age seconds (default
+        DRIFT_REPORT_INTERVAL); None is returned until the model has been loaded,
+        or if no drift reference was saved with it.
+        """
+        if self.drift_monitor is None:
+            return None
+        if max_age is None:
+            max_age = DRIFT_REPORT_INTERVAL
+        now = time.time()
+        if self._drift_report is None or now - self._drift_report_at >= max_age:
+            self._drift_report = self.drift_monitor.report()
+            self._drift_report_at = now
+        return self._drift_report
+    
+    def get_feature_store(self):
+        """The feature store for the loaded model's features (opened on first use)"""
         if not self._loaded:
             self.load_model()
+        if self._feature_store is None:
+            self._feature_store = FeatureStore(FEATURE_STORE_DIR, self.used_features)
+        return self._feature_store
+    
+    def store_features(self, db: Session, test_id: int, df: pd.DataFrame) -> int:
+        """
+        Append a test's model inputs to the feature store once db commits.
+        
+        The store is append-only, so rows of a test that is rolled back would
+        stay and be attributed to whichever test reuses its ID. Storage
+        problems are reported but never fail the inference request.
+        
+        Returns:
+            Number of rows queued
+        """
+        try:
+            store = self.get_feature_store()
+            X = df[self.used_features].to_numpy()
+        except Exception as e:
+            print(f"⚠️ Could not append to feature store: {e}")
+            return 0
+        if not event.contains(db, 'after_commit', _append_pending_features):
+            event.listen(db, 'after_commit', _append_pending_features)
+            event.listen(db, 'after_transaction_end', _discard_pending_features)
+        db.info.setdefault(PENDING_FEATURES, []).append((store, test_id, X))
+        return len(X)
+    
+    def backfill_feature_store(self, db: Session) -> Dict[str, int]:
+        """
+        Copy the inputs of stored CBC tests that are not in the feature store yet.
+        
+        Returns:
+            Dict with tests_added and rows_added
+        """
+        from app.database import TestFile
+        
+        store = self.get_feature_store()
+        present = set(store.test_ids().tolist())
+        counts = {"tests_added": 0, "rows_added": 0}
         
-        df = pd.DataFrame([cbc_data])
-        df = prepare_dataframe_for_inference(df, self.used_features, self.scaler)
+        output_files = db.query(TestFile).filter(
+            TestFile.type == 'output',
+            TestFile.extension.in_(RESULT_EXTENSIONS)
+        ).order_by(TestFile.test_id).all()
         
-        prediction = self.model.predict(df)[0]
-        probabilities = self.model.predict_proba(df)[0]
-        confidence = float(max(probabilities))
+        for output_file in output_files:
+            if output_file.test_id in present or not os.path.exists(output_file.path):
+                continue
+            df = read_results(output_file.path, columns=self.used_features)
+            if any(c not in df.columns for c in self.used_features):
+                continue
+            counts["rows_added"] += store.append(output_file.test_id, df[self.used_features].to_numpy())
+            counts["tests_added"] += 1
+            present.add(output_file.test_id)
+        
+        return counts
+    
+    def predict_single(self, cbc_data: Dict, with_report: bool = False) -> Dict:
+        """Predict anemia for a single CBC sample"""
+        df_prepared, predictions, probabilities = self.score_records([cbc_data])
+        
+        prediction = int(predictions[0])
+        probs = probabilities[0]
+        confidence = float(max(probs))
         confidence_percentage = confidence * 100  # Convert to percentage
         
+        row_data = df_prepared.iloc[0].copy()
+        row_data['Predicted_Anemia'] = prediction
+        
         result = {
-            "prediction": int(prediction),
+            "prediction": prediction,
             "prediction_label": "Anemia" if prediction == 1 else "Normal",
             "confidence": f"{confidence_percentage:.2f}%",
             "confidence_raw": confidence,
             "probabilities": {
-                "normal": float(probabilities[0]),
-                "anemia": float(probabilities[1])
-            }
+                "normal": float(probs[0]),
+                "anemia": float(probs[1])
+            },
+            "flags": row_flags(row_data),
+            "indices": row_indices(row_data)
         }
         
         if with_report:
-            result["report"] = build_report(cbc_data, prediction, confidence)
+            result["report"] = build_report(row_data)
         
         return result
     
-    def predict_batch(self, cbc_data_list: List[Dict], with_report: bool = False) -> List[Dict]:
-        """Predict anemia for multiple CBC samples"""
+    def score_records(self, cbc_data_list: List[Dict]):
+        """
+        Run the model over a list of CBC records in one vectorized pass.
+        
+        Rows with missing required features are dropped; the position of each
+        kept row in the input list is stored in the INPUT_ROW column.
+        Identical feature rows are scored once; their count is left in
+        ``df_prepared.attrs[DUPLICATE_ROWS]``.
+        
+        Args:
+            cbc_data_list: CBC records (any column names known to ALIASES)
+            
+        Returns:
+            Tuple of (prepared DataFrame, predictions array, probabilities array)
+            
+        Raises:
+            ValueError: If required columns are missing or no row is valid
+        """
         if not self._loaded:
             self.load_model()
         
         df = pd.DataFrame(cbc_data_list)
+        df[INPUT_ROW] = np.arange(len(df))
         df_prepared = prepare_dataframe_for_inference(df, self.used_features)
+        df_prepared = add_reference_flags(df_prepared)
+        df_prepared = add_derived_indices(df_prepared)
         
         # Extract features and scale
         X = df_prepared[self.used_features].values
-        X_scaled = self.scaler.transform(X)
         
-        # Make predictions
-        predictions = self.model.predict(X_scaled)
-        probabilities = self.model.predict_proba(X_scaled)
+        # Make predictions, once per distinct feature row
+        predictions, probabilities, duplicates = predict_unique(self.model, self.scaler, X)
+        df_prepared.attrs[DUPLICATE_ROWS] = duplicates
+        if self.drift_monitor is not None:
+            self.drift_monitor.update(X)
         
-        results = []
-        for i, (pred, probs) in enumerate(zip(predictions, probabilities)):
-            row_data = df_prepared.iloc[i]
+        return df_prepared, predictions, probabilities
+    
+    def iter_batch_results(
+        self,
+        df_prepared: pd.DataFrame,
+        predictions,
+        probabilities,
+        with_report: bool = False
+    ) -> Iterator[Dict]:
+        """Build result dicts one at a time from the output of score_records"""
+        for row_data, pred, probs in zip(df_prepared.to_dict('records'), predictions, probabilities):
             confidence_percentage = float(probs[1]) * 100  # Convert to percentage
             result = {
-                "row_index": i,
+                "row_index": int(row_data[INPUT_ROW]),
                 "prediction": "Anemia" if int(pred) == 1 else "Normal",
                 "prediction_code": int(pred),
                 "probability": f"{confidence_percentage:.2f}%",
@@ -122,21 +306,201 @@ class CBCPredictionService:
                     "MCHC": float(row_data.get('MCHC', 0)),
                     "TLC": float(row_data.get('TLC', 0)),
                     "PLT": float(row_data.get('PLT', 0)),
-                }
+                },
+                "flags": row_flags(row_data),
+                "indices": row_indices(row_data)
             }
             
             if with_report:
-                # Create a copy to avoid SettingWithCopyWarning
-                row_data_copy = row_data.copy()
-                row_data_copy['Predicted_Anemia'] = pred
-                row_data_copy['Anemia_Probability'] = probs[1]
-                result["report"] = build_report(row_data_copy)
+                row_data['Predicted_Anemia'] = pred
+                row_data['Anemia_Probability'] = probs[1]
+                result["report"] = build_report(row_data)
             
-            results.append(result)
-        
-        return results
+            yield result
+    
+    def predict_batch(self, cbc_data_list: List[Dict], with_report: bool = False) -> List[Dict]:
+        """Predict anemia for multiple CBC samples"""
+        df_prepared, predictions, probabilities = self.score_records(cbc_data_list)
+        return list(self.iter_batch_results(df_prepared, predictions, probabilities, with_report))
     
-    def process_csv_upload(
+    def save_annotated_test(
+        self,
+        db: Session,
+        cbc_model,
+        patient_id: int,
+        df_annotated: pd.DataFrame,
+        notes: str,
+        filename_prefix: str = "cbc"
+    ):
+        """
+        Create a CBC Test with its annotated output file and count it on the model.
+        
+        The model inputs are also appended to the feature store when the
+        caller commits. The caller owns the transaction: nothing is
+        committed here.
+        
+        Args:
+            db: Database session
+            cbc_model: The CBC Model row
+            patient_id: Patient the test belongs to
+            df_annotated: Annotated dataframe to store
+            notes: Test notes
+            filename_prefix: Prefix of the stored output filename
+            
+        Returns:
+            The new Test (flushed, so its ID is set)
+        """
+        from app.database import Test, TestFile
+        
+        new_test = Test(
+            patient_id=patient_id,
+            model_id=cbc_model.id,
+            notes=notes,
+            review_status='pending'
+        )
+        db.add(new_test)
+        db.flush()  # Get the test ID
+        
+        # Generate unique filename with datetime
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        random_id = uuid.uuid4().hex[:8]
+        extension = result_extension()
+        filename = f"{filename_prefix}_{timestamp}_{random_id}{extension}"
+        
+        # Save annotated results in the configured storage format
+        tmp_path = blob_store.temp_path(extension)
+        write_results(df_annotated, tmp_path)
+        file_path = blob_store.store_file(db, tmp_path, extension)
+        
+        # Keep the feature vectors in the memory-mappable store as well (on commit)
+        self.store_features(db, new_test.id, df_annotated)
+        
+        # Create test_files record for the output file
+        db.add(TestFile(
+            test_id=new_test.id,
+            name=filename,
+            extension=extension,
+            path=file_path,
+            type='output'
+        ))
+        
+        # Update model test count
+        cbc_model.tests_count += 1
+
+        return new_test
+
+    def get_test_attributions(self, db: Session, test_id: int) -> Optional[List[Dict]]:
+        """
+        Return per-row feature attributions for a CBC test, computing them on first use.
+
+        The first request explains all rows of the test's output file in one
+        batched model pass and writes the attribution columns back into that
+        file; later requests only read it.
+
+        Args:
+            db: Database session
+            test_id: ID of the test
+
+        Returns:
+            List of {"row_index", "prediction", "attributions"} dicts, or None
+            if the test has no CBC output file
+
+        Raises:
+            ValueError: If the stored results lack the model features
+        """
+        from app.database import TestFile
+
+        def stored_results():
+            output_file = db.query(TestFile).filter(
+                TestFile.test_id == test_id,
+                TestFile.extension.in_(RESULT_EXTENSIONS),
+                TestFile.type == 'output'
+            ).populate_existing().first()
+            if not output_file or not os.path.exists(output_file.path):
+                return None, None
+            return output_file, read_results(output_file.path)
+
+        output_file, df = stored_results()
+        if output_file is None:
+            return None
+
+        if not has_attributions(df):
+            with self._attribution_lock(test_id):
+                # Computed by another request while this one waited
+                output_file, df = stored_results()
+                if output_file is None:
+                    return None
+                if not has_attributions(df):
+                    df = self._store_attributions(db, output_file, df)
+
+        return [
+            {
+                "row_index": idx,
+                "prediction": row.get('Diagnosis'),
+                "attributions": row_attributions(row)
+            }
+            for idx, row in enumerate(df.to_dict('records'))
+        ]
+
+    @contextmanager
+    def _attribution_lock(self, test_id: int):
+        """Hold the attribution lock of a test; it is dropped once no pass waits for it"""
+        with self._attribution_guard:
+            lock = self._attribution_locks.setdefault(test_id, threading.Lock())
+        with lock:
+            try:
+                yield
+            finally:
+                with self._attribution_guard:
+                    if self._attribution_locks.get(test_id) is lock:
+                        del self._attribution_locks[test_id]
+
+    def _store_attributions(self, db: Session, output_file, df: pd.DataFrame) -> pd.DataFrame:
+        """Explain all rows of a test's results and point its output file at the annotated copy"""
+        from app.database import TestFile
+
+        if not self._loaded:
+            self.load_model()
+
+        missing = [c for c in self.used_features if c not in df.columns]
+        if missing:
+            raise ValueError(f"Stored results are missing model features: {missing}")
+
+        df = add_attributions(df, self.model, self.scaler, self.used_features)
+
+        # Stored content never changes: point the test at a new blob
+        extension = os.path.splitext(output_file.path)[1].lower()
+        tmp_path = blob_store.temp_path(extension)
+        write_results(df, tmp_path)
+        old_path = output_file.path
+        new_path = blob_store.store_file(db, tmp_path, extension)
+        # Only swap if no other process replaced the file meanwhile; the loser releases its own copy
+        swapped = db.query(TestFile).filter(
+            TestFile.id == output_file.id,
+            TestFile.path == old_path
+        ).update({TestFile.path: new_path}, synchronize_session=False)
+        blob_store.release(db, old_path if swapped else new_path)
+        db.commit()
+        return df
+
+    def claim_attributions(self, test_id: int) -> bool:
+        """
+        Mark a test's attributions as queued for computing.
+
+        Returns:
+            False if a pass for the test is queued or running already
+        """
+        with self._attribution_guard:
+            if test_id in self._attributions_queued:
+                return False
+            self._attributions_queued.add(test_id)
+            return True
+
+    def _finish_attributions(self, test_id: int):
+        with self._attribution_guard:
+            self._attributions_queued.discard(test_id)
+
+    async def process_csv_upload(
         self,
         file: UploadFile,
         patient_id: int,
@@ -144,30 +508,57 @@ class CBCPredictionService:
         notes: str = "",
         db: Optional[Session] = None
     ) -> Dict[str, Any]:
+        """
+        Stream an uploaded CBC CSV to a temporary file and analyze it.
+        
+        The upload is never held in memory as a whole; parsing, scoring and
+        saving run in the threadpool.
+        """
+        # Validate file
+        if not file or not file.filename:
+            return {
+                "success": False,
+                "message": "No file was selected. Please select a CSV file to upload."
+            }
+        
+        if not file.filename.lower().endswith('.csv'):
+            return {
+                "success": False,
+                "message": "Invalid file type. Please upload a CSV file (.csv extension)."
+            }
+        
+        tmp_path = Path(tempfile.gettempdir()) / f"cbc_upload_{uuid.uuid4().hex}.csv"
         try:
-            # Validate file
-            if not file or not file.filename:
-                return {
-                    "success": False,
-                    "message": "No file was selected. Please select a CSV file to upload."
-                }
-            
-            if not file.filename.lower().endswith('.csv'):
-                return {
-                    "success": False,
-                    "message": "Invalid file type. Please upload a CSV file (.csv extension)."
-                }
-            
-            # Read and validate content
-            contents = file.file.read()
-            if len(contents) == 0:
+            await save_upload(file, tmp_path)
+        except UploadTooLargeError as e:
+            return {"success": False, "message": str(e)}
+        
+        try:
+            return await run_in_threadpool(
+                self.process_csv_file, tmp_path, patient_id, uploaded_by_id, notes, db
+            )
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    
+    def process_csv_file(
+        self,
+        file_path: Path,
+        patient_id: int,
+        uploaded_by_id: int,
+        notes: str = "",
+        db: Optional[Session] = None
+    ) -> Dict[str, Any]:
+        """Analyze a CBC CSV file on disk and save the annotated results as a new test."""
+        try:
+            # Validate content
+            if os.path.getsize(file_path) == 0:
                 return {
                     "success": False,
                     "message": "The uploaded file is empty. Please upload a valid CSV file with CBC data."
                 }
             
             # Parse CSV
-            df_original = pd.read_csv(io.BytesIO(contents))
+            df_original = pd.read_csv(file_path)
             if df_original.empty:
                 return {
                     "success": False,
@@ -185,6 +576,7 @@ class CBCPredictionService:
                 self.scaler, 
                 self.used_features
             )
+            self.observe_features(df_annotated)
             
             if len(df_annotated) == 0:
                 return {
@@ -214,6 +606,8 @@ class CBCPredictionService:
                         "TLC": float(row.get('TLC', 0)),
                         "PLT": float(row.get('PLT', 0)),
                     },
+                    "flags": row_flags(row),
+                    "indices": row_indices(row),
                     "report": build_report(row)
                 }
                 results.append(result)
@@ -227,7 +621,7 @@ class CBCPredictionService:
             
             test_id = None
             try:
-                from app.database import Test, TestFile, Model
+                from app.database import Model
                 
                 # Get CBC model
                 cbc_model = db.query(Model).filter(Model.name == "CBC Anemia Detection").first()
@@ -237,43 +631,17 @@ class CBCPredictionService:
                         "message": "CBC Anemia Detection model not found. Please ensure database is properly initialized."
                     }
                 
-                # Create test record
-                new_test = Test(
-                    patient_id=patient_id,
-                    model_id=cbc_model.id,
+                # Create test record with its annotated output file
+                new_test = self.save_annotated_test(
+                    db,
+                    cbc_model,
+                    patient_id,
+                    df_annotated,
                     notes=notes if notes else "CBC test uploaded via CSV",
-                    review_status='pending'
+                    filename_prefix="cbc"
                 )
-                db.add(new_test)
-                db.flush()  # Get the test ID
                 test_id = new_test.id
                 
-                # Create uploads directory if it doesn't exist
-                upload_dir = Path("uploads/tests/cbc")
-                upload_dir.mkdir(parents=True, exist_ok=True)
-                
-                # Generate unique filename with datetime
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                random_id = uuid.uuid4().hex[:8]
-                filename = f"cbc_{timestamp}_{random_id}.csv"
-                file_path = upload_dir / filename
-                
-                # Save annotated CSV file
-                df_annotated.to_csv(file_path, index=False)
-                
-                # Create test_files record for output CSV
-                test_file = TestFile(
-                    test_id=new_test.id,
-                    name=filename,
-                    extension='.csv',
-                    path=str(file_path),
-                    type='output'
-                )
-                db.add(test_file)
-                
-                # Update model test count
-                cbc_model.tests_count += 1
-                
                 db.commit()
             except Exception as db_error:
                 db.rollback()
@@ -282,10 +650,16 @@ class CBCPredictionService:
                     "message": f"Error saving test to database: {str(db_error)}"
                 }
             
+            duplicates = df_annotated.attrs.get(DUPLICATE_ROWS, 0)
+            message = f"CBC analysis completed successfully! Analyzed {len(results)} sample(s)."
+            if duplicates:
+                message += f" {duplicates} duplicate row(s) reused an earlier result."
+            
             return {
                 "success": True,
-                "message": f"CBC analysis completed successfully! Analyzed {len(results)} sample(s).",
+                "message": message,
                 "results": results,
+                "duplicate_rows": duplicates,
                 "notes": notes,
                 "patient_id": patient_id,
                 "uploaded_by_id": uploaded_by_id,
@@ -346,6 +720,7 @@ class CBCPredictionService:
                 self.scaler, 
                 self.used_features
             )
+            self.observe_features(df_annotated)
             
             if len(df_annotated) == 0:
                 return {
@@ -373,6 +748,8 @@ class CBCPredictionService:
                     "TLC": float(row.get('TLC', 0)),
                     "PLT": float(row.get('PLT', 0)),
                 },
+                "flags": row_flags(row),
+                "indices": row_indices(row),
                 "report": build_report(row)
             }
             
@@ -385,7 +762,7 @@ class CBCPredictionService:
             
             test_id = None
             try:
-                from app.database import Test, TestFile, Model
+                from app.database import Model
                 
                 # Get CBC model
                 cbc_model = db.query(Model).filter(Model.name == "CBC Anemia Detection").first()
@@ -395,43 +772,17 @@ class CBCPredictionService:
                         "message": "CBC Anemia Detection model not found. Please ensure database is properly initialized."
                     }
                 
-                # Create test record
-                new_test = Test(
-                    patient_id=patient_id,
-                    model_id=cbc_model.id,
+                # Create test record with its annotated output file
+                new_test = self.save_annotated_test(
+                    db,
+                    cbc_model,
+                    patient_id,
+                    df_annotated,
                     notes=notes if notes else "CBC test entered manually",
-                    review_status='pending'
+                    filename_prefix="cbc_manual"
                 )
-                db.add(new_test)
-                db.flush()  # Get the test ID
                 test_id = new_test.id
                 
-                # Create uploads directory if it doesn't exist
-                upload_dir = Path("uploads/tests/cbc")
-                upload_dir.mkdir(parents=True, exist_ok=True)
-                
-                # Generate unique filename with datetime
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                random_id = uuid.uuid4().hex[:8]
-                filename = f"cbc_manual_{timestamp}_{random_id}.csv"
-                file_path = upload_dir / filename
-                
-                # Save annotated CSV file
-                df_annotated.to_csv(file_path, index=False)
-                
-                # Create test_files record for output CSV
-                test_file = TestFile(
-                    test_id=new_test.id,
-                    name=filename,
-                    extension='.csv',
-                    path=str(file_path),
-                    type='output'
-                )
-                db.add(test_file)
-                
-                # Update model test count
-                cbc_model.tests_count += 1
-                
                 db.commit()
             except Exception as db_error:
                 db.rollback()
@@ -466,7 +817,21 @@ class CBCPredictionService:
             }
 
 
-# ==================== Image Analysis ====================
+# ==================== Blood Cell Image Analysis ====================
+
+# Worker processes for image analysis; 0 analyzes in the web process's threadpool
+IMAGE_ANALYSIS_WORKERS = int(os.getenv("IMAGE_ANALYSIS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Name of the cached analysis result, per blob
+ANALYSIS_ARTIFACT = f"analysis_v{ANALYSIS_VERSION}.json"
+
+# Decoded pixels of a large image, memory-mapped by the tile workers
+PIXELS_ARTIFACT = "pixels.npy"
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
+
+# Most images accepted in one batch upload
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "50"))
 
 class BloodImageAnalysisService:
     """Service for blood microscope image analysis"""
@@ -474,8 +839,220 @@ class BloodImageAnalysisService:
     def __init__(self):
         self.model = None
         self._loaded = False
+        self._executor = None
+        self._executor_lock = threading.Lock()
+    
+    def executor(self) -> Optional[ProcessPoolExecutor]:
+        """The analysis process pool, started on first use (None if disabled)"""
+        if IMAGE_ANALYSIS_WORKERS <= 0:
+            return None
+        with self._executor_lock:
+            if self._executor is None:
+                # Spawned workers do not inherit the web process's threads and sockets
+                self._executor = ProcessPoolExecutor(
+                    max_workers=IMAGE_ANALYSIS_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+    
+    def shutdown(self):
+        """Stop the analysis workers"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+    
+    async def run_in_pool(self, func, *args):
+        """Run a function on the process pool, or in the threadpool if it is disabled"""
+        executor = self.executor()
+        if executor is None:
+            return await run_in_threadpool(func, *args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool next time
+            with self._executor_lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+    
+    async def analyze_image(self, image_path, sha256: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Analyze a blood smear image off the event loop.
+        
+        Runs on the process pool, so image work never holds a web worker.
+        Images larger than one tile (SLIDE_TILE_SIZE) are split into
+        overlapping tiles analyzed in parallel and merged, so memory per
+        worker stays bounded whatever the slide size. Results are cached
+        per content hash, so an image uploaded again is not analyzed twice.
+        
+        Args:
+            image_path: Image file
+            sha256: Content hash of the image (default: taken from its blob path)
+            
+        Returns:
+            Analysis result (see app.ai.blood_cell.analyze_image)
+            
+        Raises:
+            ValueError: If the file is not a readable image
+        """
+        sha256 = sha256 or blob_store.blob_sha256(image_path)
+        cache_path = blob_store.derived_path(sha256, ANALYSIS_ARTIFACT) if sha256 else None
+        if cache_path is not None and cache_path.exists():
+            return json.loads(cache_path.read_text())
+        
+        start = time.perf_counter()
+        pixels_path = blob_store.derived_path(sha256, PIXELS_ARTIFACT) if sha256 else blob_store.temp_path(".npy")
+        try:
+            result = await self.run_in_pool(slide.start_analysis, str(image_path), str(pixels_path))
+            if isinstance(result, slide.SlidePlan):
+                plan = result
+                tile_cells = await asyncio.gather(
+                    *(self.run_in_pool(slide.analyze_tile, plan, tile) for tile in plan.tiles)
+                )
+                result = await run_in_threadpool(slide.merge_tiles, plan, tile_cells)
+                result["tiles"] = len(plan.tiles)
+                result["seconds"] = round(time.perf_counter() - start, 4)
+            if cache_path is not None:
+                blob_store.cached_artifact(sha256, ANALYSIS_ARTIFACT, lambda p: p.write_text(json.dumps(result)))
+            # The pixel cache is as large as the decoded slide; once the analysis
+            # is cached it is not needed. A failed analysis keeps it for the retry.
+            pixels_path.unlink(missing_ok=True)
+        finally:
+            if sha256 is None:
+                pixels_path.unlink(missing_ok=True)
+        return result
+    
+    def _image_model(self, db: Session):
+        from app.database import Model
+        return db.query(Model).filter(Model.name == "Blood Cell Image Classification").first()
+    
+    async def _stage_image(self, file: UploadFile) -> Dict[str, Any]:
+        """
+        Validate an uploaded image, stream it to a temporary file, re-encode
+        it for storage (see app.ai.blood_cell.ingest) and analyze it.
+        
+        Nothing is written to the database. On failure the temporary files
+        are removed and the error message is returned.
+        
+        Returns:
+            Dict with success, and either message or stored, extension,
+            analysis and uploaded_size
+        """
+        file_extension = Path(file.filename).suffix.lower()
+        if file_extension not in IMAGE_EXTENSIONS:
+            return {
+                "success": False,
+                "message": f"Invalid file type. Please upload an image file ({', '.join(IMAGE_EXTENSIONS)})."
+            }
+        
+        try:
+            upload = await save_upload(file, blob_store.temp_path(file_extension))
+        except UploadTooLargeError as e:
+            return {"success": False, "message": str(e)}
+        
+        stored = upload
+        try:
+            stored, stored_extension = await self._ingest(upload, file_extension)
+            # The analysis sees the uploaded pixels whatever the storage encoding
+            analysis = await self.analyze_image(upload.path, stored.sha256)
+        except Exception as e:
+            upload.path.unlink(missing_ok=True)
+            stored.path.unlink(missing_ok=True)
+            if isinstance(e, ImageTooLargeError):
+                return {"success": False, "message": f"{e}. Please upload a smaller image or a part of the slide."}
+            if isinstance(e, ValueError):
+                return {
+                    "success": False,
+                    "message": "The uploaded file could not be read as an image. Please upload a valid microscope image."
+                }
+            raise
+        if stored.path != upload.path:
+            upload.path.unlink(missing_ok=True)
+        
+        return {
+            "success": True,
+            "stored": stored,
+            "extension": stored_extension,
+            "analysis": analysis,
+            "uploaded_size": upload.size
+        }
+    
+    async def _ingest(self, upload: StoredUpload, extension: str):
+        """
+        Re-encode an upload for storage and strip its metadata, on the worker pool.
+        
+        Returns:
+            (StoredUpload of the file to store, its extension)
+        """
+        if ingest.IMAGE_STORAGE_FORMAT == "original":
+            return upload, extension
+        result = await self.run_in_pool(
+            ingest.ingest_image, str(upload.path), extension, ingest.IMAGE_STORAGE_FORMAT, ingest.IMAGE_STORAGE_QUALITY
+        )
+        return StoredUpload(Path(result["path"]), result["size"], result["sha256"]), result["extension"]
+    
+    @staticmethod
+    def _storage_report(uploaded_size: int, stored_size: int) -> Dict[str, Any]:
+        """Sizes before and after ingest, with the compression ratio"""
+        return {
+            "uploaded_bytes": uploaded_size,
+            "stored_bytes": stored_size,
+            "compression_ratio": round(uploaded_size / stored_size, 2) if stored_size else None
+        }
+    
+    @staticmethod
+    def _storage_message(report: Dict[str, Any]) -> str:
+        if report["stored_bytes"] >= report["uploaded_bytes"]:
+            return ""
+        return (
+            f" Stored as {format_size(report['stored_bytes'])} instead of {format_size(report['uploaded_bytes'])}"
+            f" ({report['compression_ratio']:g}x smaller)."
+        )
+    
+    def _add_image_test(self, db: Session, image_model, staged: Dict[str, Any], patient_id: int, description: str):
+        """Move a staged image into the blob store and add its Test and TestFile (not committed)"""
+        from app.database import Test, TestFile
+        
+        file_extension = staged["extension"]
+        analysis = staged["analysis"]
+        file_path = blob_store.store_file(db, staged["stored"].path, file_extension, sha256=staged["stored"].sha256)
+        
+        # Generate unique filename with datetime
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        random_id = uuid.uuid4().hex[:8]
+        filename = f"{timestamp}_{random_id}{file_extension}"
+        
+        # Create new test
+        new_test = Test(
+            patient_id=patient_id,
+            model_id=image_model.id,
+            notes=description if description else "Blood cell image uploaded",
+            result=analysis["summary"],
+            confidence=analysis["confidence"],
+            review_status='pending'
+        )
+        db.add(new_test)
+        db.flush()  # Get the test ID
+        
+        # Create test_files record
+        db.add(TestFile(
+            test_id=new_test.id,
+            name=filename,
+            extension=file_extension,
+            path=file_path,
+            type='input'
+        ))
+        return new_test, file_path
+    
+    def _count_tests(self, db: Session, image_model, count: int):
+        """Add to the model's test count in the database, not from a stale in-memory value"""
+        from app.database import Model
+        db.query(Model).filter(Model.id == image_model.id).update(
+            {Model.tests_count: Model.tests_count + count}, synchronize_session=False
+        )
     
-    def process_image_upload(
+    async def process_image_upload(
         self,
         file: UploadFile,
         patient_id: int,
@@ -484,7 +1061,10 @@ class BloodImageAnalysisService:
         db: Optional[Session] = None
     ) -> Dict[str, Any]:
         """
-        Process uploaded blood microscope image.
+        Store and analyze an uploaded blood microscope image.
+        
+        The image is stored in IMAGE_STORAGE_FORMAT, without metadata, and
+        the analysis summary and confidence are saved on the new Test.
         
         Args:
             file: Uploaded image file
@@ -494,7 +1074,8 @@ class BloodImageAnalysisService:
             db: Database session (for future persistence)
             
         Returns:
-            Dict with success status and message
+            Dict with success status and message, and on success test_id,
+            file_path, analysis and storage (uploaded and stored sizes)
         """
         try:
             # Validate file
@@ -505,71 +1086,41 @@ class BloodImageAnalysisService:
                 }
             
             # Validate image extension
-            valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-            file_extension = Path(file.filename).suffix.lower()
-            if file_extension not in valid_extensions:
+            if Path(file.filename).suffix.lower() not in IMAGE_EXTENSIONS:
                 return {
                     "success": False,
-                    "message": f"Invalid file type. Please upload an image file ({', '.join(valid_extensions)})."
+                    "message": f"Invalid file type. Please upload an image file ({', '.join(IMAGE_EXTENSIONS)})."
                 }
             
-            # Create uploads directory structure if it doesn't exist
-            upload_dir = Path("uploads/tests/blood_cell")
-            upload_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Generate unique filename with datetime
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            random_id = uuid.uuid4().hex[:8]
-            filename = f"{timestamp}_{random_id}{file_extension}"
-            file_path = upload_dir / filename
-            
-            # Save the uploaded file
-            contents = file.file.read()
-            with open(file_path, "wb") as f:
-                f.write(contents)
-            
             # Create Test record in database
             if db:
-                from app.database import Test, TestFile, Model
-                
                 # Get Blood Cell Image Classification model
-                image_model = db.query(Model).filter(Model.name == "Blood Cell Image Classification").first()
+                image_model = self._image_model(db)
                 if not image_model:
                     return {
                         "success": False,
                         "message": "Blood Cell Image Classification model not found. Please ensure database is properly initialized."
                     }
                 
-                # Create new test
-                new_test = Test(
-                    patient_id=patient_id,
-                    model_id=image_model.id,
-                    notes=description if description else "Blood cell image uploaded",
-                    review_status='pending'
-                )
-                db.add(new_test)
-                db.flush()  # Get the test ID
-                
-                # Create test_files record
-                test_file = TestFile(
-                    test_id=new_test.id,
-                    name=filename,
-                    extension=file_extension,
-                    path=str(file_path),
-                    type='input'
-                )
-                db.add(test_file)
-                
-                # Increment model tests count
-                image_model.tests_count += 1
+                # Stream the upload to disk, then analyze it before touching the database
+                staged = await self._stage_image(file)
+                if not staged["success"]:
+                    return staged
                 
+                new_test, file_path = self._add_image_test(db, image_model, staged, patient_id, description)
+                self._count_tests(db, image_model, 1)
                 db.commit()
                 
+                analysis = staged["analysis"]
+                storage = self._storage_report(staged["uploaded_size"], staged["stored"].size)
                 return {
                     "success": True,
-                    "message": "Blood cell image uploaded successfully!",
+                    "message": f"Blood cell image uploaded and analyzed: {analysis['cells']} cells detected."
+                               + self._storage_message(storage),
                     "test_id": new_test.id,
-                    "file_path": str(file_path)
+                    "file_path": file_path,
+                    "analysis": analysis,
+                    "storage": storage
                 }
             else:
                 return {
@@ -584,9 +1135,146 @@ class BloodImageAnalysisService:
                 "success": False,
                 "message": f"Error uploading image: {str(e)}"
             }
+    
+    async def process_image_batch(
+        self,
+        files: List[UploadFile],
+        patient_id: int,
+        uploaded_by_id: int,
+        description: str = "",
+        db: Optional[Session] = None
+    ) -> Dict[str, Any]:
+        """
+        Store and analyze several blood microscope images uploaded together.
+        
+        All images are streamed to disk and analyzed concurrently, at most
+        IMAGE_ANALYSIS_WORKERS at a time (the analysis pool's size). The
+        Tests of the images that could be analyzed are then written in a
+        single transaction with one update of the model's test count;
+        files that are not valid images are reported and skipped.
+        
+        Args:
+            files: Uploaded image files
+            patient_id: Patient ID
+            uploaded_by_id: ID of user uploading
+            description: Description applied to every image
+            db: Database session
+            
+        Returns:
+            Dict with success status, message, test_ids, file_paths, storage
+            (total uploaded and stored sizes) and per-file results
+            (filename, success, message or test_id)
+        """
+        files = [f for f in files or [] if f and f.filename]
+        if not files:
+            return {
+                "success": False,
+                "message": "No files were selected. Please select one or more image files to upload."
+            }
+        if len(files) > MAX_BATCH_IMAGES:
+            return {
+                "success": False,
+                "message": f"Too many files: at most {MAX_BATCH_IMAGES} images can be uploaded at once."
+            }
+        if not db:
+            return {"success": False, "message": "Database session not provided"}
+        
+        image_model = self._image_model(db)
+        if not image_model:
+            return {
+                "success": False,
+                "message": "Blood Cell Image Classification model not found. Please ensure database is properly initialized."
+            }
+        
+        limit = asyncio.Semaphore(max(1, IMAGE_ANALYSIS_WORKERS))
+        
+        async def stage(file: UploadFile) -> Dict[str, Any]:
+            async with limit:
+                try:
+                    return await self._stage_image(file)
+                except Exception as e:
+                    return {"success": False, "message": f"Error uploading image: {str(e)}"}
+        
+        staged = await asyncio.gather(*(stage(file) for file in files))
+        
+        results = [
+            {"filename": file.filename, "success": False, "message": item["message"]}
+            for file, item in zip(files, staged) if not item["success"]
+        ]
+        accepted = [(file, item) for file, item in zip(files, staged) if item["success"]]
+        test_ids, file_paths = [], []
+        if accepted:
+            try:
+                for file, item in accepted:
+                    new_test, file_path = self._add_image_test(db, image_model, item, patient_id, description)
+                    test_ids.append(new_test.id)
+                    file_paths.append(file_path)
+                    results.append({
+                        "filename": file.filename,
+                        "success": True,
+                        "test_id": new_test.id,
+                        "cells": item["analysis"]["cells"],
+                        "compression_ratio": self._storage_report(item["uploaded_size"], item["stored"].size)["compression_ratio"]
+                    })
+                self._count_tests(db, image_model, len(accepted))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                for _, item in accepted:
+                    item["stored"].path.unlink(missing_ok=True)
+                return {"success": False, "message": f"Error uploading images: {str(e)}", "results": results}
+        
+        storage = self._storage_report(
+            sum(item["uploaded_size"] for _, item in accepted),
+            sum(item["stored"].size for _, item in accepted)
+        )
+        failed = len(files) - len(test_ids)
+        message = f"{len(test_ids)} of {len(files)} blood cell images uploaded and analyzed."
+        if test_ids:
+            message += self._storage_message(storage)
+        if failed:
+            message += f" {failed} could not be processed: " + "; ".join(
+                f"{r['filename']}: {r['message']}" for r in results if not r["success"]
+            )
+        return {
+            "success": bool(test_ids),
+            "message": message,
+            "test_ids": test_ids,
+            "file_paths": file_paths,
+            "storage": storage,
+            "results": results
+        }
 
 # ==================== Service Instances ====================
 
 # Global singleton instances
 cbc_prediction_service = CBCPredictionService()
 blood_image_service = BloodImageAnalysisService()
+
+
+def compute_test_attributions(test_id: int, session_factory=None):
+    """
+    Store the feature attributions of a CBC test, so later views only read them.
+
+    Meant to run as a background task after the test is first opened, once
+    claim_attributions has succeeded: errors are logged, not raised.
+
+    Args:
+        test_id: ID of the test
+        session_factory: Creates the task's own session (default SessionLocal)
+    """
+    from app.database import SessionLocal
+
+    try:
+        if not cbc_prediction_service.is_available():
+            return
+        db = (session_factory or SessionLocal)()
+        try:
+            cbc_prediction_service.get_test_attributions(db, test_id)
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️ Could not compute attributions of test {test_id}: {e}")
+        finally:
+            db.close()
+    finally:
+        cbc_prediction_service._finish_attributions(test_id)
@@ -7,12 +7,14 @@ from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 import bcrypt
 import os
 from dotenv import load_dotenv
 
-from app.database import get_db, User
+from app.database import get_db, get_async_db, User
 from app.models.schemas import TokenData
 
 load_dotenv()
@@ -102,10 +104,7 @@ def get_current_user(
     return user
 
 
-def get_current_user_from_cookie(
-    request: Request,
-    db: Session = Depends(get_db)
-) -> Optional[User]:
+def _cookie_token_data(request: Request) -> Optional[TokenData]:
     token = request.cookies.get("access_token")
     
     if not token:
@@ -115,7 +114,14 @@ def get_current_user_from_cookie(
     if token.startswith("Bearer "):
         token = token[7:]
     
-    token_data = verify_token(token)
+    return verify_token(token)
+
+
+def get_current_user_from_cookie(
+    request: Request,
+    db: Session = Depends(get_db)
+) -> Optional[User]:
+    token_data = _cookie_token_data(request)
     if token_data is None:
         return None
     
@@ -123,13 +129,41 @@ def get_current_user_from_cookie(
     return user
 
 
-# Alias for backwards compatibility with async routes
+async def get_current_user_from_cookie_async(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db)
+) -> Optional[User]:
+    """Cookie user loaded through the async session, without blocking the event loop"""
+    token_data = _cookie_token_data(request)
+    if token_data is None:
+        return None
+    
+    result = await db.execute(select(User).where(User.username == token_data.username))
+    return result.scalars().first()
+
+
 async def get_current_user_optional(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> Optional[User]:
     """Get current user optionally (async version). Returns None if not authenticated."""
-    return get_current_user_from_cookie(request, db)
+    return await get_current_user_from_cookie_async(request, db)
+
+
+def _check_role(user: Optional[User], allowed_roles: list) -> User:
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Authentication required"
+        )
+    
+    if user.role not in allowed_roles:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Access forbidden. Required roles: {', '.join(allowed_roles)}"
+        )
+    
+    return user
 
 
 def require_role(allowed_roles: list):
@@ -137,12 +171,50 @@ def require_role(allowed_roles: list):
         request: Request,
         db: Session = Depends(get_db)
     ) -> User:
-        user = get_current_user_from_cookie(request, db)
+        return _check_role(get_current_user_from_cookie(request, db), allowed_roles)
+    
+    return role_checker
+
+
+def require_role_async(allowed_roles: list):
+    """require_role for handlers on the async session (shares the request's session)"""
+    async def role_checker(
+        request: Request,
+        db: AsyncSession = Depends(get_async_db)
+    ) -> User:
+        return _check_role(await get_current_user_from_cookie_async(request, db), allowed_roles)
+    
+    return role_checker
+
+
+def get_current_user_from_request(
+    request: Request,
+    db: Session = Depends(get_db)
+) -> Optional[User]:
+    """Resolve the user from an 'Authorization: Bearer' header, falling back to the cookie."""
+    auth_header = request.headers.get("authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        token_data = verify_token(auth_header[7:])
+        if token_data is None:
+            return None
+        return db.query(User).filter(User.username == token_data.username).first()
+    
+    return get_current_user_from_cookie(request, db)
+
+
+def require_api_role(allowed_roles: list):
+    """Role check for machine clients: accepts a Bearer token header or the session cookie."""
+    def role_checker(
+        request: Request,
+        db: Session = Depends(get_db)
+    ) -> User:
+        user = get_current_user_from_request(request, db)
         
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Authentication required"
+                detail="Authentication required",
+                headers={"WWW-Authenticate": "Bearer"}
             )
         
         if user.role not in allowed_roles:
@@ -0,0 +1,407 @@
+"""
+Blob Store Service
+Content-addressed storage for uploaded and generated files (blood cell
+images, CBC results, re-scoring files, profile images).
+
+A file is stored once under the SHA-256 of its content, as
+``uploads/blobs/<first 2 hex>/<sha256><extension>``, so the same image
+uploaded by several doctors takes up disk space only once.
+TestFile.path and User.profile_image hold the blob path, which is still
+served by the /uploads static mount.
+
+The ``blobs`` table counts the rows pointing at each blob. The count is
+raised in the same transaction that stores the referencing row and
+lowered when a row stops pointing at the blob. collect_garbage removes
+blobs that have been at zero for longer than a grace period, using a
+conditional delete so a blob picked up again by a concurrent upload is
+never removed.
+
+Files derived from a blob (thumbnails, analysis results, ...) are cached
+per content hash under ``uploads/blobs/derived/<first 2 hex>/<sha256>/``
+and removed together with the blob.
+
+    python -m app.services.blob_store migrate   # move existing uploads into the store
+    python -m app.services.blob_store gc        # remove unreferenced blobs
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from fastapi import UploadFile
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, Blob, TestFile, User
+from app.services.upload_service import save_upload
+
+
+BLOB_DIR = Path(os.getenv("BLOB_STORE_DIR", "uploads/blobs"))
+
+# Unreferenced blobs and stray files younger than this are kept, so uploads
+# whose transaction has not committed yet are never collected
+GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", "3600"))
+
+_HASH_CHUNK = 1 << 20
+_BLOB_NAME = re.compile(r"^([0-9a-f]{64})(\.[^/]*)?$")
+_TOMBSTONE_SUFFIX = '.gc'
+
+
+# ==================== Paths ====================
+
+def blob_path(sha256: str, extension: str = "") -> Path:
+    """Path of the blob with the given content hash"""
+    return BLOB_DIR / sha256[:2] / f"{sha256}{extension}"
+
+
+def blob_sha256(path) -> Optional[str]:
+    """Content hash of a blob path, or None if the path is not in the store"""
+    if not path:
+        return None
+    path = Path(path)
+    match = _BLOB_NAME.match(path.name)
+    if not match or path.parent != BLOB_DIR / match.group(1)[:2]:
+        return None
+    return match.group(1)
+
+
+def temp_path(extension: str = "") -> Path:
+    """Fresh path in the store's scratch directory, to write a file before storing it"""
+    tmp_dir = BLOB_DIR / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    return tmp_dir / f"{uuid.uuid4().hex}{extension}"
+
+
+def derived_path(sha256: str, name: str, create: bool = True) -> Path:
+    """Path of an artifact derived from a blob (its directory is created unless create is False)"""
+    directory = BLOB_DIR / "derived" / sha256[:2] / sha256
+    if create:
+        directory.mkdir(parents=True, exist_ok=True)
+    return directory / name
+
+
+def file_sha256(path) -> str:
+    """SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ==================== Storing and Releasing ====================
+
+def _acquire(db: Session, sha256: str, extension: str, size: int) -> str:
+    """Add a reference to a blob, creating its row if needed; returns the blob's extension"""
+    updated = db.query(Blob).filter(Blob.sha256 == sha256).update(
+        {Blob.ref_count: Blob.ref_count + 1, Blob.released_at: None},
+        synchronize_session=False
+    )
+    if updated:
+        return db.query(Blob.extension).filter(Blob.sha256 == sha256).scalar()
+
+    try:
+        with db.begin_nested():
+            db.add(Blob(sha256=sha256, extension=extension, size=size, ref_count=1))
+    except IntegrityError:
+        # Stored concurrently by another request
+        return _acquire(db, sha256, extension, size)
+    return extension
+
+
+def store_file(db: Session, source, extension: str, sha256: Optional[str] = None) -> str:
+    """
+    Move a finished file into the store and add a reference to it.
+
+    The caller stores the returned path on the referencing row in the same
+    transaction. If the content is already stored, the source file is just
+    removed.
+
+    Args:
+        db: Database session
+        source: File to store (moved, not copied)
+        extension: Extension of the stored file (e.g. '.png')
+        sha256: Content hash if already known
+
+    Returns:
+        Path of the blob, as stored on TestFile.path / User.profile_image
+    """
+    source = Path(source)
+    sha256 = sha256 or file_sha256(source)
+    extension = _acquire(db, sha256, extension.lower(), source.stat().st_size)
+
+    path = blob_path(sha256, extension)
+    if path.exists():
+        source.unlink()
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, path)
+    return str(path)
+
+
+async def store_upload(db: Session, upload: UploadFile, extension: str, max_size: Optional[int] = None) -> str:
+    """
+    Stream an upload into the store and add a reference to it.
+
+    Raises:
+        UploadTooLargeError: If the upload exceeds the size limit
+    """
+    stored = await save_upload(upload, temp_path(extension), max_size=max_size)
+    return store_file(db, stored.path, extension, sha256=stored.sha256)
+
+
+def release(db: Session, path) -> bool:
+    """
+    Drop a reference to a blob once a row no longer points at it.
+
+    Returns:
+        True if the path is a blob, False for files outside the store
+    """
+    sha256 = blob_sha256(path)
+    if sha256 is None:
+        return False
+    db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count > 0).update(
+        {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+    )
+    db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count == 0).update(
+        {Blob.released_at: datetime.utcnow()}, synchronize_session=False
+    )
+    return True
+
+
+def cached_artifact(sha256: str, name: str, build: Callable[[Path], None]) -> Path:
+    """
+    Return a derived artifact of a blob, building it on first use.
+
+    Args:
+        sha256: Content hash of the blob
+        name: Artifact file name (e.g. 'thumb_256.jpg')
+        build: Writes the artifact to the path it is given
+
+    Returns:
+        Path of the cached artifact
+    """
+    path = derived_path(sha256, name)
+    if not path.exists():
+        tmp_path = path.with_name(f".{uuid.uuid4().hex[:8]}.{name}")
+        try:
+            build(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return path
+
+
+# ==================== Garbage Collection ====================
+
+def _is_referenced(db: Session, path: str) -> bool:
+    return (
+        db.query(TestFile.id).filter(TestFile.path == path).first() is not None
+        or db.query(User.id).filter(User.profile_image == path).first() is not None
+    )
+
+
+def _tree_size(directory: Path) -> int:
+    return sum(f.stat().st_size for f in directory.rglob("*") if f.is_file())
+
+
+def _remove_blob_files(sha256: str) -> int:
+    """Remove a blob's files and derived artifacts; returns bytes freed"""
+    derived = BLOB_DIR / "derived" / sha256[:2] / sha256
+    freed = _tree_size(derived)
+    shutil.rmtree(derived, ignore_errors=True)
+    for path in (BLOB_DIR / sha256[:2]).glob(f"{sha256}*"):
+        freed += path.stat().st_size
+        path.unlink(missing_ok=True)
+    return freed
+
+
+def _collect_blob(db: Session, sha256: str, extension: str) -> int:
+    """
+    Remove one unreferenced blob; returns bytes freed, or -1 if it is in use again.
+
+    The file is moved aside before the row is deleted, and the delete only
+    matches while the count is still zero. If a concurrent upload picked the
+    blob up again, the row survives and the file is put back (or the upload
+    has already rewritten it); otherwise the file is removed after commit.
+    """
+    path = blob_path(sha256, extension)
+    tombstone = path.with_name(path.name + _TOMBSTONE_SUFFIX)
+    if path.exists():
+        os.replace(path, tombstone)
+
+    deleted = db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count <= 0).delete(
+        synchronize_session=False
+    )
+    if deleted and not _is_referenced(db, str(path)):
+        db.commit()
+        return _remove_blob_files(sha256)
+
+    db.rollback()
+    if tombstone.exists():
+        if path.exists():
+            tombstone.unlink()
+        else:
+            os.replace(tombstone, path)
+    return -1
+
+
+def _sweep_strays(db: Session, cutoff: float) -> Dict[str, int]:
+    """Remove files in the store that no blob row accounts for, older than cutoff"""
+    removed = freed = 0
+    known = {sha256 for (sha256,) in db.query(Blob.sha256)}
+
+    for path in BLOB_DIR.glob("*/*"):
+        if path.parent.name in ("tmp", "derived") or not path.is_file():
+            continue
+        match = _BLOB_NAME.match(path.name)
+        if match and match.group(1) in known:
+            # Put back a blob left aside by an interrupted collection
+            original = path.with_name(path.name[:-len(_TOMBSTONE_SUFFIX)])
+            if path.name.endswith(_TOMBSTONE_SUFFIX) and not original.exists():
+                os.replace(path, original)
+            continue
+        if path.stat().st_mtime >= cutoff:
+            continue
+        freed += path.stat().st_size
+        path.unlink(missing_ok=True)
+        removed += 1
+
+    # Scratch files of uploads that never made it into the store
+    for path in (BLOB_DIR / "tmp").glob("*"):
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            freed += path.stat().st_size
+            path.unlink(missing_ok=True)
+            removed += 1
+
+    for directory in (BLOB_DIR / "derived").glob("*/*"):
+        if directory.name not in known and directory.stat().st_mtime < cutoff:
+            freed += _tree_size(directory)
+            shutil.rmtree(directory, ignore_errors=True)
+            removed += 1
+
+    return {"files_removed": removed, "bytes_freed": freed}
+
+
+def collect_garbage(db: Session, grace_seconds: Optional[int] = None) -> Dict[str, int]:
+    """
+    Remove blobs that have been unreferenced for longer than the grace period.
+
+    Stray files (from uploads whose transaction was rolled back, or an
+    interrupted collection) are removed once they are older than the grace
+    period as well.
+
+    Args:
+        db: Database session (committed per removed blob)
+        grace_seconds: Minimum age in seconds (default BLOB_GC_GRACE_SECONDS)
+
+    Returns:
+        Dict with blobs_removed, blobs_in_use, files_removed and bytes_freed
+    """
+    grace_seconds = GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+
+    candidates = db.query(Blob.sha256, Blob.extension).filter(
+        Blob.ref_count <= 0,
+        Blob.created_at <= cutoff,
+        (Blob.released_at.is_(None)) | (Blob.released_at <= cutoff)
+    ).all()
+    db.rollback()  # end the read so each removal runs in its own transaction
+
+    stats = {"blobs_removed": 0, "blobs_in_use": 0, "bytes_freed": 0}
+    for sha256, extension in candidates:
+        freed = _collect_blob(db, sha256, extension)
+        if freed < 0:
+            stats["blobs_in_use"] += 1
+        else:
+            stats["blobs_removed"] += 1
+            stats["bytes_freed"] += freed
+
+    strays = _sweep_strays(db, time.time() - grace_seconds)
+    db.rollback()
+    stats["files_removed"] = strays["files_removed"]
+    stats["bytes_freed"] += strays["bytes_freed"]
+    return stats
+
+
+# ==================== Migration ====================
+
+def migrate_legacy_files(db: Session, batch_size: int = 200) -> Dict[str, int]:
+    """
+    Move test files and profile images stored under random names into the store.
+
+    Rows are repointed in batches; the original files are removed only after
+    their batch has been committed.
+
+    Returns:
+        Dict with files_migrated, duplicates (files whose content was
+        already stored) and bytes_saved by deduplication
+    """
+    stats = {"files_migrated": 0, "duplicates": 0, "bytes_saved": 0}
+    pending = []
+
+    def finish():
+        db.commit()
+        for old_path in pending:
+            os.remove(old_path)
+        stats["files_migrated"] += len(pending)
+        pending.clear()
+
+    rows = [(row, "path") for row in db.query(TestFile).filter(~TestFile.path.startswith(str(BLOB_DIR)))]
+    rows += [(row, "profile_image") for row in db.query(User).filter(User.profile_image.isnot(None))]
+    for row, attribute in rows:
+        old_path = getattr(row, attribute)
+        if blob_sha256(old_path) or not os.path.isfile(old_path):
+            continue
+
+        sha256 = file_sha256(old_path)
+        if db.get(Blob, sha256) is not None:
+            stats["duplicates"] += 1
+            stats["bytes_saved"] += os.path.getsize(old_path)
+
+        # Copy, so a failed batch leaves the original files in place
+        extension = os.path.splitext(old_path)[1].lower()
+        tmp_path = temp_path(extension)
+        shutil.copyfile(old_path, tmp_path)
+        setattr(row, attribute, store_file(db, tmp_path, extension, sha256=sha256))
+        db.flush()
+
+        pending.append(old_path)
+        if len(pending) >= batch_size:
+            finish()
+    finish()
+    return stats
+
+
+# ==================== Command Line ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed upload store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="move existing test files and profile images into the store")
+    gc_parser = subparsers.add_parser("gc", help="remove unreferenced blobs")
+    gc_parser.add_argument("--grace", type=int, default=GC_GRACE_SECONDS, help="minimum age in seconds")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "migrate":
+            stats = migrate_legacy_files(db)
+            print(f"Migrated {stats['files_migrated']:,} files; {stats['duplicates']:,} duplicates "
+                  f"({stats['bytes_saved']:,} bytes saved)")
+        else:
+            stats = collect_garbage(db, grace_seconds=args.grace)
+            print(f"Removed {stats['blobs_removed']:,} blobs and {stats['files_removed']:,} stray files "
+                  f"({stats['bytes_freed']:,} bytes freed); {stats['blobs_in_use']:,} back in use")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
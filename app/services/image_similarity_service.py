@@ -0,0 +1,262 @@
+"""
+Image Similarity Service
+Finds blood smear images that look like a given one, among the image tests
+of patients the user may access.
+
+Each uploaded image gets a small descriptor (colour histograms, cell counts
+and morphology, texture; see app.ai.blood_cell.descriptor). It is computed
+once per content hash, cached with the blob's derived files:
+
+    uploads/blobs/derived/<first 2 hex>/<sha256>/descriptor_v1.npy
+
+and appended, keyed by test ID, to a memory-mapped feature store
+(IMAGE_INDEX_DIR), which a query scans in one pass. Descriptors are indexed
+in the background after an upload; images uploaded before this existed are
+indexed on first query, or all at once with:
+
+    python -m app.services.image_similarity_service backfill
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.ai.blood_cell.descriptor import DESCRIPTOR_NAMES, DESCRIPTOR_VERSION, describe_image
+from app.ai.cbc.feature_store import FeatureStore
+from app.database import SessionLocal, User, Test, TestFile, Model, doctor_patients
+from app.services import blob_store
+from app.services.ai_service import ANALYSIS_ARTIFACT, IMAGE_EXTENSIONS, blood_image_service
+from app.services.policy_service import check_patient_access
+from app.services.preview_service import preview_url
+
+
+# Outside uploads/, which is served without authentication
+IMAGE_INDEX_DIR = os.getenv("IMAGE_INDEX_DIR", f"data/feature_store/blood_cell_v{DESCRIPTOR_VERSION}")
+
+DESCRIPTOR_ARTIFACT = f"descriptor_v{DESCRIPTOR_VERSION}.npy"
+
+DEFAULT_K = 5
+MAX_K = 50
+
+ACCESS_MESSAGES = {
+    "deactivated_user": "Your account is deactivated",
+    "deactivated_patient": "Patient's account is deactivated",
+    "not_linked": "You don't have access to this patient's tests",
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_image_index() -> FeatureStore:
+    """The descriptor store, opened on first use"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FeatureStore(IMAGE_INDEX_DIR, DESCRIPTOR_NAMES)
+        return _index
+
+
+# ==================== Descriptors ====================
+
+def _cached_analysis(sha256: Optional[str]) -> Optional[Dict]:
+    if sha256 is None:
+        return None
+    path = blob_store.derived_path(sha256, ANALYSIS_ARTIFACT, create=False)
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def image_descriptor(image_path: str, analysis: Dict) -> np.ndarray:
+    """
+    Descriptor of an image, computed once per content hash.
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    sha256 = blob_store.blob_sha256(image_path)
+    if sha256 is None:
+        return describe_image(image_path, analysis)
+
+    def build(path):
+        with open(path, "wb") as f:
+            np.save(f, describe_image(image_path, analysis))
+
+    return np.load(blob_store.cached_artifact(sha256, DESCRIPTOR_ARTIFACT, build))
+
+
+def index_test_image(test_id: int, image_path: str, analysis: Optional[Dict] = None) -> bool:
+    """
+    Add the descriptor of a test's image to the index, unless it is there already.
+
+    Meant to run as a background task after an upload: errors are logged,
+    not raised.
+
+    Args:
+        test_id: Image test
+        image_path: Its stored input image
+        analysis: Its analysis result (default: the cached one)
+
+    Returns:
+        Whether a descriptor was added
+    """
+    index = get_image_index()
+    if len(index.rows_for_test(test_id)):
+        return False
+    try:
+        analysis = analysis or _cached_analysis(blob_store.blob_sha256(image_path))
+        if analysis is None:
+            return False
+        index.append(test_id, image_descriptor(image_path, analysis).reshape(1, -1))
+        return True
+    except (ValueError, OSError) as e:
+        print(f"⚠️ Could not index image of test {test_id}: {e}")
+        return False
+
+
+def _test_image(db: Session, test_id: int) -> Optional[TestFile]:
+    return db.query(TestFile).filter(
+        TestFile.test_id == test_id,
+        TestFile.type == 'input',
+        TestFile.extension.in_(IMAGE_EXTENSIONS)
+    ).first()
+
+
+# ==================== Search ====================
+
+def nearest(vector: np.ndarray, allowed_tests: np.ndarray, k: int):
+    """
+    The k indexed tests among allowed_tests whose descriptors are closest to vector.
+
+    Returns:
+        Tuple (test IDs, distances), nearest first
+    """
+    features, index = get_image_index().load()
+    rows = np.flatnonzero(np.isin(index[:, 0], allowed_tests))
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    distances = np.linalg.norm(features[rows] - vector, axis=1)
+    # A test indexed twice (concurrent first queries) counts once, at its nearest row
+    tests = index[rows, 0]
+    order = np.lexsort((distances, tests))
+    first = np.r_[True, tests[order][1:] != tests[order][:-1]]
+    test_ids, distances = tests[order][first], distances[order][first]
+    k = min(k, len(test_ids))
+    top = np.argpartition(distances, k - 1)[:k]
+    top = top[np.argsort(distances[top], kind='stable')]
+    return test_ids[top], distances[top]
+
+
+def find_similar_images(db: Session, current_user: User, test_id: int, k: int = DEFAULT_K) -> Dict:
+    """
+    Find the k image tests that look most like the image of a test.
+
+    The user must have access to the test's patient (see
+    check_patient_access). Only tests of active patients the user may
+    access are returned: linked patients for doctors, their own tests for
+    patients, all patients for admins. The test itself is excluded.
+
+    Returns:
+        Dict with success status, message, a list of similar cases and,
+        on failure, a reason ("not_found", "not_indexed" or an access reason)
+    """
+    test = db.query(Test).filter(Test.id == test_id).first()
+    patient = db.query(User).filter(User.id == test.patient_id).first() if test else None
+    image = _test_image(db, test_id) if test else None
+    if not test or not patient or not image:
+        return {"success": False, "reason": "not_found", "message": "Image test not found"}
+
+    allowed, reason = check_patient_access(current_user, patient, db)
+    if not allowed:
+        return {"success": False, "reason": reason, "message": ACCESS_MESSAGES.get(reason, "Unauthorized")}
+
+    stored = get_image_index().rows_for_test(test_id)
+    if not len(stored) and index_test_image(test_id, image.path):
+        stored = get_image_index().rows_for_test(test_id)
+    if not len(stored):
+        return {"success": False, "reason": "not_indexed", "message": "This image has not been analyzed yet"}
+
+    query = db.query(Test.id).join(Model, Test.model_id == Model.id).join(User, Test.patient_id == User.id).filter(
+        Model.name == "Blood Cell Image Classification",
+        User.is_active == 1,
+        Test.id != test_id
+    )
+    if current_user.role == "doctor":
+        linked = db.query(doctor_patients.c.patient_id).filter(doctor_patients.c.doctor_id == current_user.id)
+        query = query.filter(Test.patient_id.in_(linked))
+    elif current_user.role != "admin":
+        query = query.filter(Test.patient_id == current_user.id)
+    allowed_tests = np.fromiter((t for (t,) in query), dtype=np.int64)
+
+    test_ids, distances = nearest(stored[0], allowed_tests, max(1, min(k, MAX_K)))
+
+    tests = {t.id: t for t in db.query(Test).filter(Test.id.in_(test_ids.tolist()))} if len(test_ids) else {}
+    images = {
+        f.test_id: f for f in db.query(TestFile).filter(
+            TestFile.test_id.in_(test_ids.tolist()), TestFile.type == 'input'
+        )
+    } if len(test_ids) else {}
+    cases: List[Dict] = []
+    for similar_id, distance in zip(test_ids.tolist(), distances):
+        similar = tests.get(similar_id)
+        if not similar:
+            continue
+        cases.append({
+            "test_id": similar.id,
+            "distance": round(float(distance), 4),
+            "patient_id": similar.patient_id,
+            "result": similar.result,
+            "review_status": similar.review_status,
+            "created_at": similar.created_at.isoformat() if similar.created_at else None,
+            "thumbnail": preview_url(images[similar_id].path, "thumb") if similar_id in images else None,
+        })
+
+    return {"success": True, "message": f"Found {len(cases)} similar image(s)", "cases": cases}
+
+
+# ==================== Backfill ====================
+
+def backfill_image_index(db: Session) -> Dict[str, int]:
+    """Analyze (if needed) and index every image test missing from the index."""
+    stats = {"indexed": 0, "failed": 0}
+    indexed = set(get_image_index().test_ids().tolist())
+    images = db.query(TestFile.test_id, TestFile.path).filter(
+        TestFile.type == 'input', TestFile.extension.in_(IMAGE_EXTENSIONS)
+    )
+    for test_id, path in images:
+        if test_id in indexed or not os.path.exists(path):
+            continue
+        try:
+            analysis = asyncio.run(blood_image_service.analyze_image(path))
+        except ValueError:
+            stats["failed"] += 1
+            continue
+        if index_test_image(test_id, path, analysis):
+            stats["indexed"] += 1
+        else:
+            stats["failed"] += 1
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the blood smear image similarity index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="index image tests uploaded before the index existed")
+    parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        stats = backfill_image_index(db)
+        print(f"Indexed {stats['indexed']:,} images ({stats['failed']:,} could not be read)")
+    finally:
+        blood_image_service.shutdown()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Lab Feed Ingestion Service
+Streams CBC results from a laboratory information system (NDJSON or
+HL7 v2-style pipe-delimited messages), routes rows to patients and runs
+inference in fixed-size batches so a feed is never held in memory in full.
+"""
+import codecs
+import json
+from typing import AsyncIterator, Dict, List, Optional, Any
+
+import pandas as pd
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.database import User, Model
+from app.services.ai_service import cbc_prediction_service
+from app.services.policy_service import check_patient_access
+
+try:
+    from app.ai.cbc.predict import ALIASES, DUPLICATE_ROWS, norm, predict_and_annotate_dataframe
+except ImportError:
+    ALIASES = {}
+    DUPLICATE_ROWS = 'duplicate_rows'
+    norm = None
+    predict_and_annotate_dataframe = None
+
+
+# Column holding the routing identifier inside a batch dataframe
+PATIENT_REF = 'Patient_Ref'
+
+# Record keys (normalized) that carry the patient identifier in NDJSON feeds.
+# These take precedence over the 'patient id' variant of the ID alias.
+PATIENT_KEYS = {'patient', 'patientid', 'patientref', 'patientidentifier', 'mrn', 'pid'}
+
+SUPPORTED_FORMATS = ('auto', 'ndjson', 'hl7')
+MATCH_FIELDS = ('id', 'username', 'email')
+
+DEFAULT_BATCH_SIZE = 256
+MAX_BATCH_SIZE = 5000
+
+
+# ==================== Field Mapping ====================
+
+def _alias_lookup() -> Dict[str, str]:
+    """Flatten ALIASES into {normalized variant: standard name}."""
+    lookup = {}
+    for std_name, variants in ALIASES.items():
+        lookup.setdefault(norm(std_name), std_name)
+        for v in variants:
+            lookup.setdefault(norm(v), std_name)
+    return lookup
+
+
+def map_record(fields: Dict[str, Any], lookup: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Map one feed record onto standard CBC column names.
+
+    Args:
+        fields: Raw field name -> value
+        lookup: Result of _alias_lookup()
+
+    Returns:
+        Dict keyed by standard names, plus PATIENT_REF when an identifier is present
+    """
+    record = {}
+    for key, value in fields.items():
+        key_norm = norm(key)
+        if key_norm in PATIENT_KEYS:
+            record[PATIENT_REF] = None if value is None else str(value).strip()
+            continue
+        std_name = lookup.get(key_norm)
+        if std_name and std_name not in record:
+            record[std_name] = value
+    return record
+
+
+# ==================== Stream Parsing ====================
+
+async def iter_lines(byte_stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split an async byte stream into text lines (\\n, \\r\\n or HL7 \\r separators)."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    async for chunk in byte_stream:
+        pending += decoder.decode(chunk)
+        pending = pending.replace('\r\n', '\n').replace('\r', '\n')
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def parse_ndjson_line(line: str, lookup: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Parse one NDJSON line into a mapped record (None for blank or invalid lines)."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        fields = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(fields, dict):
+        return None
+    return map_record(fields, lookup)
+
+
+class HL7MessageAssembler:
+    """
+    Assemble HL7 v2-style ORU messages segment by segment.
+
+    A message starts at MSH; PID-3 carries the patient identifier and every
+    OBX contributes OBX-3 (code^text) -> OBX-5 (value). Only one message is
+    held at a time.
+    """
+
+    def __init__(self, lookup: Dict[str, str]):
+        self.lookup = lookup
+        self._fields = None
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        """Consume one segment; returns the previous message when a new one starts."""
+        line = line.strip()
+        if not line:
+            return None
+
+        segment = line.split('|')
+        kind = segment[0].upper()
+        completed = None
+
+        if kind == 'MSH':
+            completed = self.flush()
+            self._fields = {}
+        elif self._fields is None:
+            return None
+        elif kind == 'PID' and len(segment) > 3:
+            self._fields['patient'] = segment[3].split('^')[0]
+        elif kind == 'OBX' and len(segment) > 5:
+            components = segment[3].split('^')
+            name = next(
+                (c for c in components[:2] if norm(c) in self.lookup),
+                components[0]
+            )
+            self._fields[name] = segment[5]
+
+        return completed
+
+    def flush(self) -> Optional[Dict[str, Any]]:
+        """Return the message being assembled, if any."""
+        if not self._fields:
+            self._fields = None
+            return None
+        fields, self._fields = self._fields, None
+        return map_record(fields, self.lookup)
+
+
+async def iter_feed_records(
+    byte_stream: AsyncIterator[bytes],
+    fmt: str = 'auto'
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield mapped CBC records from an NDJSON or HL7-style byte stream.
+
+    With fmt='auto' the format is detected from the first non-blank line.
+    """
+    lookup = _alias_lookup()
+    assembler = None
+
+    async for line in iter_lines(byte_stream):
+        if fmt == 'auto':
+            stripped = line.strip()
+            if not stripped:
+                continue
+            fmt = 'ndjson' if stripped.startswith('{') else 'hl7'
+
+        if fmt == 'ndjson':
+            record = parse_ndjson_line(line, lookup)
+        else:
+            if assembler is None:
+                assembler = HL7MessageAssembler(lookup)
+            record = assembler.feed(line)
+
+        if record is not None:
+            yield record
+
+    if assembler is not None:
+        record = assembler.flush()
+        if record is not None:
+            yield record
+
+
+# ==================== Patient Routing ====================
+
+class PatientRouter:
+    """Resolve feed identifiers to patients the uploader may write to (cached per feed)."""
+
+    def __init__(self, db: Session, current_user: User, match_by: str = 'id'):
+        self.db = db
+        self.current_user = current_user
+        self.match_by = match_by
+        self._cache: Dict[str, Optional[int]] = {}
+
+    def resolve(self, identifier: Optional[str]) -> Optional[int]:
+        """Return the patient ID for an identifier, or None if unknown or not accessible."""
+        if not identifier:
+            return None
+        if identifier not in self._cache:
+            self._cache[identifier] = self._lookup(identifier)
+        return self._cache[identifier]
+
+    def _lookup(self, identifier: str) -> Optional[int]:
+        query = self.db.query(User).filter(User.role == "patient")
+        if self.match_by == 'id':
+            if not identifier.isdigit():
+                return None
+            patient = query.filter(User.id == int(identifier)).first()
+        elif self.match_by == 'username':
+            patient = query.filter(User.username == identifier).first()
+        else:
+            patient = query.filter(User.email == identifier).first()
+
+        if not patient:
+            return None
+        has_access, _ = check_patient_access(self.current_user, patient, self.db)
+        return patient.id if has_access else None
+
+
+# ==================== Ingestion ====================
+
+async def ingest_cbc_feed(
+    byte_stream: AsyncIterator[bytes],
+    current_user: User,
+    db: Session,
+    fmt: str = 'auto',
+    match_by: str = 'id',
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    notes: str = ""
+) -> Dict[str, Any]:
+    """
+    Ingest a CBC lab feed: parse, route, score in batches and store results.
+
+    Each batch creates one CBC test per patient present in it and is
+    committed on its own, so a long-running feed makes steady progress.
+    If the feed fails part way, the batches committed so far are kept and
+    reported (success False, with an "error" and the counters so far).
+
+    Args:
+        byte_stream: Async iterator over the raw request body
+        current_user: User submitting the feed
+        db: Database session
+        fmt: 'auto', 'ndjson' or 'hl7'
+        match_by: Patient field the feed identifier is matched against
+        batch_size: Feed rows per batch (routed rows are scored in one model call)
+        notes: Notes stored on each created test
+
+    Returns:
+        Dict with success status, message and row/test counters; test_ids
+        lists the stored tests
+    """
+    if fmt not in SUPPORTED_FORMATS:
+        return {"success": False, "message": f"Unsupported format '{fmt}'. Use one of: {', '.join(SUPPORTED_FORMATS)}."}
+    if match_by not in MATCH_FIELDS:
+        return {"success": False, "message": f"Unsupported match field '{match_by}'. Use one of: {', '.join(MATCH_FIELDS)}."}
+    if not cbc_prediction_service.is_available():
+        return {"success": False, "message": "AI prediction modules are not available"}
+
+    cbc_model = db.query(Model).filter(Model.name == "CBC Anemia Detection").first()
+    if not cbc_model:
+        return {
+            "success": False,
+            "message": "CBC Anemia Detection model not found. Please ensure database is properly initialized."
+        }
+
+    if not cbc_prediction_service._loaded:
+        cbc_prediction_service.load_model()
+
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    router = PatientRouter(db, current_user, match_by)
+    summary = {
+        "rows_received": 0,
+        "rows_scored": 0,
+        "rows_unrouted": 0,
+        "rows_invalid": 0,
+        "rows_duplicate": 0,
+        "batches": 0,
+        "test_ids": [],
+    }
+
+    def save_batch(df_annotated: pd.DataFrame) -> List[int]:
+        """Store one test per patient of a scored batch and commit them together"""
+        test_ids = []
+        try:
+            for patient_id, df_patient in df_annotated.groupby(PATIENT_REF, sort=False):
+                new_test = cbc_prediction_service.save_annotated_test(
+                    db,
+                    cbc_model,
+                    int(patient_id),
+                    df_patient.drop(columns=[PATIENT_REF]).reset_index(drop=True),
+                    notes=notes or "CBC results received from lab feed",
+                    filename_prefix="cbc_feed"
+                )
+                test_ids.append(new_test.id)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return test_ids
+
+    def route_batch(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Resolve the patients of a batch's records, dropping those without one"""
+        routed = []
+        for record in batch:
+            patient_id = router.resolve(record.get(PATIENT_REF))
+            if patient_id is not None:
+                record[PATIENT_REF] = patient_id
+                routed.append(record)
+        return routed
+
+    async def score_batch(batch: List[Dict[str, Any]]):
+        summary["batches"] += 1
+        # Unseen identifiers are looked up in the database, so routing stays off the event loop
+        routed = await run_in_threadpool(route_batch, batch)
+        summary["rows_unrouted"] += len(batch) - len(routed)
+        if not routed:
+            return
+        batch = routed
+        df_batch = pd.DataFrame(batch)
+        # One malformed value must not turn its whole column into text: only its row is dropped
+        for column in cbc_prediction_service.used_features:
+            if column in df_batch.columns and column != 'Sex':
+                df_batch[column] = pd.to_numeric(df_batch[column], errors='coerce')
+        try:
+            df_annotated, _ = await run_in_threadpool(
+                predict_and_annotate_dataframe,
+                df_batch,
+                cbc_prediction_service.model,
+                cbc_prediction_service.scaler,
+                cbc_prediction_service.used_features
+            )
+        except ValueError:
+            summary["rows_invalid"] += len(batch)
+            return
+        cbc_prediction_service.observe_features(df_annotated)
+
+        # File writes, blob store and commit stay off the event loop
+        test_ids = await run_in_threadpool(save_batch, df_annotated)
+
+        summary["rows_invalid"] += len(batch) - len(df_annotated)
+        summary["rows_scored"] += len(df_annotated)
+        summary["rows_duplicate"] += df_annotated.attrs.get(DUPLICATE_ROWS, 0)
+        summary["test_ids"].extend(test_ids)
+
+    batch: List[Dict[str, Any]] = []
+    try:
+        async for record in iter_feed_records(byte_stream, fmt):
+            summary["rows_received"] += 1
+            batch.append(record)
+            if len(batch) >= batch_size:
+                await score_batch(batch)
+                batch = []
+
+        if batch:
+            await score_batch(batch)
+    except Exception as e:
+        # Earlier batches are committed: tell the sender how far the feed got
+        return {
+            "success": False,
+            "error": str(e),
+            "message": (
+                f"Lab feed stopped after {len(summary['test_ids'])} stored test(s) "
+                f"({summary['rows_scored']} of {summary['rows_received']} row(s) scored): {e}"
+            ),
+            **summary
+        }
+
+    return {
+        "success": True,
+        "message": f"Lab feed processed: {summary['rows_scored']} of {summary['rows_received']} row(s) scored.",
+        **summary
+    }
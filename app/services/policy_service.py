@@ -8,9 +8,11 @@ from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from app.database import User
+from app.services.preview_service import register_filters
 
 # Initialize templates
 templates = Jinja2Templates(directory="app/templates")
+register_filters(templates.env)
 
 
 class AccountDeactivatedException(Exception):
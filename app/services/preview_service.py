@@ -0,0 +1,164 @@
+"""
+Preview Service
+Resized, recompressed previews of uploaded images at a few fixed sizes.
+
+Pages show small previews instead of the full-resolution originals: a
+profile photo is displayed at 48px, and a microscope image in a card a few
+hundred pixels wide. Previews are rendered once per image, in the
+background after the upload response is sent, and cached next to the
+original in the blob store's derived files (so they are removed with it):
+
+    uploads/blobs/derived/<first 2 hex>/<sha256>/preview_thumb_320.jpg
+
+Templates use the ``preview`` filter, which falls back to the original
+until the preview exists (or for files outside the blob store):
+
+    <img src="{{ current_user.profile_image | preview('avatar') }}">
+
+    python -m app.services.preview_service backfill   # previews for existing images
+"""
+import argparse
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import cv2
+from jinja2 import Environment
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, Blob
+from app.services import blob_store
+
+
+# Longest side in pixels of each preview
+PREVIEW_SIZES = {
+    "avatar": 96,
+    "thumb": 320,
+    "preview": 1280,
+}
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "82"))
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff"}
+
+
+def preview_name(size: str) -> str:
+    """Derived file name of a preview size"""
+    return f"preview_{size}_{PREVIEW_SIZES[size]}.jpg"
+
+
+def preview_path(path: Optional[str], size: str) -> Optional[Path]:
+    """Where the preview of a stored image is cached (None for files outside the store)"""
+    sha256 = blob_store.blob_sha256(path) if path else None
+    if sha256 is None or Path(path).suffix.lower() not in IMAGE_EXTENSIONS:
+        return None
+    return blob_store.derived_path(sha256, preview_name(size), create=False)
+
+
+def preview_url(path: Optional[str], size: str = "thumb") -> str:
+    """URL of an image's preview, or of the original until the preview exists"""
+    if not path:
+        return ""
+    preview = preview_path(path, size)
+    if preview is not None and preview.exists():
+        return f"/{preview.as_posix()}"
+    return f"/{path}"
+
+
+def register_filters(env: Environment):
+    """Make the ``preview`` filter available to templates"""
+    env.filters["preview"] = preview_url
+
+
+# ==================== Rendering ====================
+
+def render_previews(image_path, sha256: str, sizes: Iterable[str]) -> Dict[str, int]:
+    """
+    Write JPEG previews of a stored image.
+
+    The image is decoded once; each size is resized from the next larger
+    one (area interpolation), and images are never enlarged.
+
+    Args:
+        image_path: Original image
+        sha256: Its content hash
+        sizes: Preview size names to render
+
+    Returns:
+        Bytes written per size
+
+    Raises:
+        ValueError: If the file is not a readable image
+    """
+    image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Not a readable image: {os.path.basename(str(image_path))}")
+
+    written = {}
+    for size in sorted(sizes, key=PREVIEW_SIZES.get, reverse=True):
+        scale = PREVIEW_SIZES[size] / max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(
+                image,
+                (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+                interpolation=cv2.INTER_AREA
+            )
+        ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY,
+                                                cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        if not ok:
+            raise ValueError(f"Could not encode a preview of {os.path.basename(str(image_path))}")
+        blob_store.cached_artifact(sha256, preview_name(size), lambda p: p.write_bytes(data.tobytes()))
+        written[size] = len(data)
+    return written
+
+
+def generate_previews(path: Optional[str]) -> Dict[str, int]:
+    """
+    Render the missing previews of a stored image.
+
+    Meant to run as a background task after an upload: errors are logged,
+    not raised, and pages keep showing the original.
+
+    Returns:
+        Bytes written per newly rendered size
+    """
+    sizes = [
+        size for size in PREVIEW_SIZES
+        if (preview := preview_path(path, size)) is not None and not preview.exists()
+    ]
+    if not sizes or not os.path.exists(path):
+        return {}
+    try:
+        return render_previews(path, blob_store.blob_sha256(path), sizes)
+    except (ValueError, cv2.error) as e:
+        print(f"⚠️ Could not render previews of {path}: {e}")
+        return {}
+
+
+def backfill_previews(db: Session) -> Dict[str, int]:
+    """Render missing previews of every stored image."""
+    stats = {"images": 0, "bytes": 0}
+    images = db.query(Blob.sha256, Blob.extension).filter(Blob.extension.in_(IMAGE_EXTENSIONS), Blob.ref_count > 0)
+    for sha256, extension in images:
+        written = generate_previews(str(blob_store.blob_path(sha256, extension)))
+        if written:
+            stats["images"] += 1
+            stats["bytes"] += sum(written.values())
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render previews of uploaded images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="render missing previews of stored images")
+    parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        stats = backfill_previews(db)
+        print(f"Rendered previews of {stats['images']:,} images ({stats['bytes']:,} bytes)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
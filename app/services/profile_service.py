@@ -5,8 +5,9 @@ from sqlalchemy.orm import Session
 from app.database import User
 from app.services.auth_service import verify_password, hash_password
 from app.services.ui_service import set_flash_message
+from app.services import blob_store
+from app.services.upload_service import UploadTooLargeError
 from pathlib import Path
-import uuid
 import os
 
 
@@ -184,27 +185,20 @@ async def upload_user_profile_image(
     if file_ext not in allowed_extensions:
         return False, "Invalid file type. Only JPG, PNG, and GIF are allowed"
     
-    # Create uploads/profiles directory if it doesn't exist
-    upload_dir = Path("uploads/profiles")
-    upload_dir.mkdir(parents=True, exist_ok=True)
+    # Stream the new file into the content-addressed store
+    try:
+        file_path = await blob_store.store_upload(db, profile_image, file_ext)
+    except UploadTooLargeError as e:
+        return False, str(e)
     
-    # Generate unique filename
-    unique_filename = f"{uuid.uuid4()}{file_ext}"
-    file_path = upload_dir / unique_filename
-    
-    # Delete old profile image if exists
-    if current_user.profile_image:
-        old_file = Path(current_user.profile_image)
-        if old_file.exists():
-            old_file.unlink()
-    
-    # Save new file
-    with open(file_path, "wb") as buffer:
-        content = await profile_image.read()
-        buffer.write(content)
-    
-    # Update user profile_image path
-    current_user.profile_image = str(file_path)
+    # Release the old image only once the new one is saved
+    old_image = current_user.profile_image
+    current_user.profile_image = file_path
+    legacy_image = old_image and not blob_store.release(db, old_image)
     db.commit()
     
+    # Images from before the store are owned by this user alone
+    if legacy_image and Path(old_image).exists():
+        Path(old_image).unlink()
+    
     return True, "Profile image updated successfully!"
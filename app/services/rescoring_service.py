@@ -0,0 +1,406 @@
+"""
+CBC Re-scoring Service
+Re-runs the current CBC model over the stored inputs of historical tests in
+a resumable background job. Each stored test gets a companion file with the
+new predictions, tagged with the model version that produced them.
+
+Tests are walked in ID order in fixed-size batches; the highest processed
+test ID is committed together with each batch's results, so a job can be
+cancelled, or survive a restart, and continue exactly where it stopped.
+After every batch the worker sleeps long enough to stay within its CPU
+budget, leaving headroom for interactive traffic.
+
+Run ``python -m app.services.rescoring_service`` to re-score in the
+foreground (e.g. from a nightly cron job).
+"""
+import argparse
+import threading
+import time
+import os
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, Model, Test, TestFile, RescoringJob
+from app.services import blob_store
+from app.services.ai_service import cbc_prediction_service
+from app.services.result_storage import RESULT_EXTENSIONS, read_results, result_extension, write_results
+
+
+# TestFile.type of the re-scored prediction files
+RESCORE_FILE_TYPE = 'rescore'
+
+# Tests per batch and fraction of one core's wall time the job may use
+DEFAULT_BATCH_SIZE = int(os.getenv("RESCORE_BATCH_SIZE", "200"))
+DEFAULT_CPU_BUDGET = float(os.getenv("RESCORE_CPU_BUDGET", "0.25"))
+MAX_BATCH_SIZE = 5000
+
+ACTIVE_STATUSES = ('pending', 'running')
+RESUMABLE_STATUSES = ('cancelled', 'failed')
+
+# Live worker threads and their cancel signals, by job ID
+_workers: Dict[int, threading.Thread] = {}
+_cancel_events: Dict[int, threading.Event] = {}
+_workers_lock = threading.Lock()
+
+
+# ==================== Scoring ====================
+
+def rescore_filename(test_id: int, version: str, extension: Optional[str] = None) -> str:
+    return f"cbc_rescore_{test_id}_{version}{extension or result_extension()}"
+
+
+def _rescore_stem(test_id: int, version: str) -> str:
+    """Rescore file name without its extension, which follows the storage format of its time"""
+    return os.path.splitext(rescore_filename(test_id, version, '.csv'))[0]
+
+
+def throttle_delay(busy_seconds: float, cpu_budget: float) -> float:
+    """Seconds to sleep after busy_seconds of work to average out at cpu_budget."""
+    if cpu_budget >= 1:
+        return 0.0
+    return busy_seconds * (1.0 / max(cpu_budget, 0.01) - 1.0)
+
+
+def rescore_tests(db: Session, tests: List[Test], version: str) -> Dict[str, int]:
+    """
+    Score the stored inputs of a batch of tests in one model call.
+
+    Writes one rescore file per test and adds its TestFile row; the caller
+    commits. Tests already re-scored with this version, and tests without
+    a readable output file, are skipped.
+
+    Returns:
+        Dict with tests_processed, tests_skipped and rows_processed
+    """
+    model = cbc_prediction_service.model
+    scaler = cbc_prediction_service.scaler
+    used_features = cbc_prediction_service.used_features
+
+    test_ids = [t.id for t in tests]
+    files = db.query(TestFile).filter(
+        TestFile.test_id.in_(test_ids),
+        TestFile.type.in_(['output', RESCORE_FILE_TYPE])
+    ).all()
+    done = {
+        f.test_id for f in files
+        if f.type == RESCORE_FILE_TYPE and os.path.splitext(f.name)[0] == _rescore_stem(f.test_id, version)
+    }
+    outputs = {f.test_id: f for f in files if f.type == 'output' and f.extension in RESULT_EXTENSIONS}
+
+    frames, owners = [], []
+    skipped = 0
+    for test_id in test_ids:
+        output_file = outputs.get(test_id)
+        if test_id in done or output_file is None or not os.path.exists(output_file.path):
+            skipped += 1
+            continue
+        try:
+            df = read_results(output_file.path, columns=used_features)
+        except (ValueError, OSError):
+            skipped += 1
+            continue
+        if any(c not in df.columns for c in used_features) or df.empty:
+            skipped += 1
+            continue
+        frames.append(df[used_features])
+        owners.append(test_id)
+
+    if not frames:
+        return {"tests_processed": 0, "tests_skipped": skipped, "rows_processed": 0}
+
+    X = np.vstack([f.to_numpy(dtype=np.float64) for f in frames])
+    valid = ~np.isnan(X).any(axis=1)
+    predictions = np.full(len(X), -1, dtype=np.int64)
+    probabilities = np.full(len(X), np.nan)
+    if valid.any():
+        X_scaled = scaler.transform(X[valid])
+        predictions[valid] = model.predict(X_scaled)
+        probabilities[valid] = model.predict_proba(X_scaled)[:, 1]
+
+    extension = result_extension()
+    start = 0
+    for test_id, frame in zip(owners, frames):
+        end = start + len(frame)
+        preds = predictions[start:end]
+        out = pd.DataFrame({
+            'row_index': np.arange(len(frame)),
+            'Predicted_Anemia': np.where(preds >= 0, preds, np.nan),
+            'Diagnosis': np.where(preds == 1, 'Anemia', np.where(preds == 0, 'Normal', None)),
+            'Anemia_Probability': np.round(probabilities[start:end], 4),
+            'Model_Version': version,
+        })
+        tmp_path = blob_store.temp_path(extension)
+        write_results(out, tmp_path)
+        db.add(TestFile(
+            test_id=test_id,
+            name=rescore_filename(test_id, version, extension),
+            extension=extension,
+            path=blob_store.store_file(db, tmp_path, extension),
+            type=RESCORE_FILE_TYPE
+        ))
+        start = end
+
+    return {"tests_processed": len(owners), "tests_skipped": skipped, "rows_processed": len(X)}
+
+
+# ==================== Job Execution ====================
+
+def _fail_if_model_changed(db: Session, job: RescoringJob) -> bool:
+    """Mark the job failed if the loaded model is not the one it was started with."""
+    if job.model_version == cbc_prediction_service.model_version:
+        return False
+    job.status = 'failed'
+    job.error = (
+        f"Model changed from {job.model_version} to "
+        f"{cbc_prediction_service.model_version}; start a new job"
+    )
+    job.updated_at = job.finished_at = datetime.utcnow()
+    db.commit()
+    return True
+
+
+def run_rescoring_job(
+    job_id: int,
+    session_factory: Callable[[], Session] = SessionLocal,
+    cancel_event: Optional[threading.Event] = None
+) -> str:
+    """
+    Run (or continue) a re-scoring job until it finishes, fails or is cancelled.
+
+    Args:
+        job_id: ID of the RescoringJob
+        session_factory: Creates the job's own database session
+        cancel_event: Set to stop the job after the current batch
+
+    Returns:
+        The job's final status
+    """
+    cancel_event = cancel_event or threading.Event()
+    db = session_factory()
+    try:
+        job = db.query(RescoringJob).filter(RescoringJob.id == job_id).first()
+        if not job:
+            return 'missing'
+
+        if not cbc_prediction_service._loaded:
+            cbc_prediction_service.load_model()
+        if _fail_if_model_changed(db, job):
+            return job.status
+
+        job.status = 'running'
+        job.error = None
+        db.commit()
+
+        cpu_budget = float(job.cpu_budget)
+        while not cancel_event.is_set():
+            started = time.perf_counter()
+            tests = db.query(Test).filter(
+                Test.model_id == job.model_id,
+                Test.id > job.last_test_id
+            ).order_by(Test.id).limit(job.batch_size).all()
+            if not tests:
+                job.status = 'completed'
+                break
+
+            counts = rescore_tests(db, tests, job.model_version)
+            if cbc_prediction_service.model_version != job.model_version:
+                # The model was reloaded while the job ran; the batch may hold its predictions
+                db.rollback()
+                _fail_if_model_changed(db, job)
+                return job.status
+            job.last_test_id = tests[-1].id
+            job.tests_processed += counts["tests_processed"]
+            job.tests_skipped += counts["tests_skipped"]
+            job.rows_processed += counts["rows_processed"]
+            job.updated_at = datetime.utcnow()
+            db.commit()
+
+            cancel_event.wait(throttle_delay(time.perf_counter() - started, cpu_budget))
+
+        if job.status != 'completed':
+            job.status = 'cancelled'
+        job.updated_at = datetime.utcnow()
+        if job.status == 'completed':
+            job.finished_at = job.updated_at
+        db.commit()
+        return job.status
+
+    except Exception as e:
+        db.rollback()
+        job = db.query(RescoringJob).filter(RescoringJob.id == job_id).first()
+        if job:
+            job.status = 'failed'
+            job.error = str(e)
+            job.updated_at = datetime.utcnow()
+            db.commit()
+        return 'failed'
+    finally:
+        db.close()
+
+
+def _launch(job_id: int, session_factory: Callable[[], Session]):
+    """Run a job on a daemon thread."""
+    cancel_event = threading.Event()
+
+    def work():
+        try:
+            run_rescoring_job(job_id, session_factory, cancel_event)
+        finally:
+            with _workers_lock:
+                _workers.pop(job_id, None)
+                _cancel_events.pop(job_id, None)
+
+    thread = threading.Thread(target=work, name=f"rescoring-job-{job_id}", daemon=True)
+    with _workers_lock:
+        _workers[job_id] = thread
+        _cancel_events[job_id] = cancel_event
+    thread.start()
+    return thread
+
+
+def is_job_alive(job_id: int) -> bool:
+    """Check whether a job has a live worker in this process."""
+    with _workers_lock:
+        thread = _workers.get(job_id)
+    return thread is not None and thread.is_alive()
+
+
+# ==================== Job Control ====================
+
+def start_rescoring_job(
+    db: Session,
+    created_by: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cpu_budget: float = DEFAULT_CPU_BUDGET,
+    session_factory: Callable[[], Session] = SessionLocal,
+    background: bool = True
+) -> Dict:
+    """
+    Create a re-scoring job for the current CBC model and start it.
+
+    Returns:
+        Dict with success status, message and job_id
+    """
+    if not cbc_prediction_service.is_available():
+        return {"success": False, "message": "AI prediction modules are not available"}
+
+    cbc_model = db.query(Model).filter(Model.name == "CBC Anemia Detection").first()
+    if not cbc_model:
+        return {"success": False, "message": "CBC Anemia Detection model not found."}
+
+    active = db.query(RescoringJob).filter(RescoringJob.status.in_(ACTIVE_STATUSES)).first()
+    if active and is_job_alive(active.id):
+        return {"success": False, "message": f"Re-scoring job #{active.id} is already running."}
+
+    if not cbc_prediction_service._loaded:
+        cbc_prediction_service.load_model()
+
+    job = RescoringJob(
+        model_id=cbc_model.id,
+        model_version=cbc_prediction_service.model_version,
+        status='pending',
+        last_test_id=0,
+        batch_size=max(1, min(batch_size, MAX_BATCH_SIZE)),
+        cpu_budget=min(max(cpu_budget, 0.01), 1.0),
+        created_by=created_by
+    )
+    db.add(job)
+    db.commit()
+
+    if background:
+        _launch(job.id, session_factory)
+    return {"success": True, "message": f"Re-scoring job #{job.id} started.", "job_id": job.id}
+
+
+def resume_rescoring_job(
+    db: Session,
+    job_id: int,
+    session_factory: Callable[[], Session] = SessionLocal,
+    background: bool = True
+) -> Dict:
+    """
+    Continue a cancelled, failed or interrupted job from its checkpoint.
+
+    A job left 'running' without a live worker (e.g. after a restart) counts
+    as interrupted.
+    """
+    job = db.query(RescoringJob).filter(RescoringJob.id == job_id).first()
+    if not job:
+        return {"success": False, "message": "Re-scoring job not found."}
+    if is_job_alive(job_id):
+        return {"success": False, "message": f"Re-scoring job #{job_id} is already running."}
+    if job.status not in RESUMABLE_STATUSES + ACTIVE_STATUSES:
+        return {"success": False, "message": f"Re-scoring job #{job_id} is {job.status} and cannot be resumed."}
+
+    job.status = 'pending'
+    job.finished_at = None
+    db.commit()
+
+    if background:
+        _launch(job.id, session_factory)
+    return {"success": True, "message": f"Re-scoring job #{job_id} resumed after test #{job.last_test_id}.", "job_id": job.id}
+
+
+def cancel_rescoring_job(db: Session, job_id: int) -> Dict:
+    """Stop a job after its current batch; progress up to there is kept."""
+    job = db.query(RescoringJob).filter(RescoringJob.id == job_id).first()
+    if not job:
+        return {"success": False, "message": "Re-scoring job not found."}
+
+    with _workers_lock:
+        cancel_event = _cancel_events.get(job_id)
+    if cancel_event is not None:
+        cancel_event.set()
+        return {"success": True, "message": f"Re-scoring job #{job_id} will stop after the current batch."}
+
+    if job.status not in ACTIVE_STATUSES:
+        return {"success": False, "message": f"Re-scoring job #{job_id} is not running."}
+
+    job.status = 'cancelled'
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    return {"success": True, "message": f"Re-scoring job #{job_id} cancelled."}
+
+
+def get_recent_jobs(db: Session, limit: int = 5) -> List[RescoringJob]:
+    """Most recent re-scoring jobs, newest first."""
+    return db.query(RescoringJob).order_by(RescoringJob.id.desc()).limit(limit).all()
+
+
+# ==================== Command Line ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored CBC tests with the current model.")
+    parser.add_argument("--resume", type=int, metavar="JOB_ID", help="continue an existing job")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="tests per batch")
+    parser.add_argument("--cpu-budget", type=float, default=DEFAULT_CPU_BUDGET, help="fraction of one core to use (0-1]")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.resume:
+            result = resume_rescoring_job(db, args.resume, background=False)
+        else:
+            result = start_rescoring_job(
+                db, batch_size=args.batch_size, cpu_budget=args.cpu_budget, background=False
+            )
+    finally:
+        db.close()
+
+    print(result["message"])
+    if not result["success"]:
+        raise SystemExit(1)
+
+    try:
+        status = run_rescoring_job(result["job_id"])
+    except KeyboardInterrupt:
+        status = 'interrupted (resume with --resume)'
+    print(f"Re-scoring job #{result['job_id']}: {status}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Result Storage Service
+Pluggable on-disk formats for annotated CBC output files (TestFile.type
+'output').
+
+New results are written in RESULT_STORAGE_FORMAT (default "npz"): a
+compressed NumPy archive holding one typed array per column, so readers
+decompress only the columns they ask for and nothing has to be parsed
+from text. Older results stay in CSV and are read through the row offset
+index. The format of an existing file is chosen by its extension, so both
+kinds can be mixed freely.
+
+CSV is only produced when a user downloads a result (see export_csv).
+"""
+import io
+import os
+import uuid
+from typing import Callable, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from app.services.row_index import write_csv, count_rows, read_rows
+
+
+RESULT_FORMAT = os.getenv("RESULT_STORAGE_FORMAT", "npz")
+
+# Rows per chunk when streaming a CSV export
+EXPORT_CHUNK_ROWS = 5000
+
+Columns = Optional[Union[List[str], Callable[[str], bool]]]
+
+
+def _select(names: List[str], columns: Columns) -> List[str]:
+    """Column names to load, in file order"""
+    if columns is None:
+        return list(names)
+    if callable(columns):
+        return [n for n in names if columns(n)]
+    wanted = set(columns)
+    return [n for n in names if n in wanted]
+
+
+class CSVResultFormat:
+    """Plain CSV with a sidecar row offset index"""
+
+    extension = '.csv'
+
+    def write(self, df: pd.DataFrame, path) -> int:
+        return write_csv(df, path)
+
+    def columns(self, path) -> List[str]:
+        return list(pd.read_csv(path, nrows=0).columns)
+
+    def count_rows(self, path) -> int:
+        return count_rows(path)
+
+    def read(self, path, columns: Columns = None, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+        usecols = None if columns is None else _select(self.columns(path), columns)
+        return read_rows(path, start, stop, usecols=usecols)
+
+
+class NpzResultFormat:
+    """
+    Compressed NumPy archive with one typed array per column and row block.
+
+    Numeric and boolean columns keep their dtype. Other columns (diagnosis,
+    flag labels, sample IDs) are dictionary-encoded: the distinct values
+    are stored once in ``v<column>`` and each block holds small integer
+    codes, -1 marking a missing value. Each column is split into blocks of
+    ``__block__`` rows so reading a page only decompresses the blocks it
+    overlaps. Column names live in ``__columns__`` (arrays are keyed
+    c<column>_<block>, so any name is allowed) and the row count in
+    ``__rows__``.
+    """
+
+    extension = '.npz'
+    block_rows = 16384
+
+    def write(self, df: pd.DataFrame, path) -> int:
+        arrays = {
+            "__columns__": np.array([str(c) for c in df.columns], dtype=str),
+            "__rows__": np.array(len(df), dtype=np.int64),
+            "__block__": np.array(self.block_rows, dtype=np.int64),
+        }
+        for i, name in enumerate(df.columns):
+            series = df[name]
+            if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+                values = series.to_numpy()
+            else:
+                codes, uniques = pd.factorize(series, use_na_sentinel=True)
+                values = codes.astype(np.min_scalar_type(-max(len(uniques), 1)))
+                arrays[f"v{i}"] = np.asarray(uniques, dtype=object).astype(str)
+            for b, start in enumerate(range(0, max(len(df), 1), self.block_rows)):
+                arrays[f"c{i}_{b}"] = values[start:start + self.block_rows]
+
+        # Replace in one step so readers never see a partial write
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+        return len(df)
+
+    def columns(self, path) -> List[str]:
+        with np.load(path) as archive:
+            return archive["__columns__"].tolist()
+
+    def count_rows(self, path) -> int:
+        with np.load(path) as archive:
+            return int(archive["__rows__"])
+
+    def read(self, path, columns: Columns = None, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+        with np.load(path) as archive:
+            names = archive["__columns__"].tolist()
+            n_rows = int(archive["__rows__"])
+            block_rows = int(archive["__block__"])
+            start = max(0, min(start, n_rows))
+            stop = n_rows if stop is None else max(start, min(stop, n_rows))
+            first, last = start // block_rows, max(start, stop - 1) // block_rows
+            offset = start - first * block_rows
+            encoded = set(archive.files)
+
+            data = {}
+            for name in _select(names, columns):
+                i = names.index(name)
+                values = np.concatenate([archive[f"c{i}_{b}"] for b in range(first, last + 1)])
+                values = values[offset:offset + stop - start]
+                if f"v{i}" in encoded:
+                    labels = np.append(archive[f"v{i}"].astype(object), np.nan)
+                    values = labels[values]  # code -1 picks the trailing NaN
+                data[name] = values
+
+        return pd.DataFrame(data, index=pd.RangeIndex(start, stop))
+
+
+FORMATS = {fmt.extension: fmt for fmt in (CSVResultFormat(), NpzResultFormat())}
+RESULT_EXTENSIONS = list(FORMATS)
+
+
+def _format_for(path):
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported result file format: {extension}")
+    return FORMATS[extension]
+
+
+def result_extension() -> str:
+    """Extension of newly written result files (from RESULT_STORAGE_FORMAT)"""
+    extension = f".{RESULT_FORMAT.lstrip('.').lower()}"
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown RESULT_STORAGE_FORMAT: {RESULT_FORMAT}")
+    return extension
+
+
+def write_results(df: pd.DataFrame, path) -> int:
+    """Write an annotated dataframe in the format given by the path's extension"""
+    return _format_for(path).write(df, path)
+
+
+def read_results(path, columns: Columns = None, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+    """
+    Read rows [start, stop) of a result file.
+
+    Args:
+        path: Result file (.csv or .npz)
+        columns: Column names, or a predicate on the name; None for all
+        start: First row
+        stop: Row after the last one (default: end of file)
+
+    Returns:
+        DataFrame indexed by row number in the file
+    """
+    return _format_for(path).read(path, columns, start, stop)
+
+
+def result_columns(path) -> List[str]:
+    """Column names of a result file, without reading any rows"""
+    return _format_for(path).columns(path)
+
+
+def count_result_rows(path) -> int:
+    """Number of rows in a result file"""
+    return _format_for(path).count_rows(path)
+
+
+def export_csv(path) -> Iterator[bytes]:
+    """Stream a result file as CSV, chunk by chunk"""
+    fmt = _format_for(path)
+    if isinstance(fmt, CSVResultFormat):
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(1 << 20), b"")
+        return
+
+    df = fmt.read(path)
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        buffer = io.StringIO()
+        df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(buffer, index=False, header=start == 0, lineterminator='\n')
+        yield buffer.getvalue().encode("utf-8")
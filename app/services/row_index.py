@@ -0,0 +1,172 @@
+"""
+Row Offset Index Service
+Sidecar byte-offset index for stored CSV result files, so a page of rows
+can be read by seeking straight to it instead of parsing the whole file.
+
+The index of ``results.csv`` lives in ``results.csv.rowidx``: a flat int64
+array where entry i is the byte offset at which data row i starts and the
+last entry is the file size. The header is everything before entry 0.
+A size mismatch marks the index as stale, and a missing or stale index is
+rebuilt in one streaming pass.
+
+A newline ends a row unless it is inside a quoted field (e.g. a note with
+a line break); the scan tracks the parity of the quote characters seen so
+far, which an escaped quote ("") leaves unchanged.
+"""
+import io
+import os
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+ROW_INDEX_SUFFIX = '.rowidx'
+OFFSET_DTYPE = np.int64
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+_SCAN_CHUNK = 1 << 20
+
+
+def row_index_path(path) -> Path:
+    """Sidecar index path of a CSV file"""
+    return Path(f"{path}{ROW_INDEX_SUFFIX}")
+
+
+def _row_ends(data: bytes, base: int = 0, in_quotes: bool = False):
+    """
+    Offsets just past every newline in data that ends a row, shifted by base.
+
+    Args:
+        data: Bytes of the file
+        base: Offset of data in the file
+        in_quotes: Whether data starts inside a quoted field
+
+    Returns:
+        Tuple (offsets, in_quotes at the end of data)
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+    quotes = buf == 34
+    if not in_quotes and not quotes.any():
+        return newlines.astype(OFFSET_DTYPE) + base + 1, False
+
+    # 1 where the byte is inside quotes (after an odd number of quote characters)
+    inside = np.bitwise_xor.accumulate(quotes.view(np.uint8)) ^ np.uint8(in_quotes)
+    ends = newlines[inside[newlines] == 0]
+    return ends.astype(OFFSET_DTYPE) + base + 1, bool(inside[-1])
+
+
+def _write_index(path, offsets: np.ndarray):
+    index_path = row_index_path(path)
+    tmp_path = f"{index_path}.{uuid.uuid4().hex[:8]}.tmp"
+    offsets.astype(OFFSET_DTYPE).tofile(tmp_path)
+    os.replace(tmp_path, index_path)
+
+
+def write_csv(df: pd.DataFrame, path) -> int:
+    """
+    Write a dataframe as CSV together with its row offset index.
+
+    Both files are replaced atomically, the CSV last, so a reader never
+    pairs a new index with an old file without noticing the size mismatch.
+
+    Returns:
+        Number of rows written
+    """
+    data = df.to_csv(index=False, lineterminator='\n').encode('utf-8')
+    offsets, _ = _row_ends(data)
+
+    _write_index(path, offsets)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def build_row_index(path) -> np.ndarray:
+    """Scan a CSV file once and write its row offset index"""
+    parts, base, in_quotes = [], 0, False
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_SCAN_CHUNK), b""):
+            ends, in_quotes = _row_ends(chunk, base, in_quotes)
+            parts.append(ends)
+            base += len(chunk)
+
+    ends = np.concatenate(parts) if parts else np.empty(0, dtype=OFFSET_DTYPE)
+    if len(ends) == 0 or ends[-1] != base:
+        # Last line without a trailing newline still ends a row
+        ends = np.append(ends, OFFSET_DTYPE(base))
+    _write_index(path, ends)
+    return ends
+
+
+def load_row_index(path) -> np.ndarray:
+    """
+    Row offsets of a CSV file, memory-mapped; rebuilt if missing or stale.
+
+    Returns:
+        int64 array of n_rows + 1 offsets (row starts, then the file size)
+    """
+    index_path = row_index_path(path)
+    file_size = os.path.getsize(path)
+    if index_path.exists() and index_path.stat().st_size >= 8:
+        offsets = np.memmap(index_path, dtype=OFFSET_DTYPE, mode='r')
+        if offsets[-1] == file_size:
+            return offsets
+    return build_row_index(path)
+
+
+def count_rows(path) -> int:
+    """Number of data rows in a CSV file"""
+    return len(load_row_index(path)) - 1
+
+
+def read_rows(path, start: int = 0, stop: Optional[int] = None, usecols=None) -> pd.DataFrame:
+    """
+    Read data rows [start, stop) of a CSV file.
+
+    Only the header and the requested byte range are read, so memory and
+    latency depend on the page size, not on the file size.
+
+    Args:
+        path: CSV file
+        start: First row
+        stop: Row after the last one (default: end of file)
+        usecols: Optional column subset, as accepted by pandas.read_csv
+
+    Returns:
+        DataFrame indexed by row number in the file
+    """
+    offsets = load_row_index(path)
+    n_rows = len(offsets) - 1
+    start = max(0, min(start, n_rows))
+    stop = n_rows if stop is None else max(start, min(stop, n_rows))
+
+    with open(path, "rb") as f:
+        header = f.read(int(offsets[0]))
+        f.seek(int(offsets[start]))
+        body = f.read(int(offsets[stop] - offsets[start]))
+
+    df = pd.read_csv(io.BytesIO(header + body), usecols=usecols)
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+
+def page_bounds(page: int, page_size: int, n_rows: int):
+    """
+    Clamp pagination parameters.
+
+    Returns:
+        Tuple (page, page_size, total_pages, start, stop)
+    """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    total_pages = max(1, -(-n_rows // page_size))
+    page = max(1, min(page, total_pages))
+    start = (page - 1) * page_size
+    return page, page_size, total_pages, start, min(start + page_size, n_rows)
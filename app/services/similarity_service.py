@@ -0,0 +1,204 @@
+"""
+Similar Case Service
+Finds past reviewed CBC cases whose scaled feature vectors are closest to a
+given sample, using a KD-tree over the feature store.
+
+The tree is rebuilt lazily: rows appended to the feature store since the
+last build are searched by brute force alongside the tree, and the tree is
+rebuilt once that tail grows past REBUILD_TAIL_ROWS or REBUILD_INTERVAL
+seconds have passed.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sqlalchemy.orm import Session
+
+from app.database import User, Test, TestFile, Model, doctor_patients
+from app.services.ai_service import cbc_prediction_service
+from app.services.result_storage import RESULT_EXTENSIONS, read_results
+
+
+REBUILD_INTERVAL = int(os.getenv("SIMILARITY_REBUILD_INTERVAL", "300"))
+REBUILD_TAIL_ROWS = int(os.getenv("SIMILARITY_REBUILD_TAIL_ROWS", "5000"))
+
+# Below this many candidate rows a direct scan beats querying the tree
+BRUTE_FORCE_ROWS = 4096
+
+DEFAULT_K = 5
+MAX_K = 50
+
+
+class SimilarCaseIndex:
+    """KD-tree over the scaled feature store, with a brute-force tail for new rows."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = None
+        self._scaled = None
+        self._built_at = 0.0
+
+    def _snapshot(self):
+        """
+        Return (index, scaled rows covered by the tree, scaled tail rows, tree).
+
+        Only rows appended since the last build are scaled per query; the tree
+        is rebuilt when that tail or the time since the last build grows too large.
+        """
+        features, index = cbc_prediction_service.get_feature_store().load()
+        scaler = cbc_prediction_service.scaler
+
+        with self._lock:
+            built = 0 if self._scaled is None else len(self._scaled)
+            stale = (
+                self._scaled is None
+                or len(features) < built
+                or len(features) - built > REBUILD_TAIL_ROWS
+                or (len(features) > built and time.time() - self._built_at > REBUILD_INTERVAL)
+            )
+            if stale:
+                self._scaled = scaler.transform(features) if len(features) else np.empty((0, features.shape[1]))
+                self._tree = cKDTree(self._scaled) if len(self._scaled) else None
+                self._built_at = time.time()
+                built = len(self._scaled)
+            scaled, tree = self._scaled, self._tree
+
+        tail = scaler.transform(features[built:]) if len(features) > built else np.empty((0, features.shape[1]))
+        return index, scaled, tail, tree
+
+    def query(self, vector: np.ndarray, allowed_tests: np.ndarray, k: int):
+        """
+        Find the k nearest stored rows belonging to the allowed tests.
+
+        Args:
+            vector: Scaled query vector
+            allowed_tests: Test IDs whose rows may be returned
+            k: Number of neighbours
+
+        Returns:
+            Tuple (index, row positions, distances), nearest first
+        """
+        index, scaled, tail, tree = self._snapshot()
+        built = len(scaled)
+        allowed = np.isin(index[:built + len(tail), 0], allowed_tests)
+        n_allowed = int(allowed.sum())
+        if n_allowed == 0:
+            return index, np.empty(0, dtype=np.intp), np.empty(0)
+        k = min(k, n_allowed)
+
+        def distances_to(rows):
+            head = rows[rows < built]
+            return np.concatenate([
+                np.linalg.norm(scaled[head] - vector, axis=1),
+                np.linalg.norm(tail[rows[rows >= built] - built] - vector, axis=1),
+            ]), np.concatenate([head, rows[rows >= built]])
+
+        if n_allowed <= BRUTE_FORCE_ROWS or tree is None:
+            distances, rows = distances_to(np.flatnonzero(allowed))
+        else:
+            # Ask the tree for more neighbours until enough of them are allowed
+            fetch = min(built, k * 4)
+            while True:
+                tree_distances, tree_rows = tree.query(vector, k=fetch)
+                tree_distances, tree_rows = np.atleast_1d(tree_distances), np.atleast_1d(tree_rows)
+                keep = allowed[tree_rows]
+                if keep.sum() >= k or fetch >= built:
+                    break
+                fetch = min(built, fetch * 4)
+            tail_distances, tail_rows = distances_to(np.flatnonzero(allowed[built:]) + built)
+            distances = np.concatenate([tree_distances[keep], tail_distances])
+            rows = np.concatenate([tree_rows[keep], tail_rows])
+
+        order = np.argsort(distances, kind='stable')[:k]
+        return index, rows[order], distances[order]
+
+
+similar_case_index = SimilarCaseIndex()
+
+
+def _query_vector(db: Session, test_id: int, row: int) -> Optional[np.ndarray]:
+    """Raw feature vector of one row of a test (feature store first, output file as fallback)."""
+    stored = cbc_prediction_service.get_feature_store().rows_for_test(test_id)
+    if row < len(stored):
+        return np.asarray(stored[row], dtype=np.float64)
+
+    output_file = db.query(TestFile).filter(
+        TestFile.test_id == test_id,
+        TestFile.type == 'output',
+        TestFile.extension.in_(RESULT_EXTENSIONS)
+    ).first()
+    if not output_file or not os.path.exists(output_file.path):
+        return None
+    df = read_results(output_file.path, columns=cbc_prediction_service.used_features, start=row, stop=row + 1)
+    if len(df) == 0 or any(c not in df.columns for c in cbc_prediction_service.used_features):
+        return None
+    return df[cbc_prediction_service.used_features].iloc[0].to_numpy(dtype=np.float64)
+
+
+def find_similar_cases(
+    db: Session,
+    current_user: User,
+    test_id: int,
+    row: int = 0,
+    k: int = DEFAULT_K
+) -> Dict:
+    """
+    Find the k reviewed CBC cases most similar to one row of a test.
+
+    Only tests of patients the user may access are returned: linked
+    patients for doctors, all patients for admins. The test itself is
+    excluded.
+
+    Returns:
+        Dict with success status, message and a list of similar cases
+    """
+    if not cbc_prediction_service.is_available():
+        return {"success": False, "message": "AI prediction modules are not available"}
+    if not cbc_prediction_service._loaded:
+        cbc_prediction_service.load_model()
+
+    vector = _query_vector(db, test_id, row)
+    if vector is None or np.isnan(vector).any():
+        return {"success": False, "message": "No CBC values found for this sample"}
+    scaled_vector = cbc_prediction_service.scaler.transform(vector.reshape(1, -1))[0]
+
+    query = db.query(Test.id).join(Model, Test.model_id == Model.id).filter(
+        Model.name == "CBC Anemia Detection",
+        Test.review_status != 'pending',
+        Test.id != test_id
+    )
+    if current_user.role != "admin":
+        linked = db.query(doctor_patients.c.patient_id).filter(doctor_patients.c.doctor_id == current_user.id)
+        query = query.filter(Test.patient_id.in_(linked))
+    allowed_tests = np.fromiter((t for (t,) in query), dtype=np.int64)
+
+    index, rows, distances = similar_case_index.query(scaled_vector, allowed_tests, max(1, min(k, MAX_K)))
+
+    tests = {
+        t.id: t for t in db.query(Test).filter(Test.id.in_([int(index[r, 0]) for r in rows]))
+    } if len(rows) else {}
+
+    features = cbc_prediction_service.get_feature_store().load()[0]
+    cases: List[Dict] = []
+    for r, distance in zip(rows, distances):
+        test = tests.get(int(index[r, 0]))
+        if not test:
+            continue
+        cases.append({
+            "test_id": test.id,
+            "row_index": int(index[r, 1]),
+            "distance": round(float(distance), 4),
+            "patient_id": test.patient_id,
+            "review_status": test.review_status,
+            "result": test.result,
+            "reviewed_at": test.reviewed_at.isoformat() if test.reviewed_at else None,
+            "values": {
+                name: round(float(v), 2)
+                for name, v in zip(cbc_prediction_service.used_features, features[r])
+            },
+        })
+
+    return {"success": True, "message": f"Found {len(cases)} similar case(s)", "cases": cases}
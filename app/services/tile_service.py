@@ -0,0 +1,236 @@
+"""
+Tile Service
+Deep Zoom tile pyramids of blood cell images, for zooming into a slide in
+the browser without downloading the original.
+
+Each pyramid level halves the one above it, down to a single pixel, and
+every level is cut into 256px JPEG tiles (Deep Zoom Image format, as read
+by OpenSeadragon). A viewer only fetches the tiles of the region and zoom
+level on screen.
+
+Pyramids are built on the analysis process pool when an image is first
+zoomed into (images nobody zooms cost nothing), and cached with its
+derived files in the blob store, so they are removed with the image:
+
+    uploads/blobs/derived/<first 2 hex>/<sha256>/dzi_v1/image.dzi
+    uploads/blobs/derived/<first 2 hex>/<sha256>/dzi_v1/image_files/<level>/<col>_<row>.jpg
+
+OpenCV decodes an image whole, so the decoded slide is spilled to a
+memory-mapped pixel cache and dropped right away; levels are then cut and
+halved in strips, so only a few tile rows are resident while tiles are
+written. Decoding is limited to MAX_IMAGE_PIXELS, as for the analysis.
+
+Tiles are served by the doctor routes (see app.routers.doctors) with
+long-lived cache headers: they are addressed by content hash, so a tile
+URL never changes its content.
+"""
+import math
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app.ai.blood_cell import load_image
+from app.ai.blood_cell.slide import open_pixels, write_pixels
+from app.services import blob_store
+
+
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_FORMAT = "jpg"
+TILE_QUALITY = int(os.getenv("TILE_JPEG_QUALITY", "85"))
+
+# Bump when the tiles change, so pyramids are rebuilt under a new name
+PYRAMID_VERSION = "1"
+PYRAMID_DIR = f"dzi_v{PYRAMID_VERSION}"
+
+# Browsers may keep tiles for a year without revalidating
+TILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+_build_locks: Dict[str, threading.Lock] = {}
+_build_locks_guard = threading.Lock()
+
+
+def pyramid_dir(sha256: str) -> Path:
+    """Directory of an image's tile pyramid"""
+    return blob_store.derived_path(sha256, PYRAMID_DIR, create=False)
+
+
+def level_count(width: int, height: int) -> int:
+    """Number of pyramid levels: level 0 is 1x1, the last is full size"""
+    return math.ceil(math.log2(max(width, height, 1))) + 1
+
+
+def descriptor(width: int, height: int) -> str:
+    """Deep Zoom (.dzi) descriptor of an image"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{TILE_SIZE}" '
+        f'Overlap="{TILE_OVERLAP}" Format="{TILE_FORMAT}">'
+        f'<Size Width="{width}" Height="{height}"/></Image>\n'
+    )
+
+
+# ==================== Building ====================
+
+def _write_tiles(level_image: np.ndarray, level_dir: Path) -> Tuple[int, int]:
+    """Cut one level into overlapping tiles, reading a strip of tile rows at a time"""
+    level_height, level_width = level_image.shape[:2]
+    level_dir.mkdir(parents=True)
+    tiles = size = 0
+    for row in range(math.ceil(level_height / TILE_SIZE)):
+        y0 = max(row * TILE_SIZE - TILE_OVERLAP, 0)
+        y1 = min((row + 1) * TILE_SIZE + TILE_OVERLAP, level_height)
+        strip = np.ascontiguousarray(level_image[y0:y1])
+        for col in range(math.ceil(level_width / TILE_SIZE)):
+            x0 = max(col * TILE_SIZE - TILE_OVERLAP, 0)
+            x1 = min((col + 1) * TILE_SIZE + TILE_OVERLAP, level_width)
+            ok, data = cv2.imencode(f".{TILE_FORMAT}", strip[:, x0:x1],
+                                    [cv2.IMWRITE_JPEG_QUALITY, TILE_QUALITY])
+            if not ok:
+                raise ValueError("Could not encode a tile")
+            (level_dir / f"{col}_{row}.{TILE_FORMAT}").write_bytes(data.tobytes())
+            tiles += 1
+            size += len(data)
+    return tiles, size
+
+
+def _halve(level_image: np.ndarray, out_path: Path) -> np.ndarray:
+    """Write a level at half size to a memory-mapped file, two tile rows of the source at a time"""
+    level_height, level_width = level_image.shape[:2]
+    half = np.lib.format.open_memmap(
+        out_path, mode='w+', dtype=np.uint8,
+        shape=(math.ceil(level_height / 2), math.ceil(level_width / 2)) + level_image.shape[2:]
+    )
+    for y in range(0, level_height, 2 * TILE_SIZE):
+        band = np.ascontiguousarray(level_image[y:y + 2 * TILE_SIZE])
+        rows = math.ceil(len(band) / 2)
+        half[y // 2:y // 2 + rows] = cv2.resize(band, (half.shape[1], rows), interpolation=cv2.INTER_AREA)
+    half.flush()
+    return half
+
+
+def write_pyramid(pixels: np.ndarray, out_dir: Path) -> Tuple[int, int]:
+    """
+    Cut an image into Deep Zoom tiles.
+
+    Levels are built from the full size down, each resized from the one
+    above it (area interpolation). Levels below the full size are written
+    to memory-mapped scratch files in out_dir, which are removed again, so
+    a memory-mapped ``pixels`` is never loaded whole.
+
+    Returns:
+        (tiles, bytes) written
+    """
+    height, width = pixels.shape[:2]
+    tiles = size = 0
+    level_image = pixels
+    scratch = []
+    try:
+        for level in range(level_count(width, height) - 1, -1, -1):
+            level_tiles, level_size = _write_tiles(level_image, out_dir / "image_files" / str(level))
+            tiles += level_tiles
+            size += level_size
+            if level > 0:
+                scratch.append(out_dir / f".level_{level - 1}.npy")
+                level_image = _halve(level_image, scratch[-1])
+                if len(scratch) > 1:
+                    # Unlinking a mapped file keeps it readable until it is unmapped
+                    scratch[-2].unlink()
+    finally:
+        del level_image
+        for path in scratch:
+            path.unlink(missing_ok=True)
+    (out_dir / "image.dzi").write_text(descriptor(width, height))
+    return tiles, size
+
+
+@contextmanager
+def _build_lock(sha256: str):
+    """Hold the build lock of an image; it is dropped once no build waits for it"""
+    with _build_locks_guard:
+        lock = _build_locks.setdefault(sha256, threading.Lock())
+    with lock:
+        try:
+            yield
+        finally:
+            with _build_locks_guard:
+                if _build_locks.get(sha256) is lock:
+                    del _build_locks[sha256]
+
+
+def ensure_pyramid(image_path: str) -> Optional[Path]:
+    """
+    Return an image's tile pyramid directory, building it on first use.
+
+    The pyramid is written to a temporary directory and renamed into
+    place, so a half-built pyramid is never served; concurrent first
+    views of the same image build it once.
+
+    Returns:
+        The pyramid directory, or None for files outside the blob store
+
+    Raises:
+        ImageTooLargeError: If the image has more than MAX_IMAGE_PIXELS pixels
+        ValueError: If the file is not a readable image
+    """
+    sha256 = blob_store.blob_sha256(image_path)
+    if sha256 is None:
+        return None
+    final_dir = pyramid_dir(sha256)
+    if (final_dir / "image.dzi").exists():
+        return final_dir
+
+    with _build_lock(sha256):
+        if (final_dir / "image.dzi").exists():
+            return final_dir
+        tmp_dir = blob_store.derived_path(sha256, f".{uuid.uuid4().hex[:8]}.{PYRAMID_DIR}")
+        try:
+            # Only the decode holds the whole slide; tiles are cut from the mapped copy
+            tmp_dir.mkdir()
+            pixels_path = tmp_dir / ".pixels.npy"
+            write_pixels(load_image(image_path), pixels_path)
+            pixels = open_pixels(pixels_path)
+            try:
+                write_pyramid(pixels, tmp_dir)
+            finally:
+                del pixels
+                pixels_path.unlink()
+            try:
+                os.rename(tmp_dir, final_dir)
+            except OSError:
+                # Built by another process in the meantime
+                if not (final_dir / "image.dzi").exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return final_dir
+
+
+async def build_pyramid(image_path: str) -> Optional[Path]:
+    """
+    ensure_pyramid on the analysis process pool, so a build never holds a web thread.
+
+    Called by the tile routes: the first view of an image builds its pyramid.
+    """
+    # Imported here: the pool's workers import this module and need none of the app
+    from app.services.ai_service import blood_image_service
+
+    sha256 = blob_store.blob_sha256(image_path)
+    if sha256 is not None and (pyramid_dir(sha256) / "image.dzi").exists():
+        return pyramid_dir(sha256)
+    return await blood_image_service.run_in_pool(ensure_pyramid, str(image_path))
+
+
+def tile_path(pyramid: Path, level: int, col: int, row: int) -> Optional[Path]:
+    """Path of one tile of a built pyramid (None if it does not exist)"""
+    if min(level, col, row) < 0:
+        return None
+    path = pyramid / "image_files" / str(level) / f"{col}_{row}.{TILE_FORMAT}"
+    return path if path.is_file() else None
@@ -0,0 +1,103 @@
+"""
+Upload Service
+Streams uploaded files to disk in fixed-size chunks, enforcing
+MAX_UPLOAD_SIZE and computing a SHA-256 of the content on the way.
+
+Chunks are read with the UploadFile's async API and written and hashed in
+the threadpool, so a large upload never sits in worker memory as a whole
+and never blocks the event loop. The file is written next to its
+destination and moved into place only once it is complete; an upload that
+goes over the limit is aborted as soon as it does, and its partial file
+removed.
+"""
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """Exception raised when an upload exceeds the size limit"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        super().__init__(f"File is too large. The maximum upload size is {format_size(max_size)}.")
+
+
+class StoredUpload(NamedTuple):
+    """A file written by save_upload"""
+    path: Path
+    size: int
+    sha256: str
+
+
+def format_size(size: int) -> str:
+    """Human-readable byte count (e.g. 10 MB)"""
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.3g} MB"
+    if size >= 1024:
+        return f"{size / 1024:.3g} KB"
+    return f"{size} bytes"
+
+
+def _write_chunk(f, digest, chunk: bytes):
+    f.write(chunk)
+    digest.update(chunk)
+
+
+async def save_upload(
+    upload: UploadFile,
+    destination,
+    max_size: Optional[int] = None
+) -> StoredUpload:
+    """
+    Stream an upload to disk.
+
+    Args:
+        upload: The uploaded file
+        destination: Final path of the file (its directory is created)
+        max_size: Size limit in bytes (default MAX_UPLOAD_SIZE)
+
+    Returns:
+        StoredUpload with the path, size in bytes and SHA-256 hex digest
+
+    Raises:
+        UploadTooLargeError: If the upload exceeds max_size
+    """
+    max_size = MAX_UPLOAD_SIZE if max_size is None else max_size
+    destination = Path(destination)
+
+    # The multipart parser usually knows the size already
+    if upload.size is not None and upload.size > max_size:
+        raise UploadTooLargeError(max_size)
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = destination.with_name(f".{destination.name}.{uuid.uuid4().hex[:8]}.part")
+    digest = hashlib.sha256()
+    size = 0
+
+    f = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLargeError(max_size)
+            await run_in_threadpool(_write_chunk, f, digest, chunk)
+    except BaseException:
+        f.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    f.close()
+
+    os.replace(tmp_path, destination)
+    return StoredUpload(destination, size, digest.hexdigest())
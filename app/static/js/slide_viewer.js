@@ -0,0 +1,26 @@
+// Deep zoom viewer for blood cell images: only the tiles on screen are fetched
+
+const OPENSEADRAGON_IMAGES = 'https://cdn.jsdelivr.net/npm/openseadragon@4.1.0/build/openseadragon/images/';
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (typeof OpenSeadragon === 'undefined') return;
+
+    document.querySelectorAll('[data-dzi]').forEach(function(element) {
+        const fallback = element.querySelector('img');
+        const viewer = OpenSeadragon({
+            element: element,
+            tileSources: element.dataset.dzi,
+            prefixUrl: OPENSEADRAGON_IMAGES,
+            showNavigator: true,
+            navigatorPosition: 'BOTTOM_RIGHT',
+            maxZoomPixelRatio: 2,
+            visibilityRatio: 1,
+            constrainDuringPan: true
+        });
+
+        // Keep the preview until the first tiles arrive; it stays if the pyramid cannot be built
+        viewer.addOnceHandler('tile-loaded', function() {
+            if (fallback) fallback.remove();
+        });
+    });
+});
@@ -192,6 +192,22 @@ init_database() {
     fi
 }
 
+# Apply pending schema migrations, keeping the data
+migrate_database() {
+    print_header "Migrating Database"
+    
+    print_info "Applying pending schema migrations..."
+    $PYTHON_CMD -m app.migrations upgrade
+    
+    if [ $? -eq 0 ]; then
+        print_success "Database schema is up to date"
+        $PYTHON_CMD -m app.migrations status
+    else
+        print_error "Failed to migrate database"
+        return 1
+    fi
+}
+
 # 5. Create Admin User
 create_admin() {
     print_header "Creating Admin User"
@@ -597,6 +613,7 @@ show_menu() {
     echo "  10) Health Check (System Status)"
     echo "  11) Run Tests"
     echo "  12) Clean/Reset Everything"
+    echo "  13) Migrate Database (Keep Data)"
     echo ""
     echo "   0) Exit"
     echo ""
@@ -609,7 +626,7 @@ main() {
     
     while true; do
         show_menu
-        read -p "Enter your choice [0-12]: " choice
+        read -p "Enter your choice [0-13]: " choice
         
         case $choice in
             1) full_setup ;;
@@ -624,6 +641,7 @@ main() {
             10) health_check ;;
             11) run_tests ;;
             12) clean_reset ;;
+            13) migrate_database ;;
             0) 
                 echo ""
                 print_success "Goodbye!"
@@ -631,7 +649,7 @@ main() {
                 exit 0
                 ;;
             *)
-                print_error "Invalid option. Please select 0-12"
+                print_error "Invalid option. Please select 0-13"
                 ;;
         esac
         
@@ -3,6 +3,7 @@ Database initialization script.
 Creates all tables in the database.
 """
 from app.database import Base, engine
+from app.migrations import schema_migrations, stamp
 from app.database import SessionLocal, User, Model
 from app.services.auth_service import hash_password
 import sys
@@ -11,8 +12,11 @@ def init_db():
     """Drop all existing tables and create fresh ones."""
     print("Dropping existing database tables...")
     Base.metadata.drop_all(bind=engine)
+    schema_migrations.drop(bind=engine, checkfirst=True)
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    # The new tables have every migration's changes already
+    stamp(engine)
     print("Database tables created successfully!")
     run_all_seeders()
 
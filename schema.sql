@@ -500,6 +500,55 @@ ALTER TABLE ONLY public.users
 CREATE INDEX ix_users_id ON public.users USING btree (id);
 
 
+--
+-- Name: ix_doctor_patients_patient_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_doctor_patients_patient_id ON public.doctor_patients USING btree (patient_id, doctor_id);
+
+
+--
+-- Name: ix_medical_history_patient_id_created_at; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_medical_history_patient_id_created_at ON public.medical_history USING btree (patient_id, created_at);
+
+
+--
+-- Name: ix_test_files_test_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_test_files_test_id ON public.test_files USING btree (test_id);
+
+
+--
+-- Name: ix_tests_patient_id_created_at; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_tests_patient_id_created_at ON public.tests USING btree (patient_id, created_at);
+
+
+--
+-- Name: ix_tests_review_requested; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_tests_review_requested ON public.tests USING btree (review_requested_from, review_status, review_requested_at);
+
+
+--
+-- Name: ix_tests_reviewed_by_created_at; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_tests_reviewed_by_created_at ON public.tests USING btree (reviewed_by, created_at);
+
+
+--
+-- Name: ix_users_role_created_at; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_users_role_created_at ON public.users USING btree (role, created_at);
+
+
 --
 -- Name: doctor_patients doctor_patients_doctor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -1,25 +1,43 @@
 """
 Pytest configuration and fixtures
 """
+import os
+import tempfile
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool
 
 from app.main import app
-from app.database import Base, get_db, User, DoctorInfo
+from app.database import Base, get_db, get_async_db, async_database_url, User, DoctorInfo
 
-# Use in-memory SQLite database for testing
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# Use a temporary SQLite file, so sync and async sessions see the same database
+_database_dir = tempfile.TemporaryDirectory()
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(_database_dir.name, 'test.db')}"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async routes see what tests have committed
+async_engine = create_async_engine(async_database_url(SQLALCHEMY_DATABASE_URL), poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path_factory, monkeypatch):
+    """Keep every test's stored files out of the real uploads/blobs"""
+    from app.services import blob_store
+
+    directory = tmp_path_factory.mktemp("uploads") / "blobs"
+    monkeypatch.setattr(blob_store, "BLOB_DIR", directory)
+    return directory
+
 
 @pytest.fixture(scope="function")
 def db_session():
@@ -42,7 +60,12 @@ def client(db_session):
         finally:
             pass
     
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
+    
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
     test_client = TestClient(app)
     yield test_client
     app.dependency_overrides.clear()
@@ -23,6 +23,21 @@ class TestAdminDashboard:
         assert response.status_code in [403, 303]
 
 
+class TestAdminModels:
+    """Test admin models page"""
+    
+    def test_models_page(self, client, auth_headers_admin):
+        """Test viewing models with the drift panel"""
+        response = client.get("/admin/models", headers=auth_headers_admin)
+        assert response.status_code == 200
+        assert "CBC Input Drift" in response.text
+    
+    def test_models_wrong_role(self, client, auth_headers_doctor):
+        """Test accessing models page as doctor"""
+        response = client.get("/admin/models", headers=auth_headers_doctor)
+        assert response.status_code in [403, 303]
+
+
 class TestAdminDoctorManagement:
     """Test admin doctor management"""
     
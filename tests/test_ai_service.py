@@ -2,6 +2,7 @@
 Tests for AI service
 """
 import pytest
+import numpy as np
 import pandas as pd
 from io import BytesIO
 from app.services import cbc_prediction_service, blood_image_service
@@ -88,7 +89,8 @@ class TestBloodImageService:
         assert blood_image_service is not None
         assert hasattr(blood_image_service, 'process_image_upload')
     
-    def test_process_image_upload_no_file(self, db_session):
+    @pytest.mark.asyncio
+    async def test_process_image_upload_no_file(self, db_session):
         """Test image upload with no file"""
         from fastapi import UploadFile
         
@@ -98,7 +100,7 @@ class TestBloodImageService:
         
         mock_upload = UploadFile(MockFile())
         
-        result = blood_image_service.process_image_upload(
+        result = await blood_image_service.process_image_upload(
             file=mock_upload,
             patient_id=1,
             uploaded_by_id=1,
@@ -109,3 +111,364 @@ class TestBloodImageService:
         assert result is not None
         assert result['success'] is False
         assert 'message' in result
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestReferenceRanges:
+    """Test age/sex-aware reference-range flagging"""
+    
+    def test_flags_depend_on_sex(self):
+        """Test the same HGB is normal for a woman and low for a man"""
+        from app.ai.cbc import add_reference_flags
+        
+        df = pd.DataFrame({'HGB': [12.5, 12.5], 'Sex': [0, 1], 'Age': [30, 30]})
+        flagged = add_reference_flags(df)
+        
+        assert list(flagged['HGB_Flag']) == ['Normal', 'Low']
+    
+    def test_critical_and_missing_values(self):
+        """Test critical values are flagged and missing values are left unflagged"""
+        import numpy as np
+        from app.ai.cbc import add_reference_flags
+        
+        df = pd.DataFrame({'HGB': [5.0, np.nan], 'MCV': [130.0, 90.0]})
+        flagged = add_reference_flags(df)
+        
+        assert flagged['HGB_Flag'][0] == 'Critical Low'
+        assert flagged['HGB_Flag'][1] is None
+        assert flagged['MCV_Flag'][0] == 'Critical High'
+        assert 'RDW_Flag' not in flagged.columns
+    
+    def test_age_band_changes_range(self):
+        """Test child ranges are used for young patients"""
+        from app.ai.cbc import flag_batch, FLAG_PARAMETERS
+        
+        df = pd.DataFrame({'TLC': [13.0, 13.0], 'Age': [8, 40]})
+        codes = flag_batch(df)
+        tlc = FLAG_PARAMETERS.index('TLC')
+        
+        assert codes[0, tlc] == 0
+        assert codes[1, tlc] == 1
+    
+    def test_predict_batch_returns_flags(self):
+        """Test batch predictions carry reference flags"""
+        results = cbc_prediction_service.predict_batch([{
+            'RBC': 4.5, 'HGB': 13.5, 'PCV': 40.0, 'MCV': 85.0,
+            'MCH': 28.0, 'MCHC': 33.0, 'TLC': 7.0, 'PLT': 250.0
+        }])
+        
+        assert results[0]['flags']['HGB'] == 'Normal'
+        assert results[0]['flags']['PLT'] == 'Normal'
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestDerivedIndices:
+    """Test derived hematology indices"""
+    
+    def test_index_values(self):
+        """Test indices are computed from the CBC columns"""
+        from app.ai.cbc import compute_indices
+        
+        df = pd.DataFrame({'MCV': [70.0], 'RBC': [5.0], 'HGB': [10.0], 'RDW': [15.0], 'MCH': [22.0]})
+        indices = compute_indices(df)
+        
+        assert indices['Mentzer'][0] == pytest.approx(14.0)
+        assert indices['RDWI'][0] == pytest.approx(210.0)
+        assert indices['Green_King'][0] == pytest.approx(73.5)
+        assert indices['England_Fraser'][0] == pytest.approx(11.6)
+    
+    def test_indices_skipped_without_inputs(self):
+        """Test indices needing RDW are skipped when RDW is not uploaded"""
+        from app.ai.cbc import add_derived_indices, row_indices
+        
+        df = add_derived_indices(pd.DataFrame({'MCV': [85.0], 'RBC': [0.0], 'HGB': [13.0], 'MCH': [28.0]}))
+        
+        assert 'RDWI_Index' not in df.columns
+        assert 'Mentzer_Index' in df.columns
+        assert 'Mentzer Index' not in row_indices(df.iloc[0])
+    
+    @pytest.mark.slow
+    def test_benchmark_million_rows(self):
+        """Test a million rows are processed in a single vectorized pass"""
+        from app.ai.cbc.indices import benchmark
+        
+        result = benchmark(n_rows=1_000_000)
+        
+        assert result["rows"] == 1_000_000
+        assert result["seconds"] < 10
+
+
+class TestFeatureDrift:
+    """Test online feature-drift monitoring"""
+    
+    def test_running_statistics_match_numpy(self):
+        """Test batch-merged Welford statistics equal a single pass"""
+        from app.ai.cbc import FeatureDriftMonitor, build_reference
+        
+        rng = np.random.default_rng(0)
+        X = rng.normal([5.0, 100.0], [1.0, 10.0], size=(1000, 2))
+        reference = build_reference(rng.normal([5.0, 100.0], [1.0, 10.0], size=(5000, 2)), ['A', 'B'])
+        monitor = FeatureDriftMonitor(['A', 'B'], reference)
+        for chunk in np.array_split(X, 7):
+            monitor.update(chunk)
+        
+        report = monitor.report()
+        assert report["rows_observed"] == 1000
+        assert report["features"][0]["mean"] == pytest.approx(X[:, 0].mean())
+        assert report["features"][1]["std"] == pytest.approx(X[:, 1].std(ddof=1))
+        assert report["status"] == "stable"
+    
+    def test_shifted_inputs_are_flagged(self):
+        """Test a shifted feature gets a high PSI"""
+        from app.ai.cbc import FeatureDriftMonitor, build_reference
+        
+        rng = np.random.default_rng(0)
+        reference = build_reference(rng.normal(0.0, 1.0, size=(5000, 2)), ['A', 'B'])
+        X = np.column_stack([rng.normal(0.0, 1.0, 5000), rng.normal(1.5, 1.0, 5000)])
+        monitor = FeatureDriftMonitor(['A', 'B'], reference)
+        monitor.update(X)
+        
+        report = monitor.report()
+        assert report["features"][0]["status"] == "stable"
+        assert report["features"][1]["status"] == "drift"
+        assert report["drift_score"] == report["features"][1]["psi"]
+    
+    def test_rows_with_nan_are_ignored(self):
+        """Test incomplete rows do not poison the statistics"""
+        from app.ai.cbc import FeatureDriftMonitor, build_reference
+        
+        monitor = FeatureDriftMonitor(['A'], build_reference([[0.0], [1.0], [2.0]], ['A']))
+        monitor.update(np.array([[1.0], [np.nan], [3.0]]))
+        
+        assert monitor.report()["features"][0]["mean"] == pytest.approx(2.0)
+    
+    def test_training_data_is_stable(self):
+        """Test the training data does not drift from the reference saved with the model"""
+        import json
+        from app.ai.cbc import FeatureDriftMonitor, load_reference, prepare_dataframe_for_inference
+        from app.ai.cbc.predict import FEATURES_PTH
+        
+        with open(FEATURES_PTH) as f:
+            used_features = json.load(f)
+        df = prepare_dataframe_for_inference(pd.read_csv("test-data/cbc-records-v2.csv"), used_features)
+        monitor = FeatureDriftMonitor(used_features, load_reference())
+        for chunk in np.array_split(df[used_features].to_numpy(dtype=np.float64), 5):
+            monitor.update(chunk)
+        
+        report = monitor.report()
+        assert report["status"] == "stable"
+        assert all(f["status"] == "stable" for f in report["features"])
+
+
+class TestBatchDeduplication:
+    """Test identical rows are scored once"""
+    
+    def test_unique_rows_mapping(self):
+        """Test first occurrences and inverse rebuild the matrix"""
+        from app.ai.cbc.predict import unique_rows
+        
+        X = np.array([[1.0, 2.0], [3.0, 4.0], [1.0, 2.0], [5.0, 6.0], [3.0, 4.0]])
+        first, inverse = unique_rows(X)
+        
+        assert list(first) == [0, 1, 3]
+        assert list(inverse) == [0, 1, 0, 2, 1]
+        assert np.array_equal(X[first][inverse], X)
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_duplicates_scored_once(self, monkeypatch):
+        """Test the model sees only distinct rows and every row gets its result"""
+        from app.ai.cbc import DUPLICATE_ROWS, predict_and_annotate_dataframe
+        
+        cbc_prediction_service.load_model()
+        model = cbc_prediction_service.model
+        seen = []
+        original = model.predict_proba
+        monkeypatch.setattr(model, "predict_proba", lambda X: seen.append(len(X)) or original(X))
+        
+        df = pd.DataFrame([
+            {'RBC': 4.5, 'HGB': 9.0, 'PCV': 30.0, 'MCV': 70.0, 'MCH': 22.0, 'MCHC': 30.0, 'TLC': 7.0, 'PLT': 250.0},
+            {'RBC': 4.8, 'HGB': 14.5, 'PCV': 43.0, 'MCV': 88.0, 'MCH': 30.0, 'MCHC': 34.0, 'TLC': 6.0, 'PLT': 220.0},
+        ] * 3)
+        df['ID'] = range(len(df))
+        
+        df_annotated, probabilities = predict_and_annotate_dataframe(
+            df, model, cbc_prediction_service.scaler, cbc_prediction_service.used_features
+        )
+        
+        assert seen == [2]
+        assert len(df_annotated) == 6
+        assert df_annotated.attrs[DUPLICATE_ROWS] == 4
+        assert np.array_equal(probabilities[0::2], np.repeat(probabilities[:1], 3, axis=0))
+        assert list(df_annotated['Predicted_Anemia'][1::2]) == [df_annotated['Predicted_Anemia'][1]] * 3
+
+
+class TestModelEvaluation:
+    """Test the offline evaluation harness"""
+    
+    def test_binary_metrics(self):
+        """Test confusion-based metrics and AUC with tied scores"""
+        from app.ai.cbc.evaluate import binary_metrics
+        
+        y_true = np.array([1, 1, 0, 0, 1, 0])
+        y_prob = np.array([0.9, 0.4, 0.4, 0.1, 0.7, 0.6])
+        metrics = binary_metrics(y_true, y_prob)
+        
+        assert metrics["accuracy"] == pytest.approx(4 / 6)
+        assert metrics["sensitivity"] == pytest.approx(2 / 3)
+        assert metrics["specificity"] == pytest.approx(2 / 3)
+        assert metrics["auc"] == pytest.approx(7.5 / 9)
+        assert sum(b["count"] for b in metrics["calibration"]["bins"]) == 6
+    
+    def test_text_diagnosis_labels(self):
+        """Test text diagnoses map to anemia / not anemia"""
+        from app.ai.cbc.evaluate import anemia_labels
+        
+        labels = anemia_labels(pd.Series(["Healthy", "Iron deficiency anemia", "Thrombocytopenia", None]))
+        
+        assert labels[:3].tolist() == [0.0, 1.0, 0.0]
+        assert np.isnan(labels[3])
+
+    def test_negated_diagnosis_labels(self):
+        """Test negated anemia diagnoses are not counted as anemia"""
+        from app.ai.cbc.evaluate import anemia_labels
+
+        labels = anemia_labels(pd.Series(["non-anemic", "No anemia", "not anaemic", "Iron Deficiency  Anaemia", "Anemia"]))
+
+        assert labels.tolist() == [0.0, 0.0, 0.0, 1.0, 1.0]
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_evaluation_is_cached(self, tmp_path):
+        """Test a repeated evaluation of the same model and data is served from cache"""
+        from app.ai.cbc.evaluate import evaluate_files
+        
+        if not cbc_prediction_service._loaded:
+            cbc_prediction_service.load_model()
+        assets = dict(
+            model=cbc_prediction_service.model,
+            scaler=cbc_prediction_service.scaler,
+            used_features=cbc_prediction_service.used_features,
+            version=cbc_prediction_service.model_version,
+            cache_dir=tmp_path
+        )
+        
+        first = evaluate_files(["test-data/cbc-records-v2.csv"], chunk_size=300, **assets)
+        second = evaluate_files(["test-data/cbc-records-v2.csv"], **assets)
+        
+        assert first["cached"] is False
+        assert first["rows"] == 1281
+        assert 0.5 < first["metrics"]["auc"] <= 1.0
+        assert second["cached"] is True
+        assert second["metrics"]["accuracy"] == first["metrics"]["accuracy"]
+
+
+class TestFeatureStore:
+    """Test the append-only feature store"""
+    
+    def test_append_and_map(self, tmp_path):
+        """Test appended rows are readable through a memory map"""
+        from app.ai.cbc import FeatureStore
+        
+        store = FeatureStore(tmp_path, ['A', 'B'])
+        store.append(7, np.array([[1.0, 2.0], [3.0, 4.0]]))
+        store.append(9, np.array([[5.0, 6.0]]))
+        
+        features, index = FeatureStore(tmp_path, ['A', 'B']).load()
+        
+        assert isinstance(features, np.memmap)
+        assert features.dtype == np.float32
+        assert features.tolist() == [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+        assert index.tolist() == [[7, 0], [7, 1], [9, 0]]
+        assert store.rows_for_test(7).tolist() == [[1.0, 2.0], [3.0, 4.0]]
+    
+    def test_torn_append_is_trimmed(self, tmp_path):
+        """Test a partial record from an interrupted append is dropped"""
+        from app.ai.cbc import FeatureStore
+        
+        store = FeatureStore(tmp_path, ['A', 'B'])
+        store.append(1, np.array([[1.0, 2.0]]))
+        with open(store.features_path, "ab") as f:
+            f.write(np.array([9.0, 9.0, 9.0], dtype=np.float32).tobytes())
+        
+        assert len(store) == 1
+        store.append(2, np.array([[3.0, 4.0]]))
+        
+        features, index = store.load()
+        assert features.tolist() == [[1.0, 2.0], [3.0, 4.0]]
+        assert index[:, 0].tolist() == [1, 2]
+    
+    def test_feature_mismatch(self, tmp_path):
+        """Test a store cannot be reopened with different features"""
+        from app.ai.cbc import FeatureStore
+        
+        FeatureStore(tmp_path, ['A', 'B'])
+        with pytest.raises(ValueError):
+            FeatureStore(tmp_path, ['B', 'A'])
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_inference_appends_features(self, db_session, patient_user, doctor_user, tmp_path, monkeypatch):
+        """Test saved CBC tests land in the store and backfill skips them"""
+        from app.ai.cbc import FeatureStore
+        from app.database import Model
+        
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        if not cbc_prediction_service._loaded:
+            cbc_prediction_service.load_model()
+        store = FeatureStore(tmp_path / "store", cbc_prediction_service.used_features)
+        monkeypatch.setattr(cbc_prediction_service, "_feature_store", store)
+        
+        result = cbc_prediction_service.process_manual_input(
+            rbc=4.5, hgb=9.0, pcv=30.0, mcv=70.0, mch=22.0, mchc=30.0, tlc=7.0, plt=250.0,
+            patient_id=patient_user.id,
+            uploaded_by_id=doctor_user.id,
+            db=db_session
+        )
+        
+        assert store.test_ids().tolist() == [result["test_id"]]
+        assert store.rows_for_test(result["test_id"])[0][cbc_prediction_service.used_features.index('HGB')] == 9.0
+        assert cbc_prediction_service.backfill_feature_store(db_session) == {"tests_added": 0, "rows_added": 0}
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_rolled_back_test_not_stored(self, db_session, patient_user, tmp_path, monkeypatch):
+        """Test feature rows are appended on commit only, so a reused test ID gets no stale rows"""
+        from app.ai.cbc import FeatureStore
+        from app.database import Model
+        
+        monkeypatch.chdir(tmp_path)
+        cbc_model = Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0)
+        db_session.add(cbc_model)
+        db_session.commit()
+        if not cbc_prediction_service._loaded:
+            cbc_prediction_service.load_model()
+        store = FeatureStore(tmp_path / "store", cbc_prediction_service.used_features)
+        monkeypatch.setattr(cbc_prediction_service, "_feature_store", store)
+        df = pd.DataFrame([dict.fromkeys(cbc_prediction_service.used_features, 1.0)])
+        
+        rolled_back = cbc_prediction_service.save_annotated_test(db_session, cbc_model, patient_user.id, df, "rolled back")
+        assert len(store) == 0
+        db_session.rollback()
+        
+        kept = cbc_prediction_service.save_annotated_test(db_session, cbc_model, patient_user.id, df * 2, "kept")
+        db_session.commit()
+        
+        assert store.test_ids().tolist() == [kept.id]
+        assert store.rows_for_test(kept.id).tolist() == [[2.0] * len(cbc_prediction_service.used_features)]
@@ -0,0 +1,323 @@
+"""
+Tests for machine API routes
+"""
+import pytest
+from app.services import cbc_prediction_service
+
+CBC_RECORD = {
+    'RBC': 4.5,
+    'HGB': 9.0,
+    'HCT': 30.0,
+    'MCV': 70.0,
+    'MCH': 22.0,
+    'MCHC': 30.0,
+    'WBC': 7.0,
+    'PLT': 250.0
+}
+
+
+class TestCBCPredictAPI:
+    """Test the JSON batch prediction endpoint"""
+    
+    def test_predict_requires_authentication(self, client):
+        """Test prediction without authentication"""
+        response = client.post("/api/cbc/predict", json=[CBC_RECORD])
+        assert response.status_code == 401
+    
+    def test_predict_accepts_bearer_token(self, client, doctor_user):
+        """Test machine clients can authenticate with a Bearer header"""
+        from app.services.auth_service import create_access_token
+        
+        token = create_access_token({"sub": doctor_user.username, "role": doctor_user.role})
+        response = client.post(
+            "/api/cbc/predict",
+            json=[],
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 400
+    
+    def test_predict_rejects_patients(self, client, auth_headers_patient):
+        """Test patients cannot use the machine API"""
+        response = client.post("/api/cbc/predict", json=[CBC_RECORD])
+        assert response.status_code == 403
+    
+    def test_predict_enforces_max_batch(self, client, auth_headers_doctor, monkeypatch):
+        """Test oversized batches are rejected"""
+        from app.routers import api
+        
+        monkeypatch.setattr(api, "MAX_PREDICT_BATCH", 2)
+        response = client.post("/api/cbc/predict", json=[CBC_RECORD] * 3)
+        assert response.status_code == 413
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_predict_returns_results(self, client, auth_headers_doctor):
+        """Test predictions, probabilities and skipped rows"""
+        response = client.post("/api/cbc/predict", json=[{'RBC': 4.5}, CBC_RECORD])
+        body = response.json()
+        
+        assert response.status_code == 200
+        assert body["count"] == 1
+        assert body["skipped"] == 1
+        result = body["results"][0]
+        assert result["row_index"] == 1
+        assert result["prediction"] in ["Anemia", "Normal"]
+        assert set(result["probabilities"]) == {"normal", "anemia"}
+        assert "report" in result
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_predict_streams_large_responses(self, client, auth_headers_doctor, monkeypatch):
+        """Test large responses are streamed and reports can be skipped"""
+        from app.routers import api
+        
+        monkeypatch.setattr(api, "STREAM_THRESHOLD", 2)
+        response = client.post("/api/cbc/predict?with_report=false", json=[CBC_RECORD] * 5)
+        body = response.json()
+        
+        assert response.status_code == 200
+        assert "content-length" not in response.headers
+        assert body["count"] == 5
+        assert [r["row_index"] for r in body["results"]] == [0, 1, 2, 3, 4]
+        assert "report" not in body["results"][0]
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_predict_missing_columns(self, client, auth_headers_doctor):
+        """Test records without the required features"""
+        response = client.post("/api/cbc/predict", json=[{"foo": 1}])
+        assert response.status_code == 422
+
+
+class TestMetricsAPI:
+    """Test the metrics endpoint"""
+    
+    def test_metrics_admin_only(self, client, auth_headers_doctor):
+        """Test doctors cannot read metrics"""
+        response = client.get("/api/metrics")
+        assert response.status_code == 403
+    
+    def test_metrics_include_database(self, client, auth_headers_admin):
+        """Test pool settings, pool usage and session lifetimes are reported"""
+        response = client.get("/api/metrics")
+        database = response.json()["database"]
+        
+        assert response.status_code == 200
+        assert set(database["pools"]) == {"sync", "async"}
+        assert database["settings"]["pool_pre_ping"] is True
+        assert set(database["session_lifetime"]["sync"]) >= {"count", "p95_ms"}
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_metrics_include_drift(self, client, auth_headers_admin, monkeypatch):
+        """Test scored inputs show up in the drift metrics"""
+        from app.services import ai_service
+        
+        monkeypatch.setattr(ai_service, "DRIFT_REPORT_INTERVAL", 0)
+        cbc_prediction_service.predict_batch([CBC_RECORD])
+        
+        response = client.get("/api/metrics")
+        drift = response.json()["cbc_drift"]
+        
+        assert response.status_code == 200
+        assert drift["rows_observed"] >= 1
+        assert [f["feature"] for f in drift["features"]] == cbc_prediction_service.used_features
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestCBCAttributionsAPI:
+    """Test lazily computed feature attributions"""
+    
+    @pytest.fixture
+    def cbc_test(self, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        """A stored CBC test for a patient linked to the doctor"""
+        import os
+        from app.database import Model, TestFile
+        from app.services import link_patient_to_doctor
+        
+        cwd = os.getcwd()
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        
+        result = cbc_prediction_service.process_manual_input(
+            rbc=4.5, hgb=9.0, pcv=30.0, mcv=70.0, mch=22.0, mchc=30.0, tlc=7.0, plt=250.0,
+            patient_id=patient_user.id,
+            uploaded_by_id=doctor_user.id,
+            db=db_session
+        )
+        assert result["success"]
+        
+        # Templates are resolved relative to the project root
+        for test_file in db_session.query(TestFile).filter(TestFile.test_id == result["test_id"]):
+            test_file.path = str(tmp_path / test_file.path)
+        db_session.commit()
+        monkeypatch.chdir(cwd)
+        return result["test_id"]
+    
+    def test_attributions_computed_once(self, client, auth_headers_doctor, cbc_test, db_session, monkeypatch):
+        """Test the first request stores attributions and later ones read them"""
+        from app.database import TestFile
+        from app.services.result_storage import result_columns
+        
+        response = client.get(f"/api/cbc/tests/{cbc_test}/attributions")
+        body = response.json()
+        
+        assert response.status_code == 200
+        assert body["count"] == 1
+        attributions = body["results"][0]["attributions"]
+        assert set(attributions) == set(cbc_prediction_service.used_features)
+        assert sum(attributions.values()) == pytest.approx(1.0, abs=1e-3)
+        
+        output_file = db_session.query(TestFile).filter(TestFile.test_id == cbc_test).first()
+        assert "HGB_Attribution" in result_columns(output_file.path)
+        
+        def fail_explain(*args, **kwargs):
+            raise AssertionError("attributions should be served from storage")
+        
+        monkeypatch.setattr(cbc_prediction_service.model, "explain", fail_explain)
+        response = client.get(f"/api/cbc/tests/{cbc_test}/attributions")
+        assert response.json()["results"][0]["attributions"] == attributions
+    
+    def test_attributions_require_patient_link(self, client, auth_headers_doctor, cbc_test, doctor_user, patient_user, db_session):
+        """Test doctors only see attributions for linked patients"""
+        from app.services import unlink_patient_from_doctor
+        
+        unlink_patient_from_doctor(patient_user.id, doctor_user.id, db_session)
+        response = client.get(f"/api/cbc/tests/{cbc_test}/attributions")
+        assert response.status_code == 403
+    
+    def test_attributions_require_active_account(self, client, auth_headers_doctor, cbc_test, doctor_user, db_session):
+        """Test deactivated accounts cannot fetch attributions"""
+        doctor_user.is_active = 0
+        db_session.commit()
+        
+        response = client.get(f"/api/cbc/tests/{cbc_test}/attributions")
+        assert response.status_code == 403
+        assert response.json()["detail"] == "Account is deactivated"
+    
+    def test_doctor_test_page_shows_attributions(self, client, auth_headers_doctor, cbc_test, monkeypatch):
+        """Test the doctor UI shows stored attributions and never computes them in the request"""
+        from app import database
+        from tests.conftest import TestingSessionLocal
+        
+        # Background tasks open their own session
+        monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+        explain = cbc_prediction_service.get_test_attributions
+        calls = []
+        monkeypatch.setattr(cbc_prediction_service, "get_test_attributions",
+                            lambda db, test_id: calls.append(test_id) or explain(db, test_id))
+        
+        # A test stored without attributions is shown without them, and explained after the response
+        response = client.get(f"/doctor/test/{cbc_test}")
+        assert response.status_code == 200
+        assert "What Drove This Prediction" not in response.text
+        assert calls == [cbc_test]
+        
+        response = client.get(f"/doctor/test/{cbc_test}")
+        assert "What Drove This Prediction" in response.text
+        assert calls == [cbc_test]
+    
+    def test_manual_upload_does_not_compute_attributions(self, client, auth_headers_doctor, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        """Test uploads leave attributions to the first view of the test"""
+        from app.database import Model
+        from app.services import link_patient_to_doctor
+        
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        calls = []
+        monkeypatch.setattr(cbc_prediction_service, "get_test_attributions", lambda db, test_id: calls.append(test_id))
+        
+        response = client.post(
+            f"/doctor/upload-cbc-manual/{patient_user.id}",
+            data={"rbc": 4.5, "hgb": 9.0, "pcv": 30.0, "mcv": 70.0, "mch": 22.0, "mchc": 30.0, "tlc": 7.0, "plt": 250.0},
+            follow_redirects=False
+        )
+        
+        assert response.status_code == 303
+        assert calls == []
+    
+    def test_concurrent_passes_store_once(self, cbc_test, db_session, monkeypatch):
+        """Test simultaneous first requests explain a test once and keep blob references right"""
+        import threading
+        import time
+        from app.database import Blob, TestFile
+        from app.services import ai_service, blob_store
+        from tests.conftest import TestingSessionLocal
+        
+        old_path = db_session.query(TestFile).filter(TestFile.test_id == cbc_test, TestFile.type == "output").one().path
+        explain = ai_service.add_attributions
+        calls = []
+        
+        def slow_explain(*args):
+            calls.append(1)
+            time.sleep(0.2)
+            return explain(*args)
+        
+        monkeypatch.setattr(ai_service, "add_attributions", slow_explain)
+        
+        def request():
+            db = TestingSessionLocal()
+            try:
+                cbc_prediction_service.get_test_attributions(db, cbc_test)
+            finally:
+                db.close()
+        
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        db_session.expire_all()
+        new_path = db_session.query(TestFile).filter(TestFile.test_id == cbc_test, TestFile.type == "output").one().path
+        assert len(calls) == 1
+        assert db_session.get(Blob, blob_store.blob_sha256(old_path)).ref_count == 0
+        assert db_session.get(Blob, blob_store.blob_sha256(new_path)).ref_count == 1
+        assert cbc_prediction_service._attribution_locks == {}
+    
+    def test_views_queue_one_pass(self, cbc_test):
+        """Test a test's attributions are queued once however often it is opened"""
+        from app.services.ai_service import compute_test_attributions
+        from tests.conftest import TestingSessionLocal
+        
+        assert cbc_prediction_service.claim_attributions(cbc_test)
+        assert not cbc_prediction_service.claim_attributions(cbc_test)
+        compute_test_attributions(cbc_test, session_factory=TestingSessionLocal)
+        assert cbc_prediction_service.claim_attributions(cbc_test)
+        cbc_prediction_service._finish_attributions(cbc_test)
+    
+    def test_attributions_unknown_test(self, client, auth_headers_doctor):
+        """Test a missing test"""
+        response = client.get("/api/cbc/tests/9999/attributions")
+        assert response.status_code == 404
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestPredictSingle:
+    """Test single-sample prediction"""
+    
+    def test_predict_single_with_report(self):
+        """Test predict_single scales inputs and builds a report"""
+        result = cbc_prediction_service.predict_single(CBC_RECORD, with_report=True)
+        
+        assert result["prediction"] in [0, 1]
+        assert 0 <= result["confidence_raw"] <= 1
+        assert result["report"].startswith("Result:")
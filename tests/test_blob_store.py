@@ -0,0 +1,215 @@
+"""
+Tests for the content-addressed blob store
+"""
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+from fastapi import UploadFile
+
+from app.database import Blob, Test, TestFile
+from app.services import blob_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Run each test against an empty store in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    return blob_store.BLOB_DIR
+
+
+def _stage(content: bytes, extension: str = ".png"):
+    path = blob_store.temp_path(extension)
+    path.write_bytes(content)
+    return path
+
+
+def _test_file(db, patient_id, path):
+    test = Test(patient_id=patient_id, review_status='pending')
+    db.add(test)
+    db.flush()
+    db.add(TestFile(test_id=test.id, name="cells.png", extension=".png", path=path, type='input'))
+    db.commit()
+
+
+class TestStore:
+    """Test identical content is stored once"""
+
+    def test_store_deduplicates(self, db_session, store):
+        """Test the same content stored twice shares one blob"""
+        content = b"same image"
+        first = blob_store.store_file(db_session, _stage(content), ".PNG")
+        second = blob_store.store_file(db_session, _stage(content), ".png")
+        db_session.commit()
+
+        sha256 = hashlib.sha256(content).hexdigest()
+        assert first == second == str(store / sha256[:2] / f"{sha256}.png")
+        assert blob_store.blob_sha256(first) == sha256
+        assert db_session.get(Blob, sha256).ref_count == 2
+        assert list((store / sha256[:2]).iterdir()) == [store / sha256[:2] / f"{sha256}.png"]
+        assert list((store / "tmp").iterdir()) == []
+
+    @pytest.mark.asyncio
+    async def test_store_upload(self, db_session, store):
+        """Test uploads are streamed into the store"""
+        path = await blob_store.store_upload(db_session, UploadFile(filename="a.jpg", file=BytesIO(b"jpeg")), ".jpg")
+        db_session.commit()
+
+        assert open(path, "rb").read() == b"jpeg"
+        assert blob_store.blob_sha256("uploads/tests/blood_cell/a.jpg") is None
+
+    def test_cached_artifact(self, db_session, store):
+        """Test derived artifacts are built once per content hash"""
+        sha256 = blob_store.blob_sha256(blob_store.store_file(db_session, _stage(b"image"), ".png"))
+        calls = []
+
+        def build(path):
+            calls.append(path)
+            path.write_bytes(b"thumbnail")
+
+        first = blob_store.cached_artifact(sha256, "thumb.png", build)
+        second = blob_store.cached_artifact(sha256, "thumb.png", build)
+
+        assert first == second
+        assert first.read_bytes() == b"thumbnail"
+        assert len(calls) == 1
+
+
+class TestGarbageCollection:
+    """Test unreferenced blobs are removed safely"""
+
+    def test_collects_released_blobs(self, db_session, patient_user, store):
+        """Test a blob is removed only once its last reference is released"""
+        kept = blob_store.store_file(db_session, _stage(b"kept"), ".png")
+        path = blob_store.store_file(db_session, _stage(b"dropped"), ".png")
+        blob_store.store_file(db_session, _stage(b"dropped"), ".png")
+        sha256 = blob_store.blob_sha256(path)
+        blob_store.derived_path(sha256, "thumb.png").write_bytes(b"thumbnail")
+        _test_file(db_session, patient_user.id, kept)
+
+        blob_store.release(db_session, path)
+        db_session.commit()
+        assert blob_store.collect_garbage(db_session, grace_seconds=0)["blobs_removed"] == 0
+        assert os.path.exists(path)
+
+        blob_store.release(db_session, path)
+        db_session.commit()
+        stats = blob_store.collect_garbage(db_session, grace_seconds=0)
+
+        assert stats["blobs_removed"] == 1
+        assert stats["bytes_freed"] >= len(b"dropped") + len(b"thumbnail")
+        assert not os.path.exists(path)
+        assert not (store / "derived" / sha256[:2] / sha256).exists()
+        assert db_session.get(Blob, sha256) is None
+        assert os.path.exists(kept)
+
+    def test_grace_period(self, db_session, store):
+        """Test recently released blobs are kept"""
+        path = blob_store.store_file(db_session, _stage(b"recent"), ".png")
+        blob_store.release(db_session, path)
+        db_session.commit()
+
+        assert blob_store.collect_garbage(db_session)["blobs_removed"] == 0
+        assert os.path.exists(path)
+
+    def test_referenced_blob_is_kept(self, db_session, patient_user, store):
+        """Test a blob still referenced by a row survives a wrong count"""
+        path = blob_store.store_file(db_session, _stage(b"in use"), ".png")
+        _test_file(db_session, patient_user.id, path)
+        blob_store.release(db_session, path)
+        db_session.commit()
+
+        stats = blob_store.collect_garbage(db_session, grace_seconds=0)
+
+        assert stats["blobs_in_use"] == 1
+        assert os.path.exists(path)
+        assert db_session.get(Blob, blob_store.blob_sha256(path)) is not None
+
+    def test_sweeps_stray_files(self, db_session, store):
+        """Test files without a blob row (rolled back uploads) are removed"""
+        blob_store.store_file(db_session, _stage(b"rolled back"), ".png")
+        db_session.rollback()
+        _stage(b"interrupted upload")
+
+        stats = blob_store.collect_garbage(db_session, grace_seconds=0)
+
+        assert stats["files_removed"] == 2
+        assert not any(p.is_file() for p in store.rglob("*"))
+
+
+class TestMigration:
+    """Test existing uploads are moved into the store"""
+
+    def test_migrate_legacy_files(self, db_session, patient_user, doctor_user, store):
+        """Test files under random names are repointed and deduplicated"""
+        legacy = store.parent / "tests" / "blood_cell"
+        legacy.mkdir(parents=True)
+        for name in ("a.png", "b.png"):
+            (legacy / name).write_bytes(b"same image")
+            _test_file(db_session, patient_user.id, str(legacy / name))
+        profiles = store.parent / "profiles"
+        profiles.mkdir()
+        (profiles / "me.jpg").write_bytes(b"face")
+        doctor_user.profile_image = str(profiles / "me.jpg")
+        db_session.commit()
+
+        stats = blob_store.migrate_legacy_files(db_session)
+
+        assert stats == {"files_migrated": 3, "duplicates": 1, "bytes_saved": len(b"same image")}
+        paths = {f.path for f in db_session.query(TestFile)}
+        assert len(paths) == 1
+        assert blob_store.blob_sha256(paths.pop()) == hashlib.sha256(b"same image").hexdigest()
+        assert open(doctor_user.profile_image, "rb").read() == b"face"
+        assert not any(legacy.iterdir())
+        assert db_session.query(Blob).count() == 2
+
+
+class TestProfileImages:
+    """Test profile images go through the store"""
+
+    @pytest.mark.asyncio
+    async def test_replacing_releases_old_image(self, db_session, patient_user, store):
+        """Test the previous image loses its reference when replaced"""
+        from app.services.profile_service import upload_user_profile_image
+
+        await upload_user_profile_image(patient_user, db_session, UploadFile(filename="a.png", file=BytesIO(b"old")))
+        old_path = patient_user.profile_image
+        success, _ = await upload_user_profile_image(patient_user, db_session, UploadFile(filename="b.png", file=BytesIO(b"new")))
+
+        assert success is True
+        assert patient_user.profile_image != old_path
+        assert db_session.get(Blob, blob_store.blob_sha256(old_path)).ref_count == 0
+        assert db_session.get(Blob, blob_store.blob_sha256(patient_user.profile_image)).ref_count == 1
+
+
+class TestImageUploads:
+    """Test blood cell images go through the store"""
+
+    @pytest.mark.asyncio
+    async def test_same_image_stored_once(self, db_session, patient_user, doctor_user, store):
+        """Test the same image uploaded by two users is kept once on disk"""
+        from app.database import Model
+        from app.services import blood_image_service
+
+        db_session.add(Model(name="Blood Cell Image Classification", accuracy=90.0, tests_count=0))
+        db_session.commit()
+
+        import cv2
+        from app.ai.blood_cell import synthetic_smear
+
+        image = cv2.imencode(".png", synthetic_smear(128, 128)[0])[1].tobytes()
+        results = [
+            await blood_image_service.process_image_upload(
+                file=UploadFile(filename="cells.png", file=BytesIO(image)),
+                patient_id=patient_user.id,
+                uploaded_by_id=uploader.id,
+                db=db_session
+            )
+            for uploader in (patient_user, doctor_user)
+        ]
+
+        assert all(r["success"] for r in results)
+        assert results[0]["file_path"] == results[1]["file_path"]
+        assert {f.path for f in db_session.query(TestFile)} == {results[0]["file_path"]}
+        assert db_session.get(Blob, blob_store.blob_sha256(results[0]["file_path"])).ref_count == 2
@@ -0,0 +1,464 @@
+"""
+Tests for the blood smear image analysis
+"""
+import struct
+import zlib
+from io import BytesIO
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi import UploadFile
+from scipy.spatial import cKDTree
+
+from app.ai.blood_cell import ImageTooLargeError, analyze_array, analyze_image, ingest, slide, synthetic_smear
+from app.services import blob_store, blood_image_service
+from app.services import ai_service
+
+
+def _png(image) -> bytes:
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def _oversized_png(side: int = 40000) -> bytes:
+    """A PNG whose header declares side x side pixels (only two rows of data follow)"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    header = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    rows = zlib.compress(b"\x00" * (3 * side + 1) * 2)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", rows) + chunk(b"IEND", b"")
+
+
+def _jpeg_with_metadata(image, orientation: int = 1) -> bytes:
+    """A JPEG carrying an EXIF orientation and a comment"""
+    data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+    exif = (b"Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x01"
+            + struct.pack(">HHIHH", 0x0112, 3, 1, orientation, 0) + b"\x00\x00\x00\x00")
+    comment = b"Scanned by microscope 42"
+    segments = (b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+                + b"\xff\xfe" + struct.pack(">H", len(comment) + 2) + comment)
+    return data[:2] + segments + data[2:]
+
+
+class TestAnalysis:
+    """Test segmentation and counting on synthetic smears with known counts"""
+
+    def test_counts_synthetic_smear(self):
+        """Test cells are counted close to the number drawn"""
+        image, counts = synthetic_smear(768, 768, seed=3)
+
+        result = analyze_array(image)
+
+        assert result["counts"]["rbc"] == pytest.approx(counts["rbc"], rel=0.05)
+        assert result["counts"]["wbc"] == pytest.approx(counts["wbc"], abs=max(2, counts["wbc"] * 0.3))
+        assert result["counts"]["platelet"] == pytest.approx(counts["platelet"], rel=0.25)
+        assert result["rbc_morphology"]["diameter_cv"] < 0.15
+        assert result["flags"] == []
+        assert 0.9 < result["confidence"] <= 1.0
+
+    def test_touching_cells_are_split(self):
+        """Test the watershed separates cells that touch"""
+        image = synthetic_smear(64, 64, density=0.0)[0]
+        for center in ((20, 32), (42, 32)):
+            cv2.circle(image, center, 11, (150, 120, 205), -1, cv2.LINE_AA)
+
+        assert analyze_array(image)["counts"]["rbc"] == 2
+
+    def test_anisocytosis_flag(self):
+        """Test widely varying red cell sizes are flagged"""
+        image = synthetic_smear(512, 512, density=0.0)[0]
+        for i in range(36):
+            radius = 6 + (i % 6) * 3
+            center = (40 + (i % 6) * 80, 40 + (i // 6) * 80)
+            cv2.circle(image, center, radius, (150, 120, 205), -1, cv2.LINE_AA)
+
+        result = analyze_array(image)
+
+        assert "Anisocytosis" in result["flags"]
+        assert "Anisocytosis" in result["summary"]
+
+    def test_empty_and_unreadable(self, tmp_path):
+        """Test blank slides and non-images"""
+        assert analyze_array(synthetic_smear(64, 64, density=0.0)[0])["cells"] == 0
+
+        path = tmp_path / "notes.png"
+        path.write_bytes(b"not an image")
+        with pytest.raises(ValueError):
+            analyze_image(path)
+
+
+class TestSlides:
+    """Test large images analyzed in overlapping tiles"""
+
+    def test_tiles_match_whole_image(self, tmp_path):
+        """Test tiling neither loses nor double counts cells on tile borders"""
+        image, counts = synthetic_smear(1000, 900, seed=2)
+        path = tmp_path / "slide.png"
+        path.write_bytes(_png(image))
+        pixels_path = tmp_path / "slide.npy"
+
+        plan = slide.start_analysis(path, pixels_path, tile_size=256, overlap=128)
+        tile_cells = [slide.analyze_tile(plan, tile) for tile in plan.tiles]
+        result = slide.merge_tiles(plan, tile_cells)
+        whole = analyze_array(image)
+
+        assert len(plan.tiles) == 16
+        assert pixels_path.exists()
+        for cell_type in ("rbc", "platelet"):
+            assert result["counts"][cell_type] == pytest.approx(whole["counts"][cell_type], abs=3)
+        assert result["counts"]["rbc"] == pytest.approx(counts["rbc"], rel=0.05)
+
+        # A cell seen by two tiles would leave two nearly coincident centres
+        cells = pd.concat(tile_cells)
+        distances, _ = cKDTree(cells[["x", "y"]].to_numpy()).query(cells[["x", "y"]].to_numpy(), k=2)
+        assert np.sort(distances[:, 1])[1] > 3
+
+    def test_small_image_is_not_tiled(self, tmp_path):
+        """Test an image within one tile is analyzed directly, without a pixel cache"""
+        path = tmp_path / "smear.png"
+        path.write_bytes(_png(synthetic_smear(256, 256)[0]))
+
+        result = slide.analyze_slide(path, tmp_path / "smear.npy", tile_size=256)
+
+        assert result["counts"] == analyze_image(path)["counts"]
+        assert "tiles" not in result
+        assert not (tmp_path / "smear.npy").exists()
+
+    def test_oversized_slide_is_rejected(self, tmp_path):
+        """Test a slide beyond OpenCV's decoding limit fails with a clear error, before decoding"""
+        path = tmp_path / "slide.png"
+        path.write_bytes(_oversized_png())
+
+        with pytest.raises(ImageTooLargeError, match="too large"):
+            slide.start_analysis(path, tmp_path / "slide.npy")
+        assert not (tmp_path / "slide.npy").exists()
+
+
+class TestIngest:
+    """Test images are re-encoded for storage and lose their metadata"""
+
+    def test_bmp_stored_as_png(self, tmp_path):
+        """Test lossless mode turns a BMP into a PNG with the same pixels"""
+        image = synthetic_smear(256, 192, seed=2)[0]
+        path = tmp_path / "smear.bmp"
+        cv2.imwrite(str(path), image)
+
+        result = ingest.ingest_image(path, ".bmp", "lossless")
+
+        assert result["extension"] == ".png"
+        assert result["size"] < result["original_size"] == path.stat().st_size
+        np.testing.assert_array_equal(cv2.imread(result["path"]), image)
+
+    def test_jpeg_metadata_stripped(self, tmp_path):
+        """Test EXIF and comments are removed without decoding the JPEG"""
+        image = synthetic_smear(128, 96, seed=2)[0]
+        path = tmp_path / "smear.jpg"
+        path.write_bytes(_jpeg_with_metadata(image))
+
+        result = ingest.ingest_image(path, ".jpg", "jpeg")
+        stored = open(result["path"], "rb").read()
+
+        assert result["extension"] == ".jpg"
+        assert b"Exif" not in stored and b"microscope" not in stored
+        assert result["original_size"] - result["size"] > 40
+        np.testing.assert_array_equal(cv2.imread(result["path"]), cv2.imread(str(path)))
+
+    def test_rotated_jpeg_reencoded_upright(self, tmp_path):
+        """Test a JPEG rotated by its EXIF data is stored as it is displayed"""
+        path = tmp_path / "smear.jpg"
+        path.write_bytes(_jpeg_with_metadata(synthetic_smear(128, 96, seed=2)[0], orientation=6))
+
+        result = ingest.ingest_image(path, ".jpg", "lossless")
+
+        assert b"Exif" not in open(result["path"], "rb").read()
+        assert cv2.imread(result["path"]).shape[:2] == (128, 96)
+
+    def test_png_chunks_and_original_mode(self, tmp_path):
+        """Test PNG text chunks are dropped, and original mode keeps the file as is"""
+        data = _png(synthetic_smear(64, 64, seed=2)[0])
+        text = b"tEXtComment\x00patient name"
+        data = data[:33] + struct.pack(">I", len(text) - 4) + text + b"\x00" * 4 + data[33:]
+        path = tmp_path / "smear.png"
+        path.write_bytes(data)
+
+        assert ingest.ingest_image(path, ".png", "original")["path"] == str(path)
+        result = ingest.ingest_image(path, ".png", "lossless")
+
+        assert b"patient name" not in open(result["path"], "rb").read()
+        np.testing.assert_array_equal(cv2.imread(result["path"]), cv2.imread(str(path)))
+        with pytest.raises(ValueError):
+            ingest.ingest_image(path, ".png", "webp")
+
+
+class TestAnalysisService:
+    """Test analysis runs off the event loop and is cached per image"""
+
+    @pytest.mark.asyncio
+    async def test_process_pool(self, tmp_path, monkeypatch):
+        """Test analysis on a worker process gives the in-process result"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 1)
+        path = tmp_path / "smear.png"
+        path.write_bytes(_png(synthetic_smear(256, 256)[0]))
+
+        try:
+            result = await blood_image_service.analyze_image(path)
+        finally:
+            blood_image_service.shutdown()
+
+        assert result["counts"] == analyze_image(path)["counts"]
+
+    @pytest.mark.asyncio
+    async def test_cached_per_content_hash(self, tmp_path, monkeypatch):
+        """Test the same image is analyzed once"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        calls = []
+        start_analysis = slide.start_analysis
+        monkeypatch.setattr(slide, "start_analysis", lambda *args: calls.append(args) or start_analysis(*args))
+        path = tmp_path / "smear.png"
+        path.write_bytes(_png(synthetic_smear(128, 128)[0]))
+        sha256 = blob_store.file_sha256(path)
+
+        first = await blood_image_service.analyze_image(path, sha256)
+        second = await blood_image_service.analyze_image(path, sha256)
+
+        assert first == second
+        assert len(calls) == 1
+        assert blob_store.derived_path(sha256, ai_service.ANALYSIS_ARTIFACT).exists()
+
+
+    @pytest.mark.asyncio
+    async def test_large_image_is_tiled(self, tmp_path, monkeypatch):
+        """Test images larger than a tile are split and merged"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        monkeypatch.setattr(slide, "SLIDE_TILE_SIZE", 256)
+        image, counts = synthetic_smear(640, 512, seed=4)
+        path = tmp_path / "slide.png"
+        path.write_bytes(_png(image))
+
+        result = await blood_image_service.analyze_image(path)
+
+        assert result["tiles"] == 6
+        assert result["counts"]["rbc"] == pytest.approx(counts["rbc"], rel=0.05)
+        assert not any(p.is_file() for p in blob_store.BLOB_DIR.rglob("*.npy"))
+
+    @pytest.mark.asyncio
+    async def test_pixel_cache_removed_after_analysis(self, tmp_path, monkeypatch):
+        """Test a stored slide keeps its cached analysis but not its decoded pixels"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        monkeypatch.setattr(slide, "SLIDE_TILE_SIZE", 256)
+        path = tmp_path / "slide.png"
+        path.write_bytes(_png(synthetic_smear(640, 512, seed=4)[0]))
+        sha256 = blob_store.file_sha256(path)
+
+        result = await blood_image_service.analyze_image(path, sha256)
+
+        assert result["tiles"] == 6
+        assert blob_store.derived_path(sha256, ai_service.ANALYSIS_ARTIFACT).exists()
+        assert not blob_store.derived_path(sha256, ai_service.PIXELS_ARTIFACT).exists()
+
+
+class TestImageUploadAnalysis:
+    """Test uploads store the analysis on the test"""
+
+    @pytest.fixture
+    def image_model(self, db_session, tmp_path, monkeypatch):
+        from app.database import Model
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        db_session.add(Model(name="Blood Cell Image Classification", accuracy=90.0, tests_count=0))
+        db_session.commit()
+
+    @pytest.mark.asyncio
+    async def test_upload_fills_result(self, db_session, patient_user, image_model):
+        """Test Test.result and Test.confidence come from the analysis"""
+        from app.database import Test
+
+        image, counts = synthetic_smear(256, 256, seed=1)
+        result = await blood_image_service.process_image_upload(
+            file=UploadFile(filename="smear.png", file=BytesIO(_png(image))),
+            patient_id=patient_user.id,
+            uploaded_by_id=patient_user.id,
+            db=db_session
+        )
+
+        assert result["success"] is True
+        test = db_session.get(Test, result["test_id"])
+        assert test.result.startswith("Automated analysis:")
+        assert float(test.confidence) == pytest.approx(result["analysis"]["confidence"], abs=1e-4)
+        assert result["analysis"]["counts"]["rbc"] == pytest.approx(counts["rbc"], rel=0.05)
+
+    @pytest.mark.asyncio
+    async def test_oversized_upload_is_rejected(self, db_session, patient_user, image_model):
+        """Test an image OpenCV cannot decode for its size is refused with the reason"""
+        result = await blood_image_service.process_image_upload(
+            file=UploadFile(filename="slide.png", file=BytesIO(_oversized_png())),
+            patient_id=patient_user.id,
+            uploaded_by_id=patient_user.id,
+            db=db_session
+        )
+
+        assert result["success"] is False
+        assert "too large" in result["message"]
+
+    @pytest.mark.asyncio
+    async def test_upload_stored_compressed(self, db_session, patient_user, image_model, monkeypatch):
+        """Test a BMP is stored as a JPEG in jpeg mode, analyzed on its uploaded pixels"""
+        from app.database import TestFile
+
+        monkeypatch.setattr(ingest, "IMAGE_STORAGE_FORMAT", "jpeg")
+        image = synthetic_smear(256, 256, seed=1)[0]
+        result = await blood_image_service.process_image_upload(
+            file=UploadFile(filename="smear.bmp", file=BytesIO(cv2.imencode(".bmp", image)[1].tobytes())),
+            patient_id=patient_user.id,
+            uploaded_by_id=patient_user.id,
+            db=db_session
+        )
+
+        assert result["success"] is True
+        assert result["file_path"].endswith(".jpg")
+        assert result["storage"]["compression_ratio"] > 5
+        assert "smaller" in result["message"]
+        assert result["analysis"] == analyze_array(image) | {"seconds": result["analysis"]["seconds"]}
+        assert db_session.query(TestFile).filter(TestFile.test_id == result["test_id"]).one().extension == ".jpg"
+        assert [p.name for p in blob_store.BLOB_DIR.rglob("*") if p.is_file() and p.parent.name != "tmp"
+                and "derived" not in p.parts] == [result["file_path"].rsplit("/", 1)[-1]]
+
+    @pytest.mark.asyncio
+    async def test_unreadable_upload_rejected(self, db_session, patient_user, image_model):
+        """Test files that are not images create no test and leave no file behind"""
+        from app.database import Test
+
+        result = await blood_image_service.process_image_upload(
+            file=UploadFile(filename="smear.png", file=BytesIO(b"not an image")),
+            patient_id=patient_user.id,
+            uploaded_by_id=patient_user.id,
+            db=db_session
+        )
+
+        assert result["success"] is False
+        assert db_session.query(Test).count() == 0
+        assert not any(p.is_file() for p in blob_store.BLOB_DIR.rglob("*"))
+
+
+class TestBatchImageUpload:
+    """Test several images uploaded together"""
+
+    @pytest.fixture
+    def image_model(self, db_session, tmp_path, monkeypatch):
+        from app.database import Model
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        model = Model(name="Blood Cell Image Classification", accuracy=90.0, tests_count=2)
+        db_session.add(model)
+        db_session.commit()
+        return model
+
+    @pytest.mark.asyncio
+    async def test_batch_in_one_transaction(self, db_session, patient_user, image_model):
+        """Test every valid image gets a test, written with one commit and one count update"""
+        from sqlalchemy import event
+        from app.database import Test
+
+        files = [
+            UploadFile(filename=f"smear_{seed}.png", file=BytesIO(_png(synthetic_smear(128, 128, seed=seed)[0])))
+            for seed in range(3)
+        ] + [UploadFile(filename="notes.png", file=BytesIO(b"not an image"))]
+        commits = []
+        engine = db_session.get_bind()
+
+        def on_commit(connection):
+            commits.append(connection)
+
+        event.listen(engine, "commit", on_commit)
+        try:
+            result = await blood_image_service.process_image_batch(
+                files=files,
+                patient_id=patient_user.id,
+                uploaded_by_id=patient_user.id,
+                description="Morning session",
+                db=db_session
+            )
+        finally:
+            event.remove(engine, "commit", on_commit)
+
+        assert result["success"] is True
+        assert len(result["test_ids"]) == 3
+        assert len(commits) == 1
+        assert "3 of 4" in result["message"] and "notes.png" in result["message"]
+        db_session.refresh(image_model)
+        assert image_model.tests_count == 5
+        tests = db_session.query(Test).all()
+        assert {t.id for t in tests} == set(result["test_ids"])
+        assert all(t.notes == "Morning session" and t.result.startswith("Automated analysis:") for t in tests)
+        assert not any(blob_store.BLOB_DIR.joinpath("tmp").iterdir())
+
+    @pytest.mark.asyncio
+    async def test_batch_without_valid_images(self, db_session, patient_user, image_model):
+        """Test a batch of unusable files creates nothing"""
+        from app.database import Test
+
+        result = await blood_image_service.process_image_batch(
+            files=[UploadFile(filename="report.pdf", file=BytesIO(b"%PDF"))],
+            patient_id=patient_user.id,
+            uploaded_by_id=patient_user.id,
+            db=db_session
+        )
+
+        assert result["success"] is False
+        assert "Invalid file type" in result["message"]
+        assert db_session.query(Test).count() == 0
+
+    def test_batch_route(self, client, auth_headers_patient, db_session, patient_user, image_model):
+        """Test the patient batch endpoint accepts several files"""
+        from app.database import Test
+
+        response = client.post(
+            "/patient/upload-blood-images",
+            files=[
+                ("files", (f"smear_{seed}.png", _png(synthetic_smear(96, 96, seed=seed)[0]), "image/png"))
+                for seed in range(2)
+            ],
+            follow_redirects=False
+        )
+
+        assert response.status_code == 303
+        assert db_session.query(Test).filter(Test.patient_id == patient_user.id).count() == 2
+
+    def test_batch_route_unlinked_doctor(self, client, auth_headers_doctor, db_session, patient_user, image_model, tmp_path):
+        """Test a doctor cannot upload images for a patient they are not linked to"""
+        from app.database import Test
+
+        # The fixture runs in tmp_path; the 403 page needs the templates
+        (tmp_path / "app").mkdir()
+        (tmp_path / "app" / "templates").symlink_to(Path(__file__).resolve().parents[1] / "app" / "templates")
+        response = client.post(
+            f"/doctor/upload-blood-images/{patient_user.id}",
+            files=[("files", ("smear.png", _png(synthetic_smear(96, 96)[0]), "image/png"))],
+            follow_redirects=False
+        )
+
+        assert response.status_code == 403
+        assert db_session.query(Test).count() == 0
+
+    def test_single_route_unlinked_doctor(self, client, auth_headers_doctor, db_session, patient_user, image_model, tmp_path):
+        """Test the single-image route checks patient access like the batch route"""
+        from app.database import Test
+
+        (tmp_path / "app").mkdir()
+        (tmp_path / "app" / "templates").symlink_to(Path(__file__).resolve().parents[1] / "app" / "templates")
+        response = client.post(
+            f"/doctor/upload-blood-image/{patient_user.id}",
+            files={"file": ("smear.png", _png(synthetic_smear(96, 96)[0]), "image/png")},
+            follow_redirects=False
+        )
+
+        assert response.status_code == 403
+        assert db_session.query(Test).count() == 0
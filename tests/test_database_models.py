@@ -5,7 +5,8 @@ import pytest
 from datetime import datetime
 from app.database import (
     User, DoctorInfo, MedicalHistory, Test, TestFile,
-    Model, PasswordResetToken, Message, doctor_patients
+    Model, PasswordResetToken, Message, doctor_patients,
+    async_database_url
 )
 
 
@@ -570,3 +571,70 @@ class TestMessageModel:
         
         db_session.refresh(message)
         assert message.is_read == 1
+
+
+class TestAsyncDatabaseUrl:
+    """Test async route handlers reach the same database through an asyncio driver"""
+    
+    def test_postgresql_uses_asyncpg(self):
+        """Test PostgreSQL URLs keep their credentials and options"""
+        url = async_database_url("postgresql://user:secret@db:5432/bloodcell?sslmode=require")
+        assert url == "postgresql+asyncpg://user:secret@db:5432/bloodcell?sslmode=require"
+    
+    def test_driver_replaced(self):
+        """Test an explicit sync driver is replaced"""
+        assert async_database_url("postgresql+psycopg2://u:p@db/x") == "postgresql+asyncpg://u:p@db/x"
+        assert async_database_url("sqlite:///./app.db") == "sqlite+aiosqlite:///./app.db"
+    
+    def test_unsupported_backend(self):
+        """Test databases without a configured async driver are refused"""
+        with pytest.raises(RuntimeError):
+            async_database_url("mysql://u:p@db/x")
+
+
+class TestConnectionPool:
+    """Test pool configuration and checkout metrics"""
+    
+    def test_pool_options(self):
+        """Test server databases get a sized, timed pool; in-memory SQLite does not"""
+        from app.database import TimedAsyncQueuePool, TimedQueuePool, pool_options
+        
+        options = pool_options("postgresql://u:p@db/x")
+        assert options["poolclass"] is TimedQueuePool
+        assert {"pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping"} <= set(options)
+        assert pool_options("postgresql://u:p@db/x", is_async=True)["poolclass"] is TimedAsyncQueuePool
+        assert "poolclass" not in pool_options("sqlite:///:memory:")
+    
+    def test_checkout_wait_and_timeouts_recorded(self, tmp_path):
+        """Test an exhausted pool records the wait and the timeout"""
+        from sqlalchemy import create_engine
+        from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+        from app.database import TimedQueuePool, pool_status
+        
+        engine = create_engine(
+            f"sqlite:///{tmp_path / 'pool.db'}",
+            poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.05
+        )
+        try:
+            with engine.connect():
+                assert pool_status(engine.pool)["checked_out"] == 1
+                with pytest.raises(PoolTimeoutError):
+                    engine.connect()
+            status = pool_status(engine.pool)
+        finally:
+            engine.dispose()
+        
+        assert status["checked_out"] == 0
+        assert status["checkout_timeouts"] == 1
+        assert status["checkout_wait"]["count"] == 2
+        assert status["checkout_wait"]["max_ms"] >= 50
+    
+    def test_session_lifetime_recorded(self):
+        """Test request sessions record how long they were open"""
+        from app.database import get_db, session_lifetime
+        
+        before = session_lifetime["sync"].count
+        dependency = get_db()
+        next(dependency)
+        dependency.close()
+        assert session_lifetime["sync"].count == before + 1
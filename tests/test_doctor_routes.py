@@ -57,6 +57,45 @@ class TestDoctorPatients:
         # Should redirect after success
         assert response.status_code == 303
 
+    
+    def test_dashboard_lists_review_requests(self, client, auth_headers_doctor, doctor_user, patient_user, db_session):
+        """Test review requests addressed to the doctor show with their patient"""
+        from datetime import datetime
+        from app.database import Test
+        from app.services import link_patient_to_doctor
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        db_session.add(Test(
+            patient_id=patient_user.id,
+            review_requested_from=doctor_user.id,
+            review_requested_at=datetime(2024, 3, 5),
+            notes="Please check my iron levels"
+        ))
+        db_session.commit()
+        
+        response = client.get("/doctor/dashboard")
+        assert response.status_code == 200
+        assert "Please check my iron levels" in response.text
+
+
+class TestDoctorTestAccess:
+    """Test doctors only open tests of linked patients"""
+    
+    def test_view_test_requires_link(self, client, auth_headers_doctor, doctor_user, patient_user, db_session):
+        """Test an unlinked doctor is sent back, a linked one sees the test"""
+        from app.database import Test
+        from app.services import link_patient_to_doctor
+        test = Test(patient_id=patient_user.id, result="Normal")
+        db_session.add(test)
+        db_session.commit()
+        
+        response = client.get(f"/doctor/test/{test.id}", follow_redirects=False)
+        assert response.status_code == 303
+        assert response.headers["location"] == "/doctor/dashboard"
+        
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        response = client.get(f"/doctor/test/{test.id}", follow_redirects=False)
+        assert response.status_code == 200
+
 
 class TestDoctorPatientRelationships:
     """Test linking/unlinking patients"""
@@ -0,0 +1,147 @@
+"""
+Tests for the blood smear image similarity index
+"""
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pytest
+from fastapi import UploadFile
+
+from app.ai.blood_cell import synthetic_smear
+from app.services import ai_service, blood_image_service, image_similarity_service
+
+
+def _png(image) -> bytes:
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+@pytest.fixture
+def image_model(db_session, tmp_path, monkeypatch):
+    from app.database import Model
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+    monkeypatch.setattr(image_similarity_service, "_index", None)
+    db_session.add(Model(name="Blood Cell Image Classification", accuracy=90.0, tests_count=0))
+    db_session.commit()
+
+
+@pytest.fixture
+def other_patient(db_session):
+    from app.database import User
+
+    user = User(username="patient2", email="patient2@test.com", password="x", fname="Sam", lname="Lee",
+                role="patient", is_active=1)
+    db_session.add(user)
+    db_session.commit()
+    return user
+
+
+async def _upload(db_session, patient, index=True, **smear):
+    """Upload a synthetic smear for a patient and index it; returns the test ID"""
+    image, _ = synthetic_smear(256, 256, **smear)
+    result = await blood_image_service.process_image_upload(
+        file=UploadFile(filename="smear.png", file=BytesIO(_png(image))),
+        patient_id=patient.id,
+        uploaded_by_id=patient.id,
+        db=db_session
+    )
+    assert result["success"] is True
+    if index:
+        assert image_similarity_service.index_test_image(result["test_id"], result["file_path"], result["analysis"])
+    return result["test_id"]
+
+
+def _link(db_session, doctor, patient):
+    from app.database import doctor_patients
+
+    db_session.execute(doctor_patients.insert().values(doctor_id=doctor.id, patient_id=patient.id))
+    db_session.commit()
+
+
+class TestImageIndex:
+    """Test descriptors are computed once and searched by distance"""
+
+    @pytest.mark.asyncio
+    async def test_descriptor_computed_once_per_image(self, db_session, patient_user, image_model, monkeypatch):
+        """Test the same image uploaded twice is described once and indexed under both tests"""
+        calls = []
+        describe = image_similarity_service.describe_image
+        monkeypatch.setattr(image_similarity_service, "describe_image",
+                            lambda *args: calls.append(args) or describe(*args))
+
+        first = await _upload(db_session, patient_user, seed=1)
+        second = await _upload(db_session, patient_user, seed=1)
+
+        index = image_similarity_service.get_image_index()
+        assert len(calls) == 1
+        assert len(index) == 2
+        np.testing.assert_array_equal(index.rows_for_test(first), index.rows_for_test(second))
+        # Indexing a test again adds nothing
+        assert not image_similarity_service.index_test_image(first, "unused.png")
+
+    def test_nearest_orders_and_filters(self, tmp_path, monkeypatch):
+        """Test the closest allowed tests come first, a test indexed twice counts once"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(image_similarity_service, "_index", None)
+        index = image_similarity_service.get_image_index()
+        width = len(image_similarity_service.DESCRIPTOR_NAMES)
+        for test_id, value in ((1, 0.9), (2, 0.1), (3, 0.5), (2, 0.3), (4, 0.0)):
+            index.append(test_id, np.full((1, width), value))
+
+        test_ids, distances = image_similarity_service.nearest(np.zeros(width), np.array([1, 2, 3]), 2)
+
+        assert test_ids.tolist() == [2, 3]
+        assert distances[0] == pytest.approx(0.1 * np.sqrt(width), rel=1e-5)
+
+
+class TestSimilarImages:
+    """Test searches only return tests the user may access"""
+
+    @pytest.mark.asyncio
+    async def test_doctor_sees_linked_patients_only(self, db_session, doctor_user, patient_user, other_patient, image_model):
+        """Test a doctor finds images of linked, active patients, nearest first"""
+        _link(db_session, doctor_user, patient_user)
+        query = await _upload(db_session, patient_user, seed=1)
+        alike = await _upload(db_session, patient_user, seed=2)
+        unlike = await _upload(db_session, patient_user, seed=3, wbc_ratio=0.3, rbc_radius=7)
+        await _upload(db_session, other_patient, seed=4)
+
+        result = image_similarity_service.find_similar_images(db_session, doctor_user, query)
+
+        assert result["success"] is True
+        assert [c["test_id"] for c in result["cases"]] == [alike, unlike]
+        assert result["cases"][0]["distance"] < result["cases"][1]["distance"]
+
+        _link(db_session, doctor_user, other_patient)
+        other_patient.is_active = 0
+        db_session.commit()
+        result = image_similarity_service.find_similar_images(db_session, doctor_user, query)
+        assert [c["test_id"] for c in result["cases"]] == [alike, unlike]
+
+    @pytest.mark.asyncio
+    async def test_unindexed_image_is_indexed_on_query(self, db_session, patient_user, image_model):
+        """Test images uploaded before indexing are described from their cached analysis"""
+        query = await _upload(db_session, patient_user, index=False, seed=1)
+        await _upload(db_session, patient_user, seed=2)
+
+        result = image_similarity_service.find_similar_images(db_session, patient_user, query)
+
+        assert result["success"] is True
+        assert len(result["cases"]) == 1
+        assert len(image_similarity_service.get_image_index().rows_for_test(query)) == 1
+
+    @pytest.mark.asyncio
+    async def test_route_checks_access(self, client, auth_headers_doctor, db_session, doctor_user, patient_user, image_model):
+        """Test the route refuses doctors not linked to the patient"""
+        query = await _upload(db_session, patient_user, seed=1)
+        await _upload(db_session, patient_user, seed=2)
+
+        assert client.get(f"/doctor/test/{query}/similar-images").status_code == 403
+
+        _link(db_session, doctor_user, patient_user)
+        response = client.get(f"/doctor/test/{query}/similar-images")
+        assert response.status_code == 200
+        assert len(response.json()["cases"]) == 1
+        assert client.get(f"/doctor/test/{query + 10}/similar-images").status_code == 404
@@ -0,0 +1,188 @@
+"""
+Tests for lab feed ingestion service
+"""
+import json
+import pytest
+from app.services import cbc_prediction_service
+
+
+async def _stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _collect(byte_stream, fmt="auto"):
+    from app.services.lab_feed_service import iter_feed_records
+    return [record async for record in iter_feed_records(byte_stream, fmt)]
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestFeedParsing:
+    """Test NDJSON and HL7-style feed parsing"""
+    
+    async def test_ndjson_fields_mapped_through_aliases(self):
+        """Test NDJSON keys are mapped to standard CBC names"""
+        line = json.dumps({"patient_id": 7, "hb": 12.1, "WBC": 6.5, "hct": 38})
+        records = await _collect(_stream(line.encode()))
+        
+        assert records == [{"Patient_Ref": "7", "HGB": 12.1, "TLC": 6.5, "PCV": 38}]
+    
+    async def test_ndjson_split_across_chunks(self):
+        """Test records split across chunk boundaries are reassembled"""
+        body = (json.dumps({"mrn": "a1", "mcv": 80}) + "\n" + json.dumps({"mrn": "a2", "mcv": 90}) + "\n").encode()
+        records = await _collect(_stream(body[:7], body[7:30], body[30:]))
+        
+        assert [r["Patient_Ref"] for r in records] == ["a1", "a2"]
+        assert [r["MCV"] for r in records] == [80, 90]
+    
+    async def test_invalid_ndjson_lines_skipped(self):
+        """Test blank and malformed lines are ignored"""
+        body = b'not json\n\n[1, 2]\n{"pid": "3", "plt": 200}\n'
+        records = await _collect(_stream(body), fmt="ndjson")
+        
+        assert records == [{"Patient_Ref": "3", "PLT": 200}]
+    
+    async def test_hl7_messages(self):
+        """Test HL7-style messages are assembled per MSH segment"""
+        message = (
+            "MSH|^~\\&|LIS|LAB|BDS|HOSP|20251201||ORU^R01|{n}|P|2.5\r"
+            "PID|1||{pid}^^^MRN||Doe^Jane\r"
+            "OBX|1|NM|HGB^Hemoglobin||13.5|g/dL\r"
+            "OBX|2|NM|718-7^Platelets||250|10*3/uL\r"
+        )
+        body = (message.format(n=1, pid=11) + message.format(n=2, pid=12)).encode()
+        records = await _collect(_stream(body), fmt="hl7")
+        
+        assert len(records) == 2
+        assert records[0] == {"Patient_Ref": "11", "HGB": "13.5", "PLT": "250"}
+        assert records[1]["Patient_Ref"] == "12"
+
+
+class TestFeedRoute:
+    """Test the lab feed endpoint"""
+    
+    def test_feed_requires_authentication(self, client):
+        """Test feed ingestion without authentication"""
+        response = client.post("/api/cbc/feed", content=b"{}")
+        assert response.status_code == 401
+        assert response.json()["detail"] == "Authentication required"
+    
+    def test_feed_rejects_patients(self, client, auth_headers_patient):
+        """Test patients cannot push lab feeds"""
+        response = client.post("/api/cbc/feed", content=b"{}")
+        assert response.status_code == 403
+    
+    def test_feed_unsupported_format(self, client, auth_headers_doctor):
+        """Test unsupported feed formats are rejected"""
+        response = client.post("/api/cbc/feed?format=xml", content=b"{}")
+        assert response.status_code == 400
+        assert response.json()["success"] is False
+    
+    @pytest.mark.skipif(
+        not cbc_prediction_service.is_available(),
+        reason="AI model not available"
+    )
+    def test_feed_routes_rows_to_linked_patients(self, client, auth_headers_doctor, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        """Test rows are scored for linked patients and unknown patients are skipped"""
+        from app.database import Model, Test
+        from app.services import link_patient_to_doctor
+        
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        
+        row = {"hb": 9.5, "rbc": 3.9, "hct": 30, "mcv": 75, "mch": 24, "mchc": 31, "wbc": 6, "plt": 240}
+        lines = [json.dumps({"patient_id": patient_user.id, **row}) for _ in range(5)]
+        lines.append(json.dumps({"patient_id": 9999, **row}))
+        
+        response = client.post("/api/cbc/feed?batch_size=2", content="\n".join(lines).encode())
+        body = response.json()
+        
+        assert response.status_code == 200
+        assert body["rows_received"] == 6
+        assert body["rows_scored"] == 5
+        assert body["rows_unrouted"] == 1
+        assert body["batches"] == 3
+        assert db_session.query(Test).filter(Test.patient_id == patient_user.id).count() == 3
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestFeedBatches:
+    """Test bad values and failing streams only cost what they have to"""
+    
+    ROW = {"hb": 9.5, "rbc": 3.9, "hct": 30, "mcv": 75, "mch": 24, "mchc": 31, "wbc": 6, "plt": 240}
+    
+    @pytest.fixture
+    def linked_patient(self, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        from app.database import Model
+        from app.services import link_patient_to_doctor
+        
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        link_patient_to_doctor(patient_user.id, doctor_user.id, db_session)
+        return patient_user
+    
+    def _line(self, patient, **values):
+        return (json.dumps({"patient_id": patient.id, **self.ROW, **values}) + "\n").encode()
+    
+    @pytest.mark.asyncio
+    async def test_non_numeric_value_rejects_its_row_only(self, db_session, doctor_user, linked_patient):
+        """Test one unreadable value drops its row, not its batch"""
+        from app.services.lab_feed_service import ingest_cbc_feed
+        
+        lines = [self._line(linked_patient) for _ in range(3)] + [self._line(linked_patient, hb="see note")]
+        result = await ingest_cbc_feed(_stream(*lines), current_user=doctor_user, db=db_session)
+        
+        assert result["success"] is True
+        assert result["rows_scored"] == 3
+        assert result["rows_invalid"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_stream_failure_reports_progress(self, db_session, doctor_user, linked_patient):
+        """Test a feed failing part way keeps and reports the batches already stored"""
+        from app.database import Test
+        from app.services.lab_feed_service import ingest_cbc_feed
+        
+        async def failing_stream():
+            for _ in range(4):
+                yield self._line(linked_patient)
+            raise ConnectionResetError("lab connection lost")
+        
+        result = await ingest_cbc_feed(failing_stream(), current_user=doctor_user, db=db_session, batch_size=2)
+        
+        assert result["success"] is False
+        assert "lab connection lost" in result["error"]
+        assert result["rows_scored"] == 4
+        assert len(result["test_ids"]) == 2
+        assert db_session.query(Test).filter(Test.patient_id == linked_patient.id).count() == 2
+    
+    @pytest.mark.asyncio
+    async def test_patients_resolved_off_event_loop(self, db_session, doctor_user, linked_patient, monkeypatch):
+        """Test identifier lookups run in the threadpool, and unknown ones are counted as unrouted"""
+        import threading
+        from app.services import lab_feed_service
+        
+        threads = []
+        lookup = lab_feed_service.PatientRouter._lookup
+        
+        def recording_lookup(router, identifier):
+            threads.append(threading.current_thread())
+            return lookup(router, identifier)
+        
+        monkeypatch.setattr(lab_feed_service.PatientRouter, "_lookup", recording_lookup)
+        lines = [self._line(linked_patient), self._line(linked_patient)]
+        lines.append((json.dumps({"patient_id": 9999, **self.ROW}) + "\n").encode())
+        result = await lab_feed_service.ingest_cbc_feed(_stream(*lines), current_user=doctor_user, db=db_session)
+        
+        assert result["rows_scored"] == 2
+        assert result["rows_unrouted"] == 1
+        assert len(threads) == 2
+        assert threading.main_thread() not in threads
@@ -0,0 +1,198 @@
+"""
+Tests for schema migrations and the indexes of the hot query paths
+
+The query plan tests run on SQLite, and on PostgreSQL when TEST_POSTGRES_URL
+points to a scratch database (its tables are dropped afterwards).
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, inspect, select, text
+
+from app import migrations
+from app.database import Base, User, Test, TestFile, MedicalHistory, doctor_patients
+from app.migrations.v0001_hot_path_indexes import INDEXES
+
+
+HOT_PATH_INDEXES = {name for name, _, _ in INDEXES}
+
+
+def _index_names(engine):
+    inspector = inspect(engine)
+    return {index["name"] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+def _postgres_url():
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL not set")
+    pytest.importorskip("psycopg2")
+    return url
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def migration_engine(request, tmp_path):
+    """An empty database on each backend"""
+    url = f"sqlite:///{tmp_path / 'migrations.db'}" if request.param == "sqlite" else _postgres_url()
+    engine = create_engine(url)
+    yield engine
+    Base.metadata.drop_all(bind=engine)
+    migrations.schema_migrations.drop(bind=engine, checkfirst=True)
+    engine.dispose()
+
+
+@pytest.fixture
+def old_database(migration_engine):
+    """A database as created before the hot path indexes existed"""
+    Base.metadata.create_all(bind=migration_engine)
+    with migration_engine.begin() as connection:
+        migrations.v0001_hot_path_indexes.downgrade(connection)
+    return migration_engine
+
+
+class TestMigrationRunner:
+    """Test migrations are applied once, in order, and can be reverted"""
+
+    def test_upgrade_adds_indexes(self, old_database):
+        """Test upgrading an existing database adds the indexes and records the version"""
+        assert not HOT_PATH_INDEXES & _index_names(old_database)
+
+        assert migrations.upgrade(old_database) == ["0001"]
+        assert HOT_PATH_INDEXES <= _index_names(old_database)
+        assert migrations.upgrade(old_database) == []
+        assert migrations.status(old_database)[0]["applied_at"] is not None
+
+    def test_downgrade_drops_indexes(self, old_database):
+        """Test reverting a migration removes its indexes and its record"""
+        migrations.upgrade(old_database)
+
+        assert migrations.downgrade(old_database, "0000") == ["0001"]
+        assert not HOT_PATH_INDEXES & _index_names(old_database)
+        assert migrations.status(old_database)[0]["applied_at"] is None
+
+    def test_models_match_migrations(self, old_database):
+        """Test a new database gets the same indexes from the models as an old one from migrations"""
+        migrations.upgrade(old_database)
+        migrated = inspect(old_database)
+
+        fresh = create_engine("sqlite://")
+        Base.metadata.create_all(bind=fresh)
+        created = inspect(fresh)
+        for _, table, _ in INDEXES:
+            expected = {i["name"]: i["column_names"] for i in created.get_indexes(table)}
+            actual = {i["name"]: i["column_names"] for i in migrated.get_indexes(table)}
+            assert {n: c for n, c in actual.items() if n in HOT_PATH_INDEXES} == \
+                {n: c for n, c in expected.items() if n in HOT_PATH_INDEXES}
+
+    def test_stamp_skips_migrations(self, migration_engine):
+        """Test a database created from the models is marked up to date"""
+        Base.metadata.create_all(bind=migration_engine)
+
+        assert migrations.stamp(migration_engine) == ["0001"]
+        assert migrations.upgrade(migration_engine) == []
+
+
+# Queries of the dashboards and patient pages, and the index each should use
+HOT_QUERIES = {
+    "ix_tests_patient_id_created_at":
+        select(Test).where(Test.patient_id == 3).order_by(Test.created_at.desc()).limit(5),
+    "ix_tests_review_requested":
+        select(Test).where(Test.review_requested_from == 1, Test.review_status == "pending")
+        .order_by(Test.review_requested_at.desc()).limit(5),
+    "ix_tests_reviewed_by_created_at":
+        select(Test).where(Test.reviewed_by == 1).order_by(Test.created_at.desc()).limit(5),
+    "ix_test_files_test_id":
+        select(TestFile).where(TestFile.test_id == 7),
+    "ix_medical_history_patient_id_created_at":
+        select(MedicalHistory).where(MedicalHistory.patient_id == 3).order_by(MedicalHistory.created_at.desc()),
+    "ix_doctor_patients_patient_id":
+        select(doctor_patients.c.doctor_id).where(doctor_patients.c.patient_id == 3),
+    "ix_users_role_created_at":
+        select(User).where(User.role == "patient").order_by(User.created_at.desc()).limit(5),
+}
+
+
+def _fill(engine, patients=60, tests_per_patient=20):
+    """Enough rows for the planner to prefer an index over a scan"""
+    start = datetime(2024, 1, 1)
+    doctors = [
+        {"id": i, "username": f"doctor{i}", "email": f"doctor{i}@test.com", "password": "x",
+         "fname": "D", "lname": "R", "role": "doctor", "is_active": 1, "created_at": start}
+        for i in (1, 2)
+    ]
+    patient_rows = [
+        {"id": i, "username": f"patient{i}", "email": f"patient{i}@test.com", "password": "x",
+         "fname": "P", "lname": "T", "role": "patient", "is_active": 1, "created_at": start + timedelta(days=i)}
+        for i in range(3, patients + 3)
+    ]
+    tests = []
+    for patient in patient_rows:
+        for n in range(tests_per_patient):
+            tests.append({
+                "id": len(tests) + 1, "patient_id": patient["id"], "created_at": start + timedelta(hours=len(tests)),
+                "review_status": "pending" if n % 4 else "accepted",
+                "reviewed_by": 1 if n % 4 == 0 else None,
+                "review_requested_from": 1 + n % 2 if n % 3 == 0 else None,
+                "review_requested_at": start + timedelta(hours=len(tests)) if n % 3 == 0 else None,
+            })
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), doctors + patient_rows)
+        connection.execute(Test.__table__.insert(), tests)
+        connection.execute(TestFile.__table__.insert(), [
+            {"test_id": t["id"], "name": "in", "extension": ".csv", "path": f"uploads/{t['id']}.csv",
+             "type": "input", "created_at": t["created_at"]}
+            for t in tests
+        ])
+        connection.execute(MedicalHistory.__table__.insert(), [
+            {"patient_id": p["id"], "doctor_id": 1, "medical_condition": "Anemia", "created_at": p["created_at"]}
+            for p in patient_rows for _ in range(5)
+        ])
+        connection.execute(doctor_patients.insert(), [
+            {"doctor_id": 1 + p["id"] % 2, "patient_id": p["id"]} for p in patient_rows
+        ])
+        connection.execute(text("ANALYZE"))
+
+
+def _plan_indexes(connection, statement) -> set:
+    """Names of the indexes the plan of a statement reads"""
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    if connection.dialect.name == "sqlite":
+        details = [row[-1] for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        return {word for detail in details for word in detail.split() if word.startswith("ix_")}
+
+    plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    names, nodes = set(), [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            names.add(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+    return names
+
+
+class TestQueryPlans:
+    """Test the hot queries read their index once the migration is applied"""
+
+    @pytest.fixture
+    def filled_database(self, old_database):
+        migrations.upgrade(old_database)
+        _fill(old_database)
+        return old_database
+
+    @pytest.mark.parametrize("index_name", sorted(HOT_QUERIES))
+    def test_query_uses_index(self, filled_database, index_name):
+        """Test each hot query is answered from its index"""
+        with filled_database.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                # A test-sized table fits in a page or two; make a sequential scan the last resort
+                connection.execute(text("SET enable_seqscan = off"))
+            assert index_name in _plan_indexes(connection, HOT_QUERIES[index_name])
+
+    def test_query_scans_without_index(self, old_database):
+        """Test the patient test list falls back to a scan before the migration"""
+        _fill(old_database)
+        with old_database.connect() as connection:
+            assert not _plan_indexes(connection, HOT_QUERIES["ix_tests_patient_id_created_at"])
@@ -61,3 +61,28 @@ class TestPatientTests:
         """Test accessing CBC upload page"""
         response = client.get("/patient/upload-cbc", headers=auth_headers_patient)
         assert response.status_code in [200, 303]
+    
+    def test_tests_page_shows_reviewers(self, client, auth_headers_patient, patient_user, doctor_user, db_session):
+        """Test the tests page lists the patient's tests with their reviewers"""
+        from app.database import Test
+        db_session.add_all([
+            Test(patient_id=patient_user.id, result="Normal", review_status="reviewed", reviewed_by=doctor_user.id),
+            Test(patient_id=patient_user.id, result="Anemia")
+        ])
+        db_session.commit()
+        
+        response = client.get("/patient/tests")
+        assert response.status_code == 200
+        assert "Dr. John Doe" in response.text
+        assert "Anemia" in response.text
+    
+    def test_view_other_patients_test(self, client, auth_headers_patient, doctor_user, db_session):
+        """Test a patient cannot open someone else's test"""
+        from app.database import Test
+        test = Test(patient_id=doctor_user.id, result="Normal")
+        db_session.add(test)
+        db_session.commit()
+        
+        response = client.get(f"/patient/test/{test.id}", follow_redirects=False)
+        assert response.status_code == 303
+        assert response.headers["location"] == "/patient/dashboard"
@@ -0,0 +1,93 @@
+"""
+Tests for image previews
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from app.services import blob_store, preview_service
+
+
+@pytest.fixture
+def stored_image(db_session, tmp_path, monkeypatch):
+    """A 2000x1500 photo-like image in an empty store"""
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 255, (1500, 2000, 3), dtype=np.uint8), (9, 9), 0)
+    path = blob_store.temp_path(".png")
+    cv2.imwrite(str(path), image)
+    stored = blob_store.store_file(db_session, path, ".png")
+    db_session.commit()
+    return stored
+
+
+class TestPreviews:
+    """Test previews are rendered at the fixed sizes and used by templates"""
+
+    def test_generate_previews(self, stored_image):
+        """Test every size is written once, scaled to its longest side"""
+        written = preview_service.generate_previews(stored_image)
+
+        assert set(written) == set(preview_service.PREVIEW_SIZES)
+        for size, longest_side in preview_service.PREVIEW_SIZES.items():
+            preview = cv2.imread(str(preview_service.preview_path(stored_image, size)))
+            assert max(preview.shape[:2]) == longest_side
+            assert preview.shape[1] / preview.shape[0] == pytest.approx(2000 / 1500, rel=0.02)
+        assert written["thumb"] < written["preview"] < os.path.getsize(stored_image)
+        assert preview_service.generate_previews(stored_image) == {}
+
+    def test_small_images_are_not_enlarged(self, db_session, tmp_path, monkeypatch):
+        """Test an image smaller than a preview keeps its size"""
+        monkeypatch.chdir(tmp_path)
+        path = blob_store.temp_path(".png")
+        cv2.imwrite(str(path), np.full((40, 60, 3), 200, dtype=np.uint8))
+        stored = blob_store.store_file(db_session, path, ".png")
+
+        preview_service.generate_previews(stored)
+
+        assert cv2.imread(str(preview_service.preview_path(stored, "avatar"))).shape[:2] == (40, 60)
+
+    def test_preview_url_falls_back_to_original(self, stored_image):
+        """Test the original is used until the preview exists, and for files outside the store"""
+        assert preview_service.preview_url(stored_image, "avatar") == f"/{stored_image}"
+        assert preview_service.preview_url("uploads/profiles/legacy.jpg", "avatar") == "/uploads/profiles/legacy.jpg"
+        assert preview_service.preview_url(None) == ""
+
+        preview_service.generate_previews(stored_image)
+
+        assert preview_service.preview_url(stored_image, "avatar").endswith("preview_avatar_96.jpg")
+
+    def test_unreadable_image_is_skipped(self, db_session, tmp_path, monkeypatch):
+        """Test a file that is not an image gets no previews and raises nothing"""
+        monkeypatch.chdir(tmp_path)
+        stored = blob_store.store_file(db_session, _write(blob_store.temp_path(".jpg"), b"not an image"), ".jpg")
+
+        assert preview_service.generate_previews(stored) == {}
+        assert preview_service.preview_url(stored) == f"/{stored}"
+
+    def test_profile_upload_renders_previews(self, client, auth_headers_patient, patient_user, db_session, tmp_path, monkeypatch):
+        """Test uploading a profile image renders its previews in the background"""
+        (tmp_path / "app").mkdir()
+        (tmp_path / "app" / "templates").symlink_to(os.path.abspath("app/templates"))
+        monkeypatch.chdir(tmp_path)
+        image = cv2.imencode(".png", np.full((400, 400, 3), 120, dtype=np.uint8))[1].tobytes()
+
+        response = client.post(
+            "/patient/upload-profile-image",
+            files={"profile_image": ("me.png", image, "image/png")},
+            follow_redirects=False
+        )
+        db_session.refresh(patient_user)
+
+        assert response.status_code == 303
+        assert preview_service.preview_path(patient_user.profile_image, "avatar").exists()
+        page = client.get("/patient/account")
+        assert preview_service.preview_url(patient_user.profile_image, "avatar") in page.text
+        assert f'src="/{patient_user.profile_image}"' not in page.text
+
+
+def _write(path, content: bytes):
+    path.write_bytes(content)
+    return path
@@ -1,6 +1,8 @@
 """
 Tests for public routes
 """
+from pathlib import Path
+
 import pytest
 
 
@@ -27,3 +29,36 @@ class TestPublicPages:
         response = client.get("/", headers=auth_headers_admin, follow_redirects=False)
         # Should redirect to appropriate dashboard
         assert response.status_code in [200, 303]
+
+
+class TestUploadsExposure:
+    """Test server-side data is not reachable through the public /uploads mount"""
+
+    def test_feature_store_not_served(self, client, tmp_path, monkeypatch):
+        """Test the CBC feature store (patient lab values) is not under /uploads"""
+        from app.ai.cbc import FeatureStore
+        from app.services.ai_service import FEATURE_STORE_DIR
+
+        # Serve a scratch tree laid out like the app's working directory
+        (tmp_path / "app").symlink_to(Path("app").resolve())
+        (tmp_path / "uploads").mkdir()
+        monkeypatch.chdir(tmp_path)
+        store = FeatureStore(FEATURE_STORE_DIR, ["HGB"])
+        assert (store.directory / "meta.json").exists()
+
+        response = client.get("/uploads/feature_store/cbc/meta.json")
+        assert response.status_code == 404
+
+    def test_image_index_not_served(self, client, tmp_path, monkeypatch):
+        """Test the image descriptor index is not under /uploads"""
+        from app.ai.cbc import FeatureStore
+        from app.services.image_similarity_service import IMAGE_INDEX_DIR
+
+        (tmp_path / "app").symlink_to(Path("app").resolve())
+        (tmp_path / "uploads").mkdir()
+        monkeypatch.chdir(tmp_path)
+        store = FeatureStore(IMAGE_INDEX_DIR, ["rbc"])
+        assert (store.directory / "meta.json").exists()
+
+        response = client.get(f"/uploads/feature_store/{Path(IMAGE_INDEX_DIR).name}/meta.json")
+        assert response.status_code == 404
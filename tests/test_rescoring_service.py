@@ -0,0 +1,153 @@
+"""
+Tests for the CBC re-scoring job
+"""
+import threading
+
+import pytest
+
+from app.services import cbc_prediction_service
+from app.services.rescoring_service import throttle_delay
+from app.services.result_storage import read_results, result_extension
+
+
+class TestThrottle:
+    """Test CPU budget throttling"""
+
+    def test_throttle_delay(self):
+        """Test the sleep keeps the duty cycle at the budget"""
+        assert throttle_delay(1.0, 0.25) == pytest.approx(3.0)
+        assert throttle_delay(1.0, 1.0) == 0.0
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestRescoringJob:
+    """Test resumable re-scoring of stored CBC tests"""
+
+    @pytest.fixture
+    def stored_tests(self, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        """Three stored CBC tests"""
+        from app.database import Model
+
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+
+        test_ids = []
+        for hgb in (9.0, 13.5, 15.0):
+            result = cbc_prediction_service.process_manual_input(
+                rbc=4.5, hgb=hgb, pcv=40.0, mcv=85.0, mch=28.0, mchc=33.0, tlc=7.0, plt=250.0,
+                patient_id=patient_user.id,
+                uploaded_by_id=doctor_user.id,
+                db=db_session
+            )
+            assert result["success"]
+            test_ids.append(result["test_id"])
+        return test_ids
+
+    @pytest.fixture
+    def session_factory(self):
+        from tests.conftest import TestingSessionLocal
+        return TestingSessionLocal
+
+    def test_job_rescores_all_tests(self, db_session, stored_tests, session_factory):
+        """Test every test gets a version-tagged rescore file"""
+        from app.database import RescoringJob, TestFile
+        from app.services.rescoring_service import start_rescoring_job, run_rescoring_job
+
+        result = start_rescoring_job(db_session, batch_size=2, cpu_budget=1.0, background=False)
+        assert result["success"]
+
+        assert run_rescoring_job(result["job_id"], session_factory) == "completed"
+
+        db_session.expire_all()
+        job = db_session.query(RescoringJob).get(result["job_id"])
+        assert job.tests_processed == 3
+        assert job.rows_processed == 3
+        assert job.last_test_id == stored_tests[-1]
+
+        rescored = db_session.query(TestFile).filter(TestFile.type == "rescore").all()
+        assert sorted(f.test_id for f in rescored) == stored_tests
+        assert {f.extension for f in rescored} == {result_extension()}
+        df = read_results(rescored[0].path)
+        assert df["Model_Version"][0] == cbc_prediction_service.model_version
+        assert df["Diagnosis"][0] in ["Anemia", "Normal"]
+
+    def test_cancel_and_resume_from_checkpoint(self, db_session, stored_tests, session_factory, monkeypatch):
+        """Test a cancelled job continues after the last committed batch"""
+        from app.database import RescoringJob, TestFile
+        from app.services import rescoring_service
+
+        result = rescoring_service.start_rescoring_job(db_session, batch_size=1, cpu_budget=1.0, background=False)
+        cancel_event = threading.Event()
+        original = rescoring_service.rescore_tests
+
+        def rescore_then_cancel(*args, **kwargs):
+            counts = original(*args, **kwargs)
+            cancel_event.set()
+            return counts
+
+        monkeypatch.setattr(rescoring_service, "rescore_tests", rescore_then_cancel)
+        status = rescoring_service.run_rescoring_job(result["job_id"], session_factory, cancel_event)
+        assert status == "cancelled"
+
+        db_session.expire_all()
+        job = db_session.query(RescoringJob).get(result["job_id"])
+        assert job.last_test_id == stored_tests[0]
+
+        monkeypatch.setattr(rescoring_service, "rescore_tests", original)
+        assert rescoring_service.resume_rescoring_job(db_session, job.id, background=False)["success"]
+        assert rescoring_service.run_rescoring_job(job.id, session_factory) == "completed"
+
+        db_session.expire_all()
+        assert db_session.query(TestFile).filter(TestFile.type == "rescore").count() == 3
+        assert db_session.query(RescoringJob).get(job.id).tests_processed == 3
+
+    def test_model_change_fails_job(self, db_session, stored_tests, session_factory):
+        """Test a job is not continued with a different model version"""
+        from app.database import RescoringJob
+        from app.services.rescoring_service import start_rescoring_job, run_rescoring_job
+
+        result = start_rescoring_job(db_session, background=False)
+        job = db_session.query(RescoringJob).get(result["job_id"])
+        job.model_version = "000000000000"
+        db_session.commit()
+
+        assert run_rescoring_job(job.id, session_factory) == "failed"
+
+    def test_model_reload_during_job_fails_it(self, db_session, stored_tests, session_factory, monkeypatch):
+        """Test a model reloaded mid-job stops it before the batch is checkpointed"""
+        from app.database import RescoringJob, TestFile
+        from app.services import rescoring_service
+
+        result = rescoring_service.start_rescoring_job(db_session, batch_size=1, cpu_budget=1.0, background=False)
+        original = rescoring_service.rescore_tests
+
+        def rescore_then_reload(*args, **kwargs):
+            counts = original(*args, **kwargs)
+            monkeypatch.setattr(cbc_prediction_service, "model_version", "111111111111")
+            return counts
+
+        monkeypatch.setattr(rescoring_service, "rescore_tests", rescore_then_reload)
+        assert rescoring_service.run_rescoring_job(result["job_id"], session_factory) == "failed"
+
+        db_session.expire_all()
+        job = db_session.query(RescoringJob).get(result["job_id"])
+        assert job.last_test_id == 0
+        assert "111111111111" in job.error
+        assert db_session.query(TestFile).filter(TestFile.type == "rescore").count() == 0
+
+    def test_admin_can_start_job(self, client, auth_headers_admin, stored_tests, monkeypatch):
+        """Test the admin route starts a job"""
+        from app.routers import admin
+
+        started = []
+        monkeypatch.setattr(admin, "start_rescoring_job", lambda db, **kwargs: started.append(kwargs) or {
+            "success": True, "message": "started", "job_id": 1
+        })
+        response = client.post("/admin/models/rescore", data={"batch_size": "50"}, follow_redirects=False)
+
+        assert response.status_code == 303
+        assert started[0]["batch_size"] == 50
@@ -0,0 +1,107 @@
+"""
+Tests for the pluggable CBC result storage
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services import cbc_prediction_service
+from app.services.result_storage import (
+    write_results, read_results, result_columns, count_result_rows, export_csv
+)
+
+
+def _results(n):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "HGB": np.round(rng.uniform(8, 16, n), 2),
+        "Predicted_Anemia": rng.integers(0, 2, n),
+        "Diagnosis": "Normal",
+        "HGB_Flag": rng.choice(["Low", "Normal", "High"], n),
+    })
+    df.loc[::7, "HGB_Flag"] = np.nan
+    return df
+
+
+class TestResultStorage:
+    """Test both storage formats round-trip annotated results"""
+
+    @pytest.mark.parametrize("extension", [".npz", ".csv"])
+    def test_round_trip(self, tmp_path, monkeypatch, extension):
+        """Test values, types, missing labels, pages and column subsets"""
+        from app.services.result_storage import NpzResultFormat
+
+        monkeypatch.setattr(NpzResultFormat, "block_rows", 64)
+        path = tmp_path / f"results{extension}"
+        df = _results(300)
+        write_results(df, path)
+
+        assert result_columns(path) == list(df.columns)
+        assert count_result_rows(path) == 300
+        pd.testing.assert_frame_equal(read_results(path), df, check_dtype=False)
+
+        page = read_results(path, columns=["HGB_Flag", "HGB"], start=100, stop=150)
+        assert list(page.columns) == ["HGB", "HGB_Flag"]
+        assert list(page.index) == list(range(100, 150))
+        assert page["HGB_Flag"].isna().sum() == df["HGB_Flag"][100:150].isna().sum()
+
+    def test_npz_keeps_types(self, tmp_path):
+        """Test numeric columns are stored typed"""
+        path = tmp_path / "results.npz"
+        write_results(_results(10), path)
+
+        df = read_results(path, columns=lambda c: c != "Diagnosis")
+        assert df["Predicted_Anemia"].dtype == np.int64
+        assert df["HGB"].dtype == np.float64
+
+    def test_export_csv(self, tmp_path, monkeypatch):
+        """Test the CSV export matches the stored results"""
+        from app.services import result_storage
+
+        monkeypatch.setattr(result_storage, "EXPORT_CHUNK_ROWS", 64)
+        path = tmp_path / "results.npz"
+        df = _results(300)
+        write_results(df, path)
+
+        exported = pd.read_csv(io.BytesIO(b"".join(export_csv(path))))
+        pd.testing.assert_frame_equal(exported, df, check_dtype=False)
+
+    def test_unknown_format(self, tmp_path):
+        """Test unsupported extensions are rejected"""
+        with pytest.raises(ValueError):
+            write_results(_results(3), tmp_path / "results.json")
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestResultDownload:
+    """Test results are downloaded as CSV"""
+
+    def test_patient_downloads_csv(self, client, auth_headers_patient, patient_user, doctor_user, db_session, tmp_path, monkeypatch):
+        """Test a stored test is exported as CSV on request"""
+        from app.database import Model, TestFile
+
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0))
+        db_session.commit()
+        result = cbc_prediction_service.process_manual_input(
+            rbc=4.5, hgb=9.0, pcv=30.0, mcv=70.0, mch=22.0, mchc=30.0, tlc=7.0, plt=250.0,
+            patient_id=patient_user.id,
+            uploaded_by_id=doctor_user.id,
+            db=db_session
+        )
+        output_file = db_session.query(TestFile).filter(TestFile.test_id == result["test_id"]).first()
+        assert output_file.extension == ".npz"
+
+        response = client.get(f"/patient/test/{result['test_id']}/download")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert output_file.name.replace(".npz", ".csv") in response.headers["content-disposition"]
+        df = pd.read_csv(io.BytesIO(response.content))
+        assert df["Diagnosis"][0] == result["result"]["prediction"]
+        assert df["HGB"][0] == pytest.approx(9.0)
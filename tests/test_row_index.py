@@ -0,0 +1,131 @@
+"""
+Tests for the CSV row offset index and paginated result views
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.services import cbc_prediction_service
+from app.services.row_index import (
+    row_index_path, write_csv, load_row_index, count_rows, read_rows, page_bounds
+)
+
+
+def _frame(n):
+    return pd.DataFrame({"ID": np.arange(n), "HGB": np.round(np.linspace(8, 16, n), 2), "Diagnosis": "Normal"})
+
+
+class TestRowIndex:
+    """Test seeking to pages through the sidecar index"""
+
+    def test_read_page(self, tmp_path):
+        """Test a page matches the same slice of the full file"""
+        path = tmp_path / "results.csv"
+        df = _frame(1000)
+        write_csv(df, path)
+
+        assert row_index_path(path).exists()
+        assert count_rows(path) == 1000
+        page = read_rows(path, 250, 300)
+        assert list(page.index) == list(range(250, 300))
+        pd.testing.assert_frame_equal(page, pd.read_csv(path).iloc[250:300])
+
+    def test_read_columns_and_bounds(self, tmp_path):
+        """Test column subsets and out-of-range pages"""
+        path = tmp_path / "results.csv"
+        write_csv(_frame(10), path)
+
+        assert list(read_rows(path, 8, 20, usecols=["HGB"]).columns) == ["HGB"]
+        assert len(read_rows(path, 8, 20)) == 2
+        assert len(read_rows(path, 50, 60)) == 0
+
+    def test_missing_or_stale_index_is_rebuilt(self, tmp_path):
+        """Test files written without the index, or rewritten later, still page correctly"""
+        path = tmp_path / "results.csv"
+        _frame(30).to_csv(path, index=False)
+        assert count_rows(path) == 30
+
+        _frame(45).to_csv(path, index=False)
+        assert count_rows(path) == 45
+        assert read_rows(path, 40, 45)["ID"].tolist() == [40, 41, 42, 43, 44]
+        assert load_row_index(path)[-1] == path.stat().st_size
+
+    def test_quoted_line_breaks(self, tmp_path, monkeypatch):
+        """Test a newline inside a quoted field does not start a new row"""
+        from app.services import row_index
+
+        path = tmp_path / "results.csv"
+        df = _frame(20)
+        df["Notes"] = ""
+        df.loc[5, "Notes"] = 'Repeat draw,\n"haemolysed"\nsample'
+        df.loc[12, "Notes"] = "line one\nline two"
+        df.to_csv(path, index=False)
+
+        # Small chunks so quoted fields span chunk boundaries
+        monkeypatch.setattr(row_index, "_SCAN_CHUNK", 7)
+        assert count_rows(path) == 20
+        pd.testing.assert_frame_equal(read_rows(path, 4, 14), pd.read_csv(path).iloc[4:14])
+
+        write_csv(df, path)
+        assert read_rows(path, 12, 13)["Notes"].tolist() == ["line one\nline two"]
+
+    def test_page_bounds(self):
+        """Test pagination parameters are clamped"""
+        assert page_bounds(3, 50, 120) == (3, 50, 3, 100, 120)
+        assert page_bounds(9, 50, 120) == (3, 50, 3, 100, 120)
+        assert page_bounds(0, 0, 0) == (1, 1, 1, 0, 0)
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestPaginatedTestView:
+    """Test the test detail pages render one page of samples"""
+
+    @pytest.fixture
+    def large_test(self, patient_user, db_session, tmp_path, monkeypatch):
+        """A stored CBC test with 120 samples"""
+        import os
+        from app.ai.cbc import predict_and_annotate_dataframe
+        from app.database import Model, TestFile
+
+        cwd = os.getcwd()
+        monkeypatch.chdir(tmp_path)
+
+        cbc_model = Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0)
+        db_session.add(cbc_model)
+        db_session.commit()
+
+        cbc_prediction_service.load_model()
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({
+            "RBC": rng.uniform(3.5, 5.5, 120), "HGB": rng.uniform(8, 16, 120),
+            "PCV": rng.uniform(30, 48, 120), "MCV": rng.uniform(70, 100, 120),
+            "MCH": rng.uniform(22, 33, 120), "MCHC": rng.uniform(30, 36, 120),
+            "TLC": rng.uniform(4, 11, 120), "PLT": rng.uniform(150, 400, 120),
+        })
+        df_annotated, _ = predict_and_annotate_dataframe(
+            df, cbc_prediction_service.model, cbc_prediction_service.scaler, cbc_prediction_service.used_features
+        )
+        test = cbc_prediction_service.save_annotated_test(
+            db_session, cbc_model, patient_user.id, df_annotated, notes="Large upload"
+        )
+        db_session.commit()
+
+        # Templates are resolved relative to the project root
+        for test_file in db_session.query(TestFile).filter(TestFile.test_id == test.id):
+            test_file.path = str(tmp_path / test_file.path)
+        db_session.commit()
+        monkeypatch.chdir(cwd)
+        return test.id
+
+    def test_patient_sees_requested_page(self, client, auth_headers_patient, large_test):
+        """Test only the rows of the requested page are rendered"""
+        response = client.get(f"/patient/test/{large_test}?page=2&page_size=50")
+
+        assert response.status_code == 200
+        assert "Sample 51 of 120" in response.text
+        assert "Sample 100 of 120" in response.text
+        assert "Sample 101 of 120" not in response.text
+        assert "Page 2 of 3" in response.text
@@ -0,0 +1,114 @@
+"""
+Tests for the similar reviewed cases search
+"""
+import pytest
+
+from app.services import cbc_prediction_service
+
+
+@pytest.mark.skipif(
+    not cbc_prediction_service.is_available(),
+    reason="AI model not available"
+)
+class TestSimilarCases:
+    """Test KD-tree search over reviewed CBC tests"""
+
+    @pytest.fixture
+    def reviewed_tests(self, doctor_user, patient_user, db_session, tmp_path, monkeypatch):
+        """A query test plus reviewed tests for a linked and an unlinked patient"""
+        from app.ai.cbc import FeatureStore
+        from app.database import Model, Test, User, doctor_patients
+        from app.services import hash_password, similarity_service
+
+        monkeypatch.chdir(tmp_path)
+        cbc_prediction_service.load_model()
+        monkeypatch.setattr(
+            cbc_prediction_service, "_feature_store",
+            FeatureStore(tmp_path / "store", cbc_prediction_service.used_features)
+        )
+        monkeypatch.setattr(similarity_service, "similar_case_index", similarity_service.SimilarCaseIndex())
+
+        other = User(username="patient2", email="patient2@test.com", password=hash_password("patient123"),
+                     fname="Sam", lname="Lee", role="patient", is_active=1)
+        db_session.add_all([other, Model(name="CBC Anemia Detection", accuracy=95.0, tests_count=0)])
+        db_session.execute(doctor_patients.insert().values(doctor_id=doctor_user.id, patient_id=patient_user.id))
+        db_session.commit()
+
+        def add(patient, hgb, status):
+            result = cbc_prediction_service.process_manual_input(
+                rbc=4.5, hgb=hgb, pcv=40.0, mcv=85.0, mch=28.0, mchc=33.0, tlc=7.0, plt=250.0,
+                patient_id=patient.id,
+                uploaded_by_id=doctor_user.id,
+                db=db_session
+            )
+            assert result["success"]
+            test = db_session.query(Test).get(result["test_id"])
+            test.review_status = status
+            db_session.commit()
+            return test.id
+
+        return {
+            "query": add(patient_user, 10.0, "pending"),
+            "near": add(patient_user, 10.2, "accepted"),
+            "far": add(patient_user, 16.0, "rejected"),
+            "pending": add(patient_user, 10.0, "pending"),
+            "unlinked": add(other, 10.0, "accepted"),
+        }
+
+    def test_nearest_reviewed_first(self, db_session, doctor_user, reviewed_tests):
+        """Test only reviewed tests of linked patients are returned, nearest first"""
+        from app.services.similarity_service import find_similar_cases
+
+        result = find_similar_cases(db_session, doctor_user, reviewed_tests["query"], k=5)
+
+        assert result["success"]
+        assert [c["test_id"] for c in result["cases"]] == [reviewed_tests["near"], reviewed_tests["far"]]
+        assert result["cases"][0]["review_status"] == "accepted"
+        assert result["cases"][0]["distance"] <= result["cases"][1]["distance"]
+
+    def test_admin_sees_all_patients(self, db_session, admin_user, reviewed_tests):
+        """Test admins are not limited to linked patients"""
+        from app.services.similarity_service import find_similar_cases
+
+        result = find_similar_cases(db_session, admin_user, reviewed_tests["query"], k=1)
+
+        assert [c["test_id"] for c in result["cases"]] == [reviewed_tests["unlinked"]]
+
+    def test_tree_matches_brute_force(self, tmp_path, monkeypatch):
+        """Test the tree path with a brute-force tail agrees with a direct scan"""
+        import numpy as np
+        from app.ai.cbc import FeatureStore
+        from app.services import similarity_service
+
+        cbc_prediction_service.load_model()
+        rng = np.random.default_rng(0)
+        n_features = len(cbc_prediction_service.used_features)
+        store = FeatureStore(tmp_path / "store", cbc_prediction_service.used_features)
+        for test_id in range(1, 41):
+            store.append(test_id, rng.normal(size=(50, n_features)) * 5 + 50)
+        monkeypatch.setattr(cbc_prediction_service, "_feature_store", store)
+        monkeypatch.setattr(similarity_service, "BRUTE_FORCE_ROWS", 10)
+
+        index = similarity_service.SimilarCaseIndex()
+        index._snapshot()
+        for test_id in range(41, 45):
+            store.append(test_id, rng.normal(size=(50, n_features)) * 5 + 50)
+
+        vector = cbc_prediction_service.scaler.transform(rng.normal(size=(1, n_features)) * 5 + 50)[0]
+        allowed = np.arange(2, 45, 2)
+        _, rows, distances = index.query(vector, allowed, 7)
+
+        features, ids = store.load()
+        scaled = cbc_prediction_service.scaler.transform(features)
+        candidates = np.flatnonzero(np.isin(ids[:, 0], allowed))
+        expected = candidates[np.argsort(np.linalg.norm(scaled[candidates] - vector, axis=1))[:7]]
+        assert list(rows) == list(expected)
+
+    def test_route_forbids_unlinked_test(self, client, auth_headers_doctor, reviewed_tests):
+        """Test doctors cannot search from tests of unlinked patients"""
+        response = client.get(f"/doctor/test/{reviewed_tests['unlinked']}/similar")
+        assert response.status_code == 403
+
+        response = client.get(f"/doctor/test/{reviewed_tests['query']}/similar?k=1")
+        assert response.status_code == 200
+        assert response.json()["cases"][0]["test_id"] == reviewed_tests["near"]
@@ -0,0 +1,189 @@
+"""
+Tests for deep zoom tile pyramids
+"""
+import math
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from app.services import blob_store, tile_service
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _store_image(db, width, height):
+    rng = np.random.default_rng(0)
+    path = blob_store.temp_path(".png")
+    cv2.imwrite(str(path), rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+    stored = blob_store.store_file(db, path, ".png")
+    db.commit()
+    return stored
+
+
+class TestPyramid:
+    """Test the Deep Zoom levels and tiles"""
+
+    def test_levels_and_tiles(self, db_session, tmp_path, monkeypatch):
+        """Test each level halves the last and is cut into overlapping 256px tiles"""
+        monkeypatch.chdir(tmp_path)
+        stored = _store_image(db_session, 700, 300)
+
+        pyramid = tile_service.ensure_pyramid(stored)
+
+        assert 'Width="700" Height="300"' in (pyramid / "image.dzi").read_text()
+        levels = sorted(int(p.name) for p in (pyramid / "image_files").iterdir())
+        assert levels == list(range(tile_service.level_count(700, 300))) == list(range(11))
+
+        def tile(level, col, row):
+            return cv2.imread(str(tile_service.tile_path(pyramid, level, col, row))).shape[:2]
+
+        # Full size: 3 x 2 tiles, inner edges carry one pixel of overlap
+        assert len(list((pyramid / "image_files" / "10").iterdir())) == 6
+        assert tile(10, 0, 0) == (257, 257)
+        assert tile(10, 1, 0) == (257, 258)
+        assert tile(10, 2, 1) == (300 - 255, 700 - 511)
+        # Half size fits in 2 x 1 tiles; level 0 is a single pixel
+        assert tile(9, 1, 0) == (150, 350 - 255)
+        assert tile(0, 0, 0) == (1, 1)
+        assert tile_service.tile_path(pyramid, 10, 3, 0) is None
+
+    def test_built_once(self, db_session, tmp_path, monkeypatch):
+        """Test later views reuse the cached pyramid"""
+        monkeypatch.chdir(tmp_path)
+        stored = _store_image(db_session, 300, 300)
+        first = tile_service.ensure_pyramid(stored)
+        calls = []
+        monkeypatch.setattr(tile_service, "write_pyramid", lambda *args: calls.append(args))
+
+        assert tile_service.ensure_pyramid(stored) == first
+        assert calls == []
+        assert [p.name for p in first.parent.iterdir()] == [tile_service.PYRAMID_DIR]
+
+    def test_build_lock_released(self, db_session, tmp_path, monkeypatch):
+        """Test the per-image build lock is dropped once the build is done"""
+        monkeypatch.chdir(tmp_path)
+        stored = _store_image(db_session, 300, 300)
+
+        tile_service.ensure_pyramid(stored)
+
+        assert tile_service._build_locks == {}
+
+    def test_no_scratch_files_left(self, db_session, tmp_path, monkeypatch):
+        """Test the pixel cache and half-size levels are removed once the pyramid is written"""
+        monkeypatch.chdir(tmp_path)
+        stored = _store_image(db_session, 700, 300)
+
+        pyramid = tile_service.ensure_pyramid(stored)
+
+        assert sorted(p.name for p in pyramid.iterdir()) == ["image.dzi", "image_files"]
+        assert [p.name for p in pyramid.parent.iterdir()] == [tile_service.PYRAMID_DIR]
+
+    def test_tiles_cut_from_memory_map(self, tmp_path):
+        """Test a memory-mapped image is tiled like the decoded array"""
+        from app.ai.blood_cell.slide import open_pixels, write_pixels
+
+        image = np.random.default_rng(0).integers(0, 255, (600, 1100, 3), dtype=np.uint8)
+        write_pixels(image, tmp_path / "pixels.npy")
+        tile_service.write_pyramid(image, tmp_path / "array")
+        tile_service.write_pyramid(open_pixels(tmp_path / "pixels.npy"), tmp_path / "mapped")
+
+        for path in (tmp_path / "array").rglob("*.jpg"):
+            assert path.read_bytes() == (tmp_path / "mapped" / path.relative_to(tmp_path / "array")).read_bytes()
+
+    @pytest.mark.asyncio
+    async def test_built_on_pool(self, db_session, tmp_path, monkeypatch):
+        """Test the first view builds on the analysis pool, and later views reuse its pyramid"""
+        from app.services import ai_service
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        stored = _store_image(db_session, 300, 300)
+        calls = []
+        run_in_pool = ai_service.blood_image_service.run_in_pool
+        monkeypatch.setattr(
+            ai_service.blood_image_service, "run_in_pool",
+            lambda func, *args: calls.append(func) or run_in_pool(func, *args)
+        )
+
+        first = await tile_service.build_pyramid(stored)
+        pyramid = await tile_service.build_pyramid(stored)
+
+        assert calls == [tile_service.ensure_pyramid]
+        assert pyramid == first
+        assert (pyramid / "image.dzi").exists()
+
+    def test_files_outside_store(self, tmp_path):
+        """Test legacy uploads have no pyramid"""
+        assert tile_service.ensure_pyramid(str(tmp_path / "legacy.png")) is None
+
+
+class TestTileRoutes:
+    """Test tiles are served to doctors with access to the test"""
+
+    @pytest.fixture
+    def image_test(self, db_session, patient_user, tmp_path, monkeypatch):
+        from app.database import Test, TestFile
+
+        from app.services import ai_service
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(ai_service, "IMAGE_ANALYSIS_WORKERS", 0)
+        stored = _store_image(db_session, 600, 400)
+        test = Test(patient_id=patient_user.id, review_status='pending')
+        db_session.add(test)
+        db_session.flush()
+        file = TestFile(test_id=test.id, name="smear.png", extension=".png", path=stored, type='input')
+        db_session.add(file)
+        db_session.commit()
+        return test.id, file.id
+
+    def _link(self, db_session, doctor_user, patient_user):
+        from app.database import doctor_patients
+
+        db_session.execute(doctor_patients.insert().values(doctor_id=doctor_user.id, patient_id=patient_user.id))
+        db_session.commit()
+
+    def test_descriptor_and_tiles(self, client, auth_headers_doctor, db_session, doctor_user, patient_user, image_test):
+        """Test the first view builds the pyramid and tiles are cached for long"""
+        self._link(db_session, doctor_user, patient_user)
+        test_id, file_id = image_test
+        base = f"/doctor/test/{test_id}/files/{file_id}"
+
+        descriptor = client.get(f"{base}/image.dzi")
+        tile = client.get(f"{base}/image_files/{math.ceil(math.log2(600))}/2_1.jpg")
+
+        assert descriptor.status_code == 200
+        assert 'TileSize="256"' in descriptor.text
+        assert tile.status_code == 200
+        assert tile.headers["content-type"] == "image/jpeg"
+        assert "max-age=31536000" in tile.headers["cache-control"]
+        assert client.get(f"{base}/image_files/3/9_9.jpg").status_code == 404
+
+    def test_test_page_has_viewer(self, client, auth_headers_doctor, db_session, doctor_user, patient_user, image_test, tmp_path):
+        """Test the test page embeds the viewer instead of the original"""
+        (tmp_path / "app").mkdir()
+        (tmp_path / "app" / "templates").symlink_to(os.path.join(ROOT, "app", "templates"))
+        self._link(db_session, doctor_user, patient_user)
+        test_id, file_id = image_test
+
+        page = client.get(f"/doctor/test/{test_id}")
+
+        assert f'data-dzi="/doctor/test/{test_id}/files/{file_id}/image.dzi"' in page.text
+        assert "openseadragon" in page.text
+
+    def test_unlinked_doctor_forbidden(self, client, auth_headers_doctor, image_test):
+        """Test doctors cannot view tiles of patients they are not linked to"""
+        test_id, file_id = image_test
+
+        response = client.get(f"/doctor/test/{test_id}/files/{file_id}/image.dzi")
+
+        assert response.status_code == 403
+
+    def test_file_of_other_test(self, client, auth_headers_admin, image_test):
+        """Test a file id only resolves within its own test"""
+        test_id, file_id = image_test
+
+        assert client.get(f"/doctor/test/{test_id + 1}/files/{file_id}/image.dzi").status_code == 404
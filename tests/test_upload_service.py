@@ -0,0 +1,77 @@
+"""
+Tests for streaming uploads to disk
+"""
+import hashlib
+from io import BytesIO
+
+import pytest
+from fastapi import UploadFile
+
+from app.services import upload_service
+from app.services.upload_service import UploadTooLargeError, save_upload
+
+
+class TestSaveUpload:
+    """Test chunked saving with the size limit"""
+
+    @pytest.mark.asyncio
+    async def test_saves_content_and_hash(self, tmp_path, monkeypatch):
+        """Test the file is written in chunks with its size and SHA-256"""
+        monkeypatch.setattr(upload_service, "UPLOAD_CHUNK_SIZE", 1000)
+        content = bytes(range(256)) * 40
+        destination = tmp_path / "nested" / "image.png"
+
+        stored = await save_upload(UploadFile(filename="image.png", file=BytesIO(content)), destination)
+
+        assert stored.path == destination
+        assert stored.size == len(content)
+        assert stored.sha256 == hashlib.sha256(content).hexdigest()
+        assert destination.read_bytes() == content
+        assert list(destination.parent.iterdir()) == [destination]
+
+    @pytest.mark.asyncio
+    async def test_too_large_leaves_no_file(self, tmp_path, monkeypatch):
+        """Test an upload over the limit is aborted and its partial file removed"""
+        monkeypatch.setattr(upload_service, "UPLOAD_CHUNK_SIZE", 100)
+        destination = tmp_path / "image.png"
+
+        with pytest.raises(UploadTooLargeError) as exc_info:
+            await save_upload(UploadFile(filename="image.png", file=BytesIO(b"x" * 1000)), destination, max_size=250)
+
+        assert "too large" in str(exc_info.value)
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.asyncio
+    async def test_known_size_rejected_before_reading(self, tmp_path):
+        """Test a declared size over the limit is rejected without reading the body"""
+        file = UploadFile(filename="image.png", file=BytesIO(b"x" * 10), size=10_000)
+
+        with pytest.raises(UploadTooLargeError):
+            await save_upload(file, tmp_path / "image.png", max_size=1000)
+
+        assert file.file.tell() == 0
+
+
+class TestUploadRoutes:
+    """Test routes reject oversized uploads"""
+
+    def test_blood_image_too_large(self, client, auth_headers_patient, patient_user, db_session, tmp_path, monkeypatch):
+        """Test a blood cell image over MAX_UPLOAD_SIZE is not stored"""
+        from app.database import Model, Test
+
+        monkeypatch.chdir(tmp_path)
+        db_session.add(Model(name="Blood Cell Image Classification", accuracy=90.0, tests_count=0))
+        db_session.commit()
+        monkeypatch.setattr(upload_service, "MAX_UPLOAD_SIZE", 1024)
+
+        response = client.post(
+            "/patient/upload-blood-image",
+            files={"file": ("cells.png", b"x" * 4096, "image/png")},
+            data={"description": "Too large"},
+            follow_redirects=False
+        )
+
+        assert response.status_code == 303
+        assert "too%20large" in response.headers["set-cookie"]
+        assert db_session.query(Test).count() == 0
+        assert not any(tmp_path.joinpath("uploads").rglob("*.png"))